@@ -8,18 +8,46 @@
 2. by_dst: 以目標 IP 聚合 -> netflow_stats_3m_by_dst
 
 模擬 Transform 的聚合邏輯，但處理歷史資料
+
+並行模式（--workers N 或 --mode both）：
+- 多個時間窗口同時處理，by_src 與 by_dst 可在同一個工作池中一起執行
+- 並行數依 ES 延遲與 429 拒絕自動調整（AIMD）
+- 已完成的窗口記錄在檢查點檔案，中斷後重新執行會從未完成的窗口繼續
+
+單次讀取引擎（--engine inprocess）：
+- 以 sliced PIT 平行讀取原始 flow（_source 只取聚合需要的欄位），
+  在本機同時聚合出 by_src 與 by_dst，原始索引只掃描一次
+- 聚合的 CPU 負擔由 ES 叢集移到回填程序
+
+缺口修補（--repair-gaps）：
+- 只回填覆蓋率索引佇列中的缺口桶（由 check_coverage_gaps.py --queue 放入）
 """
 
-import requests
 import json
+import os
+import random
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime, timedelta
 import time
 import sys
 
+import requests
+
+from nad.utils.bulk_ingest import BulkIngester, ingest_stats_line
+from nad.utils.coverage_index import DEFAULT_COVERAGE_PATH, CoverageIndex, gap_windows
+from nad.utils.es_transport import get_transport
+from nad.utils.flow_aggregator import SOURCE_FIELDS, FlowAggregator
+
 # ES 配置
 ES_HOST = "http://localhost:9200"
 SOURCE_INDEX = "flow_collector-*"
 
+DEFAULT_CHECKPOINT_PATH = "nad/state/backfill_checkpoint.json"
+
+# 回填引擎：composite（ES 端聚合，每個模式各掃描一次）或 inprocess（單次讀取、本機聚合）
+ENGINES = ('composite', 'inprocess')
+
 # 聚合模式配置
 AGGREGATION_MODES = {
     'by_src': {
@@ -38,15 +66,23 @@ AGGREGATION_MODES = {
     }
 }
 
+
+class BackfillRejected(Exception):
+    """ES 以 429 拒絕請求（叢集過載），窗口需要退避後重試"""
+
+
 class HistoricalDataBackfill:
     """歷史資料回填處理器"""
 
-    def __init__(self, mode='by_src'):
+    def __init__(self, mode='by_src', page_size=2000, bulk_workers=3, max_chunk_bytes=5 * 1024 * 1024):
         """
         初始化回填處理器
 
         Args:
             mode: 聚合模式 ('by_src' 或 'by_dst')
+            page_size: composite 聚合每頁的 (time_bucket, IP) 組合數
+            bulk_workers: 寫入時並行的 _bulk 連線數
+            max_chunk_bytes: 每個 _bulk 請求的最大位元組數
         """
         if mode not in AGGREGATION_MODES:
             raise ValueError(f"不支援的聚合模式: {mode}。支援的模式: {list(AGGREGATION_MODES.keys())}")
@@ -54,9 +90,19 @@ class HistoricalDataBackfill:
         self.mode = mode
         self.mode_config = AGGREGATION_MODES[mode]
         self.es_url = ES_HOST
+        self.page_size = page_size
         self.processed_buckets = 0
         self.processed_docs = 0
         self.errors = []
+        self.ingester = BulkIngester(self.es_url, max_chunk_bytes=max_chunk_bytes,
+                                     workers=bulk_workers, caller='backfill')
+        # 並行模式下不輸出每個窗口的細節
+        self.verbose = True
+        self._lock = threading.Lock()
+
+    def _log(self, message):
+        if self.verbose:
+            print(message)
 
     def backfill(self, days=3, batch_hours=1, dry_run=False, auto_confirm=False):
         """
@@ -132,14 +178,26 @@ class HistoricalDataBackfill:
         # 輸出總結
         self._print_summary(dry_run)
 
-    def _process_time_range(self, start_time, end_time, dry_run=False):
-        """處理指定時間範圍的資料"""
+    def _process_time_range(self, start_time, end_time, dry_run=False, page_size=None):
+        """
+        處理指定時間範圍的資料
+
+        以 composite 聚合（time_bucket × IP）分頁取回，每頁直接寫入目標索引，
+        回應大小與記憶體用量固定，不受窗口內活躍 IP 數影響。
+
+        Args:
+            start_time: 開始時間（UTC）
+            end_time: 結束時間（UTC，不含）
+            dry_run: 是否僅測試不實際寫入
+            page_size: 每頁的 (time_bucket, IP) 組合數（默認 self.page_size）
+        """
+        page_size = page_size or self.page_size
 
         # 計算時間範圍內有多少個3分鐘桶
         num_3m_buckets = int((end_time - start_time).total_seconds() / 180)
 
-        print(f"🔍 查詢原始資料...")
-        print(f"   預計包含 {num_3m_buckets} 個3分鐘時間桶")
+        self._log(f"🔍 查詢原始資料...")
+        self._log(f"   預計包含 {num_3m_buckets} 個3分鐘時間桶")
 
         # 構建聚合查詢（動態根據模式調整）
         group_field = self.mode_config['group_field']
@@ -158,176 +216,167 @@ class HistoricalDataBackfill:
                 }
             },
             "aggs": {
-                "time_buckets": {
-                    "date_histogram": {
-                        "field": "FLOW_START_MILLISECONDS",
-                        "fixed_interval": "3m",
-                        "time_zone": "Asia/Taipei",
-                        "min_doc_count": 1
+                "by_bucket_ip": {
+                    "composite": {
+                        "size": page_size,
+                        "sources": [
+                            {"time_bucket": {
+                                "date_histogram": {
+                                    "field": "FLOW_START_MILLISECONDS",
+                                    "fixed_interval": "3m",
+                                    "time_zone": "Asia/Taipei",
+                                    # 與 date_histogram 的 key_as_string 相同，文檔 ID 不變
+                                    "format": "strict_date_optional_time"
+                                }
+                            }},
+                            {"ip": {"terms": {"field": group_field}}}
+                        ]
                     },
                     "aggs": {
-                        "by_ip": {
-                            "terms": {
-                                "field": group_field,
-                                "size": 10000  # 處理大量 IP
-                            },
-                            "aggs": {
-                                "total_bytes": {
-                                    "sum": {"field": "IN_BYTES"}
-                                },
-                                "total_packets": {
-                                    "sum": {"field": "IN_PKTS"}
-                                },
-                                "flow_count": {
-                                    "value_count": {"field": group_field}
-                                },
-                                cardinality_name: {
-                                    "cardinality": {
-                                        "field": cardinality_field,
-                                        "precision_threshold": 3000
-                                    }
-                                },
-                                "unique_src_ports": {
-                                    "cardinality": {
-                                        "field": "L4_SRC_PORT",
-                                        "precision_threshold": 1000
-                                    }
-                                },
-                                "unique_dst_ports": {
-                                    "cardinality": {
-                                        "field": "L4_DST_PORT",
-                                        "precision_threshold": 1000
-                                    }
-                                },
-                                "avg_bytes": {
-                                    "avg": {"field": "IN_BYTES"}
-                                },
-                                "max_bytes": {
-                                    "max": {"field": "IN_BYTES"}
-                                }
+                        "total_bytes": {
+                            "sum": {"field": "IN_BYTES"}
+                        },
+                        "total_packets": {
+                            "sum": {"field": "IN_PKTS"}
+                        },
+                        "flow_count": {
+                            "value_count": {"field": group_field}
+                        },
+                        cardinality_name: {
+                            "cardinality": {
+                                "field": cardinality_field,
+                                "precision_threshold": 3000
                             }
+                        },
+                        "unique_src_ports": {
+                            "cardinality": {
+                                "field": "L4_SRC_PORT",
+                                "precision_threshold": 1000
+                            }
+                        },
+                        "unique_dst_ports": {
+                            "cardinality": {
+                                "field": "L4_DST_PORT",
+                                "precision_threshold": 1000
+                            }
+                        },
+                        "avg_bytes": {
+                            "avg": {"field": "IN_BYTES"}
+                        },
+                        "max_bytes": {
+                            "max": {"field": "IN_BYTES"}
                         }
                     }
                 }
             }
         }
 
-        # 執行查詢
-        response = requests.post(
-            f"{self.es_url}/{SOURCE_INDEX}/_search",
-            json=query,
-            headers={'Content-Type': 'application/json'},
-            timeout=300  # 5分鐘超時
-        )
-        response.raise_for_status()
-        data = response.json()
-
-        # 檢查是否有數據
-        time_buckets = data['aggregations']['time_buckets']['buckets']
-
-        if not time_buckets:
-            print(f"   ⚠️  此時間範圍內無數據")
-            return
-
-        print(f"   ✓ 找到 {len(time_buckets)} 個時間桶")
-
-        # 準備批次寫入的文檔
-        docs_to_index = []
-        total_ips = 0
-
         # 根據模式決定 IP 欄位名稱
         ip_field_name = 'src_ip' if self.mode == 'by_src' else 'dst_ip'
 
-        for time_bucket in time_buckets:
-            bucket_time = time_bucket['key_as_string']
-            ip_buckets = time_bucket['by_ip']['buckets']
-            total_ips += len(ip_buckets)
+        time_keys = set()
+        total_docs = 0
+        pages = 0
+
+        while True:
+            # 執行查詢
+            response = get_transport().post(
+                f"{self.es_url}/{SOURCE_INDEX}/_search",
+                json=query,
+                timeout=300,  # 5分鐘超時
+                caller='backfill'
+            )
+            response.raise_for_status()
+            composite = response.json()['aggregations']['by_bucket_ip']
+            buckets = composite['buckets']
+            if not buckets:
+                break
+            pages += 1
+
+            # 本頁的文檔（寫入後即釋放）
+            docs_to_index = []
+            for bucket in buckets:
+                bucket_time = bucket['key']['time_bucket']
+                time_keys.add(bucket_time)
 
-            for ip_bucket in ip_buckets:
                 # 建立文檔（包含所有通用欄位）
                 doc = {
                     "time_bucket": bucket_time,
-                    ip_field_name: ip_bucket['key'],
-                    "total_bytes": ip_bucket['total_bytes']['value'],
-                    "total_packets": ip_bucket['total_packets']['value'],
-                    "flow_count": ip_bucket['flow_count']['value'],
-                    "unique_src_ports": ip_bucket['unique_src_ports']['value'],
-                    "unique_dst_ports": ip_bucket['unique_dst_ports']['value'],
-                    "avg_bytes": ip_bucket['avg_bytes']['value'],
-                    "max_bytes": ip_bucket['max_bytes']['value']
+                    ip_field_name: bucket['key']['ip'],
+                    "total_bytes": bucket['total_bytes']['value'],
+                    "total_packets": bucket['total_packets']['value'],
+                    "flow_count": bucket['flow_count']['value'],
+                    "unique_src_ports": bucket['unique_src_ports']['value'],
+                    "unique_dst_ports": bucket['unique_dst_ports']['value'],
+                    "avg_bytes": bucket['avg_bytes']['value'],
+                    "max_bytes": bucket['max_bytes']['value']
                 }
 
                 # 添加模式特定的 cardinality 欄位
-                cardinality_name = self.mode_config['cardinality_name']
-                doc[cardinality_name] = ip_bucket[cardinality_name]['value']
+                doc[cardinality_name] = bucket[cardinality_name]['value']
 
                 docs_to_index.append(doc)
 
-        print(f"   📊 聚合結果: {total_ips} 個唯一 IP ({ip_field_name})")
+            if dry_run:
+                # 顯示範例文檔
+                if pages == 1:
+                    self._log(f"\n   範例文檔:")
+                    self._log(f"   {json.dumps(docs_to_index[0], indent=4)}")
+            else:
+                # 逐頁寫入到目標索引
+                self._bulk_index(docs_to_index)
+            total_docs += len(docs_to_index)
 
+            after_key = composite.get('after_key')
+            if after_key is None:
+                break
+            query['aggs']['by_bucket_ip']['composite']['after'] = after_key
+
+        if not total_docs:
+            self._log(f"   ⚠️  此時間範圍內無數據")
+            return
+
+        self._log(f"   ✓ 找到 {len(time_keys)} 個時間桶，{pages} 頁")
+        self._log(f"   📊 聚合結果: {total_docs} 筆 (time_bucket, {ip_field_name})")
         if dry_run:
-            print(f"   🔍 [測試模式] 跳過寫入，共 {len(docs_to_index)} 筆文檔")
-            # 顯示範例文檔
-            if docs_to_index:
-                print(f"\n   範例文檔:")
-                print(f"   {json.dumps(docs_to_index[0], indent=4)}")
-        else:
-            # 批次寫入到目標索引
-            self._bulk_index(docs_to_index)
+            self._log(f"   🔍 [測試模式] 跳過寫入，共 {total_docs} 筆文檔")
 
-        self.processed_buckets += len(time_buckets)
-        self.processed_docs += len(docs_to_index)
+        with self._lock:
+            self.processed_buckets += len(time_keys)
+            self.processed_docs += total_docs
 
     def _bulk_index(self, docs):
-        """批次寫入文檔到 ES"""
+        """
+        批次寫入文檔到 ES
+
+        由 BulkIngester 依大小切塊、壓縮並行送出，只重試失敗的項目。
+        重試後仍被拒絕（429）時拋出 BackfillRejected，由窗口退避重試；
+        其他失敗逐筆計入錯誤。
+        """
         if not docs:
             return
 
         dest_index = self.mode_config['dest_index']
-        print(f"   💾 寫入 {len(docs)} 筆文檔到 {dest_index}...")
-
-        # 構建 bulk 請求
-        bulk_body = []
         ip_field_name = 'src_ip' if self.mode == 'by_src' else 'dst_ip'
+        self._log(f"   💾 寫入 {len(docs)} 筆文檔到 {dest_index}...")
 
-        for doc in docs:
-            # 使用 time_bucket + IP 作為文檔 ID，避免重複
-            doc_id = f"{doc['time_bucket']}_{doc[ip_field_name]}"
-
-            # Index action
-            bulk_body.append(json.dumps({
-                "index": {
-                    "_index": dest_index,
-                    "_id": doc_id
-                }
-            }))
-            # Document
-            bulk_body.append(json.dumps(doc))
-
-        bulk_data = "\n".join(bulk_body) + "\n"
-
-        # 執行 bulk 寫入
-        response = requests.post(
-            f"{self.es_url}/_bulk",
-            data=bulk_data,
-            headers={'Content-Type': 'application/x-ndjson'},
-            timeout=120
+        # 使用 time_bucket + IP 作為文檔 ID，避免重複
+        result = self.ingester.index(
+            (dest_index, f"{doc['time_bucket']}_{doc[ip_field_name]}", doc) for doc in docs
         )
-        response.raise_for_status()
-        result = response.json()
-
-        # 檢查錯誤
-        if result.get('errors'):
-            error_count = sum(1 for item in result['items'] if 'error' in item.get('index', {}))
-            print(f"   ⚠️  寫入時發生 {error_count} 個錯誤")
-
-            # 顯示第一個錯誤範例
-            for item in result['items']:
-                if 'error' in item.get('index', {}):
-                    print(f"   錯誤範例: {item['index']['error']}")
-                    break
+
+        if result['rejected']:
+            # 文檔 ID 固定，整個窗口重寫不會重複
+            raise BackfillRejected(f"{result['rejected']} 筆文檔重試後仍被 ES 拒絕 (429)")
+
+        if result['failed']:
+            self._log(f"   ⚠️  寫入時有 {result['failed']} 筆失敗")
+            with self._lock:
+                self.errors.append(f"{dest_index} 寫入時有 {result['failed']} 筆失敗")
+            for doc_id, error in result['errors']:
+                self._log(f"   錯誤範例 ({doc_id}): {error}")
         else:
-            print(f"   ✓ 成功寫入 {len(docs)} 筆文檔")
+            self._log(f"   ✓ 成功寫入 {result['indexed']} 筆文檔（{result['docs_per_sec']:,.0f} docs/sec）")
 
     def _print_summary(self, dry_run):
         """輸出執行總結"""
@@ -336,6 +385,8 @@ class HistoricalDataBackfill:
         print("=" * 80)
         print(f"處理的時間桶數: {self.processed_buckets}")
         print(f"生成的文檔數: {self.processed_docs:,}")
+        if not dry_run:
+            print(f"寫入: {ingest_stats_line(self.ingester.get_stats())}")
 
         if self.errors:
             print(f"\n❌ 錯誤數量: {len(self.errors)}")
@@ -385,10 +436,10 @@ class HistoricalDataBackfill:
 
         try:
             dest_index = self.mode_config['dest_index']
-            response = requests.post(
+            response = get_transport().post(
                 f"{self.es_url}/{dest_index}/_search",
                 json=query,
-                headers={'Content-Type': 'application/json'}
+                caller='backfill'
             )
             response.raise_for_status()
             data = response.json()
@@ -411,6 +462,474 @@ class HistoricalDataBackfill:
         print("=" * 80)
 
 
+class SinglePassBackfill:
+    """
+    單次讀取、本機聚合的回填引擎
+
+    composite 引擎每個模式各自在 ES 端聚合，原始索引被掃描兩次。
+    此引擎以 sliced PIT 將窗口內的原始 flow 分成 slices 份平行讀取，
+    每個 slice 各自以 FlowAggregator 聚合，合併後同時寫入各模式的目標索引。
+    文檔 ID 與 composite 引擎相同；欄位與 Transform 相同，比 composite 引擎
+    多了 top_src_ports / top_dst_ports。
+    """
+
+    def __init__(self, backfills, slices=4, scroll_size=5000, keep_alive='2m'):
+        """
+        Args:
+            backfills: {mode: HistoricalDataBackfill}，負責寫入與統計
+            slices: 平行讀取的 slice 數
+            scroll_size: 每個 slice 每頁取回的 flow 數
+            keep_alive: PIT 保留時間
+        """
+        self.backfills = backfills
+        self.es_url = ES_HOST
+        self.slices = max(1, slices)
+        self.scroll_size = scroll_size
+        self.keep_alive = keep_alive
+        self.flows_read = 0
+        self._lock = threading.Lock()
+
+    def _process_time_range(self, start_time, end_time, dry_run=False, modes=None):
+        """
+        讀取一次指定時間範圍的原始資料，產生並寫入各模式的文檔
+
+        Args:
+            start_time: 開始時間（UTC）
+            end_time: 結束時間（UTC，不含）
+            dry_run: 是否僅測試不實際寫入
+            modes: 要產生的模式（默認全部）
+        """
+        modes = list(modes or self.backfills)
+        query = {
+            "range": {
+                "FLOW_START_MILLISECONDS": {
+                    "gte": start_time.isoformat(),
+                    "lt": end_time.isoformat(),
+                    "format": "strict_date_optional_time"
+                }
+            }
+        }
+
+        response = get_transport().post(
+            f"{self.es_url}/{SOURCE_INDEX}/_pit?keep_alive={self.keep_alive}", caller='backfill'
+        )
+        response.raise_for_status()
+        pit_id = response.json()['id']
+        try:
+            with ThreadPoolExecutor(max_workers=self.slices) as executor:
+                partials = list(executor.map(
+                    lambda slice_id: self._read_slice(pit_id, query, slice_id, modes), range(self.slices)
+                ))
+        finally:
+            try:
+                get_transport().request('DELETE', f"{self.es_url}/_pit", json={"id": pit_id}, caller='backfill')
+            except Exception:
+                pass
+
+        aggregator = partials[0]
+        for partial in partials[1:]:
+            aggregator.merge(partial)
+        with self._lock:
+            self.flows_read += aggregator.flows
+
+        for mode in modes:
+            backfill = self.backfills[mode]
+            # 與 composite 引擎相同，每 page_size 筆文檔寫入一次（寫入後即釋放）
+            time_keys = set()
+            total_docs = 0
+            for docs in aggregator.iter_documents(mode, batch_size=backfill.page_size):
+                if dry_run:
+                    if not total_docs:
+                        backfill._log(f"\n   [{mode}] 範例文檔:")
+                        backfill._log(f"   {json.dumps(docs[0], indent=4)}")
+                else:
+                    backfill._bulk_index(docs)
+                time_keys.update(doc['time_bucket'] for doc in docs)
+                total_docs += len(docs)
+
+            if not total_docs:
+                backfill._log(f"   ⚠️  [{mode}] 此時間範圍內無數據")
+                continue
+
+            with backfill._lock:
+                backfill.processed_buckets += len(time_keys)
+                backfill.processed_docs += total_docs
+
+    def _read_slice(self, pit_id, query, slice_id, modes):
+        """以 PIT + search_after 讀取一個 slice，返回其聚合結果"""
+        aggregator = FlowAggregator(modes)
+        body = {
+            "size": self.scroll_size,
+            "query": query,
+            "_source": SOURCE_FIELDS,
+            "pit": {"id": pit_id, "keep_alive": self.keep_alive},
+            "sort": ["_shard_doc"],
+            "track_total_hits": False
+        }
+        if self.slices > 1:
+            body["slice"] = {"id": slice_id, "max": self.slices}
+
+        while True:
+            response = get_transport().post(
+                f"{self.es_url}/_search", json=body, timeout=300, caller='backfill'
+            )
+            response.raise_for_status()
+            result = response.json()
+            # PIT id 可能在每次查詢後更新
+            body["pit"]["id"] = result.get('pit_id', body["pit"]["id"])
+
+            hits = result['hits']['hits']
+            if not hits:
+                break
+            aggregator.add_flows([hit['_source'] for hit in hits])
+            if len(hits) < self.scroll_size:
+                break
+            body["search_after"] = hits[-1]['sort']
+        return aggregator
+
+
+class BackfillCheckpoint:
+    """
+    已完成時間窗口的檢查點
+
+    格式: {mode: [[窗口開始, 窗口結束], ...]}（UTC ISO 字串），
+    每完成一個窗口即寫入（先寫暫存檔再替換）。
+    """
+
+    def __init__(self, path=DEFAULT_CHECKPOINT_PATH):
+        self.path = path
+        self._lock = threading.Lock()
+        self._done = {}
+        if os.path.exists(path):
+            try:
+                with open(path, 'r', encoding='utf-8') as f:
+                    self._done = {mode: {tuple(w) for w in windows} for mode, windows in json.load(f).items()}
+            except (OSError, ValueError) as e:
+                print(f"⚠️  無法讀取檢查點 {path}: {e}，從頭開始")
+
+    @staticmethod
+    def _key(start_time, end_time):
+        return (start_time.isoformat(), end_time.isoformat())
+
+    def is_done(self, mode, start_time, end_time):
+        with self._lock:
+            return self._key(start_time, end_time) in self._done.get(mode, set())
+
+    def mark_done(self, mode, start_time, end_time):
+        with self._lock:
+            self._done.setdefault(mode, set()).add(self._key(start_time, end_time))
+            self._save()
+
+    def reset(self, modes):
+        with self._lock:
+            for mode in modes:
+                self._done.pop(mode, None)
+            self._save()
+
+    def _save(self):
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump({mode: sorted(windows) for mode, windows in self._done.items()}, f, indent=2)
+        os.replace(tmp_path, self.path)
+
+
+class AdaptiveConcurrency:
+    """
+    依 ES 延遲與 429 拒絕調整並行數（AIMD）
+
+    - 請求成功且延遲 <= target_latency：並行數 +1（不超過 max_limit）
+    - 延遲 > target_latency：並行數 -1
+    - 被拒絕（429）：並行數減半
+    """
+
+    def __init__(self, initial=2, max_limit=8, target_latency=30.0):
+        self.max_limit = max(1, max_limit)
+        self.limit = max(1, min(initial, self.max_limit))
+        self.target_latency = target_latency
+        self.active = 0
+        self.rejections = 0
+        self._cond = threading.Condition()
+
+    def acquire(self):
+        with self._cond:
+            while self.active >= self.limit:
+                self._cond.wait()
+            self.active += 1
+
+    def release(self, latency, rejected=False):
+        with self._cond:
+            self.active -= 1
+            if rejected:
+                self.rejections += 1
+                self.limit = max(1, self.limit // 2)
+            elif latency > self.target_latency:
+                self.limit = max(1, self.limit - 1)
+            else:
+                self.limit = min(self.max_limit, self.limit + 1)
+            self._cond.notify_all()
+
+
+class ParallelBackfill:
+    """
+    並行、可續傳的回填
+
+    將回填範圍切成對齊 batch_hours 的時間窗口（重新執行時窗口相同，
+    檢查點才能對應），各模式的窗口一起放進工作池，由 AdaptiveConcurrency
+    控制同時執行的數量。被 429 拒絕的窗口以指數退避重試。
+
+    engine 為 inprocess 時，同一窗口的所有模式由 SinglePassBackfill 一次處理。
+    """
+
+    def __init__(self, modes=('by_src',), max_workers=4, initial_workers=2, target_latency=30.0,
+                 checkpoint_path=DEFAULT_CHECKPOINT_PATH, max_retries=5, page_size=2000,
+                 engine='composite', slices=4, bulk_workers=3):
+        """
+        Args:
+            modes: 聚合模式列表（例如 ['by_src', 'by_dst']）
+            max_workers: 最大並行窗口數
+            initial_workers: 初始並行窗口數
+            target_latency: 目標延遲（秒），單一窗口超過時降低並行數
+            checkpoint_path: 檢查點檔案路徑
+            max_retries: 每個窗口被拒絕時的最大重試次數
+            page_size: composite 聚合每頁的 (time_bucket, IP) 組合數
+            engine: 回填引擎（'composite' 或 'inprocess'）
+            slices: inprocess 引擎每個窗口平行讀取的 slice 數
+            bulk_workers: 每個窗口寫入時並行的 _bulk 連線數
+        """
+        if engine not in ENGINES:
+            raise ValueError(f"不支援的回填引擎: {engine}。支援的引擎: {list(ENGINES)}")
+        self.backfills = {mode: HistoricalDataBackfill(mode, page_size=page_size, bulk_workers=bulk_workers)
+                          for mode in modes}
+        for backfill in self.backfills.values():
+            backfill.verbose = False
+        self.max_workers = max_workers
+        self.concurrency = AdaptiveConcurrency(initial_workers, max_workers, target_latency)
+        self.checkpoint = BackfillCheckpoint(checkpoint_path)
+        self.max_retries = max_retries
+        self.engine = engine
+        self.single_pass = SinglePassBackfill(self.backfills, slices=slices) if engine == 'inprocess' else None
+
+    @staticmethod
+    def plan_windows(start_time, end_time, batch_hours):
+        """
+        切分時間窗口（以 UTC epoch 對齊 batch_hours）
+
+        Returns:
+            [(窗口開始, 窗口結束, 是否完整)]；最後一個窗口若尚未結束則不完整
+        """
+        step = batch_hours * 3600
+        epoch = int((start_time - datetime(1970, 1, 1)).total_seconds())
+        window_start = datetime(1970, 1, 1) + timedelta(seconds=epoch - epoch % step)
+        windows = []
+        while window_start < end_time:
+            window_end = window_start + timedelta(seconds=step)
+            windows.append((window_start, min(window_end, end_time), window_end <= end_time))
+            window_start = window_end
+        return windows
+
+    def run(self, days=3, batch_hours=1, dry_run=False, auto_confirm=False, reset=False):
+        """
+        回填過去 N 天的歷史資料
+
+        Args:
+            days: 回填天數
+            batch_hours: 每個窗口的小時數
+            dry_run: 是否僅測試不實際寫入（不更新檢查點）
+            auto_confirm: 自動確認執行（用於背景執行）
+            reset: 忽略並清除既有檢查點
+        """
+        modes = list(self.backfills)
+        end_time = datetime.utcnow()
+        start_time = end_time - timedelta(days=days)
+        windows = self.plan_windows(start_time, end_time, batch_hours)
+
+        if reset and not dry_run:
+            self.checkpoint.reset(modes)
+
+        # 任務: (模式列表, 窗口開始, 窗口結束, 是否完整)
+        tasks = []
+        for window_start, window_end, complete in windows:
+            pending = [mode for mode in modes
+                       if reset or not self.checkpoint.is_done(mode, window_start, window_end)]
+            if self.single_pass and pending:
+                tasks.append((tuple(pending), window_start, window_end, complete))
+            else:
+                tasks.extend(((mode,), window_start, window_end, complete) for mode in pending)
+        skipped = len(windows) * len(modes) - sum(len(task[0]) for task in tasks)
+
+        print("=" * 80)
+        print("NetFlow 歷史資料回填工具 - 並行模式")
+        print("=" * 80)
+        print(f"聚合模式: {', '.join(modes)}")
+        print(f"回填引擎: {self.engine}" + (f"（{self.single_pass.slices} 個 slice）" if self.single_pass else ""))
+        print(f"回填範圍: 過去 {days} 天（{len(windows)} 個窗口 × {len(modes)} 個模式）")
+        print(f"批次大小: {batch_hours} 小時/窗口")
+        print(f"並行數: 初始 {self.concurrency.limit}，最大 {self.max_workers}"
+              f"（目標延遲 {self.concurrency.target_latency:.0f} 秒）")
+        print(f"檢查點: {self.checkpoint.path}（已完成 {skipped} 個，待處理 {len(tasks)} 個任務）")
+        print(f"模式: {'測試模式 (不寫入)' if dry_run else '正式模式 (寫入數據)'}")
+        print("=" * 80)
+        print()
+
+        if not tasks:
+            print("✅ 所有窗口皆已完成")
+            return
+
+        if not dry_run and not auto_confirm:
+            try:
+                response = input("⚠️  這將寫入實際數據，是否繼續? (yes/no): ")
+                if response.lower() != 'yes':
+                    print("已取消")
+                    return
+            except EOFError:
+                print("⚠️  無法讀取輸入（可能在背景執行），請使用 --auto-confirm 參數")
+                print("已取消")
+                return
+
+        started = time.time()
+        finished = 0
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            futures = {
+                executor.submit(self._run_window, task_modes, window_start, window_end, dry_run):
+                    (task_modes, window_start, window_end, complete)
+                for task_modes, window_start, window_end, complete in tasks
+            }
+            for future in as_completed(futures):
+                task_modes, window_start, window_end, complete = futures[future]
+                finished += 1
+                label = f"[{'+'.join(task_modes)}] {window_start.strftime('%Y-%m-%d %H:%M')} - {window_end.strftime('%H:%M')}"
+                try:
+                    latency = future.result()
+                except Exception as e:
+                    error_msg = f"{label} 處理失敗: {e}"
+                    print(f"❌ {error_msg}")
+                    for mode in task_modes:
+                        self.backfills[mode].errors.append(error_msg)
+                    continue
+
+                # 尚未結束的最後一個窗口不記錄，下次重新處理
+                if complete and not dry_run:
+                    for mode in task_modes:
+                        self.checkpoint.mark_done(mode, window_start, window_end)
+                elapsed = time.time() - started
+                eta = elapsed / finished * (len(tasks) - finished)
+                print(f"✓ {label} ({finished}/{len(tasks)}) "
+                      f"耗時 {latency:.1f} 秒，並行數 {self.concurrency.limit}，預估剩餘 {eta / 60:.1f} 分鐘")
+
+        if self.concurrency.rejections:
+            print(f"\n⚠️  ES 拒絕 (429) 次數: {self.concurrency.rejections}")
+        if self.single_pass:
+            print(f"\n📥 讀取原始 flow: {self.single_pass.flows_read:,} 筆（各模式共用一次讀取）")
+        for backfill in self.backfills.values():
+            print(f"\n[{backfill.mode}]")
+            backfill._print_summary(dry_run)
+
+    def _run_window(self, task_modes, window_start, window_end, dry_run):
+        """處理單一窗口（被拒絕時退避重試），返回最後一次的耗時"""
+        attempt = 0
+        while True:
+            self.concurrency.acquire()
+            started = time.time()
+            rejected = False
+            try:
+                if self.single_pass:
+                    self.single_pass._process_time_range(window_start, window_end, dry_run, modes=task_modes)
+                else:
+                    self.backfills[task_modes[0]]._process_time_range(window_start, window_end, dry_run)
+                return time.time() - started
+            except BackfillRejected:
+                rejected = True
+            except requests.HTTPError as e:
+                if e.response is None or e.response.status_code != 429:
+                    raise
+                rejected = True
+            finally:
+                self.concurrency.release(time.time() - started, rejected)
+
+            attempt += 1
+            if attempt > self.max_retries:
+                raise BackfillRejected(f"重試 {self.max_retries} 次後仍被 ES 拒絕")
+            time.sleep(min(60, 2 ** attempt) * random.uniform(0.5, 1.5))
+
+
+def repair_gaps(modes, engine='composite', dry_run=False, coverage_path=DEFAULT_COVERAGE_PATH,
+                window_hours=3, max_attempts=3, slices=4, bulk_workers=3, page_size=2000):
+    """
+    回填覆蓋率索引佇列中的缺口
+
+    相鄰的缺口桶合併為不超過 window_hours 的窗口；inprocess 引擎時同一窗口
+    的所有模式一次讀取。成功後移出佇列並重新同步該窗口的覆蓋率計數，
+    失敗則累計嘗試次數（達 max_attempts 後不再處理）。
+
+    Returns:
+        (成功窗口數, 失敗窗口數)
+    """
+    coverage = CoverageIndex(coverage_path, es_host=ES_HOST)
+    queued = {mode: buckets for mode, buckets in coverage.queued_buckets(max_attempts=max_attempts).items()
+              if mode in modes}
+    backfills = {mode: HistoricalDataBackfill(mode, page_size=page_size, bulk_workers=bulk_workers)
+                 for mode in modes}
+    single_pass = SinglePassBackfill(backfills, slices=slices) if engine == 'inprocess' else None
+
+    max_buckets = max(1, window_hours * 20)
+    if single_pass:
+        tasks = []
+        for start_ms, end_ms in gap_windows([b for buckets in queued.values() for b in buckets], max_buckets):
+            task_modes = tuple(mode for mode, buckets in queued.items()
+                               if any(start_ms <= b < end_ms for b in buckets))
+            tasks.append((task_modes, start_ms, end_ms))
+    else:
+        tasks = [((mode,), start_ms, end_ms)
+                 for mode, buckets in queued.items()
+                 for start_ms, end_ms in gap_windows(buckets, max_buckets)]
+
+    print("=" * 80)
+    print("NetFlow 覆蓋率缺口修補")
+    print("=" * 80)
+    print(f"覆蓋率索引: {coverage_path}")
+    for mode in modes:
+        print(f"  [{mode}] 待修補 {len(queued.get(mode, [])):,} 個 3 分鐘桶")
+    print(f"回填引擎: {engine}，共 {len(tasks)} 個窗口")
+    print(f"模式: {'測試模式 (不寫入)' if dry_run else '正式模式 (寫入數據)'}")
+    print("=" * 80)
+
+    repaired = failed = 0
+    for task_modes, start_ms, end_ms in tasks:
+        window_start = datetime(1970, 1, 1) + timedelta(milliseconds=start_ms)
+        window_end = datetime(1970, 1, 1) + timedelta(milliseconds=end_ms)
+        label = f"[{'+'.join(task_modes)}] {window_start.strftime('%Y-%m-%d %H:%M')} - {window_end.strftime('%H:%M')}"
+        try:
+            if single_pass:
+                single_pass._process_time_range(window_start, window_end, dry_run, modes=task_modes)
+            else:
+                backfills[task_modes[0]]._process_time_range(window_start, window_end, dry_run)
+        except Exception as e:
+            failed += 1
+            print(f"❌ {label} 修補失敗: {e}")
+            if not dry_run:
+                for mode in task_modes:
+                    coverage.mark_failed(mode, start_ms, end_ms)
+            continue
+
+        repaired += 1
+        if not dry_run:
+            for mode in task_modes:
+                coverage.mark_repaired(mode, start_ms, end_ms)
+            coverage.refresh(start_ms, end_ms, sources=['raw', *task_modes])
+        print(f"✓ {label} 已修補")
+
+    for backfill in backfills.values():
+        if backfill.processed_docs or backfill.errors:
+            print(f"\n[{backfill.mode}]")
+            backfill._print_summary(dry_run)
+    print(f"\n修補完成: 成功 {repaired} 個窗口，失敗 {failed} 個")
+    coverage.close()
+    return repaired, failed
+
+
 def main():
     # 解析聚合模式
     mode = 'by_src'  # 預設模式
@@ -418,18 +937,61 @@ def main():
         mode_idx = sys.argv.index('--mode')
         if len(sys.argv) > mode_idx + 1:
             mode = sys.argv[mode_idx + 1]
-            if mode not in AGGREGATION_MODES:
+            if mode not in AGGREGATION_MODES and mode != 'both':
                 print(f"❌ 錯誤: 不支援的聚合模式 '{mode}'")
-                print(f"   支援的模式: {', '.join(AGGREGATION_MODES.keys())}")
+                print(f"   支援的模式: {', '.join(AGGREGATION_MODES.keys())}, both")
                 sys.exit(1)
-
-    backfill = HistoricalDataBackfill(mode=mode)
+    modes = list(AGGREGATION_MODES) if mode == 'both' else [mode]
+
+    # 並行模式參數
+    workers = 4 if mode == 'both' else 1
+    if '--workers' in sys.argv:
+        workers = int(sys.argv[sys.argv.index('--workers') + 1])
+    target_latency = 30.0
+    if '--target-latency' in sys.argv:
+        target_latency = float(sys.argv[sys.argv.index('--target-latency') + 1])
+    checkpoint_path = DEFAULT_CHECKPOINT_PATH
+    if '--checkpoint' in sys.argv:
+        checkpoint_path = sys.argv[sys.argv.index('--checkpoint') + 1]
+
+    page_size = 2000
+    if '--page-size' in sys.argv:
+        page_size = int(sys.argv[sys.argv.index('--page-size') + 1])
+
+    engine = 'composite'
+    if '--engine' in sys.argv:
+        engine = sys.argv[sys.argv.index('--engine') + 1]
+        if engine not in ENGINES:
+            print(f"❌ 錯誤: 不支援的回填引擎 '{engine}'")
+            print(f"   支援的引擎: {', '.join(ENGINES)}")
+            sys.exit(1)
+    slices = 4
+    if '--slices' in sys.argv:
+        slices = int(sys.argv[sys.argv.index('--slices') + 1])
+    bulk_workers = 3
+    if '--bulk-workers' in sys.argv:
+        bulk_workers = int(sys.argv[sys.argv.index('--bulk-workers') + 1])
+
+    backfill = HistoricalDataBackfill(mode=modes[0], page_size=page_size, bulk_workers=bulk_workers)
+
+    if '--repair-gaps' in sys.argv:
+        # 未指定 --mode 時修補所有模式
+        coverage_path = DEFAULT_COVERAGE_PATH
+        if '--coverage-db' in sys.argv:
+            coverage_path = sys.argv[sys.argv.index('--coverage-db') + 1]
+        repair_gaps(
+            modes if '--mode' in sys.argv else list(AGGREGATION_MODES), engine=engine,
+            dry_run='--execute' not in sys.argv, coverage_path=coverage_path,
+            slices=slices, bulk_workers=bulk_workers, page_size=page_size
+        )
+        return
 
     # 解析命令行參數
     if '--check' in sys.argv:
         # 只檢查現有資料
         days = int(sys.argv[sys.argv.index('--check') + 1]) if len(sys.argv) > sys.argv.index('--check') + 1 else 7
-        backfill.check_existing_data(days)
+        for check_mode in modes:
+            HistoricalDataBackfill(mode=check_mode).check_existing_data(days)
         return
 
     # 回填模式
@@ -447,10 +1009,21 @@ def main():
         batch_hours = int(sys.argv[sys.argv.index('--batch-hours') + 1])
 
     # 先檢查現有資料
-    backfill.check_existing_data(days)
+    for check_mode in modes:
+        HistoricalDataBackfill(mode=check_mode).check_existing_data(days)
 
     # 執行回填
-    backfill.backfill(days=days, batch_hours=batch_hours, dry_run=dry_run, auto_confirm=auto_confirm)
+    if workers > 1 or len(modes) > 1 or engine == 'inprocess':
+        ParallelBackfill(
+            modes, max_workers=workers, initial_workers=min(2, workers),
+            target_latency=target_latency, checkpoint_path=checkpoint_path, page_size=page_size,
+            engine=engine, slices=slices, bulk_workers=bulk_workers
+        ).run(
+            days=days, batch_hours=batch_hours, dry_run=dry_run, auto_confirm=auto_confirm,
+            reset='--reset-checkpoint' in sys.argv
+        )
+    else:
+        backfill.backfill(days=days, batch_hours=batch_hours, dry_run=dry_run, auto_confirm=auto_confirm)
 
 
 if __name__ == "__main__":
@@ -476,19 +1049,47 @@ NetFlow 歷史資料回填工具
     # 自訂批次大小 (每批處理幾小時)
     python3 backfill_historical_data.py --execute --days 7 --batch-hours 2
 
+    # 並行模式（by_src + by_dst 一起，最多 6 個窗口同時處理，中斷後重新執行即可續傳）
+    python3 backfill_historical_data.py --execute --auto-confirm --mode both --days 30 --workers 6
+
+    # 單次讀取引擎（原始索引只掃描一次，by_src 與 by_dst 在本機一起聚合）
+    python3 backfill_historical_data.py --execute --auto-confirm --mode both --engine inprocess --days 30
+
+    # 只回填覆蓋率缺口（先執行 python3 check_coverage_gaps.py --queue）
+    python3 backfill_historical_data.py --execute --repair-gaps
+
     # 檢查現有資料
     python3 backfill_historical_data.py --check
     python3 backfill_historical_data.py --check 7
     python3 backfill_historical_data.py --mode by_dst --check 7
 
 參數說明:
-    --mode MODE      聚合模式 (by_src 或 by_dst，預設: by_src)
+    --mode MODE      聚合模式 (by_src、by_dst 或 both，預設: by_src)
                      - by_src: 以來源 IP 聚合 -> netflow_stats_3m_by_src
                      - by_dst: 以目標 IP 聚合 -> netflow_stats_3m_by_dst
+                     - both: 兩種模式一起回填（並行模式）
     --execute        正式執行模式 (會實際寫入資料)
     --auto-confirm   自動確認執行（用於 nohup 背景執行）
     --days N         回填過去 N 天的資料 (預設: 3)
     --batch-hours N  每批處理 N 小時 (預設: 1，建議 1-6)
+    --page-size N    每頁取回的 (時間桶, IP) 組合數 (預設: 2000)，每頁取回後即寫入
+    --workers N      並行模式：最多同時處理 N 個時間窗口 (預設: 1，mode both 時 4)
+                     並行數依 ES 延遲與 429 拒絕自動調整
+    --target-latency S
+                     並行模式：單一窗口的目標耗時（秒，預設: 30），超過時降低並行數
+    --checkpoint PATH
+                     並行模式：檢查點檔案 (預設: nad/state/backfill_checkpoint.json)
+    --reset-checkpoint
+                     並行模式：忽略既有檢查點，從頭回填
+    --engine ENGINE  回填引擎 (composite 或 inprocess，預設: composite)
+                     - composite: ES 端 composite 聚合，每個模式各掃描一次原始索引
+                     - inprocess: sliced PIT 讀取原始 flow 一次，本機聚合所有模式
+    --slices N       inprocess 引擎：每個窗口平行讀取的 slice 數 (預設: 4)
+    --bulk-workers N 寫入時並行的 _bulk 連線數 (預設: 3)；每個請求不超過 5 MB，
+                     只重試失敗的文檔，總結中顯示寫入速度 (docs/sec)
+    --repair-gaps    只回填覆蓋率索引佇列中的缺口桶（未指定 --mode 時修補所有模式）
+    --coverage-db PATH
+                     覆蓋率索引 (預設: nad/state/coverage.db)
     --check [N]      檢查索引中現有資料 (可選擇天數)
     --help, -h       顯示此說明
 
@@ -507,10 +1108,11 @@ NetFlow 歷史資料回填工具
 
 注意事項:
     1. 首次執行建議使用測試模式，確認資料範圍無誤
-    2. 批次大小建議 1-6 小時，避免單次查詢過大
+    2. 批次大小建議 1-6 小時；窗口內以 composite 聚合分頁，活躍 IP 再多也不會截斷
     3. 回填會自動跳過已存在的文檔 (使用 time_bucket + IP 作為 ID)
     4. 大量回填可能需要較長時間，請耐心等待
     5. 兩種模式可獨立執行，互不影響
+    6. 並行模式中斷後，以相同參數重新執行會跳過檢查點中已完成的窗口
 
 範例:
     # 回填過去3天，by_src 模式，測試模式
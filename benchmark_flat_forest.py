@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+"""
+扁平化 Isolation Forest 評分器基準測試
+
+比較 sklearn predict() + score_samples() 與 FlatIsolationForest.score_and_predict()
+在不同批量大小下的延遲。
+
+使用方式:
+    python3 benchmark_flat_forest.py
+    python3 benchmark_flat_forest.py --max-size 100000 --repeat 5
+"""
+
+import argparse
+import time
+
+import numpy as np
+from sklearn.ensemble import IsolationForest
+
+from nad.ml.flat_forest import FlatIsolationForest
+
+
+def best_time(func, repeat):
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description='扁平化 Isolation Forest 評分器基準測試')
+    parser.add_argument('--max-size', type=int, default=1_000_000, help='最大批量大小')
+    parser.add_argument('--n-features', type=int, default=13, help='特徵數')
+    parser.add_argument('--n-estimators', type=int, default=150, help='樹的數量')
+    parser.add_argument('--repeat', type=int, default=3, help='每個批量重複次數（取最佳）')
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(42)
+    X_train = rng.normal(size=(50000, args.n_features))
+    model = IsolationForest(n_estimators=args.n_estimators, max_samples=512,
+                            max_features=0.8, contamination=0.05, random_state=42)
+    model.fit(X_train)
+
+    start = time.perf_counter()
+    flat = FlatIsolationForest.from_sklearn(model)
+    print(f"匯出扁平化模型: {time.perf_counter() - start:.3f}s "
+          f"({flat.n_trees} 棵樹, {len(flat.feature):,} 個節點, 最大深度 {flat.max_depth})\n")
+
+    print(f"{'批量大小':>10} | {'sklearn (ms)':>14} | {'flat (ms)':>12} | {'加速':>7} | 一致")
+    print("-" * 62)
+
+    size = 10
+    while size <= args.max_size:
+        X = rng.normal(size=(size, args.n_features)) * 1.5
+        repeat = args.repeat if size <= 100_000 else 1
+
+        def run_sklearn():
+            return model.predict(X), model.score_samples(X)
+
+        t_sklearn = best_time(run_sklearn, repeat)
+        t_flat = best_time(lambda: flat.score_and_predict(X), repeat)
+
+        scores, predictions = flat.score_and_predict(X)
+        matches = (np.array_equal(scores, model.score_samples(X)) and
+                   np.array_equal(predictions, model.predict(X)))
+
+        print(f"{size:>10,} | {t_sklearn * 1000:>14.2f} | {t_flat * 1000:>12.2f} | "
+              f"{t_sklearn / t_flat:>6.1f}x | {'✓' if matches else '✗'}")
+        size *= 10
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+"""
+批次建立所有 IP 的行為基準線
+
+以 composite 聚合串流 netflow_stats_3m_by_src，一次計算學習期內所有 src_ip
+的基準線並存檔。實時偵測（realtime_detection_dual.py）載入存檔後只需查表，
+不再為每個新 IP 即時查詢 ES。
+
+默認同時建立 168 個時段（星期幾 × 小時）的週期性基準線。
+
+建議以排程（例如每天一次）重新建立。
+"""
+
+import sys
+import os
+import time
+import argparse
+
+# 添加專案根目錄到 Python 路徑
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from nad.ml.baseline_manager import BaselineManager, DEFAULT_BASELINE_STORE_PATH
+from nad.utils.config_loader import load_config
+
+
+def main():
+    """主函數"""
+    parser = argparse.ArgumentParser(
+        description='批次建立所有 IP 的行為基準線'
+    )
+    parser.add_argument(
+        '--days',
+        type=int,
+        default=None,
+        help='學習期天數（默認讀取 config.yaml 的 baseline.learning_days，否則 7 天）'
+    )
+    parser.add_argument(
+        '--output',
+        default=None,
+        help=f'基準線存檔路徑（默認讀取 baseline.store_path，否則 {DEFAULT_BASELINE_STORE_PATH}）'
+    )
+    parser.add_argument(
+        '--page-size',
+        type=int,
+        default=500,
+        help='composite 聚合每頁 IP 數（默認 500）'
+    )
+    parser.add_argument(
+        '--no-seasonal',
+        action='store_true',
+        help='不建立週期性（星期幾 × 小時）基準線'
+    )
+
+    args = parser.parse_args()
+
+    try:
+        config = load_config()
+    except Exception:
+        config = None
+    baseline_config = config.get('baseline', {}) if hasattr(config, 'get') else {}
+    es_host = config.get('elasticsearch.host', 'http://localhost:9200') if hasattr(config, 'get') \
+        else 'http://localhost:9200'
+
+    learning_days = args.days or baseline_config.get('learning_days', 7)
+    output = args.output or baseline_config.get('store_path') or DEFAULT_BASELINE_STORE_PATH
+
+    print("\n" + "📊 " * 25)
+    print("批次建立行為基準線")
+    print("📊 " * 25 + "\n")
+    print(f"  - 索引: {BaselineManager.HISTORY_INDEX}")
+    print(f"  - 學習期: {learning_days} 天")
+    print(f"  - 輸出: {output}\n")
+
+    manager = BaselineManager(
+        es_host, learning_days=learning_days,
+        utc_offset_hours=baseline_config.get('utc_offset_hours', 8)
+    )
+
+    try:
+        start = time.time()
+        count = manager.build_all_baselines(page_size=args.page_size)
+        seasonal_count = 0 if args.no_seasonal else manager.build_seasonal_baselines()
+        manager.save_baselines(output)
+
+        print(f"\n✓ 已建立 {count:,} 條基準線（耗時 {time.time() - start:.1f} 秒）")
+        if not args.no_seasonal:
+            print(f"  週期性基準線: {seasonal_count:,} 條")
+        print(f"  存檔: {output}")
+    except Exception as e:
+        print(f"\n❌ 建立基準線失敗: {e}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+"""
+以本機覆蓋率索引檢查聚合資料的缺口
+
+增量同步原始索引與 by_src / by_dst 聚合索引每個 3 分鐘桶的計數到
+nad/state/coverage.db（只查詢上次同步之後的範圍），再以一次向量化比較
+找出缺漏或不足的桶。加上 --queue 時將缺口放入佇列，之後以
+    python3 backfill_historical_data.py --execute --repair-gaps
+針對性回填。
+
+首次同步需要讀取整個 --days 範圍，之後每次只需數秒。
+"""
+
+import sys
+import os
+import time
+import argparse
+
+# 添加專案根目錄到 Python 路徑
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from nad.utils.coverage_index import DEFAULT_COVERAGE_PATH, CoverageIndex, gap_windows
+
+
+def main():
+    """主函數"""
+    parser = argparse.ArgumentParser(
+        description='以本機覆蓋率索引檢查聚合資料的缺口'
+    )
+    parser.add_argument('--days', type=int, default=30, help='比對範圍天數（首次同步範圍，默認 30 天）')
+    parser.add_argument('--db', default=DEFAULT_COVERAGE_PATH, help=f'覆蓋率索引路徑（默認 {DEFAULT_COVERAGE_PATH}）')
+    parser.add_argument('--es-host', default='http://localhost:9200', help='ES 位址')
+    parser.add_argument('--mode', choices=['by_src', 'by_dst', 'both'], default='both', help='聚合模式（默認 both）')
+    parser.add_argument('--min-ratio', type=float, default=0.99,
+                        help='聚合計數低於原始計數的此比例視為不足（默認 0.99）')
+    parser.add_argument('--no-sync', action='store_true', help='不同步，只以既有計數比對')
+    parser.add_argument('--queue', action='store_true', help='將缺口放入回填佇列')
+    parser.add_argument('--show', type=int, default=10, help='每個模式顯示的缺口窗口數（默認 10）')
+
+    args = parser.parse_args()
+    modes = ['by_src', 'by_dst'] if args.mode == 'both' else [args.mode]
+
+    print("\n" + "🧭 " * 25)
+    print("聚合覆蓋率缺口檢查")
+    print("🧭 " * 25 + "\n")
+    print(f"  - 覆蓋率索引: {args.db}")
+    print(f"  - 範圍: 過去 {args.days} 天")
+    print(f"  - 模式: {', '.join(modes)}\n")
+
+    index = CoverageIndex(args.db, es_host=args.es_host)
+    try:
+        if not args.no_sync:
+            start = time.time()
+            written = index.sync(['raw'] + modes, days=args.days)
+            print(f"✓ 同步完成（耗時 {time.time() - start:.1f} 秒）: "
+                  + ", ".join(f"{source} {count:,} 桶" for source, count in written.items()))
+
+        start = time.time()
+        gaps = index.find_gaps(modes, days=args.days, min_ratio=args.min_ratio)
+        print(f"✓ 比對完成（耗時 {time.time() - start:.2f} 秒）\n")
+
+        for mode in modes:
+            mode_gaps = [gap for gap in gaps if gap['mode'] == mode]
+            missing = sum(gap['reason'] == 'missing' for gap in mode_gaps)
+            print(f"[{mode}] 缺漏 {missing:,} 桶，不足 {len(mode_gaps) - missing:,} 桶")
+            if not mode_gaps:
+                print("   ✅ 無缺口")
+                continue
+            windows = gap_windows([gap['bucket'] for gap in mode_gaps])
+            by_bucket = {gap['bucket']: gap for gap in mode_gaps}
+            for start_ms, end_ms in windows[:args.show]:
+                first = by_bucket[start_ms]
+                print(f"   - {first['time_bucket']} 起 {(end_ms - start_ms) // 180000} 桶"
+                      f"（原始 {first['raw_flows']:,} flows / {first['raw_ips']:,} IP，"
+                      f"聚合 {first['agg_flows']:,} flows / {first['agg_docs']:,} 筆）")
+            if len(windows) > args.show:
+                print(f"   ... 還有 {len(windows) - args.show} 個窗口")
+
+        if args.queue and gaps:
+            added = index.enqueue_gaps(gaps)
+            print(f"\n📥 已放入回填佇列: {added:,} 桶（已在佇列中的不重複）")
+            print("   修補: python3 backfill_historical_data.py --execute --repair-gaps")
+    except Exception as e:
+        print(f"\n❌ 檢查覆蓋率失敗: {e}")
+        sys.exit(1)
+    finally:
+        index.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -6,13 +6,203 @@
 
 from elasticsearch import Elasticsearch
 from datetime import datetime, timezone
-from typing import Dict, List
+from typing import Dict, List, Optional
+import hashlib
+import queue
+import threading
+import time
 import warnings
 import pytz
 
 warnings.filterwarnings('ignore')
 
 
+def anomaly_doc_id(anomaly: Dict) -> str:
+    """
+    异常文档的确定性 ID（ip + time_bucket + perspective）
+
+    同一异常重复写入时会覆盖同一文档，保证幂等。
+    """
+    perspective = anomaly.get('perspective', 'SRC')
+    ip = anomaly.get('dst_ip') if perspective == 'DST' else anomaly.get('src_ip')
+    key = f"{ip}|{anomaly.get('time_bucket')}|{perspective}"
+    return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+
+class BulkAnomalyWriter:
+    """
+    后台批量写入器
+
+    - 检测线程只把文档放入有界队列，不等待 ES 写入
+    - 后台线程累积到 bulk_size 笔或超过 flush_interval 秒即以 _bulk 写入
+    - 被拒绝的项目（429 / 5xx）以指数退避重试，其余错误计入失败统计
+    """
+
+    # 可重试的 bulk 项目状态码
+    RETRYABLE_STATUS = (429, 502, 503, 504)
+
+    def __init__(self, es, bulk_size: int = 500, flush_interval: float = 5.0,
+                 queue_size: int = 10000, max_retries: int = 3, backoff: float = 0.5,
+                 enqueue_timeout: float = 1.0):
+        """
+        Args:
+            es: Elasticsearch 客户端
+            bulk_size: 每次 _bulk 的最大文档数
+            flush_interval: 最长累积时间（秒）
+            queue_size: 队列容量
+            max_retries: 被拒绝项目的最大重试次数
+            backoff: 第一次重试的等待时间（秒），之后每次加倍
+            enqueue_timeout: 队列已满时最多等待的时间（秒），超时则丢弃并计数
+        """
+        self.es = es
+        self.bulk_size = bulk_size
+        self.flush_interval = flush_interval
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.enqueue_timeout = enqueue_timeout
+
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._stop = threading.Event()
+        self.stats = {'queued': 0, 'written': 0, 'retried': 0, 'failed': 0, 'dropped': 0}
+        self._stats_lock = threading.Lock()
+        # 上次 flush 时的丢弃 + 失败数（判断本次 flush 之前是否有文档遗失）
+        self._losses_at_flush = 0
+
+        self._thread = threading.Thread(target=self._run, name='anomaly-bulk-writer', daemon=True)
+        self._thread.start()
+
+    def _count(self, key: str, n: int = 1):
+        with self._stats_lock:
+            self.stats[key] += n
+
+    def submit(self, index: str, doc_id: str, doc: Dict) -> bool:
+        """
+        放入一笔文档
+
+        Returns:
+            是否成功放入队列（队列持续满载时返回 False）
+        """
+        try:
+            self._queue.put((index, doc_id, doc), timeout=self.enqueue_timeout)
+        except queue.Full:
+            self._count('dropped')
+            print(f"警告: 异常写入队列已满，丢弃文档 {doc_id}")
+            return False
+        self._count('queued')
+        return True
+
+    def flush(self, timeout: Optional[float] = None) -> bool:
+        """
+        写入目前队列中的所有文档
+
+        Args:
+            timeout: 最长等待时间（秒，含放入 flush 标记的等待），None 表示一直等待
+
+        Returns:
+            是否全部写入：在时限内完成，且自上次 flush 以来没有被丢弃或写入失败的文档
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        done = threading.Event()
+        try:
+            self._queue.put(done, timeout=timeout)
+        except queue.Full:
+            return False
+
+        remaining = None if deadline is None else max(0.0, deadline - time.monotonic())
+        if not done.wait(remaining):
+            return False
+
+        with self._stats_lock:
+            losses = self.stats['dropped'] + self.stats['failed']
+        clean = losses == self._losses_at_flush
+        self._losses_at_flush = losses
+        return clean
+
+    def close(self, timeout: Optional[float] = 30.0) -> bool:
+        """
+        写入剩余文档并停止后台线程
+
+        Returns:
+            剩余文档是否全部写入（同 flush）
+        """
+        flushed = self.flush(timeout)
+        self._stop.set()
+        self._thread.join(timeout)
+        return flushed
+
+    def _run(self):
+        """后台线程：按大小或时间累积后批量写入"""
+        batch = []
+        deadline = None
+
+        while not self._stop.is_set():
+            wait = None if deadline is None else max(0.0, deadline - time.monotonic())
+            try:
+                item = self._queue.get(timeout=wait if wait is not None else 0.5)
+            except queue.Empty:
+                item = None
+
+            if isinstance(item, threading.Event):
+                # flush 标记：写入已累积的文档后通知等待者
+                self._write(batch)
+                batch, deadline = [], None
+                item.set()
+                continue
+
+            if item is not None:
+                batch.append(item)
+                if deadline is None:
+                    deadline = time.monotonic() + self.flush_interval
+
+            if batch and (len(batch) >= self.bulk_size or time.monotonic() >= deadline):
+                self._write(batch)
+                batch, deadline = [], None
+
+        self._write(batch)
+
+    def _write(self, batch: List):
+        """以 _bulk 写入一批文档，被拒绝的项目退避重试"""
+        pending = batch
+        attempt = 0
+
+        while pending:
+            body = []
+            for index, doc_id, doc in pending:
+                body.append({"index": {"_index": index, "_id": doc_id}})
+                body.append(doc)
+
+            retry = []
+            try:
+                response = self.es.bulk(body=body)
+                for item, entry in zip(response.get('items', []), pending):
+                    result = item.get('index', {})
+                    status = result.get('status', 500)
+                    if status < 300:
+                        self._count('written')
+                    elif status in self.RETRYABLE_STATUS:
+                        retry.append(entry)
+                    else:
+                        self._count('failed')
+                        print(f"警告: 写入异常记录失败 ({entry[1]}): {result.get('error')}")
+            except Exception as e:
+                # 整个请求失败（连线错误等），全部重试
+                print(f"警告: 批量写入异常记录失败: {e}")
+                retry = pending
+
+            if not retry:
+                return
+
+            attempt += 1
+            if attempt > self.max_retries:
+                self._count('failed', len(retry))
+                print(f"警告: {len(retry)} 笔异常记录重试 {self.max_retries} 次后仍失败，放弃写入")
+                return
+
+            self._count('retried', len(retry))
+            time.sleep(self.backoff * (2 ** (attempt - 1)))
+            pending = retry
+
+
 class AnomalyLogger:
     """
     异常记录日志器
@@ -23,17 +213,32 @@ class AnomalyLogger:
     - 便于后续统计和分析
     """
 
-    def __init__(self, es_host: str = 'localhost:9200', index_prefix: str = 'anomaly_detection'):
+    def __init__(self, es_host: str = 'localhost:9200', index_prefix: str = 'anomaly_detection',
+                 async_bulk: bool = False, bulk_size: int = 500, flush_interval: float = 5.0,
+                 queue_size: int = 10000):
         """
         初始化日志器
 
         Args:
             es_host: Elasticsearch 地址
             index_prefix: 索引前缀
+            async_bulk: 是否使用后台批量写入（log_anomaly 只入队，不等待 ES）
+            bulk_size: 批量写入的文档数上限
+            flush_interval: 批量写入的最长累积时间（秒）
+            queue_size: 后台写入队列容量
         """
         self.es = Elasticsearch([es_host], request_timeout=30)
         self.index_prefix = index_prefix
 
+        self.writer = None
+        # 同步模式下自上次 flush 以来写入失败的笔数
+        self._sync_failures = 0
+        if async_bulk:
+            self.writer = BulkAnomalyWriter(
+                self.es, bulk_size=bulk_size, flush_interval=flush_interval,
+                queue_size=queue_size
+            )
+
         # 确保索引模板存在
         self._create_index_template()
 
@@ -120,6 +325,25 @@ class AnomalyLogger:
 
         return f"{self.index_prefix}-{timestamp.strftime('%Y.%m.%d')}"
 
+    def anomaly_index_name(self, anomaly: Dict) -> str:
+        """
+        异常所属的索引（time_bucket 的台北日期）
+
+        重新处理或延迟写入跨过午夜时，同一异常仍写入同一索引，确定性 ID 才能覆盖；
+        time_bucket 缺失或无法解析时使用当天的索引
+        """
+        time_bucket = anomaly.get('time_bucket')
+        try:
+            if isinstance(time_bucket, (int, float)):
+                timestamp = datetime.fromtimestamp(time_bucket / 1000, timezone.utc)
+            else:
+                timestamp = datetime.fromisoformat(str(time_bucket).replace('Z', '+00:00'))
+                if timestamp.tzinfo is None:
+                    timestamp = timestamp.replace(tzinfo=timezone.utc)
+        except (TypeError, ValueError, OverflowError, OSError):
+            return self.get_index_name()
+        return self.get_index_name(timestamp.astimezone(pytz.timezone('Asia/Taipei')))
+
     def log_anomaly(self, anomaly: Dict, device_type: str, classification: Dict = None):
         """
         记录单条异常
@@ -218,13 +442,46 @@ class AnomalyLogger:
                 "response": ', '.join(classification.get('response', []))
             })
 
-        # 写入 ES
+        # 写入 ES（确定性 ID + time_bucket 的日期索引，重复写入同一异常不会产生重复文档）
+        index_name = self.anomaly_index_name(anomaly)
+        doc_id = anomaly_doc_id(anomaly)
+
+        if self.writer is not None:
+            self.writer.submit(index_name, doc_id, doc)
+            return
+
         try:
-            index_name = self.get_index_name()
-            self.es.index(index=index_name, body=doc)
+            self.es.index(index=index_name, id=doc_id, body=doc)
         except Exception as e:
+            self._sync_failures += 1
             print(f"警告: 写入异常记录失败: {e}")
 
+    def flush(self, timeout: Optional[float] = None) -> bool:
+        """
+        写入后台队列中的所有异常（检测周期结束时调用）
+
+        Returns:
+            自上次 flush 以来的异常是否全部写入：
+            后台模式下为时限内完成且没有丢弃 / 失败；同步模式下为没有写入失败
+        """
+        if self.writer is None:
+            failures, self._sync_failures = self._sync_failures, 0
+            return failures == 0
+        return self.writer.flush(timeout)
+
+    def close(self) -> bool:
+        """
+        写入剩余异常并停止后台写入线程
+
+        Returns:
+            剩余异常是否全部写入
+        """
+        if self.writer is None:
+            return self.flush()
+        flushed = self.writer.close()
+        self.writer = None
+        return flushed
+
     def log_anomalies_batch(self, anomalies: List[Dict], device_classifier=None, classifier=None):
         """
         批量记录异常
@@ -339,9 +596,12 @@ class AnomalyLogger:
                     "response_actions": '\n'.join(classification.get('response', [])) if classification.get('response') else None,
                 })
 
-            # 添加到批量操作
-            index_name = self.get_index_name()
-            bulk_body.append({"index": {"_index": index_name}})
+            # 添加到批量操作（确定性 ID + time_bucket 的日期索引）
+            index_name = self.anomaly_index_name(anomaly)
+            if self.writer is not None:
+                self.writer.submit(index_name, anomaly_doc_id(anomaly), doc)
+                continue
+            bulk_body.append({"index": {"_index": index_name, "_id": anomaly_doc_id(anomaly)}})
             bulk_body.append(doc)
 
         # 执行批量写入
@@ -5,9 +5,17 @@
 """
 
 import yaml
+import bisect
+import heapq
 import ipaddress
+from functools import lru_cache
 from pathlib import Path
-from typing import Dict, Optional
+from typing import Dict, List, Optional, Sequence, Union
+
+import numpy as np
+
+# classify() 字符串输入的 LRU 缓存大小
+CLASSIFY_CACHE_SIZE = 65536
 
 
 class DeviceClassifier:
@@ -15,6 +23,10 @@ class DeviceClassifier:
     设备类型分类器
 
     根据 device_mapping.yaml 配置判断 IP 地址所属的设备类型
+
+    加载配置时将 ip_ranges 编译为排序后、互不重叠的 IPv4 整数区间
+    （重叠时以配置中先出现的设备类型为准，与逐一比对的结果相同），
+    查询时以二分搜索定位；特殊设备以精确匹配表优先判断。
     """
 
     def __init__(self, config_path: str = None):
@@ -34,6 +46,18 @@ class DeviceClassifier:
         self.type_to_code_mapping = {}  # 動態映射表
         self._load_config()
 
+    @staticmethod
+    def _special_ips(group_config: Dict) -> List[str]:
+        """
+        特殊设备组的 IP 列表（ips 列表，或直接以 IP 作为键的旧格式）
+
+        注意：ips 列表中的 IP 会改变 device_type 特征，已训练的模型需重新训练
+        """
+        ips = group_config.get('ips')
+        if isinstance(ips, list):
+            return [str(ip) for ip in ips]
+        return [ip for ip in group_config if ip not in ['device_type', 'ips']]
+
     def _load_config(self):
         """加载配置文件"""
         try:
@@ -47,19 +71,104 @@ class DeviceClassifier:
             self._build_type_mapping()
 
             # 加载特殊设备配置
-            special_config = config.get('special_devices', {})
+            self.special_devices = {}
+            special_config = config.get('special_devices') or {}
             for group_name, group_config in special_config.items():
                 device_type = group_config.get('device_type', 'external')
                 # 将列表转换为字典
-                for ip in group_config:
-                    if ip not in ['device_type']:
-                        self.special_devices[ip] = device_type
+                for ip in self._special_ips(group_config):
+                    self.special_devices[ip] = device_type
 
         except Exception as e:
             print(f"警告: 无法加载设备映射配置 {self.config_path}: {e}")
             # 使用默认配置
             self._use_default_config()
 
+        self._compile_index()
+
+    def _compile_index(self):
+        """
+        将设备类型的 ip_ranges 与特殊设备编译为查询索引
+
+        - IPv4: 互不重叠的区间 [_range_starts[i], _range_ends[i]] → _range_types[i]
+        - IPv6: 依配置顺序的网段列表（数量少，逐一比对）
+        - 特殊设备: 排序后的 IPv4 整数 → 设备类型编码
+        """
+        self._type_names = list(self.device_types.keys())
+        type_codes = [self._type_code(t) for t in self._type_names]
+
+        # 依配置顺序收集网段（priority 越小越优先）
+        intervals = []
+        self._ipv6_networks = []
+        for priority, device_type in enumerate(self._type_names):
+            for ip_range in self.device_types[device_type].get('ip_ranges') or []:
+                try:
+                    network = ipaddress.ip_network(ip_range, strict=False)
+                except ValueError:
+                    continue
+                if network.version == 4:
+                    intervals.append((int(network.network_address), int(network.broadcast_address), priority))
+                else:
+                    self._ipv6_networks.append((network, device_type))
+
+        # 依端点排序后扫描一次：在每个端点加入 / 移除网段，以最小堆维护覆盖中的
+        # 最高优先级（延迟删除），每段取优先级最高的类型，再合并相邻的同类型区段
+        opening, closing = {}, {}
+        for start, end, priority in intervals:
+            opening.setdefault(start, []).append(priority)
+            closing.setdefault(end + 1, []).append(priority)
+        boundaries = sorted(opening.keys() | closing.keys())
+
+        active = {}
+        heap = []
+        starts, ends, types = [], [], []
+        for seg_start, seg_next in zip(boundaries, boundaries[1:]):
+            for priority in closing.get(seg_start, ()):
+                active[priority] -= 1
+            for priority in opening.get(seg_start, ()):
+                active[priority] = active.get(priority, 0) + 1
+                heapq.heappush(heap, priority)
+            while heap and not active.get(heap[0]):
+                heapq.heappop(heap)
+            if not heap:
+                continue
+            winner = heap[0]
+            if types and types[-1] == winner and ends[-1] + 1 == seg_start:
+                ends[-1] = seg_next - 1
+            else:
+                starts.append(seg_start)
+                ends.append(seg_next - 1)
+                types.append(winner)
+
+        # 单个查询用 Python 列表（bisect），批量查询用 NumPy 数组（searchsorted）
+        self._range_start_list, self._range_end_list, self._range_type_list = starts, ends, types
+        self._range_starts = np.array(starts, dtype=np.int64)
+        self._range_ends = np.array(ends, dtype=np.int64)
+        self._range_types = np.array(types, dtype=np.int64)
+        self._range_codes = np.array([type_codes[t] for t in types], dtype=np.int64)
+
+        special_v4 = {}
+        for ip, device_type in self.special_devices.items():
+            try:
+                ip_obj = ipaddress.ip_address(ip)
+            except ValueError:
+                continue
+            if ip_obj.version == 4:
+                special_v4[int(ip_obj)] = self._type_code(device_type)
+        special_ints = sorted(special_v4)
+        self._special_ints = np.array(special_ints, dtype=np.int64)
+        self._special_codes = np.array([special_v4[i] for i in special_ints], dtype=np.int64)
+
+        # 重新加载配置后缓存失效
+        self._classify_cached = lru_cache(maxsize=CLASSIFY_CACHE_SIZE)(self._classify_uncached)
+
+    def _type_code(self, device_type: str) -> int:
+        """设备类型的数值编码（未知类型返回 external 的编码）"""
+        return self.type_to_code_mapping.get(
+            device_type,
+            len(self.type_to_code_mapping) - 1
+        )
+
     def _build_type_mapping(self):
         """
         建立設備類型到數值編碼的動態映射表
@@ -115,6 +224,13 @@ class DeviceClassifier:
         Returns:
             设备类型: 'server_farm', 'station', 'iot', 'external'
         """
+        try:
+            return self._classify_cached(ip)
+        except TypeError:
+            # 不可哈希的输入
+            return 'external'
+
+    def _classify_uncached(self, ip: str) -> str:
         # 首先检查特殊设备列表
         if ip in self.special_devices:
             return self.special_devices[ip]
@@ -125,21 +241,60 @@ class DeviceClassifier:
         except ValueError:
             return 'external'
 
-        # 检查每个设备类型的 IP 范围
-        for device_type, config in self.device_types.items():
-            ip_ranges = config.get('ip_ranges', [])
-
-            for ip_range in ip_ranges:
-                try:
-                    network = ipaddress.ip_network(ip_range, strict=False)
-                    if ip_obj in network:
-                        return device_type
-                except ValueError:
-                    continue
+        if ip_obj.version == 4:
+            # 二分搜索所属区间
+            value = int(ip_obj)
+            idx = bisect.bisect_right(self._range_start_list, value) - 1
+            if idx >= 0 and value <= self._range_end_list[idx]:
+                return self._type_names[self._range_type_list[idx]]
+        else:
+            for network, device_type in self._ipv6_networks:
+                if ip_obj in network:
+                    return device_type
 
         # 默认返回 external
         return 'external'
 
+    def classify_many(self, ips: Union[np.ndarray, Sequence[str]]) -> np.ndarray:
+        """
+        批量获取设备类型编码（与逐一调用 get_device_type_code 的结果相同）
+
+        Args:
+            ips: IPv4 整数数组（例如 int(ipaddress.IPv4Address(ip))），
+                 或 IP 字符串序列（每个不同的字符串只解析一次）
+
+        Returns:
+            设备类型编码数组（int64）
+        """
+        values = np.asarray(ips)
+        if values.dtype.kind not in 'iu':
+            # 字符串输入：去重后逐一分类（含 IPv6 与无效 IP）
+            unique, inverse = np.unique(values.astype(str), return_inverse=True)
+            codes = np.fromiter(
+                (self.get_device_type_code(ip) for ip in unique), dtype=np.int64, count=len(unique)
+            )
+            return codes[inverse].reshape(values.shape)
+
+        values = values.astype(np.int64, copy=False)
+        external_code = self._type_code('external')
+        codes = np.full(values.shape, external_code, dtype=np.int64)
+
+        if len(self._range_starts):
+            idx = np.searchsorted(self._range_starts, values, side='right') - 1
+            valid = idx >= 0
+            idx_clipped = np.where(valid, idx, 0)
+            hit = valid & (values <= self._range_ends[idx_clipped])
+            codes[hit] = self._range_codes[idx_clipped[hit]]
+
+        # 特殊设备优先
+        if len(self._special_ints):
+            pos = np.searchsorted(self._special_ints, values)
+            pos_clipped = np.minimum(pos, len(self._special_ints) - 1)
+            special = self._special_ints[pos_clipped] == values
+            codes[special] = self._special_codes[pos_clipped[special]]
+
+        return codes
+
     def get_device_type_code(self, ip: str) -> int:
         """
         获取设备类型的数值编码（用于特征工程）
@@ -153,11 +308,8 @@ class DeviceClassifier:
         """
         device_type = self.classify(ip)
 
-        # 使用動態映射表
-        return self.type_to_code_mapping.get(
-            device_type,
-            len(self.type_to_code_mapping) - 1  # 未知類型返回 external 的編碼
-        )
+        # 使用動態映射表（未知類型返回 external 的編碼）
+        return self._type_code(device_type)
 
     def get_device_type_info(self, ip: str) -> Dict:
         """
@@ -242,6 +394,18 @@ class DeviceClassifier:
         """
         return self.code_to_type_mapping.copy()
 
+    def get_mapping(self) -> Dict:
+        """
+        獲取目前生效的設備映射內容（用於判斷映射是否變更）
+
+        Returns:
+            {'device_types': ..., 'special_devices': {ip: device_type}}
+        """
+        return {
+            'device_types': self.device_types,
+            'special_devices': self.special_devices,
+        }
+
     def reload_config(self):
         """
         重新載入配置檔案（當配置更新時使用）
@@ -23,10 +23,11 @@ from collections import OrderedDict
 import threading
 import yaml
 import os
-import requests
 import json
 import logging
 
+from ..utils.es_transport import get_transport
+
 # 設定 post_process logger
 post_process_logger = logging.getLogger('post_process')
 post_process_logger.setLevel(logging.INFO)
@@ -350,6 +351,163 @@ THREAT_CLASSES = {
 }
 
 
+# ========== 分類規則閾值（classify / classify_batch 與 classify_dst / classify_dst_batch 共用） ==========
+
+# 可由 thresholds 配置（src_threats.<規則>.thresholds）覆寫的預設閾值
+SRC_RULE_THRESHOLDS = {
+    'PORT_SCAN': {'unique_dst_ports': 100, 'avg_bytes': 5000, 'dst_port_diversity': 0.5},
+    'NETWORK_SCAN': {'unique_dsts': 50, 'dst_diversity': 0.3, 'flow_count': 1000, 'avg_bytes': 50000},
+    'DNS_TUNNELING': {'flow_count': 1000, 'unique_dst_ports': 2, 'avg_bytes': 1000, 'unique_dsts': 5},
+    'DDOS': {'flow_count': 10000, 'flow_rate': 30, 'avg_bytes': 500, 'unique_dsts': 20},
+    'DATA_EXFILTRATION': {
+        'total_bytes': 1000000000,  # 1GB
+        'byte_rate': 3000000,  # 3MB/s
+        'unique_dsts': 5, 'dst_diversity': 0.1
+    },
+    'C2_COMMUNICATION': {
+        'unique_dsts': 1, 'flow_count_min': 100, 'flow_count_max': 1000,
+        'avg_bytes_min': 1000, 'avg_bytes_max': 100000
+    },
+    'NORMAL_HIGH_TRAFFIC': {
+        'total_bytes': 1000000000,  # 1GB
+        'unique_dsts_min': 10, 'unique_dsts_max': 100
+    },
+}
+
+# 不開放配置的固定條件
+SRC_RULE_LIMITS = {
+    'PORT_SCAN': {
+        'sequential_min_ports': 50,  # 連續端口掃描的快速路徑
+        'max_unique_dsts': 50,  # 與網路掃描區分
+        'max_top_dst_port_concentration': 0.3,
+    },
+    'NETWORK_SCAN': {
+        'min_top_dst_port_concentration': 0.3,
+        'min_dst_well_known_ratio': 0.7,
+        'max_top_src_port_concentration': 0.2,
+    },
+    'DNS_TUNNELING': {'min_top_dst_port_concentration': 0.9},
+    'DATA_EXFILTRATION': {
+        'min_dst_registered_ratio': 0.5,
+        'min_dst_ephemeral_ratio': 0.3,
+        'max_dst_well_known_ratio': 0.3,
+    },
+    'C2_COMMUNICATION': {
+        'max_unique_dst_ports': 3,
+        'min_dst_registered_ratio': 0.5,
+        'min_dst_ephemeral_ratio': 0.5,
+    },
+    'NORMAL_HIGH_TRAFFIC': {'min_dst_ephemeral_ratio': 0.8},
+}
+
+# 置信度：基礎值、上限與加分級距（級距依門檻由嚴到寬排列，取第一個成立者）
+SRC_CONFIDENCE = {
+    'PORT_SCAN': {
+        'base': 0.6, 'cap': 0.99,
+        'sequential': 0.2,
+        'unique_dst_ports': ((1000, 0.2), (500, 0.1)),  # 高於
+        'dst_port_diversity': ((0.7, 0.15), (0.6, 0.08)),  # 高於
+        'avg_bytes': ((2000, 0.1), (3000, 0.05)),  # 低於
+    },
+    'NETWORK_SCAN': {
+        'base': 0.6, 'cap': 0.99,
+        'unique_dsts': ((100, 0.15), (70, 0.08)),  # 高於
+        'dst_diversity': ((0.5, 0.1), (0.4, 0.05)),  # 高於
+        'dst_well_known_ratio': ((0.8, 0.1), (0.6, 0.05)),  # 高於
+        'top_dst_port_concentration': (0.5, 0.08),  # 高於
+        'top_src_port_concentration': (0.1, 0.06),  # 低於
+    },
+    'DNS_TUNNELING': {
+        'base': 0.7, 'cap': 0.99,
+        'single_port': 0.2,
+        'flow_count': (5000, 0.1),  # 高於
+    },
+    'DDOS': {
+        'base': 0.7, 'cap': 0.99,
+        'flow_count_or_rate': ((50000, 100, 0.2), (20000, 50, 0.1)),  # flow_count 或 flow_rate 高於
+        'avg_bytes': (300, 0.1),  # 低於
+    },
+    'DATA_EXFILTRATION': {
+        'base': 0.7, 'cap': 0.99,
+        'total_bytes_or_rate': ((10e9, 30e6, 0.15), (5e9, 15e6, 0.1)),  # total_bytes 或 byte_rate 高於
+        'single_dst': 0.1,
+        'few_dsts': (3, 0.05),  # 不超過
+        'dst_diversity': (0.05, 0.05),  # 低於
+    },
+    'C2_COMMUNICATION': {
+        'base': 0.6, 'cap': 0.85,
+        'single_dst': 0.2,
+    },
+    'NORMAL_HIGH_TRAFFIC': {
+        'base': 0.5, 'cap': 0.95,
+        'server_response': 0.3,
+        'known_server': 0.25,
+        'all_internal': 0.2,
+        'backup_time': 0.1,
+    },
+    'UNKNOWN': {'base': 0.5},
+}
+
+# 可由 thresholds 配置（dst_threats.<規則>.thresholds）覆寫的預設閾值
+DST_RULE_THRESHOLDS = {
+    'DDOS_TARGET': {'unique_srcs': 100, 'flow_count': 1000, 'avg_bytes': 500},
+    'SCAN_TARGET': {'unique_src_ports': 100, 'unique_dst_ports': 50, 'avg_bytes': 2000},
+    'DATA_SINK': {
+        'unique_srcs': 10,
+        'total_bytes': 100000000,  # 100MB
+        'avg_bytes': 10000
+    },
+    'MALWARE_DISTRIBUTION': {
+        'unique_srcs': 5,
+        'total_bytes': 50000000,  # 50MB
+        'flows_per_src': 10
+    },
+    'POPULAR_SERVER': {'unique_srcs': 20, 'avg_bytes_min': 500, 'avg_bytes_max': 50000},
+    'NORMAL_DST_TRAFFIC': {
+        'unique_srcs_max': 3, 'avg_bytes_min': 500, 'avg_bytes_max': 100000,
+        'flow_count_max': 100, 'unique_dst_ports_max': 10
+    },
+}
+
+# 不開放配置的固定條件
+DST_RULE_LIMITS = {
+    # 掃描回應流量（也用於排除 DDoS 目標誤判）
+    'SCAN_RESPONSE': {
+        'min_unique_srcs': 50, 'min_unique_dst_ports': 100,
+        'max_flows_per_src': 5, 'max_avg_bytes': 2000
+    },
+    # 觸發跨視角（SRC）伺服器回應檢查
+    'SERVER_RESPONSE_TRAFFIC': {'min_unique_dst_ports': 20},
+}
+
+# Dst 視角各類別的置信度
+DST_CONFIDENCE = {
+    'SERVER_RESPONSE_TRAFFIC': 0.90,
+    'SCAN_RESPONSE': 0.90,
+    'DDOS_TARGET': 0.95,
+    'SCAN_TARGET': 0.90,
+    'DATA_SINK': 0.85,
+    'MALWARE_DISTRIBUTION': 0.80,
+    'POPULAR_SERVER': 0.70,
+    'NORMAL_DST_TRAFFIC': 0.85,
+    'UNKNOWN': 0.50,
+}
+
+
+def _tier_bonus(value, tiers, below: bool = False) -> float:
+    """依級距取加分（value 高於門檻；below=True 時為低於門檻）"""
+    for threshold, bonus in tiers:
+        if (value < threshold) if below else (value > threshold):
+            return bonus
+    return 0.0
+
+
+def _tier_bonus_batch(values: np.ndarray, tiers, below: bool = False) -> np.ndarray:
+    """_tier_bonus 的向量化版本"""
+    conditions = [(values < threshold) if below else (values > threshold) for threshold, _ in tiers]
+    return np.select(conditions, [bonus for _, bonus in tiers], 0.0)
+
+
 class AnomalyClassifier:
     """
     異常分類器
@@ -589,13 +747,23 @@ class AnomalyClassifier:
         # 8. 未知異常
         return self._create_classification(
             'UNKNOWN',
-            confidence=0.5,
+            confidence=SRC_CONFIDENCE['UNKNOWN']['base'],
             features=features,
             context=context
         )
 
     # ========== 分類判斷方法 ==========
 
+    def _src_rule(self, name: str) -> Tuple[bool, Dict]:
+        """Src 規則是否啟用與閾值（配置覆寫 SRC_RULE_THRESHOLDS 的預設值）"""
+        config = self.src_thresholds.get(name, {})
+        return config.get('enabled', True), {**SRC_RULE_THRESHOLDS[name], **config.get('thresholds', {})}
+
+    def _dst_rule(self, name: str) -> Tuple[bool, Dict]:
+        """Dst 規則是否啟用與閾值（配置覆寫 DST_RULE_THRESHOLDS 的預設值）"""
+        config = self.dst_thresholds.get(name, {})
+        return config.get('enabled', True), {**DST_RULE_THRESHOLDS[name], **config.get('thresholds', {})}
+
     def _is_port_scan(self, features: Dict) -> bool:
         """判斷是否為埠掃描"""
         unique_dst_ports = features.get('unique_dst_ports', 0)
@@ -610,18 +778,14 @@ class AnomalyClassifier:
         has_sequential = features.get('has_sequential_dst_ports', 0)
 
         # 從配置讀取閾值，如果沒有配置則使用預設值
-        config = self.src_thresholds.get('PORT_SCAN', {})
-        if not config.get('enabled', True):
+        enabled, thresholds = self._src_rule('PORT_SCAN')
+        if not enabled:
             return False
-
-        thresholds = config.get('thresholds', {})
-        threshold_ports = thresholds.get('unique_dst_ports', 100)
-        threshold_bytes = thresholds.get('avg_bytes', 5000)
-        threshold_diversity = thresholds.get('dst_port_diversity', 0.5)
+        limits = SRC_RULE_LIMITS['PORT_SCAN']
 
         # ✅ 快速路徑：連續端口掃描（如 1-1024）是明顯的掃描行為
         # 即使不滿足其他條件，只要是連續掃描大量端口就判定為掃描
-        if has_sequential == 1 and unique_dst_ports > 50:
+        if has_sequential == 1 and unique_dst_ports > limits['sequential_min_ports']:
             return True
 
         # 埠掃描特徵（標準判斷）：
@@ -631,11 +795,11 @@ class AnomalyClassifier:
         # 4. 目標主機少（專注於少數目標的端口掃描）
         # 5. 端口流量分散（沒有集中在特定端口）
         return (
-            unique_dst_ports > threshold_ports and
-            avg_bytes < threshold_bytes and
-            dst_port_diversity > threshold_diversity and
-            unique_dsts < 50 and  # 少於 50 個目標（與網路掃描區分）
-            top_dst_port_concentration < 0.3  # 端口流量分散
+            unique_dst_ports > thresholds['unique_dst_ports'] and
+            avg_bytes < thresholds['avg_bytes'] and
+            dst_port_diversity > thresholds['dst_port_diversity'] and
+            unique_dsts < limits['max_unique_dsts'] and  # 目標少（與網路掃描區分）
+            top_dst_port_concentration < limits['max_top_dst_port_concentration']  # 端口流量分散
         )
 
     def _is_network_scan(self, features: Dict) -> bool:
@@ -651,15 +815,11 @@ class AnomalyClassifier:
         top_src_port_concentration = features.get('top_src_port_concentration', 0)
 
         # 從配置讀取閾值
-        config = self.src_thresholds.get('NETWORK_SCAN', {})
-        if not config.get('enabled', True):
+        enabled, thresholds = self._src_rule('NETWORK_SCAN')
+        if not enabled:
             return False
-
-        thresholds = config.get('thresholds', {})
-        threshold_dsts = thresholds.get('unique_dsts', 50)
-        threshold_diversity = thresholds.get('dst_diversity', 0.3)
-        threshold_flows = thresholds.get('flow_count', 1000)
-        threshold_bytes = thresholds.get('avg_bytes', 50000)
+        limits = SRC_RULE_LIMITS['NETWORK_SCAN']
+        threshold_dsts = thresholds['unique_dsts']
 
         # 網路掃描特徵：
         # 1. 掃描大量主機
@@ -672,16 +832,17 @@ class AnomalyClassifier:
         # 基本掃描特徵
         is_basic_scan = (
             unique_dsts > threshold_dsts and
-            dst_diversity > threshold_diversity and
-            flow_count > threshold_flows and
-            avg_bytes < threshold_bytes
+            dst_diversity > thresholds['dst_diversity'] and
+            flow_count > thresholds['flow_count'] and
+            avg_bytes < thresholds['avg_bytes']
         )
 
         # Port 特徵加成：提高識別準確度
         has_scan_port_pattern = (
-            top_dst_port_concentration > 0.3 and  # 目的端口相對集中（掃描常見服務）
-            dst_well_known_ratio > 0.7 and         # 70% 以上是知名端口
-            top_src_port_concentration < 0.2       # 來源端口高度分散
+            # 目的端口相對集中（掃描常見服務）
+            top_dst_port_concentration > limits['min_top_dst_port_concentration'] and
+            dst_well_known_ratio > limits['min_dst_well_known_ratio'] and  # 大多是知名端口
+            top_src_port_concentration < limits['max_top_src_port_concentration']  # 來源端口高度分散
         )
 
         return is_basic_scan or (unique_dsts > threshold_dsts and has_scan_port_pattern)
@@ -697,15 +858,10 @@ class AnomalyClassifier:
         top_dst_port_concentration = features.get('top_dst_port_concentration', 0)
 
         # 從配置讀取閾值
-        config = self.src_thresholds.get('DNS_TUNNELING', {})
-        if not config.get('enabled', True):
+        enabled, thresholds = self._src_rule('DNS_TUNNELING')
+        if not enabled:
             return False
-
-        thresholds = config.get('thresholds', {})
-        threshold_flows = thresholds.get('flow_count', 1000)
-        threshold_ports = thresholds.get('unique_dst_ports', 2)
-        threshold_bytes = thresholds.get('avg_bytes', 1000)
-        threshold_dsts = thresholds.get('unique_dsts', 5)
+        limits = SRC_RULE_LIMITS['DNS_TUNNELING']
 
         # DNS 隧道特徵：
         # 1. 大量連線
@@ -714,11 +870,12 @@ class AnomalyClassifier:
         # 4. 目的地極少
         # 5. 【新增】端口極度集中（幾乎只用 port 53）
         return (
-            flow_count > threshold_flows and
-            unique_dst_ports <= threshold_ports and
-            avg_bytes < threshold_bytes and
-            unique_dsts <= threshold_dsts and
-            top_dst_port_concentration > 0.9  # 90% 流量集中在單一端口（DNS:53）
+            flow_count > thresholds['flow_count'] and
+            unique_dst_ports <= thresholds['unique_dst_ports'] and
+            avg_bytes < thresholds['avg_bytes'] and
+            unique_dsts <= thresholds['unique_dsts'] and
+            # 流量幾乎集中在單一端口（DNS:53）
+            top_dst_port_concentration > limits['min_top_dst_port_concentration']
         )
 
     def _is_ddos(self, features: Dict) -> bool:
@@ -729,24 +886,18 @@ class AnomalyClassifier:
         flow_rate = features.get('flow_rate', 0)
 
         # 從配置讀取閾值
-        config = self.src_thresholds.get('DDOS', {})
-        if not config.get('enabled', True):
+        enabled, thresholds = self._src_rule('DDOS')
+        if not enabled:
             return False
 
-        thresholds = config.get('thresholds', {})
-        threshold_flows = thresholds.get('flow_count', 10000)
-        threshold_rate = thresholds.get('flow_rate', 30)
-        threshold_bytes = thresholds.get('avg_bytes', 500)
-        threshold_dsts = thresholds.get('unique_dsts', 20)
-
         # DDoS 特徵：
         # 1. 極高連線數或高連線速率
         # 2. 極小封包 - SYN Flood
         # 3. 目的地少
         return (
-            (flow_count > threshold_flows or flow_rate > threshold_rate) and
-            avg_bytes < threshold_bytes and
-            unique_dsts < threshold_dsts
+            (flow_count > thresholds['flow_count'] or flow_rate > thresholds['flow_rate']) and
+            avg_bytes < thresholds['avg_bytes'] and
+            unique_dsts < thresholds['unique_dsts']
         )
 
     def _is_data_exfiltration(self, features: Dict, dst_ips: List[str]) -> bool:
@@ -765,15 +916,10 @@ class AnomalyClassifier:
         dst_ephemeral_ratio = features.get('dst_ephemeral_ratio', 0)
 
         # 從配置讀取閾值
-        config = self.src_thresholds.get('DATA_EXFILTRATION', {})
-        if not config.get('enabled', True):
+        enabled, thresholds = self._src_rule('DATA_EXFILTRATION')
+        if not enabled:
             return False
-
-        thresholds = config.get('thresholds', {})
-        threshold_bytes = thresholds.get('total_bytes', 1000000000)  # 1GB
-        threshold_rate = thresholds.get('byte_rate', 3000000)  # 3MB/s
-        threshold_dsts = thresholds.get('unique_dsts', 5)
-        threshold_diversity = thresholds.get('dst_diversity', 0.1)
+        limits = SRC_RULE_LIMITS['DATA_EXFILTRATION']
 
         # 檢查是否有外部 IP
         has_external = any(not self._is_internal_ip(ip) for ip in dst_ips) if dst_ips else False
@@ -781,8 +927,9 @@ class AnomalyClassifier:
         # ✅ Phase 2: 使用非標準端口（規避檢測的常見手法）
         # 註冊端口（1024-49151）或臨時端口（49152-65535）比例高，知名端口比例低
         uses_non_standard_ports = (
-            (dst_registered_ratio > 0.5 or dst_ephemeral_ratio > 0.3) and
-            dst_well_known_ratio < 0.3
+            (dst_registered_ratio > limits['min_dst_registered_ratio'] or
+             dst_ephemeral_ratio > limits['min_dst_ephemeral_ratio']) and
+            dst_well_known_ratio < limits['max_dst_well_known_ratio']
         )
 
         # 數據外洩特徵：
@@ -792,9 +939,9 @@ class AnomalyClassifier:
         # 4. 有外部 IP
         # 5. ✅ Phase 2: 使用非標準端口（提高置信度）
         basic_exfil = (
-            (total_bytes > threshold_bytes or byte_rate > threshold_rate) and
-            unique_dsts <= threshold_dsts and
-            dst_diversity < threshold_diversity and
+            (total_bytes > thresholds['total_bytes'] or byte_rate > thresholds['byte_rate']) and
+            unique_dsts <= thresholds['unique_dsts'] and
+            dst_diversity < thresholds['dst_diversity'] and
             has_external
         )
 
@@ -816,23 +963,18 @@ class AnomalyClassifier:
         dst_registered_ratio = features.get('dst_registered_ratio', 0)
 
         # 從配置讀取閾值
-        config = self.src_thresholds.get('C2_COMMUNICATION', {})
-        if not config.get('enabled', True):
+        enabled, thresholds = self._src_rule('C2_COMMUNICATION')
+        if not enabled:
             return False
-
-        thresholds = config.get('thresholds', {})
-        threshold_dsts = thresholds.get('unique_dsts', 1)
-        threshold_flow_min = thresholds.get('flow_count_min', 100)
-        threshold_flow_max = thresholds.get('flow_count_max', 1000)
-        threshold_bytes_min = thresholds.get('avg_bytes_min', 1000)
-        threshold_bytes_max = thresholds.get('avg_bytes_max', 100000)
+        limits = SRC_RULE_LIMITS['C2_COMMUNICATION']
 
         # C&C 常用高端口號或非標準端口（規避檢測）
         uses_high_ports = (common_ports_ratio < 0.5)  # 少於 50% 使用標準端口
 
         # ✅ C&C 通常使用註冊端口（1024-49151）或動態端口（49152-65535）
         # 如果主要使用這些端口，增加 C&C 可能性
-        uses_non_well_known = (dst_registered_ratio > 0.5 or dst_ephemeral_ratio > 0.5)
+        uses_non_well_known = (dst_registered_ratio > limits['min_dst_registered_ratio'] or
+                               dst_ephemeral_ratio > limits['min_dst_ephemeral_ratio'])
 
         # C&C 通訊特徵：
         # 1. 單一目的地
@@ -841,10 +983,10 @@ class AnomalyClassifier:
         # 4. 通常使用少數端口（1-3個）
         # 5. ✅ 使用非知名端口（註冊或動態端口，規避檢測）
         basic_c2_pattern = (
-            unique_dsts == threshold_dsts and
-            threshold_flow_min < flow_count < threshold_flow_max and
-            threshold_bytes_min < avg_bytes < threshold_bytes_max and
-            unique_dst_ports <= 3
+            unique_dsts == thresholds['unique_dsts'] and
+            thresholds['flow_count_min'] < flow_count < thresholds['flow_count_max'] and
+            thresholds['avg_bytes_min'] < avg_bytes < thresholds['avg_bytes_max'] and
+            unique_dst_ports <= limits['max_unique_dst_ports']
         )
 
         # 如果符合基本模式且使用非知名端口，判定為 C&C
@@ -874,18 +1016,14 @@ class AnomalyClassifier:
         dst_ephemeral_ratio = features.get('dst_ephemeral_ratio', 0)
         # 如果回應到大量臨時端口（> 80%），這是典型的服務器回應客戶端模式
         # 與 verify_anomaly.py 的 ephemeral_ratio > 0.9 邏輯一致（但稍微寬鬆）
-        is_server_response_pattern = (dst_ephemeral_ratio > 0.8)
+        is_server_response_pattern = (
+            dst_ephemeral_ratio > SRC_RULE_LIMITS['NORMAL_HIGH_TRAFFIC']['min_dst_ephemeral_ratio'])
 
         # 從配置讀取閾值
-        config = self.src_thresholds.get('NORMAL_HIGH_TRAFFIC', {})
-        if not config.get('enabled', True):
+        enabled, thresholds = self._src_rule('NORMAL_HIGH_TRAFFIC')
+        if not enabled:
             return False
 
-        thresholds = config.get('thresholds', {})
-        threshold_bytes = thresholds.get('total_bytes', 1000000000)  # 1GB
-        threshold_dsts_min = thresholds.get('unique_dsts_min', 10)
-        threshold_dsts_max = thresholds.get('unique_dsts_max', 100)
-
         # 檢查是否都是內部 IP
         all_internal = all(self._is_internal_ip(ip) for ip in dst_ips) if dst_ips else False
 
@@ -901,10 +1039,10 @@ class AnomalyClassifier:
         # 5. 或者在備份時間
         # 6. 目的地數量合理（不是單一也不是太分散）
         return (
-            total_bytes > threshold_bytes and
+            total_bytes > thresholds['total_bytes'] and
             (all_internal or is_likely_server == 1 or is_known_server or
              is_server_response_pattern or is_backup_time) and
-            threshold_dsts_min < unique_dsts < threshold_dsts_max
+            thresholds['unique_dsts_min'] < unique_dsts < thresholds['unique_dsts_max']
         )
 
     # ========== 置信度計算方法 ==========
@@ -918,31 +1056,23 @@ class AnomalyClassifier:
         # ✅ Phase 1: 連續端口檢測特徵
         has_sequential = features.get('has_sequential_dst_ports', 0)
 
-        confidence = 0.6  # 基礎置信度
+        c = SRC_CONFIDENCE['PORT_SCAN']
+        confidence = c['base']  # 基礎置信度
 
         # ✅ 連續端口掃描是非常明顯的特徵
         if has_sequential == 1:
-            confidence += 0.2  # 連續掃描（如 1-1024）
+            confidence += c['sequential']  # 連續掃描（如 1-1024）
 
         # 埠數量越多，置信度越高
-        if unique_dst_ports > 1000:
-            confidence += 0.2
-        elif unique_dst_ports > 500:
-            confidence += 0.1
+        confidence += _tier_bonus(unique_dst_ports, c['unique_dst_ports'])
 
         # 埠分散度越高，置信度越高
-        if dst_port_diversity > 0.7:
-            confidence += 0.15
-        elif dst_port_diversity > 0.6:
-            confidence += 0.08
+        confidence += _tier_bonus(dst_port_diversity, c['dst_port_diversity'])
 
         # 封包越小，置信度越高
-        if avg_bytes < 2000:
-            confidence += 0.1
-        elif avg_bytes < 3000:
-            confidence += 0.05
+        confidence += _tier_bonus(avg_bytes, c['avg_bytes'], below=True)
 
-        return min(confidence, 0.99)
+        return min(confidence, c['cap'])
 
     def _calculate_network_scan_confidence(self, features: Dict) -> float:
         """計算網路掃描的置信度"""
@@ -954,53 +1084,43 @@ class AnomalyClassifier:
         dst_well_known_ratio = features.get('dst_well_known_ratio', 0)
         top_src_port_concentration = features.get('top_src_port_concentration', 0)
 
-        confidence = 0.6
+        c = SRC_CONFIDENCE['NETWORK_SCAN']
+        confidence = c['base']
 
         # 掃描主機數量
-        if unique_dsts > 100:
-            confidence += 0.15
-        elif unique_dsts > 70:
-            confidence += 0.08
+        confidence += _tier_bonus(unique_dsts, c['unique_dsts'])
 
         # 目的地分散度
-        if dst_diversity > 0.5:
-            confidence += 0.1
-        elif dst_diversity > 0.4:
-            confidence += 0.05
+        confidence += _tier_bonus(dst_diversity, c['dst_diversity'])
 
         # 【新增】Port 特徵加成
         # 掃描常見服務端口（知名端口比例高）
-        if dst_well_known_ratio > 0.8:
-            confidence += 0.1
-        elif dst_well_known_ratio > 0.6:
-            confidence += 0.05
+        confidence += _tier_bonus(dst_well_known_ratio, c['dst_well_known_ratio'])
 
         # 目的端口集中在少數服務
-        if top_dst_port_concentration > 0.5:
-            confidence += 0.08
+        confidence += _tier_bonus(top_dst_port_concentration, [c['top_dst_port_concentration']])
 
         # 來源端口高度隨機化（掃描器特徵）
-        if top_src_port_concentration < 0.1:
-            confidence += 0.06
+        confidence += _tier_bonus(top_src_port_concentration, [c['top_src_port_concentration']], below=True)
 
-        return min(confidence, 0.99)
+        return min(confidence, c['cap'])
 
     def _calculate_dns_tunneling_confidence(self, features: Dict) -> float:
         """計算 DNS 隧道的置信度"""
         flow_count = features.get('flow_count', 0)
         unique_dst_ports = features.get('unique_dst_ports', 0)
 
-        confidence = 0.7
+        c = SRC_CONFIDENCE['DNS_TUNNELING']
+        confidence = c['base']
 
         # 只使用 DNS 埠，置信度很高
         if unique_dst_ports == 1:
-            confidence += 0.2
+            confidence += c['single_port']
 
         # 連線數越多，置信度越高
-        if flow_count > 5000:
-            confidence += 0.1
+        confidence += _tier_bonus(flow_count, [c['flow_count']])
 
-        return min(confidence, 0.99)
+        return min(confidence, c['cap'])
 
     def _calculate_ddos_confidence(self, features: Dict) -> float:
         """計算 DDoS 的置信度"""
@@ -1008,17 +1128,17 @@ class AnomalyClassifier:
         avg_bytes = features.get('avg_bytes', 0)
         flow_rate = features.get('flow_rate', 0)
 
-        confidence = 0.7
+        c = SRC_CONFIDENCE['DDOS']
+        confidence = c['base']
 
-        if flow_count > 50000 or flow_rate > 100:
-            confidence += 0.2
-        elif flow_count > 20000 or flow_rate > 50:
-            confidence += 0.1
+        for min_flows, min_rate, bonus in c['flow_count_or_rate']:
+            if flow_count > min_flows or flow_rate > min_rate:
+                confidence += bonus
+                break
 
-        if avg_bytes < 300:
-            confidence += 0.1
+        confidence += _tier_bonus(avg_bytes, [c['avg_bytes']], below=True)
 
-        return min(confidence, 0.99)
+        return min(confidence, c['cap'])
 
     def _calculate_exfil_confidence(self, features: Dict, dst_ips: List[str]) -> float:
         """計算數據外洩的置信度"""
@@ -1027,47 +1147,50 @@ class AnomalyClassifier:
         dst_diversity = features.get('dst_diversity', 0)
         byte_rate = features.get('byte_rate', 0)
 
-        confidence = 0.7
+        c = SRC_CONFIDENCE['DATA_EXFILTRATION']
+        confidence = c['base']
 
-        # 流量越大，置信度越高
-        if total_bytes > 10e9 or byte_rate > 30e6:  # > 10GB or > 30MB/s
-            confidence += 0.15
-        elif total_bytes > 5e9 or byte_rate > 15e6:  # > 5GB or > 15MB/s
-            confidence += 0.1
+        # 流量越大，置信度越高（> 10GB 或 > 30MB/s；> 5GB 或 > 15MB/s）
+        for min_bytes, min_rate, bonus in c['total_bytes_or_rate']:
+            if total_bytes > min_bytes or byte_rate > min_rate:
+                confidence += bonus
+                break
 
         # 目的地越集中，置信度越高
+        max_dsts, few_dsts_bonus = c['few_dsts']
         if unique_dsts == 1:
-            confidence += 0.1
-        elif unique_dsts <= 3:
-            confidence += 0.05
+            confidence += c['single_dst']
+        elif unique_dsts <= max_dsts:
+            confidence += few_dsts_bonus
 
-        if dst_diversity < 0.05:
-            confidence += 0.05
+        confidence += _tier_bonus(dst_diversity, [c['dst_diversity']], below=True)
 
-        return min(confidence, 0.99)
+        return min(confidence, c['cap'])
 
     def _calculate_c2_confidence(self, features: Dict) -> float:
         """計算 C&C 通訊的置信度"""
         unique_dsts = features.get('unique_dsts', 0)
 
-        confidence = 0.6
+        c = SRC_CONFIDENCE['C2_COMMUNICATION']
+        confidence = c['base']
 
         # 單一目的地，置信度較高
         if unique_dsts == 1:
-            confidence += 0.2
+            confidence += c['single_dst']
 
         # 需要時間序列分析才能更準確判斷，這裡給較低置信度
-        return min(confidence, 0.85)
+        return min(confidence, c['cap'])
 
     def _calculate_normal_confidence(self, features: Dict, dst_ips: List[str], timestamp) -> float:
         """計算正常流量的置信度"""
         is_likely_server = features.get('is_likely_server_response', 0)
 
-        confidence = 0.5
+        c = SRC_CONFIDENCE['NORMAL_HIGH_TRAFFIC']
+        confidence = c['base']
 
         # 是服務器回應流量
         if is_likely_server == 1:
-            confidence += 0.3
+            confidence += c['server_response']
 
         # ✅ Phase 1: 明確識別為已知服務器類型
         is_known_server = any([
@@ -1078,18 +1201,18 @@ class AnomalyClassifier:
         ])
 
         if is_known_server:
-            confidence += 0.25  # 明確的服務器類型識別，高置信度
+            confidence += c['known_server']  # 明確的服務器類型識別，高置信度
 
         # 都是內部 IP
         if dst_ips and all(self._is_internal_ip(ip) for ip in dst_ips):
-            confidence += 0.2
+            confidence += c['all_internal']
 
         # 在備份時間
         hour = timestamp.hour if isinstance(timestamp, datetime) else 0
         if hour in self.backup_hours:
-            confidence += 0.1
+            confidence += c['backup_time']
 
-        return min(confidence, 0.95)
+        return min(confidence, c['cap'])
 
     # ========== 輔助方法 ==========
 
@@ -1253,39 +1376,11 @@ class AnomalyClassifier:
             SRC 視角的特徵資料，如果查無資料則返回 None
         """
         try:
-            # 解析時間桶，設定 ±6 分鐘的時間容錯
-            if isinstance(time_bucket, str):
-                bucket_time = datetime.fromisoformat(time_bucket.replace('Z', '+00:00'))
-            else:
-                bucket_time = time_bucket
-
-            # 移除時區資訊以便計算
-            if bucket_time.tzinfo:
-                bucket_time = bucket_time.replace(tzinfo=None)
-
-            time_start = (bucket_time - timedelta(minutes=6)).isoformat() + 'Z'
-            time_end = (bucket_time + timedelta(minutes=6)).isoformat() + 'Z'
-
-            # 查詢 SRC 視角資料
-            query = {
-                "size": 1,
-                "query": {
-                    "bool": {
-                        "must": [
-                            {"term": {"src_ip": ip}},
-                            {"range": {"time_bucket": {"gte": time_start, "lte": time_end}}}
-                        ]
-                    }
-                },
-                "sort": [{"time_bucket": {"order": "desc"}}]
-            }
+            query = self._build_src_perspective_query(ip, time_bucket)
 
             url = f"{self.es_host}/netflow_stats_3m_by_src/_search"
-            response = requests.post(
-                url,
-                json=query,
-                headers={"Content-Type": "application/json"},
-                timeout=5
+            response = get_transport().post(
+                url, json=query, timeout=5, caller='anomaly_classifier'
             )
 
             if response.status_code != 200:
@@ -1303,6 +1398,112 @@ class AnomalyClassifier:
             # 查詢失敗時靜默返回 None，不影響主流程
             return None
 
+    def _build_src_perspective_query(self, ip: str, time_bucket) -> Dict:
+        """建立 SRC 視角查詢（同一 IP、時間桶 ±6 分鐘內最新的一筆）"""
+        # 解析時間桶，設定 ±6 分鐘的時間容錯
+        if isinstance(time_bucket, str):
+            bucket_time = datetime.fromisoformat(time_bucket.replace('Z', '+00:00'))
+        else:
+            bucket_time = time_bucket
+
+        # 移除時區資訊以便計算
+        if bucket_time.tzinfo:
+            bucket_time = bucket_time.replace(tzinfo=None)
+
+        time_start = (bucket_time - timedelta(minutes=6)).isoformat() + 'Z'
+        time_end = (bucket_time + timedelta(minutes=6)).isoformat() + 'Z'
+
+        return {
+            "size": 1,
+            "query": {
+                "bool": {
+                    "must": [
+                        {"term": {"src_ip": ip}},
+                        {"range": {"time_bucket": {"gte": time_start, "lte": time_end}}}
+                    ]
+                }
+            },
+            "sort": [{"time_bucket": {"order": "desc"}}]
+        }
+
+    def prefetch_src_perspective(self, anomalies: List[Dict], batch_size: int = 200) -> int:
+        """
+        批次預取 DST 異常的 SRC 視角資料並填入快取
+
+        在分類開始前，以 _msearch 一次查詢本週期所有 (dst_ip, time_bucket)，
+        並依 classify_dst 相同的判斷寫入 _src_check_cache，
+        之後 classify_dst 直接命中快取，不再逐筆查詢 ES。
+
+        Args:
+            anomalies: DST 異常列表，每筆需包含 dst_ip、time_bucket、features
+            batch_size: 每次 _msearch 的查詢數
+
+        Returns:
+            寫入快取的筆數
+        """
+        # 只處理會觸發跨視角查詢、且尚未在快取中的項目（同一快取 key 只查一次）
+        pending = OrderedDict()
+        now = datetime.now()
+        min_ports = DST_RULE_LIMITS['SERVER_RESPONSE_TRAFFIC']['min_unique_dst_ports']
+        with self._src_check_cache_lock:
+            for anomaly in anomalies:
+                dst_ip = anomaly.get('dst_ip')
+                time_bucket = anomaly.get('time_bucket')
+                features = anomaly.get('features', {})
+                if not dst_ip or not time_bucket or features.get('unique_dst_ports', 0) <= min_ports:
+                    continue
+                cache_key = self._get_cache_key(dst_ip, time_bucket)
+                cached = self._src_check_cache.get(cache_key)
+                if cached and (now - cached['timestamp']).total_seconds() < self._src_check_cache_ttl:
+                    continue
+                if cache_key in pending:
+                    continue
+                try:
+                    query = self._build_src_perspective_query(dst_ip, time_bucket)
+                except (ValueError, TypeError, AttributeError):
+                    continue
+                pending[cache_key] = (dst_ip, time_bucket, features, query)
+
+        items = list(pending.values())
+        if len(items) > self._src_check_cache_max_size:
+            # 超過快取容量的部分會被 LRU 淘汰，留給 classify_dst 個別查詢
+            items = items[:self._src_check_cache_max_size]
+
+        filled = 0
+        for start in range(0, len(items), batch_size):
+            batch = items[start:start + batch_size]
+
+            searches = [("netflow_stats_3m_by_src", query) for _, _, _, query in batch]
+
+            try:
+                responses = get_transport().msearch(
+                    self.es_host, searches, timeout=10, caller='anomaly_classifier'
+                )
+            except Exception:
+                # 預取失敗不影響主流程，classify_dst 會退回個別查詢
+                continue
+
+            for (dst_ip, time_bucket, features, _), result in zip(batch, responses):
+                if 'error' in result:
+                    continue
+
+                hits = result.get('hits', {}).get('hits', [])
+                if not hits:
+                    self._update_src_cache(dst_ip, time_bucket, 'NO_DATA')
+                else:
+                    src_features = hits[0].get('_source', {})
+                    if self._is_server_response_traffic(features, src_features):
+                        self._update_src_cache(dst_ip, time_bucket, 'SERVER_RESPONSE', src_features)
+                    else:
+                        self._update_src_cache(dst_ip, time_bucket, 'NOT_SERVER', src_features)
+                filled += 1
+
+        if items:
+            post_process_logger.info(
+                f"[SRC_PREFETCH] requested={len(items)}, cached={filled}"
+            )
+        return filled
+
     def _is_server_response_traffic(self, dst_features: Dict, src_features: Dict) -> bool:
         """
         判斷 DST 視角的流量是否實際上是伺服器回應流量
@@ -1713,7 +1914,8 @@ class AnomalyClassifier:
         unique_srcs = features.get('unique_srcs', 0)
         flow_count = features.get('flow_count', 0)
 
-        if unique_dst_ports > 20 and dst_ip != 'unknown' and time_bucket:
+        min_ports = DST_RULE_LIMITS['SERVER_RESPONSE_TRAFFIC']['min_unique_dst_ports']
+        if unique_dst_ports > min_ports and dst_ip != 'unknown' and time_bucket:
             # ===== 先檢查快取 =====
             cached_result = self._check_src_cache(dst_ip, time_bucket)
 
@@ -1728,7 +1930,8 @@ class AnomalyClassifier:
                 if cache_result_type == 'SERVER_RESPONSE':
                     # 從快取中取得 src_features
                     context['src_perspective'] = cached_result.get('src_features', {})
-                    return self._create_classification('SERVER_RESPONSE_TRAFFIC', 0.90, features, context)
+                    return self._create_classification(
+                        'SERVER_RESPONSE_TRAFFIC', DST_CONFIDENCE['SERVER_RESPONSE_TRAFFIC'], features, context)
                 # 如果是 'NOT_SERVER' 或 'NO_DATA'，繼續後續分類邏輯
 
             else:
@@ -1761,7 +1964,8 @@ class AnomalyClassifier:
                             f"[FALSE_POSITIVE_EXCLUDED] dst_ip={dst_ip}, reason=SERVER_RESPONSE_TRAFFIC, "
                             f"dst_unique_ports={unique_dst_ports}, src_unique_dsts={src_unique_dsts}"
                         )
-                        return self._create_classification('SERVER_RESPONSE_TRAFFIC', 0.90, features, context)
+                        return self._create_classification(
+                            'SERVER_RESPONSE_TRAFFIC', DST_CONFIDENCE['SERVER_RESPONSE_TRAFFIC'], features, context)
                     else:
                         # 更新快取（非伺服器回應）
                         self._update_src_cache(dst_ip, time_bucket, 'NOT_SERVER', src_features)
@@ -1780,34 +1984,34 @@ class AnomalyClassifier:
 
         # 1. 掃描回應流量（優先判斷，避免誤判為 DDoS）
         if self._is_scan_response(features, context):
-            return self._create_classification('SCAN_RESPONSE', 0.90, features, context)
+            return self._create_classification('SCAN_RESPONSE', DST_CONFIDENCE['SCAN_RESPONSE'], features, context)
 
         # 2. DDoS 攻擊目標
         if self._is_ddos_target(features, context):
-            return self._create_classification('DDOS_TARGET', 0.95, features, context)
+            return self._create_classification('DDOS_TARGET', DST_CONFIDENCE['DDOS_TARGET'], features, context)
 
         # 3. 掃描目標
         if self._is_scan_target(features, context):
-            return self._create_classification('SCAN_TARGET', 0.90, features, context)
+            return self._create_classification('SCAN_TARGET', DST_CONFIDENCE['SCAN_TARGET'], features, context)
 
         # 4. 資料外洩目標端
         if self._is_data_sink(features, context):
-            return self._create_classification('DATA_SINK', 0.85, features, context)
+            return self._create_classification('DATA_SINK', DST_CONFIDENCE['DATA_SINK'], features, context)
 
         # 5. 惡意軟體分發服務器
         if self._is_malware_distribution(features, context):
-            return self._create_classification('MALWARE_DISTRIBUTION', 0.80, features, context)
+            return self._create_classification('MALWARE_DISTRIBUTION', DST_CONFIDENCE['MALWARE_DISTRIBUTION'], features, context)
 
         # 6. 熱門服務器（內部服務）
         if self._is_popular_server(features, context):
-            return self._create_classification('POPULAR_SERVER', 0.70, features, context)
+            return self._create_classification('POPULAR_SERVER', DST_CONFIDENCE['POPULAR_SERVER'], features, context)
 
         # 7. 正常 DST 流量（少量來源的點對點通訊）
         if self._is_normal_dst_traffic(features, context):
-            return self._create_classification('NORMAL_DST_TRAFFIC', 0.85, features, context)
+            return self._create_classification('NORMAL_DST_TRAFFIC', DST_CONFIDENCE['NORMAL_DST_TRAFFIC'], features, context)
 
         # 8. 未知 dst 異常
-        return self._create_classification('UNKNOWN', 0.50, features, context)
+        return self._create_classification('UNKNOWN', DST_CONFIDENCE['UNKNOWN'], features, context)
 
     def _is_scan_response(self, features: Dict, context: Dict) -> bool:
         """判斷是否為掃描回應流量"""
@@ -1821,11 +2025,12 @@ class AnomalyClassifier:
         # 2. 大量不同的本地端口（掃描器隨機分配的本地端口）
         # 3. 每個來源僅少量連線（通常 1-3 個，因為是掃描探測回應）
         # 4. 小封包（探測回應）
+        limits = DST_RULE_LIMITS['SCAN_RESPONSE']
         return (
-            unique_srcs > 50 and
-            unique_dst_ports > 100 and
-            flows_per_src < 5 and
-            avg_bytes < 2000
+            unique_srcs > limits['min_unique_srcs'] and
+            unique_dst_ports > limits['min_unique_dst_ports'] and
+            flows_per_src < limits['max_flows_per_src'] and
+            avg_bytes < limits['max_avg_bytes']
         )
 
     def _is_ddos_target(self, features: Dict, context: Dict) -> bool:
@@ -1837,19 +2042,16 @@ class AnomalyClassifier:
         flows_per_src = features.get('flows_per_src', 1)
 
         # 從配置讀取閾值
-        config = self.dst_thresholds.get('DDOS_TARGET', {})
-        if not config.get('enabled', True):
+        enabled, thresholds = self._dst_rule('DDOS_TARGET')
+        if not enabled:
             return False
 
-        thresholds = config.get('thresholds', {})
-        threshold_srcs = thresholds.get('unique_srcs', 100)
-        threshold_flows = thresholds.get('flow_count', 1000)
-        threshold_bytes = thresholds.get('avg_bytes', 500)
-
         # ⚠️ 排除掃描回應流量：
-        # 如果有大量不同的目標端口 (> 100) 且每個來源平均連線少 (< 5)
+        # 如果有大量不同的目標端口且每個來源平均連線少
         # 這是掃描後的回應流量，不是 DDoS
-        is_scan_response = (unique_dst_ports > 100 and flows_per_src < 5)
+        limits = DST_RULE_LIMITS['SCAN_RESPONSE']
+        is_scan_response = (unique_dst_ports > limits['min_unique_dst_ports'] and
+                            flows_per_src < limits['max_flows_per_src'])
 
         if is_scan_response:
             return False
@@ -1860,9 +2062,9 @@ class AnomalyClassifier:
         # 3. 小封包 - SYN flood 特徵
         # 4. 不是掃描回應流量
         return (
-            unique_srcs > threshold_srcs and
-            flow_count > threshold_flows and
-            avg_bytes < threshold_bytes
+            unique_srcs > thresholds['unique_srcs'] and
+            flow_count > thresholds['flow_count'] and
+            avg_bytes < thresholds['avg_bytes']
         )
 
     def _is_scan_target(self, features: Dict, context: Dict) -> bool:
@@ -1872,23 +2074,18 @@ class AnomalyClassifier:
         avg_bytes = features.get('avg_bytes', 0)
 
         # 從配置讀取閾值
-        config = self.dst_thresholds.get('SCAN_TARGET', {})
-        if not config.get('enabled', True):
+        enabled, thresholds = self._dst_rule('SCAN_TARGET')
+        if not enabled:
             return False
 
-        thresholds = config.get('thresholds', {})
-        threshold_src_ports = thresholds.get('unique_src_ports', 100)
-        threshold_dst_ports = thresholds.get('unique_dst_ports', 50)
-        threshold_bytes = thresholds.get('avg_bytes', 2000)
-
         # 掃描目標特徵：
         # 1. 大量不同來源端口 - 掃描器隨機化來源端口
         # 2. 多個目標端口被探測
         # 3. 小封包（探測性質）
         return (
-            unique_src_ports > threshold_src_ports and
-            unique_dst_ports > threshold_dst_ports and
-            avg_bytes < threshold_bytes
+            unique_src_ports > thresholds['unique_src_ports'] and
+            unique_dst_ports > thresholds['unique_dst_ports'] and
+            avg_bytes < thresholds['avg_bytes']
         )
 
     def _is_data_sink(self, features: Dict, context: Dict) -> bool:
@@ -1899,23 +2096,18 @@ class AnomalyClassifier:
         dst_ip = context.get('dst_ip', '')
 
         # 從配置讀取閾值
-        config = self.dst_thresholds.get('DATA_SINK', {})
-        if not config.get('enabled', True):
+        enabled, thresholds = self._dst_rule('DATA_SINK')
+        if not enabled:
             return False
 
-        thresholds = config.get('thresholds', {})
-        threshold_srcs = thresholds.get('unique_srcs', 10)
-        threshold_bytes = thresholds.get('total_bytes', 100000000)  # 100MB
-        threshold_avg_bytes = thresholds.get('avg_bytes', 10000)
-
         # 資料外洩目標端特徵：
         # 1. 多個內部來源
         # 2. 大流量
         # 3. 目標是外部 IP
         return (
-            unique_srcs > threshold_srcs and
-            total_bytes > threshold_bytes and
-            avg_bytes > threshold_avg_bytes and
+            unique_srcs > thresholds['unique_srcs'] and
+            total_bytes > thresholds['total_bytes'] and
+            avg_bytes > thresholds['avg_bytes'] and
             not self._is_internal_ip(dst_ip)
         )
 
@@ -1927,24 +2119,19 @@ class AnomalyClassifier:
         dst_ip = context.get('dst_ip', '')
 
         # 從配置讀取閾值
-        config = self.dst_thresholds.get('MALWARE_DISTRIBUTION', {})
-        if not config.get('enabled', True):
+        enabled, thresholds = self._dst_rule('MALWARE_DISTRIBUTION')
+        if not enabled:
             return False
 
-        thresholds = config.get('thresholds', {})
-        threshold_srcs = thresholds.get('unique_srcs', 5)
-        threshold_bytes = thresholds.get('total_bytes', 50000000)  # 50MB
-        threshold_flows_per_src = thresholds.get('flows_per_src', 10)
-
         # 惡意軟體分發特徵：
         # 1. 多個內部來源下載
         # 2. 大流量入站
         # 3. 每個來源連線次數少 - 下載後就斷開
         # 4. 目標是外部 IP
         return (
-            unique_srcs > threshold_srcs and
-            total_bytes > threshold_bytes and
-            flows_per_src < threshold_flows_per_src and
+            unique_srcs > thresholds['unique_srcs'] and
+            total_bytes > thresholds['total_bytes'] and
+            flows_per_src < thresholds['flows_per_src'] and
             not self._is_internal_ip(dst_ip)
         )
 
@@ -1955,22 +2142,17 @@ class AnomalyClassifier:
         dst_ip = context.get('dst_ip', '')
 
         # 從配置讀取閾值
-        config = self.dst_thresholds.get('POPULAR_SERVER', {})
-        if not config.get('enabled', True):
+        enabled, thresholds = self._dst_rule('POPULAR_SERVER')
+        if not enabled:
             return False
 
-        thresholds = config.get('thresholds', {})
-        threshold_srcs = thresholds.get('unique_srcs', 20)
-        threshold_bytes_min = thresholds.get('avg_bytes_min', 500)
-        threshold_bytes_max = thresholds.get('avg_bytes_max', 50000)
-
         # 熱門服務器特徵：
         # 1. 大量內部來源訪問
         # 2. 正常封包大小
         # 3. 目標是內部 IP
         return (
-            unique_srcs > threshold_srcs and
-            threshold_bytes_min < avg_bytes < threshold_bytes_max and
+            unique_srcs > thresholds['unique_srcs'] and
+            thresholds['avg_bytes_min'] < avg_bytes < thresholds['avg_bytes_max'] and
             self._is_internal_ip(dst_ip)
         )
 
@@ -1996,15 +2178,8 @@ class AnomalyClassifier:
         unique_dst_ports = features.get('unique_dst_ports', 0)
         dst_ip = context.get('dst_ip', '')
 
-        # 從配置讀取閾值（如果有的話）
-        config = self.dst_thresholds.get('NORMAL_DST_TRAFFIC', {})
-        thresholds = config.get('thresholds', {})
-
-        threshold_srcs_max = thresholds.get('unique_srcs_max', 3)
-        threshold_bytes_min = thresholds.get('avg_bytes_min', 500)
-        threshold_bytes_max = thresholds.get('avg_bytes_max', 100000)
-        threshold_flows_max = thresholds.get('flow_count_max', 100)
-        threshold_ports_max = thresholds.get('unique_dst_ports_max', 10)
+        # 從配置讀取閾值（如果有的話；此規則無 enabled 開關）
+        _, thresholds = self._dst_rule('NORMAL_DST_TRAFFIC')
 
         # 正常 DST 流量特徵：
         # 1. 少量來源（1-3 個）- 不是 DDoS 或分散式攻擊
@@ -2013,9 +2188,346 @@ class AnomalyClassifier:
         # 4. 少量服務埠（< 10）- 正常服務使用模式
         # 5. 內部 IP - 內網正常通訊
         return (
-            1 <= unique_srcs <= threshold_srcs_max and
-            threshold_bytes_min < avg_bytes < threshold_bytes_max and
-            flow_count < threshold_flows_max and
-            unique_dst_ports < threshold_ports_max and
+            1 <= unique_srcs <= thresholds['unique_srcs_max'] and
+            thresholds['avg_bytes_min'] < avg_bytes < thresholds['avg_bytes_max'] and
+            flow_count < thresholds['flow_count_max'] and
+            unique_dst_ports < thresholds['unique_dst_ports_max'] and
             self._is_internal_ip(dst_ip)
         )
+
+    # ========== 批次分類（向量化） ==========
+
+    @staticmethod
+    def _as_columns(features, feature_names: Optional[List[str]] = None) -> Tuple[Dict[str, np.ndarray], int]:
+        """將特徵矩陣或欄位字典轉為 {特徵名稱: 陣列}"""
+        if isinstance(features, dict):
+            columns = {name: np.asarray(values, dtype=np.float64) for name, values in features.items()}
+            n = len(next(iter(columns.values()))) if columns else 0
+        else:
+            matrix = np.asarray(features, dtype=np.float64)
+            if feature_names is None or matrix.ndim != 2 or matrix.shape[1] != len(feature_names):
+                raise ValueError("特徵矩陣需搭配長度相符的 feature_names")
+            columns = {name: matrix[:, i] for i, name in enumerate(feature_names)}
+            n = len(matrix)
+        return columns, n
+
+    def _batch_hours(self, timestamps: Optional[List], n: int) -> np.ndarray:
+        """各筆的小時（同 classify：非 datetime 視為 0，未提供時使用目前時間）"""
+        if timestamps is None:
+            return np.full(n, datetime.now().hour)
+        return np.array([ts.hour if isinstance(ts, datetime) else 0 for ts in timestamps])
+
+    def classify_batch(self, features, feature_names: Optional[List[str]] = None,
+                       dst_ips: Optional[List[List[str]]] = None,
+                       timestamps: Optional[List] = None) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Src 視角的批次分類（與 classify 逐筆結果一致）
+
+        每條規則以布林遮罩計算，依 classify 相同的優先順序指定類別，
+        置信度也以相同的加總順序向量化計算。
+
+        Args:
+            features: 特徵矩陣 (n_samples, n_features) 或 {特徵名稱: 陣列}
+            feature_names: 特徵矩陣的欄位名稱
+            dst_ips: 每筆的目的地 IP 列表（對應 context['dst_ips']）
+            timestamps: 每筆的時間戳（對應 context['timestamp']）
+
+        Returns:
+            (classes, confidences)：類別名稱陣列與置信度陣列
+        """
+        cols, n = self._as_columns(features, feature_names)
+
+        def col(name, default=0):
+            return cols[name] if name in cols else np.full(n, float(default))
+
+        flow_count = col('flow_count')
+        unique_dsts = col('unique_dsts')
+        unique_dst_ports = col('unique_dst_ports')
+        total_bytes = col('total_bytes')
+        avg_bytes = col('avg_bytes')
+        dst_diversity = col('dst_diversity')
+        dst_port_diversity = col('dst_port_diversity')
+        flow_rate = col('flow_rate')
+        byte_rate = col('byte_rate')
+        common_ports_ratio = col('common_ports_ratio')
+        top_dst_port_concentration = col('top_dst_port_concentration')
+        top_src_port_concentration = col('top_src_port_concentration')
+        dst_well_known_ratio = col('dst_well_known_ratio')
+        dst_registered_ratio = col('dst_registered_ratio')
+        dst_ephemeral_ratio = col('dst_ephemeral_ratio')
+        has_sequential = col('has_sequential_dst_ports')
+
+        is_known_server = (
+            (col('is_likely_web_server') == 1) | (col('is_likely_dns_server') == 1) |
+            (col('is_likely_db_server') == 1) | (col('is_likely_mail_server') == 1)
+        )
+        is_likely_server = col('is_likely_server_response') == 1
+
+        if dst_ips is None:
+            dst_ips = [[]] * n
+        has_external = np.array([
+            any(not self._is_internal_ip(ip) for ip in ips) if ips else False for ips in dst_ips
+        ], dtype=bool)
+        all_internal = np.array([
+            all(self._is_internal_ip(ip) for ip in ips) if ips else False for ips in dst_ips
+        ], dtype=bool)
+        is_backup_time = np.isin(self._batch_hours(timestamps, n), list(self.backup_hours))
+
+        masks, confidences = [], []
+
+        # 1. PORT_SCAN
+        enabled, t = self._src_rule('PORT_SCAN')
+        limits, c = SRC_RULE_LIMITS['PORT_SCAN'], SRC_CONFIDENCE['PORT_SCAN']
+        mask = ((has_sequential == 1) & (unique_dst_ports > limits['sequential_min_ports'])) | (
+            (unique_dst_ports > t['unique_dst_ports']) &
+            (avg_bytes < t['avg_bytes']) &
+            (dst_port_diversity > t['dst_port_diversity']) &
+            (unique_dsts < limits['max_unique_dsts']) &
+            (top_dst_port_concentration < limits['max_top_dst_port_concentration'])
+        )
+        conf = np.full(n, c['base'])
+        conf += np.where(has_sequential == 1, c['sequential'], 0.0)
+        conf += _tier_bonus_batch(unique_dst_ports, c['unique_dst_ports'])
+        conf += _tier_bonus_batch(dst_port_diversity, c['dst_port_diversity'])
+        conf += _tier_bonus_batch(avg_bytes, c['avg_bytes'], below=True)
+        masks.append(('PORT_SCAN', mask & enabled))
+        confidences.append(np.minimum(conf, c['cap']))
+
+        # 2. NETWORK_SCAN
+        enabled, t = self._src_rule('NETWORK_SCAN')
+        limits, c = SRC_RULE_LIMITS['NETWORK_SCAN'], SRC_CONFIDENCE['NETWORK_SCAN']
+        many_dsts = unique_dsts > t['unique_dsts']
+        is_basic_scan = (
+            many_dsts &
+            (dst_diversity > t['dst_diversity']) &
+            (flow_count > t['flow_count']) &
+            (avg_bytes < t['avg_bytes'])
+        )
+        has_scan_port_pattern = (
+            (top_dst_port_concentration > limits['min_top_dst_port_concentration']) &
+            (dst_well_known_ratio > limits['min_dst_well_known_ratio']) &
+            (top_src_port_concentration < limits['max_top_src_port_concentration'])
+        )
+        conf = np.full(n, c['base'])
+        conf += _tier_bonus_batch(unique_dsts, c['unique_dsts'])
+        conf += _tier_bonus_batch(dst_diversity, c['dst_diversity'])
+        conf += _tier_bonus_batch(dst_well_known_ratio, c['dst_well_known_ratio'])
+        conf += _tier_bonus_batch(top_dst_port_concentration, [c['top_dst_port_concentration']])
+        conf += _tier_bonus_batch(top_src_port_concentration, [c['top_src_port_concentration']], below=True)
+        masks.append(('NETWORK_SCAN', (is_basic_scan | (many_dsts & has_scan_port_pattern)) & enabled))
+        confidences.append(np.minimum(conf, c['cap']))
+
+        # 3. DNS_TUNNELING
+        enabled, t = self._src_rule('DNS_TUNNELING')
+        limits, c = SRC_RULE_LIMITS['DNS_TUNNELING'], SRC_CONFIDENCE['DNS_TUNNELING']
+        mask = (
+            (flow_count > t['flow_count']) &
+            (unique_dst_ports <= t['unique_dst_ports']) &
+            (avg_bytes < t['avg_bytes']) &
+            (unique_dsts <= t['unique_dsts']) &
+            (top_dst_port_concentration > limits['min_top_dst_port_concentration'])
+        )
+        conf = np.full(n, c['base'])
+        conf += np.where(unique_dst_ports == 1, c['single_port'], 0.0)
+        conf += _tier_bonus_batch(flow_count, [c['flow_count']])
+        masks.append(('DNS_TUNNELING', mask & enabled))
+        confidences.append(np.minimum(conf, c['cap']))
+
+        # 4. DDOS
+        enabled, t = self._src_rule('DDOS')
+        c = SRC_CONFIDENCE['DDOS']
+        mask = (
+            ((flow_count > t['flow_count']) | (flow_rate > t['flow_rate'])) &
+            (avg_bytes < t['avg_bytes']) &
+            (unique_dsts < t['unique_dsts'])
+        )
+        conf = np.full(n, c['base'])
+        conf += np.select(
+            [(flow_count > min_flows) | (flow_rate > min_rate) for min_flows, min_rate, _ in c['flow_count_or_rate']],
+            [bonus for _, _, bonus in c['flow_count_or_rate']], 0.0)
+        conf += _tier_bonus_batch(avg_bytes, [c['avg_bytes']], below=True)
+        masks.append(('DDOS', mask & enabled))
+        confidences.append(np.minimum(conf, c['cap']))
+
+        # 5. DATA_EXFILTRATION
+        enabled, t = self._src_rule('DATA_EXFILTRATION')
+        limits, c = SRC_RULE_LIMITS['DATA_EXFILTRATION'], SRC_CONFIDENCE['DATA_EXFILTRATION']
+        uses_non_standard_ports = (
+            ((dst_registered_ratio > limits['min_dst_registered_ratio']) |
+             (dst_ephemeral_ratio > limits['min_dst_ephemeral_ratio'])) &
+            (dst_well_known_ratio < limits['max_dst_well_known_ratio'])
+        )
+        mask = (
+            ((total_bytes > t['total_bytes']) | (byte_rate > t['byte_rate'])) &
+            (unique_dsts <= t['unique_dsts']) &
+            (dst_diversity < t['dst_diversity']) &
+            has_external & uses_non_standard_ports
+        )
+        conf = np.full(n, c['base'])
+        conf += np.select(
+            [(total_bytes > min_bytes) | (byte_rate > min_rate) for min_bytes, min_rate, _ in c['total_bytes_or_rate']],
+            [bonus for _, _, bonus in c['total_bytes_or_rate']], 0.0)
+        max_dsts, few_dsts_bonus = c['few_dsts']
+        conf += np.select([unique_dsts == 1, unique_dsts <= max_dsts], [c['single_dst'], few_dsts_bonus], 0.0)
+        conf += _tier_bonus_batch(dst_diversity, [c['dst_diversity']], below=True)
+        masks.append(('DATA_EXFILTRATION', mask & enabled))
+        confidences.append(np.minimum(conf, c['cap']))
+
+        # 6. C2_COMMUNICATION
+        enabled, t = self._src_rule('C2_COMMUNICATION')
+        limits, c = SRC_RULE_LIMITS['C2_COMMUNICATION'], SRC_CONFIDENCE['C2_COMMUNICATION']
+        mask = (
+            (unique_dsts == t['unique_dsts']) &
+            (flow_count > t['flow_count_min']) & (flow_count < t['flow_count_max']) &
+            (avg_bytes > t['avg_bytes_min']) & (avg_bytes < t['avg_bytes_max']) &
+            (unique_dst_ports <= limits['max_unique_dst_ports']) &
+            ((dst_registered_ratio > limits['min_dst_registered_ratio']) |
+             (dst_ephemeral_ratio > limits['min_dst_ephemeral_ratio']))
+        )
+        conf = np.full(n, c['base'])
+        conf += np.where(unique_dsts == 1, c['single_dst'], 0.0)
+        masks.append(('C2_COMMUNICATION', mask & enabled))
+        confidences.append(np.minimum(conf, c['cap']))
+
+        # 7. NORMAL_HIGH_TRAFFIC
+        enabled, t = self._src_rule('NORMAL_HIGH_TRAFFIC')
+        limits, c = SRC_RULE_LIMITS['NORMAL_HIGH_TRAFFIC'], SRC_CONFIDENCE['NORMAL_HIGH_TRAFFIC']
+        mask = (
+            (total_bytes > t['total_bytes']) &
+            (all_internal | is_likely_server | is_known_server |
+             (dst_ephemeral_ratio > limits['min_dst_ephemeral_ratio']) | is_backup_time) &
+            (unique_dsts > t['unique_dsts_min']) & (unique_dsts < t['unique_dsts_max'])
+        )
+        conf = np.full(n, c['base'])
+        conf += np.where(is_likely_server, c['server_response'], 0.0)
+        conf += np.where(is_known_server, c['known_server'], 0.0)
+        conf += np.where(all_internal, c['all_internal'], 0.0)
+        conf += np.where(is_backup_time, c['backup_time'], 0.0)
+        masks.append(('NORMAL_HIGH_TRAFFIC', mask & enabled))
+        confidences.append(np.minimum(conf, c['cap']))
+
+        # 8. UNKNOWN
+        masks.append(('UNKNOWN', np.ones(n, dtype=bool)))
+        confidences.append(np.full(n, SRC_CONFIDENCE['UNKNOWN']['base']))
+
+        return self._select_by_priority(masks, confidences)
+
+    def classify_dst_batch(self, features, feature_names: Optional[List[str]] = None,
+                           dst_ips: Optional[List[str]] = None) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Dst 視角的批次分類（與 classify_dst 的規則鏈一致）
+
+        不包含需要查詢 ES 的跨視角伺服器回應檢查，適用於離線重播與閾值調校。
+
+        Args:
+            features: 特徵矩陣 (n_samples, n_features) 或 {特徵名稱: 陣列}
+            feature_names: 特徵矩陣的欄位名稱
+            dst_ips: 每筆的目標 IP（對應 context['dst_ip']）
+
+        Returns:
+            (classes, confidences)：類別名稱陣列與置信度陣列
+        """
+        cols, n = self._as_columns(features, feature_names)
+
+        def col(name, default=0):
+            return cols[name] if name in cols else np.full(n, float(default))
+
+        unique_srcs = col('unique_srcs')
+        unique_src_ports = col('unique_src_ports')
+        unique_dst_ports = col('unique_dst_ports')
+        flow_count = col('flow_count')
+        total_bytes = col('total_bytes')
+        avg_bytes = col('avg_bytes')
+
+        if dst_ips is None:
+            dst_ips = [''] * n
+        is_internal = np.array([self._is_internal_ip(ip) for ip in dst_ips], dtype=bool)
+
+        flows_per_src = col('flows_per_src', 1)
+        limits = DST_RULE_LIMITS['SCAN_RESPONSE']
+        masks = []
+
+        # 1. SCAN_RESPONSE
+        masks.append(('SCAN_RESPONSE', (
+            (unique_srcs > limits['min_unique_srcs']) & (unique_dst_ports > limits['min_unique_dst_ports']) &
+            (flows_per_src < limits['max_flows_per_src']) & (avg_bytes < limits['max_avg_bytes'])
+        )))
+
+        # 2. DDOS_TARGET
+        enabled, t = self._dst_rule('DDOS_TARGET')
+        is_scan_response = (
+            (unique_dst_ports > limits['min_unique_dst_ports']) & (flows_per_src < limits['max_flows_per_src'])
+        )
+        masks.append(('DDOS_TARGET', enabled & ~is_scan_response & (
+            (unique_srcs > t['unique_srcs']) &
+            (flow_count > t['flow_count']) &
+            (avg_bytes < t['avg_bytes'])
+        )))
+
+        # 3. SCAN_TARGET
+        enabled, t = self._dst_rule('SCAN_TARGET')
+        masks.append(('SCAN_TARGET', enabled & (
+            (unique_src_ports > t['unique_src_ports']) &
+            (unique_dst_ports > t['unique_dst_ports']) &
+            (avg_bytes < t['avg_bytes'])
+        )))
+
+        # 4. DATA_SINK
+        enabled, t = self._dst_rule('DATA_SINK')
+        masks.append(('DATA_SINK', enabled & (
+            (unique_srcs > t['unique_srcs']) &
+            (total_bytes > t['total_bytes']) &
+            (avg_bytes > t['avg_bytes']) &
+            ~is_internal
+        )))
+
+        # 5. MALWARE_DISTRIBUTION
+        enabled, t = self._dst_rule('MALWARE_DISTRIBUTION')
+        masks.append(('MALWARE_DISTRIBUTION', enabled & (
+            (unique_srcs > t['unique_srcs']) &
+            (total_bytes > t['total_bytes']) &
+            (col('flows_per_src') < t['flows_per_src']) &
+            ~is_internal
+        )))
+
+        # 6. POPULAR_SERVER
+        enabled, t = self._dst_rule('POPULAR_SERVER')
+        masks.append(('POPULAR_SERVER', enabled & (
+            (unique_srcs > t['unique_srcs']) &
+            (avg_bytes > t['avg_bytes_min']) & (avg_bytes < t['avg_bytes_max']) &
+            is_internal
+        )))
+
+        # 7. NORMAL_DST_TRAFFIC（此規則無 enabled 開關）
+        _, t = self._dst_rule('NORMAL_DST_TRAFFIC')
+        masks.append(('NORMAL_DST_TRAFFIC', (
+            (unique_srcs >= 1) & (unique_srcs <= t['unique_srcs_max']) &
+            (avg_bytes > t['avg_bytes_min']) & (avg_bytes < t['avg_bytes_max']) &
+            (flow_count < t['flow_count_max']) &
+            (unique_dst_ports < t['unique_dst_ports_max']) &
+            is_internal
+        )))
+
+        # 8. UNKNOWN
+        masks.append(('UNKNOWN', np.ones(n, dtype=bool)))
+
+        return self._select_by_priority(
+            masks, [np.full(n, DST_CONFIDENCE[name]) for name, _ in masks]
+        )
+
+    @staticmethod
+    def _select_by_priority(masks: List[Tuple[str, np.ndarray]],
+                            confidences: List[np.ndarray]) -> Tuple[np.ndarray, np.ndarray]:
+        """依優先順序取第一個成立的規則（最後一條規則需恆為 True）"""
+        n = len(masks[0][1])
+        classes = np.empty(n, dtype=object)
+        result_confidence = np.empty(n, dtype=np.float64)
+        remaining = np.ones(n, dtype=bool)
+
+        for (name, mask), confidence in zip(masks, confidences):
+            hit = remaining & mask
+            classes[hit] = name
+            result_confidence[hit] = confidence[hit]
+            remaining &= ~hit
+
+        return classes, result_confidence
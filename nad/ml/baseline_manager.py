@@ -9,15 +9,34 @@
 2. 偵測當前行為是否偏離基準線
 3. 計算偏離的嚴重程度
 4. 支援多種統計指標的基準線
+5. 批次建立所有 IP 的基準線（composite 聚合）並存檔，
+   實時偵測只需查表（build_baselines.py）
+6. 增量模式：每個週期以新的聚合記錄更新串流統計，不需重新查詢歷史數據；
+   串流統計存放在獨立的 SQLite，每個週期只寫入有更新的 IP
+7. 基準線存放在記憶體 LRU + SQLite 的 BaselineStore，重啟後直接沿用
+8. 週期性基準線：每個 IP 每個指標 168 個「星期幾 × 小時」時段，
+   偏離檢查與對應時段比較
 """
 
-import requests
+import base64
 import json
+import os
 import numpy as np
 from typing import Dict, List, Optional
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
 from collections import defaultdict
 
+from ..utils.es_transport import get_transport
+from .baseline_store import BaselineStore, DEFAULT_BASELINE_DB_PATH
+from .streaming_stats import RunningMetric
+
+
+# build_baselines.py 預設的基準線存檔路徑
+DEFAULT_BASELINE_STORE_PATH = "nad/state/baselines.json"
+
+# 增量模式的串流統計（SQLite，記憶體 LRU 與基準線相同上限）
+DEFAULT_STREAMING_DB_PATH = "nad/state/baseline_streaming.db"
+
 
 class BaselineManager:
     """
@@ -26,28 +45,111 @@ class BaselineManager:
     管理每個 IP 的正常行為模式，用於偵測異常偏離。
     """
 
-    def __init__(self, es_host="http://localhost:9200", learning_days=7):
+    # 與實時偵測的特徵相同，使用 3 分鐘 by_src 聚合
+    HISTORY_INDEX = "netflow_stats_3m_by_src"
+
+    # 基準線統計的指標
+    BASELINE_METRICS = [
+        'unique_dst_ports', 'unique_dsts', 'flow_count',
+        'avg_bytes', 'total_bytes', 'unique_src_ports'
+    ]
+
+    # 基準線最少需要的樣本數
+    MIN_SAMPLES = 10
+
+    # 週期性基準線：每週 168 個時段（星期一 00:00 為 0），只針對 check_deviation 檢查的指標
+    SEASONAL_SLOTS = 168
+    SEASONAL_METRICS = ['unique_dst_ports', 'unique_dsts', 'flow_count', 'avg_bytes']
+    # 時段內至少需要的記錄數，不足時使用整體基準線
+    SEASONAL_MIN_SLOT_SAMPLES = 5
+    # 每個時段存放的統計（與 _check_metric_deviation 使用的欄位相同）
+    SEASONAL_STATS = ['mean', 'std', 'max', 'p95', 'p99']
+
+    STORE_FORMAT_VERSION = 1
+
+    def __init__(self, es_host="http://localhost:9200", learning_days=7,
+                 store_path: Optional[str] = None, incremental: bool = False,
+                 ewma_alpha: float = 0.05, db_path: Optional[str] = None,
+                 max_memory_entries: int = 50000, ttl_hours: Optional[float] = None,
+                 utc_offset_hours: int = 8, streaming_db_path: Optional[str] = None):
         """
         初始化基準線管理器
 
         Args:
             es_host: Elasticsearch 主機地址
             learning_days: 學習期（天數），默認 7 天
+            store_path: 批次建立的基準線檔案（可選）；載入成功後只查表，
+                不再對缺少基準線的 IP 即時查詢 ES
+            incremental: 是否啟用增量模式（update_baselines）
+            ewma_alpha: 增量模式中 EWMA 的平滑係數
+            db_path: 基準線的 SQLite 檔案（None 表示不落地，重啟後重新學習）
+            max_memory_entries: 記憶體中最多保留的基準線數（其餘在 SQLite）
+            ttl_hours: 即時學習的基準線有效期，過期後重新學習（None 表示不過期）
+            utc_offset_hours: 週期性基準線的時區（默認 UTC+8，Asia/Taipei）
+            streaming_db_path: 增量模式串流統計的 SQLite 檔案（None 表示不落地）
         """
         self.es_host = es_host
-        self.src_index = f"{es_host}/netflow_stats_5m/_search"
+        self.src_index = f"{es_host}/{self.HISTORY_INDEX}/_search"
         self.learning_days = learning_days
+        self.utc_offset_hours = utc_offset_hours
+
+        # 基準線緩存 {src_ip: baseline}（記憶體 LRU + SQLite）
+        self.baselines = BaselineStore(
+            db_path,
+            max_memory_entries=max_memory_entries,
+            ttl_seconds=ttl_hours * 3600 if ttl_hours else None
+        )
 
-        # 基準線緩存 {src_ip: baseline}
-        self.baselines = {}
+        # 沒有基準線時是否即時查詢 ES 學習
+        self.lazy_learning = True
+
+        # 增量模式的串流狀態 {src_ip: {'sample_count', 'first_bucket', 'last_bucket', 'metrics'}}
+        # （記憶體 LRU + SQLite，與基準線分開存放，重新執行 build_baselines.py 不會覆蓋）
+        self.incremental = incremental
+        self.ewma_alpha = ewma_alpha
+        self.streaming = BaselineStore(
+            streaming_db_path if incremental else None,
+            max_memory_entries=max_memory_entries,
+            table='streaming',
+            encode=self._encode_streaming_state,
+            decode=self._decode_streaming_state
+        )
 
         # 統計信息
         self.stats = {
             'total_learned': 0,
             'total_checked': 0,
-            'deviations_detected': 0
+            'deviations_detected': 0,
+            'streaming_updates': 0
         }
 
+        # 批次建立的基準線檔案（只查表模式下，檔案更新時重新載入）
+        self.store_path = store_path
+        self._store_mtime = None
+
+        if store_path:
+            if os.path.exists(store_path):
+                self.load_baselines(store_path)
+            else:
+                print(f"⚠️  基準線檔案不存在: {store_path}（請執行 build_baselines.py），改為即時學習")
+
+    @classmethod
+    def from_config(cls, config=None, es_host: str = "http://localhost:9200") -> 'BaselineManager':
+        """依 config.yaml 的 baseline 區塊建立"""
+        baseline_config = config.get('baseline', {}) if hasattr(config, 'get') else {}
+        return cls(
+            es_host,
+            learning_days=baseline_config.get('learning_days', 7),
+            store_path=baseline_config.get('store_path', DEFAULT_BASELINE_STORE_PATH) or None,
+            incremental=baseline_config.get('incremental', False),
+            ewma_alpha=baseline_config.get('ewma_alpha', 0.05),
+            db_path=baseline_config.get('db_path', DEFAULT_BASELINE_DB_PATH) or None,
+            max_memory_entries=baseline_config.get('max_memory_entries', 50000),
+            ttl_hours=baseline_config.get('ttl_hours', 24),
+            utc_offset_hours=baseline_config.get('utc_offset_hours', 8),
+            streaming_db_path=baseline_config.get('streaming_db_path', DEFAULT_STREAMING_DB_PATH) or None,
+        )
+
     def learn_baseline(self, src_ip: str) -> Optional[Dict]:
         """
         學習某個 IP 的行為基準線
@@ -71,7 +173,89 @@ class BaselineManager:
             end_time.isoformat()
         )
 
-        if not historical_data or len(historical_data) < 10:  # 至少需要 10 個樣本
+        return self._build_baseline(src_ip, historical_data)
+
+    def prefetch_baselines(self, src_ips: List[str], chunk_size: int = 200) -> Dict[str, Optional[Dict]]:
+        """
+        批次學習多個 IP 的基準線（已緩存的 IP 會略過）
+
+        每 chunk_size 個 IP 以一次 terms 聚合查詢歷史數據，各指標在 ES 端以
+        extended_stats + percentiles 計算（與 build_all_baselines 相同），
+        回應大小只與 IP 數相關，不再取回原始文件。
+
+        Args:
+            src_ips: IP 列表
+            chunk_size: 每次查詢的 IP 數
+
+        Returns:
+            {src_ip: baseline 或 None（歷史數據不足）}
+        """
+        if not self.lazy_learning:
+            # 已載入批次建立的基準線，只查表
+            self._reload_store_if_changed()
+            return {ip: self.baselines.get(ip) for ip in src_ips if ip}
+
+        end_time = datetime.now()
+        start_time = end_time - timedelta(days=self.learning_days)
+        learned_at = end_time.isoformat()
+
+        results = {}
+        pending = []
+        for ip in dict.fromkeys(src_ips):
+            if not ip:
+                continue
+            baseline = self.baselines.get(ip)
+            if baseline is not None:
+                results[ip] = baseline
+            else:
+                pending.append(ip)
+
+        for start in range(0, len(pending), chunk_size):
+            chunk = pending[start:start + chunk_size]
+            query = {
+                "size": 0,
+                "query": {
+                    "bool": {
+                        "filter": [
+                            {"terms": {"src_ip": chunk}},
+                            {"range": {"time_bucket": {"gte": start_time.isoformat(),
+                                                       "lte": end_time.isoformat()}}}
+                        ]
+                    }
+                },
+                "aggs": {
+                    "by_ip": {
+                        "terms": {"field": "src_ip", "size": len(chunk)},
+                        "aggs": self._metric_aggs()
+                    }
+                }
+            }
+            try:
+                response = get_transport().post(
+                    self.src_index, json=query, timeout=60, caller='baseline_manager'
+                )
+                response.raise_for_status()
+                buckets = response.json()['aggregations']['by_ip']['buckets']
+            except Exception as e:
+                print(f"Error querying historical data: {e}")
+                continue
+
+            learned = {}
+            for bucket in buckets:
+                if bucket['doc_count'] >= self.MIN_SAMPLES:
+                    learned[bucket['key']] = self._baseline_from_bucket(bucket['key'], bucket, learned_at)
+
+            for ip in chunk:
+                results[ip] = learned.get(ip)
+            self.baselines.update_many(learned.items())
+            self.stats['total_learned'] += len(learned)
+
+        self.baselines.flush()
+        return results
+
+    def _build_baseline(self, src_ip: str, historical_data: List[Dict]) -> Optional[Dict]:
+        """由歷史數據計算並緩存基準線（樣本不足時返回 None）"""
+        if not historical_data or len(historical_data) < self.MIN_SAMPLES:  # 至少需要 10 個樣本
             return None
 
         # 計算各指標的統計特徵
@@ -80,27 +264,9 @@ class BaselineManager:
             'learning_period_days': self.learning_days,
             'sample_count': len(historical_data),
             'learned_at': datetime.now().isoformat(),
-
-            # 各指標的統計
-            'unique_dst_ports': self._calculate_metric_stats(
-                historical_data, 'unique_dst_ports'
-            ),
-            'unique_dsts': self._calculate_metric_stats(
-                historical_data, 'unique_dsts'
-            ),
-            'flow_count': self._calculate_metric_stats(
-                historical_data, 'flow_count'
-            ),
-            'avg_bytes': self._calculate_metric_stats(
-                historical_data, 'avg_bytes'
-            ),
-            'total_bytes': self._calculate_metric_stats(
-                historical_data, 'total_bytes'
-            ),
-            'unique_src_ports': self._calculate_metric_stats(
-                historical_data, 'unique_src_ports'
-            )
         }
+        for metric_name in self.BASELINE_METRICS:
+            baseline[metric_name] = self._calculate_metric_stats(historical_data, metric_name)
 
         # 緩存基準線
         self.baselines[src_ip] = baseline
@@ -108,13 +274,14 @@ class BaselineManager:
 
         return baseline
 
-    def check_deviation(self, src_ip: str, current_data: Dict) -> Dict:
+    def check_deviation(self, src_ip: str, current_data: Dict, learn: bool = True) -> Dict:
         """
         檢查當前行為是否偏離基準線
 
         Args:
             src_ip: 源 IP
             current_data: 當前的行為數據（from netflow_stats_5m）
+            learn: 沒有緩存的基準線時是否查詢 ES 學習（已由 prefetch_baselines 處理時為 False）
 
         Returns:
             {
@@ -126,17 +293,20 @@ class BaselineManager:
         """
         self.stats['total_checked'] += 1
 
-        # 如果沒有基準線，先學習
-        if src_ip not in self.baselines:
-            baseline = self.learn_baseline(src_ip)
+        # 如果沒有基準線（或已過期），先學習
+        baseline = self.baselines.get(src_ip)
+        if baseline is None:
+            baseline = self.learn_baseline(src_ip) if learn and self.lazy_learning else None
             if not baseline:
                 return {
                     'has_deviation': False,
                     'reason': 'Insufficient historical data for baseline',
                     'baseline': None
                 }
-        else:
-            baseline = self.baselines[src_ip]
+
+        # 對應時段的週期性基準線（沒有或樣本不足時使用整體基準線）
+        slot = self.hour_of_week(current_data.get('time_bucket'))
+        seasonal = self._seasonal_slot_stats(baseline, slot)
 
         # 檢查各指標是否偏離
         deviations = {}
@@ -145,7 +315,7 @@ class BaselineManager:
         # 檢查 unique_dst_ports
         deviation = self._check_metric_deviation(
             current_value=current_data.get('unique_dst_ports', 0),
-            baseline_stats=baseline['unique_dst_ports'],
+            baseline_stats={**baseline['unique_dst_ports'], **seasonal.get('unique_dst_ports', {})},
             metric_name='unique_dst_ports'
         )
         if deviation['has_deviation']:
@@ -155,7 +325,7 @@ class BaselineManager:
         # 檢查 unique_dsts
         deviation = self._check_metric_deviation(
             current_value=current_data.get('unique_dsts', 0),
-            baseline_stats=baseline['unique_dsts'],
+            baseline_stats={**baseline['unique_dsts'], **seasonal.get('unique_dsts', {})},
             metric_name='unique_dsts'
         )
         if deviation['has_deviation']:
@@ -165,7 +335,7 @@ class BaselineManager:
         # 檢查 flow_count
         deviation = self._check_metric_deviation(
             current_value=current_data.get('flow_count', 0),
-            baseline_stats=baseline['flow_count'],
+            baseline_stats={**baseline['flow_count'], **seasonal.get('flow_count', {})},
             metric_name='flow_count'
         )
         if deviation['has_deviation']:
@@ -175,7 +345,7 @@ class BaselineManager:
         # 檢查 avg_bytes
         deviation = self._check_metric_deviation(
             current_value=current_data.get('avg_bytes', 0),
-            baseline_stats=baseline['avg_bytes'],
+            baseline_stats={**baseline['avg_bytes'], **seasonal.get('avg_bytes', {})},
             metric_name='avg_bytes',
             allow_decrease=True  # avg_bytes 減少也可能是異常（DDoS）
         )
@@ -193,6 +363,7 @@ class BaselineManager:
             'deviations': deviations,
             'severity': max_severity,
             'baseline': baseline,
+            'seasonal_slot': slot if seasonal else None,
             'current_data': current_data
         }
 
@@ -208,7 +379,25 @@ class BaselineManager:
         Returns:
             歷史數據列表
         """
-        query = {
+        query = self._historical_query(src_ip, start_time, end_time)
+
+        try:
+            response = get_transport().post(self.src_index, json=query, caller='baseline_manager')
+            data = response.json()
+
+            historical_data = []
+            for hit in data.get('hits', {}).get('hits', []):
+                historical_data.append(hit['_source'])
+
+            return historical_data
+
+        except Exception as e:
+            print(f"Error querying historical data: {e}")
+            return []
+
+    def _historical_query(self, src_ip: str, start_time: str, end_time: str) -> Dict:
+        """歷史數據查詢"""
+        return {
             "size": 10000,  # 最多獲取 10000 個樣本
             "query": {
                 "bool": {
@@ -228,20 +417,496 @@ class BaselineManager:
             "sort": [{"time_bucket": "asc"}]
         }
 
+    # ========== 批次建立 ==========
+
+    def build_all_baselines(self, page_size: int = 500) -> int:
+        """
+        以 composite 聚合一次建立學習期內所有 IP 的基準線
+
+        依 src_ip 分頁（after_key）串流聚合結果，每個指標在 ES 端以
+        extended_stats + percentiles 計算（只統計 > 0 的值，與逐一學習相同），
+        不再取回原始文件。結果取代目前緩存的基準線。
+
+        Args:
+            page_size: 每頁 IP 數
+
+        Returns:
+            建立的基準線數量
+        """
+        end_time = datetime.now()
+        start_time = end_time - timedelta(days=self.learning_days)
+        learned_at = end_time.isoformat()
+
+        query = {
+            "size": 0,
+            "query": {
+                "range": {
+                    "time_bucket": {
+                        "gte": start_time.isoformat(),
+                        "lte": end_time.isoformat()
+                    }
+                }
+            },
+            "aggs": {
+                "by_ip": {
+                    "composite": {
+                        "size": page_size,
+                        "sources": [{"src_ip": {"terms": {"field": "src_ip"}}}]
+                    },
+                    "aggs": self._metric_aggs()
+                }
+            }
+        }
+
+        baselines = {}
+        n_buckets = 0
+        while True:
+            response = get_transport().post(
+                self.src_index, json=query, timeout=120, caller='baseline_builder'
+            )
+            response.raise_for_status()
+            by_ip = response.json()['aggregations']['by_ip']
+
+            for bucket in by_ip['buckets']:
+                n_buckets += 1
+                if bucket['doc_count'] < self.MIN_SAMPLES:
+                    continue
+                src_ip = bucket['key']['src_ip']
+                baseline = self._baseline_from_bucket(src_ip, bucket, learned_at)
+                baselines[src_ip] = baseline
+
+            print(f"  已處理 {n_buckets:,} 個 IP，建立 {len(baselines):,} 條基準線", end='\r')
+
+            after_key = by_ip.get('after_key')
+            if not by_ip['buckets'] or after_key is None:
+                break
+            query['aggs']['by_ip']['composite']['after'] = after_key
+
+        print()
+        self.baselines.clear()
+        self.baselines.update_many(baselines.items())
+        self.baselines.flush()
+        self.stats['total_learned'] += len(baselines)
+        return len(baselines)
+
+    def _metric_aggs(self) -> Dict:
+        """各指標的 extended_stats + percentiles 聚合（只統計 > 0 的值，與逐一學習相同）"""
+        return {
+            metric_name: {
+                "filter": {"range": {metric_name: {"gt": 0}}},
+                "aggs": {
+                    "stats": {"extended_stats": {"field": metric_name}},
+                    "percentiles": {"percentiles": {"field": metric_name, "percents": [50, 95, 99]}}
+                }
+            }
+            for metric_name in self.BASELINE_METRICS
+        }
+
+    def _baseline_from_bucket(self, src_ip: str, bucket: Dict, learned_at: str) -> Dict:
+        """由單一 IP 的聚合 bucket 組裝基準線"""
+        baseline = {
+            'src_ip': src_ip,
+            'learning_period_days': self.learning_days,
+            'sample_count': bucket['doc_count'],
+            'learned_at': learned_at,
+        }
+        for metric_name in self.BASELINE_METRICS:
+            baseline[metric_name] = self._metric_stats_from_aggs(bucket[metric_name])
+        return baseline
+
+    @staticmethod
+    def _metric_stats_from_aggs(metric_aggs: Dict) -> Dict:
+        """將 extended_stats + percentiles 聚合結果轉為與 _calculate_metric_stats 相同的格式"""
+        stats = metric_aggs['stats']
+        if not stats.get('count'):
+            return {'mean': 0, 'std': 0, 'min': 0, 'max': 0, 'p50': 0, 'p95': 0, 'p99': 0}
+
+        percentiles = metric_aggs['percentiles']['values']
+        return {
+            'mean': float(stats['avg']),
+            'std': float(stats['std_deviation']),
+            'min': float(stats['min']),
+            'max': float(stats['max']),
+            'p50': float(percentiles['50.0']),
+            'p95': float(percentiles['95.0']),
+            'p99': float(percentiles['99.0'])
+        }
+
+    # ========== 週期性基準線 ==========
+
+    def hour_of_week(self, time_bucket=None) -> int:
+        """
+        時間所屬的時段（本地時間，星期一 00:00 為 0，星期日 23:00 為 167）
+
+        Args:
+            time_bucket: ISO 字串、epoch 毫秒或 datetime（None 表示現在）
+        """
+        if time_bucket is None:
+            dt = datetime.now(timezone.utc)
+        elif isinstance(time_bucket, datetime):
+            dt = time_bucket if time_bucket.tzinfo else time_bucket.replace(tzinfo=timezone.utc)
+        elif isinstance(time_bucket, (int, float)):
+            dt = datetime.fromtimestamp(time_bucket / 1000, timezone.utc)
+        else:
+            try:
+                dt = datetime.fromisoformat(str(time_bucket).replace('Z', '+00:00'))
+            except ValueError:
+                dt = datetime.now(timezone.utc)
+            if dt.tzinfo is None:
+                dt = dt.replace(tzinfo=timezone.utc)
+        local = dt.astimezone(timezone(timedelta(hours=self.utc_offset_hours)))
+        return local.weekday() * 24 + local.hour
+
+    def _hour_of_week_array(self, epoch_ms: np.ndarray) -> np.ndarray:
+        """hour_of_week 的向量化版本（1970-01-01 為星期四）"""
+        hours = epoch_ms // 3_600_000 + self.utc_offset_hours
+        return (hours + 3 * 24) % self.SEASONAL_SLOTS
+
+    def build_seasonal_baselines(self, page_size: int = 2000) -> int:
+        """
+        為已建立的基準線加上 168 個時段的週期性統計
+
+        以 composite 聚合（src_ip × 每小時）取回每小時的 extended_stats
+        與 P95 / P99，再以 numpy 依 (IP, 時段) 向量化合併學習期內的各週：
+        count / sum / sum_of_squares 相加、max 取最大、P95 / P99 以記錄數
+        加權平均（學習期 7 天時每個時段只有一個小時，即為該小時的分位數），
+        算出每個時段的平均值、標準差、最大值與 P95 / P99。
+        結果以 base64 編碼的 float32 陣列存放。
+
+        Args:
+            page_size: composite 聚合每頁的 bucket 數
+
+        Returns:
+            加上週期性統計的基準線數量
+        """
+        end_time = datetime.now()
+        start_time = end_time - timedelta(days=self.learning_days)
+
+        query = {
+            "size": 0,
+            "query": {
+                "range": {
+                    "time_bucket": {
+                        "gte": start_time.isoformat(),
+                        "lte": end_time.isoformat()
+                    }
+                }
+            },
+            "aggs": {
+                "by_ip_hour": {
+                    "composite": {
+                        "size": page_size,
+                        "sources": [
+                            {"src_ip": {"terms": {"field": "src_ip"}}},
+                            {"hour": {"date_histogram": {"field": "time_bucket", "fixed_interval": "1h"}}}
+                        ]
+                    },
+                    "aggs": {
+                        metric_name: {
+                            "filter": {"range": {metric_name: {"gt": 0}}},
+                            "aggs": {
+                                "stats": {"extended_stats": {"field": metric_name}},
+                                "percentiles": {"percentiles": {"field": metric_name, "percents": [95, 99]}}
+                            }
+                        }
+                        for metric_name in self.SEASONAL_METRICS
+                    }
+                }
+            }
+        }
+
+        # 每個 (IP, 小時) bucket 一列
+        ips, hours, doc_counts = [], [], []
+        columns = {m: [] for m in self.SEASONAL_METRICS}
+        while True:
+            response = get_transport().post(
+                self.src_index, json=query, timeout=120, caller='baseline_builder'
+            )
+            response.raise_for_status()
+            by_ip_hour = response.json()['aggregations']['by_ip_hour']
+
+            for bucket in by_ip_hour['buckets']:
+                ips.append(bucket['key']['src_ip'])
+                hours.append(bucket['key']['hour'])
+                doc_counts.append(bucket['doc_count'])
+                for metric_name in self.SEASONAL_METRICS:
+                    stats = bucket[metric_name]['stats']
+                    if stats.get('count'):
+                        percentiles = bucket[metric_name]['percentiles']['values']
+                        columns[metric_name].append(
+                            (stats['count'], stats['sum'], stats['sum_of_squares'], stats['max'],
+                             percentiles['95.0'], percentiles['99.0'])
+                        )
+                    else:
+                        columns[metric_name].append((0, 0.0, 0.0, 0.0, 0.0, 0.0))
+
+            after_key = by_ip_hour.get('after_key')
+            if not by_ip_hour['buckets'] or after_key is None:
+                break
+            query['aggs']['by_ip_hour']['composite']['after'] = after_key
+
+        if not ips:
+            return 0
+
+        # 向量化 group-by：key = IP 序號 × 168 + 時段
+        unique_ips, ip_index = np.unique(np.array(ips), return_inverse=True)
+        slots = self._hour_of_week_array(np.array(hours, dtype=np.int64))
+        keys = ip_index * self.SEASONAL_SLOTS + slots
+        n_keys = len(unique_ips) * self.SEASONAL_SLOTS
+
+        slot_counts = np.bincount(keys, weights=np.array(doc_counts, dtype=float), minlength=n_keys)
+        encoded = {}
+        for metric_name in self.SEASONAL_METRICS:
+            values = np.array(columns[metric_name], dtype=float).reshape(-1, 6)
+            count = np.bincount(keys, weights=values[:, 0], minlength=n_keys)
+            total = np.bincount(keys, weights=values[:, 1], minlength=n_keys)
+            total_sq = np.bincount(keys, weights=values[:, 2], minlength=n_keys)
+            maximum = np.zeros(n_keys)
+            np.maximum.at(maximum, keys, values[:, 3])
+            weighted_p95 = np.bincount(keys, weights=values[:, 0] * values[:, 4], minlength=n_keys)
+            weighted_p99 = np.bincount(keys, weights=values[:, 0] * values[:, 5], minlength=n_keys)
+
+            with np.errstate(divide='ignore', invalid='ignore'):
+                mean = np.where(count > 0, total / count, 0.0)
+                variance = np.where(count > 0, total_sq / count - mean ** 2, 0.0)
+                p95 = np.where(count > 0, weighted_p95 / count, 0.0)
+                p99 = np.where(count > 0, weighted_p99 / count, 0.0)
+            std = np.sqrt(np.clip(variance, 0, None))
+            n_stats = len(self.SEASONAL_STATS)
+            encoded[metric_name] = np.stack([mean, std, maximum, p95, p99], axis=1) \
+                .reshape(len(unique_ips), self.SEASONAL_SLOTS, n_stats).transpose(0, 2, 1).astype(np.float32)
+
+        slot_counts = np.minimum(slot_counts, np.iinfo(np.uint16).max) \
+            .reshape(len(unique_ips), self.SEASONAL_SLOTS).astype(np.uint16)
+
+        updated = []
+        for i, src_ip in enumerate(unique_ips.tolist()):
+            baseline = self.baselines.get(src_ip)
+            if baseline is None:
+                continue
+            baseline['seasonal'] = {
+                'utc_offset_hours': self.utc_offset_hours,
+                'slot_counts': base64.b64encode(slot_counts[i].tobytes()).decode('ascii'),
+                **{
+                    metric_name: base64.b64encode(encoded[metric_name][i].tobytes()).decode('ascii')
+                    for metric_name in self.SEASONAL_METRICS
+                }
+            }
+            updated.append((src_ip, baseline))
+
+        self.baselines.update_many(updated)
+        self.baselines.flush()
+        return len(updated)
+
+    def _seasonal_slot_stats(self, baseline: Dict, slot: int) -> Dict[str, Dict]:
+        """
+        取出基準線中某個時段的統計 {metric: {'mean', 'std', 'max', 'p95', 'p99'}}
+
+        沒有週期性基準線、時區不同或時段樣本不足時返回空字典；
+        時段平均值 < 1 的指標（該時段幾乎沒有活動）沿用整體基準線。
+        舊版存檔只有 mean / std / max，P95 / P99 沿用整體基準線
+        """
+        seasonal = baseline.get('seasonal')
+        if not seasonal or seasonal.get('utc_offset_hours') != self.utc_offset_hours:
+            return {}
+
+        slot_counts = np.frombuffer(base64.b64decode(seasonal['slot_counts']), dtype=np.uint16)
+        if slot_counts[slot] < self.SEASONAL_MIN_SLOT_SAMPLES:
+            return {}
+
+        result = {}
+        for metric_name in self.SEASONAL_METRICS:
+            if metric_name not in seasonal:
+                continue
+            stats = np.frombuffer(base64.b64decode(seasonal[metric_name]), dtype=np.float32) \
+                .reshape(-1, self.SEASONAL_SLOTS)[:, slot]
+            if stats[0] >= 1:
+                result[metric_name] = {name: float(value) for name, value in zip(self.SEASONAL_STATS, stats)}
+        return result
+
+    def save_baselines(self, path: str):
+        """將目前的基準線存檔（先寫暫存檔再替換，避免讀到不完整的檔案）"""
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        payload = {
+            'version': self.STORE_FORMAT_VERSION,
+            'index': self.HISTORY_INDEX,
+            'learning_days': self.learning_days,
+            'built_at': datetime.now().isoformat(),
+            'baselines': dict(self.baselines.items())
+        }
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(payload, f, separators=(',', ':'))
+        os.replace(tmp_path, path)
+
+    def load_baselines(self, path: str) -> bool:
+        """
+        載入 save_baselines 存檔的基準線
+
+        載入成功後只查表（lazy_learning = False），基準線不再因 TTL 過期；
+        SQLite 中已是同一份檔案的內容時略過匯入（重啟不需重新載入）
+
+        Returns:
+            是否載入成功
+        """
         try:
-            response = requests.post(self.src_index, json=query,
-                                    headers={'Content-Type': 'application/json'})
-            data = response.json()
+            mtime = os.path.getmtime(path)
+            with open(path, 'r', encoding='utf-8') as f:
+                payload = json.load(f)
+        except (OSError, ValueError) as e:
+            print(f"⚠️  無法讀取基準線檔案 {path}: {e}，改為即時學習")
+            return False
+
+        if payload.get('version') != self.STORE_FORMAT_VERSION:
+            print(f"⚠️  基準線檔案版本不符 {path}，改為即時學習")
+            return False
+
+        built_at = payload.get('built_at', 'Unknown')
+        if self.baselines.get_meta('store_built_at') != built_at:
+            self.baselines.clear()
+            self.baselines.update_many(payload.get('baselines', {}).items())
+            self.baselines.flush()
+            self.baselines.set_meta('store_built_at', built_at)
+            # 重新匯入後，串流基準線仍優先於批次基準線（分頁讀取串流統計，逐批寫入）
+            batch = []
+            for ip, state in self.streaming.items():
+                baseline = self._streaming_baseline(ip, state)
+                if baseline:
+                    batch.append((ip, baseline))
+                if len(batch) >= self.baselines.commit_every:
+                    self.baselines.update_many(batch)
+                    batch = []
+            self.baselines.update_many(batch)
+            self.baselines.flush()
+
+        self.baselines.ttl_seconds = None
+        self.lazy_learning = False
+        self._store_mtime = mtime
+        print(f"✓ 已載入 {len(self.baselines):,} 條基準線（建立於 {built_at}）")
+        return True
+
+    def _reload_store_if_changed(self):
+        """只查表模式下，基準線檔案被 build_baselines.py 更新時重新載入"""
+        if not self.store_path:
+            return
+        try:
+            mtime = os.path.getmtime(self.store_path)
+        except OSError:
+            return
+        if self._store_mtime is None or mtime > self._store_mtime:
+            self.load_baselines(self.store_path)
 
-            historical_data = []
-            for hit in data.get('hits', {}).get('hits', []):
-                historical_data.append(hit['_source'])
+    def flush(self):
+        """將基準線與串流統計寫入磁碟"""
+        self.baselines.flush()
+        self.streaming.flush()
 
-            return historical_data
+    # ========== 增量模式 ==========
 
-        except Exception as e:
-            print(f"Error querying historical data: {e}")
-            return []
+    def update_baselines(self, records: List[Dict], exclude: Optional[set] = None) -> int:
+        """
+        以本週期的 by_src 聚合記錄更新串流統計（增量模式）
+
+        每個 IP 只保留各指標的 Welford / EWMA / 分位數草圖狀態，
+        不需重新查詢歷史數據。每個 IP 只接受比上次更新更新的 time_bucket，
+        重疊的偵測窗口不會重複計入。樣本數達到 MIN_SAMPLES 後，
+        串流基準線取代緩存中的基準線，check_deviation 直接使用。
+        串流統計只寫回本週期有更新的 IP。
+
+        Args:
+            records: by_src 聚合記錄（netflow_stats_3m_by_src 文件）
+            exclude: 不納入基準線的 IP（例如本週期確認的異常）
+
+        Returns:
+            更新的 IP 數量
+        """
+        if not self.incremental:
+            return 0
+
+        exclude = exclude or set()
+        touched = {}
+        for record in sorted(records, key=lambda r: r.get('time_bucket') or ''):
+            src_ip = record.get('src_ip')
+            if not src_ip or src_ip in exclude:
+                continue
+
+            time_bucket = record.get('time_bucket')
+            state = touched.get(src_ip) or self.streaming.get(src_ip)
+            if state is None:
+                state = {
+                    'sample_count': 0,
+                    'first_bucket': time_bucket,
+                    'last_bucket': None,
+                    'metrics': {m: RunningMetric(self.ewma_alpha) for m in self.BASELINE_METRICS}
+                }
+            elif time_bucket and state['last_bucket'] and time_bucket <= state['last_bucket']:
+                continue
+
+            state['sample_count'] += 1
+            state['last_bucket'] = time_bucket
+            for metric_name, metric in state['metrics'].items():
+                value = record.get(metric_name)
+                # 與批次學習相同，只統計 > 0 的值
+                if value is not None and value > 0:
+                    metric.update(value)
+            touched[src_ip] = state
+
+        self.streaming.update_many(touched.items())
+        self.streaming.flush()
+        baselines = [(src_ip, self._streaming_baseline(src_ip, state)) for src_ip, state in touched.items()]
+        self.baselines.update_many((src_ip, b) for src_ip, b in baselines if b)
+        self.baselines.flush()
+
+        self.stats['streaming_updates'] += len(touched)
+        return len(touched)
+
+    def _streaming_baseline(self, src_ip: str, state: Dict) -> Optional[Dict]:
+        """
+        由串流狀態產生與 _build_baseline 相同格式的基準線
+
+        串流狀態沒有時段資料，沿用目前基準線的週期性統計（build_seasonal_baselines）
+        """
+        if state['sample_count'] < self.MIN_SAMPLES:
+            return None
+
+        learning_days = self.learning_days
+        try:
+            first = datetime.fromisoformat(state['first_bucket'].replace('Z', '+00:00'))
+            last = datetime.fromisoformat(state['last_bucket'].replace('Z', '+00:00'))
+            learning_days = round((last - first).total_seconds() / 86400, 1)
+        except (AttributeError, ValueError):
+            pass
+
+        baseline = {
+            'src_ip': src_ip,
+            'learning_period_days': learning_days,
+            'sample_count': state['sample_count'],
+            'learned_at': datetime.now().isoformat(),
+            'streaming': True,
+        }
+        for metric_name, metric in state['metrics'].items():
+            baseline[metric_name] = metric.to_stats()
+
+        previous = self.baselines.get(src_ip)
+        if previous and 'seasonal' in previous:
+            baseline['seasonal'] = previous['seasonal']
+        return baseline
+
+    @staticmethod
+    def _encode_streaming_state(state: Dict) -> Dict:
+        """串流狀態轉為可 JSON 序列化的格式（RunningMetric → dict）"""
+        return {
+            **{k: v for k, v in state.items() if k != 'metrics'},
+            'metrics': {m: metric.to_dict() for m, metric in state['metrics'].items()}
+        }
+
+    @staticmethod
+    def _decode_streaming_state(data: Dict) -> Dict:
+        """_encode_streaming_state 的反向轉換"""
+        return {**data, 'metrics': {m: RunningMetric.from_dict(d) for m, d in data['metrics'].items()}}
 
     def _calculate_metric_stats(self, data: List[Dict], metric_name: str) -> Dict:
         """
@@ -382,7 +1047,9 @@ class BaselineManager:
         """獲取統計信息"""
         return {
             **self.stats,
-            'baselines_cached': len(self.baselines)
+            'baselines_cached': len(self.baselines),
+            'streaming_ips': len(self.streaming),
+            'store': self.baselines.get_metrics()
         }
 
     def generate_deviation_report(self, deviation_result: Dict) -> str:
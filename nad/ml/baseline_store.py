@@ -0,0 +1,232 @@
+#!/usr/bin/env python3
+"""
+基準線儲存（記憶體 LRU + SQLite 磁碟層）
+
+BaselineManager.baselines 原為不斷成長的 dict，重啟後全部遺失，
+每次重啟都需要重新對每個 IP 查詢 ES 學習基準線。BaselineStore 以
+相同的 mapping 介面提供：
+
+- 固定上限的記憶體 LRU 層（max_memory_entries），大量 IP 時記憶體不再成長
+- SQLite 磁碟層（寫入即落地，定期 commit），重啟後直接沿用
+- TTL：超過 ttl_seconds 的基準線視為不存在，由呼叫端重新學習
+- 命中 / 未命中 / 過期 / 淘汰等統計
+
+同一個 SQLite 檔案可以有多個資料表（table），值的序列化可由
+encode / decode 指定（例如增量模式的串流統計）。
+"""
+
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from collections.abc import MutableMapping
+from typing import Any, Callable, Dict, Iterable, Iterator, Optional, Tuple
+
+DEFAULT_BASELINE_DB_PATH = 'nad/state/baselines.db'
+
+
+class BaselineStore(MutableMapping):
+    """
+    {ip: baseline} 的兩層儲存
+
+    所有寫入都會寫到 SQLite（磁碟層為完整資料），記憶體層只是熱資料的
+    LRU 快取，淘汰時不需回寫。path 為 None 時使用記憶體中的 SQLite。
+    """
+
+    def __init__(self, path: Optional[str] = None, max_memory_entries: int = 50000,
+                 ttl_seconds: Optional[float] = None, commit_every: int = 500,
+                 table: str = 'baselines', encode: Optional[Callable[[Any], Any]] = None,
+                 decode: Optional[Callable[[Any], Any]] = None):
+        """
+        Args:
+            path: SQLite 檔案路徑（None 表示不落地）
+            max_memory_entries: 記憶體層最多保留的基準線數
+            ttl_seconds: 基準線有效期（None 表示不過期）
+            commit_every: 累積多少筆寫入後 commit
+            table: 資料表名稱（同一個檔案可存放多種資料）
+            encode: 寫入前將值轉為可 JSON 序列化的物件（None 表示原樣）
+            decode: 由磁碟讀回時的反向轉換（None 表示原樣）
+        """
+        if max_memory_entries <= 0:
+            raise ValueError("max_memory_entries 必須大於 0")
+        if not table.isidentifier():
+            raise ValueError(f"無效的資料表名稱: {table}")
+        self.path = path
+        self.max_memory_entries = max_memory_entries
+        self.ttl_seconds = ttl_seconds
+        self.commit_every = commit_every
+        self.table = table
+        self._encode = encode or (lambda value: value)
+        self._decode = decode or (lambda value: value)
+
+        if path:
+            directory = os.path.dirname(path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+        self._conn = sqlite3.connect(path or ':memory:', check_same_thread=False)
+        if path:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            f"CREATE TABLE IF NOT EXISTS {table} ("
+            "ip TEXT PRIMARY KEY, stored_at REAL NOT NULL, data TEXT NOT NULL) WITHOUT ROWID"
+        )
+        self._conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+        self._conn.commit()
+
+        # 記憶體層 {ip: (stored_at, baseline)}
+        self._memory: 'OrderedDict[str, Tuple[float, Dict]]' = OrderedDict()
+        self._lock = threading.RLock()
+        self._pending = 0
+
+        self.metrics = {
+            'hits': 0,
+            'disk_hits': 0,
+            'misses': 0,
+            'expired': 0,
+            'evictions': 0,
+            'writes': 0
+        }
+
+    # ========== mapping 介面 ==========
+
+    def __getitem__(self, ip: str) -> Dict:
+        with self._lock:
+            entry = self._memory.get(ip)
+            if entry is not None:
+                if self._expired(entry[0]):
+                    self.metrics['expired'] += 1
+                    del self._memory[ip]
+                    raise KeyError(ip)
+                self._memory.move_to_end(ip)
+                self.metrics['hits'] += 1
+                return entry[1]
+
+            row = self._conn.execute(
+                f"SELECT stored_at, data FROM {self.table} WHERE ip = ?", (ip,)
+            ).fetchone()
+            if row is None:
+                self.metrics['misses'] += 1
+                raise KeyError(ip)
+            if self._expired(row[0]):
+                self.metrics['expired'] += 1
+                raise KeyError(ip)
+
+            self.metrics['disk_hits'] += 1
+            baseline = self._decode(json.loads(row[1]))
+            self._remember(ip, row[0], baseline)
+            return baseline
+
+    def __setitem__(self, ip: str, baseline: Dict):
+        self.update_many([(ip, baseline)])
+
+    def __delitem__(self, ip: str):
+        with self._lock:
+            self._memory.pop(ip, None)
+            cursor = self._conn.execute(f"DELETE FROM {self.table} WHERE ip = ?", (ip,))
+            self._mark_written(1)
+            if cursor.rowcount == 0:
+                raise KeyError(ip)
+
+    def __contains__(self, ip) -> bool:
+        return self.get(ip) is not None
+
+    def __iter__(self) -> Iterator[str]:
+        return (ip for ip, _ in self.items())
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self._conn.execute(f"SELECT COUNT(*) FROM {self.table}").fetchone()[0]
+
+    def items(self, page_size: int = 1000) -> Iterator[Tuple[str, Dict]]:
+        """
+        逐筆讀取磁碟層的全部基準線（不經過記憶體層、不計入命中統計）
+
+        依 ip 分頁讀取，記憶體中最多只有 page_size 筆
+        """
+        last_ip = ''
+        while True:
+            with self._lock:
+                rows = self._conn.execute(
+                    f"SELECT ip, data FROM {self.table} WHERE ip > ? ORDER BY ip LIMIT ?",
+                    (last_ip, page_size)
+                ).fetchall()
+            for ip, data in rows:
+                yield ip, self._decode(json.loads(data))
+            if len(rows) < page_size:
+                return
+            last_ip = rows[-1][0]
+
+    def clear(self):
+        with self._lock:
+            self._memory.clear()
+            self._conn.execute(f"DELETE FROM {self.table}")
+            self._conn.commit()
+            self._pending = 0
+
+    # ========== 批次與維護 ==========
+
+    def update_many(self, items: Iterable[Tuple[str, Dict]]):
+        """批次寫入（同一個交易）"""
+        now = time.time()
+        with self._lock:
+            rows = []
+            for ip, baseline in items:
+                rows.append((ip, now, json.dumps(self._encode(baseline), separators=(',', ':'))))
+                self._remember(ip, now, baseline)
+            self._conn.executemany(
+                f"INSERT OR REPLACE INTO {self.table} (ip, stored_at, data) VALUES (?, ?, ?)", rows
+            )
+            self.metrics['writes'] += len(rows)
+            self._mark_written(len(rows))
+
+    def flush(self):
+        """commit 尚未落地的寫入"""
+        with self._lock:
+            if self._pending:
+                self._conn.commit()
+                self._pending = 0
+
+    def close(self):
+        with self._lock:
+            self._conn.commit()
+            self._conn.close()
+
+    def get_meta(self, key: str) -> Optional[str]:
+        with self._lock:
+            row = self._conn.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+    def set_meta(self, key: str, value: str):
+        with self._lock:
+            self._conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, value))
+            self._conn.commit()
+
+    def memory_size(self) -> int:
+        return len(self._memory)
+
+    def get_metrics(self) -> Dict:
+        lookups = self.metrics['hits'] + self.metrics['disk_hits'] + self.metrics['misses'] + self.metrics['expired']
+        return {
+            **self.metrics,
+            'memory_entries': len(self._memory),
+            'hit_rate': (self.metrics['hits'] + self.metrics['disk_hits']) / lookups if lookups else 0.0
+        }
+
+    def _expired(self, stored_at: float) -> bool:
+        return self.ttl_seconds is not None and time.time() - stored_at > self.ttl_seconds
+
+    def _remember(self, ip: str, stored_at: float, baseline: Dict):
+        self._memory[ip] = (stored_at, baseline)
+        self._memory.move_to_end(ip)
+        while len(self._memory) > self.max_memory_entries:
+            self._memory.popitem(last=False)
+            self.metrics['evictions'] += 1
+
+    def _mark_written(self, n: int):
+        self._pending += n
+        if self._pending >= self.commit_every:
+            self._conn.commit()
+            self._pending = 0
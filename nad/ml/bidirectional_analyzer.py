@@ -11,11 +11,12 @@
 4. 服務器流量模式識別（減少誤報）
 """
 
-import requests
 import json
 from typing import Dict, List, Tuple, Optional
 from datetime import datetime
 from .port_analyzer import PortAnalyzer
+from .perspective_source import PerspectiveSource, ESPerspectiveSource
+from ..utils.es_transport import get_transport
 
 
 class BidirectionalAnalyzer:
@@ -26,13 +27,16 @@ class BidirectionalAnalyzer:
     進行交叉分析，減少誤報並提高偵測準確率。
     """
 
-    def __init__(self, es_host="http://localhost:9200"):
+    def __init__(self, es_host="http://localhost:9200", data_source: Optional[PerspectiveSource] = None):
         self.es_host = es_host
         self.src_index = f"{es_host}/netflow_stats_3m_by_src/_search"
         self.dst_index = f"{es_host}/netflow_stats_3m_by_dst/_search"
 
+        # 雙視角數據來源（預設直接查詢 ES，可換成每週期載入的記憶體快照）
+        self.data_source = data_source or ESPerspectiveSource(es_host, caller='bidirectional_analyzer')
+
         # 通訊埠分析器（非臨時埠計數法）
-        self.port_analyzer = PortAnalyzer(es_host)
+        self.port_analyzer = PortAnalyzer(es_host, data_source=self.data_source)
 
         # 內部網段定義
         self.internal_networks = [
@@ -46,7 +50,8 @@ class BidirectionalAnalyzer:
 
     # ========== Port Scan 偵測（改進版）==========
 
-    def detect_port_scan_improved(self, src_ip: str, time_range: str = "now-5m") -> Dict:
+    def detect_port_scan_improved(self, src_ip: str, time_range: str = "now-5m",
+                                  prefetched: Optional[Dict] = None) -> Dict:
         """
         改進的 Port Scan 偵測（整合非臨時埠計數法）
 
@@ -61,12 +66,20 @@ class BidirectionalAnalyzer:
         Args:
             src_ip: 要分析的源 IP
             time_range: 時間範圍（Elasticsearch 格式）
+            prefetched: 已批次查詢的資料（可選），包含時不再查詢 ES
+                - src_data: 該 IP 最新的 src 視角記錄（None 表示查無資料）
+                - reverse_scan_records: fetch_reverse_scan_records 的結果
 
         Returns:
             偵測結果字典，包含 pattern 類型
         """
+        prefetched = prefetched or {}
+
         # 1. 獲取 src 視角的數據
-        src_data = self._get_src_perspective(src_ip, time_range)
+        if 'src_data' in prefetched:
+            src_data = prefetched['src_data']
+        else:
+            src_data = self._get_src_perspective(src_ip, time_range)
 
         if not src_data:
             return {'is_port_scan': False, 'reason': 'No data found'}
@@ -188,7 +201,9 @@ class BidirectionalAnalyzer:
             }
 
         # 6. REVERSE_SCAN_PATTERN - 檢查目標是否被大量掃描（dst 視角）
-        reverse_scan = self._check_reverse_scan_pattern(src_ip, src_data, time_range)
+        reverse_scan = self._check_reverse_scan_pattern(
+            src_ip, src_data, time_range, records=prefetched.get('reverse_scan_records')
+        )
         if reverse_scan['is_reverse_scan']:
             return reverse_scan
 
@@ -358,7 +373,8 @@ class BidirectionalAnalyzer:
             avg_bytes < 5000                  # 小封包
         )
 
-    def _check_reverse_scan_pattern(self, src_ip: str, src_data: Dict, time_range: str) -> Dict:
+    def _check_reverse_scan_pattern(self, src_ip: str, src_data: Dict, time_range: str,
+                                    records: Optional[List[Dict]] = None) -> Dict:
         """
         REVERSE_SCAN_PATTERN - 檢查目標是否被大量掃描（dst 視角）
 
@@ -375,58 +391,63 @@ class BidirectionalAnalyzer:
         if unique_dsts == 0:
             return {'is_reverse_scan': False}
 
-        # 查詢 by_dst 索引，檢查這些目標是否被大量掃描
-        # 簡化實作：查詢 by_dst 索引中 unique_src_ports 很高的記錄
-        query = {
-            "size": 10,
-            "query": {
-                "bool": {
-                    "must": [
-                        {"range": {"time_bucket": {"gte": time_range}}},
-                        {"range": {"unique_src_ports": {"gte": 100}}}  # 被大量不同 src_ports 連接
+        if records is None:
+            try:
+                records = self.fetch_reverse_scan_records(time_range)
+            except Exception:
+                # 查詢失敗，忽略
+                records = []
+
+        # 檢查是否有目標被高度掃描
+        for dst_data in records:
+            unique_src_ports = dst_data.get('unique_src_ports', 0)
+
+            if unique_src_ports > 100:
+                return {
+                    'is_port_scan': True,
+                    'is_reverse_scan': True,
+                    'pattern': 'REVERSE_SCAN_PATTERN',
+                    'confidence': 0.80,
+                    'reason': 'Target being scanned from multiple source ports',
+                    'details': {
+                        'target_ip': dst_data.get('dst_ip', 'unknown'),
+                        'unique_src_ports': unique_src_ports,
+                        'unique_srcs': dst_data.get('unique_srcs', 0),
+                        'flow_count': dst_data.get('flow_count', 0)
+                    },
+                    'indicators': [
+                        f"目標 {dst_data.get('dst_ip')} 被從 {unique_src_ports} 個不同來源端口掃描",
+                        f"來源 IP 數: {dst_data.get('unique_srcs', 0)}",
+                        "目標可能正在被掃描"
                     ]
                 }
-            },
-            "sort": [{"unique_src_ports": "desc"}]
-        }
-
-        try:
-            response = requests.post(self.dst_index, json=query,
-                                    headers={'Content-Type': 'application/json'})
-            data = response.json()
-
-            hits = data.get('hits', {}).get('hits', [])
-            if hits:
-                # 檢查是否有目標被高度掃描
-                for hit in hits:
-                    dst_data = hit['_source']
-                    unique_src_ports = dst_data.get('unique_src_ports', 0)
-
-                    if unique_src_ports > 100:
-                        return {
-                            'is_port_scan': True,
-                            'is_reverse_scan': True,
-                            'pattern': 'REVERSE_SCAN_PATTERN',
-                            'confidence': 0.80,
-                            'reason': 'Target being scanned from multiple source ports',
-                            'details': {
-                                'target_ip': dst_data.get('dst_ip', 'unknown'),
-                                'unique_src_ports': unique_src_ports,
-                                'unique_srcs': dst_data.get('unique_srcs', 0),
-                                'flow_count': dst_data.get('flow_count', 0)
-                            },
-                            'indicators': [
-                                f"目標 {dst_data.get('dst_ip')} 被從 {unique_src_ports} 個不同來源端口掃描",
-                                f"來源 IP 數: {dst_data.get('unique_srcs', 0)}",
-                                "目標可能正在被掃描"
-                            ]
-                        }
-        except Exception as e:
-            # 查詢失敗，忽略
-            pass
 
         return {'is_reverse_scan': False}
 
+    def fetch_reverse_scan_records(self, time_range: str) -> List[Dict]:
+        """
+        查詢反向掃描檢查所需的 by_dst 記錄（與 src_ip 無關，每個驗證週期只需查詢一次）
+
+        簡化實作：by_dst 中被大量不同 src_ports 連接的記錄
+        """
+        return self.data_source.top_records('DST', 'unique_src_ports', 100, time_range, size=10)
+
+    def fetch_latest_records(self, ips: List[str], perspective: str, time_range: str) -> Dict[str, Dict]:
+        """
+        批次取得多個 IP 在時間範圍內最新的一筆聚合記錄
+
+        結果與 _get_src_perspective 相同；查無資料的 IP 不會出現在結果中。
+
+        Args:
+            ips: IP 列表
+            perspective: 'SRC' 或 'DST'
+            time_range: 時間範圍
+
+        Returns:
+            {ip: record}
+        """
+        return self.data_source.latest_records([ip for ip in ips if ip], perspective, time_range)
+
     def _is_microservice_pattern(self, src_data: Dict, dst_data_list: List[Dict]) -> bool:
         """
         檢查是否是微服務架構模式
@@ -527,8 +548,7 @@ class BidirectionalAnalyzer:
             "sort": [{"unique_srcs": "desc"}]
         }
 
-        response = requests.post(self.dst_index, json=query,
-                                headers={'Content-Type': 'application/json'})
+        response = get_transport().post(self.dst_index, json=query, caller='bidirectional_analyzer')
         data = response.json()
 
         ddos_candidates = []
@@ -644,27 +664,7 @@ class BidirectionalAnalyzer:
 
     def _get_src_perspective(self, src_ip: str, time_range: str) -> Optional[Dict]:
         """獲取 src 視角的數據"""
-        query = {
-            "size": 1,
-            "query": {
-                "bool": {
-                    "must": [
-                        {"term": {"src_ip": src_ip}},
-                        {"range": {"time_bucket": {"gte": time_range}}}
-                    ]
-                }
-            },
-            "sort": [{"time_bucket": "desc"}]
-        }
-
-        response = requests.post(self.src_index, json=query,
-                                headers={'Content-Type': 'application/json'})
-        data = response.json()
-
-        hits = data.get('hits', {}).get('hits', [])
-        if hits:
-            return hits[0]['_source']
-        return None
+        return self.data_source.latest_record(src_ip, 'SRC', time_range)
 
     def _get_targets_perspective(self, src_ip: str, time_range: str) -> List[Dict]:
         """
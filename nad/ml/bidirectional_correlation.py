@@ -12,11 +12,12 @@
 4. 識別 Server 行為模式
 """
 
-import requests
-from typing import Dict, Optional, Tuple
+from typing import Dict, List, Optional, Tuple
 from datetime import datetime, timedelta
 import numpy as np
 
+from .perspective_source import PerspectiveSource, ESPerspectiveSource
+
 
 class BidirectionalCorrelationAnalyzer:
     """
@@ -25,16 +26,19 @@ class BidirectionalCorrelationAnalyzer:
     分析同一 IP 在 SRC 和 DST 視角的行為一致性
     """
 
-    def __init__(self, es_host: str = "http://localhost:9200"):
+    def __init__(self, es_host: str = "http://localhost:9200",
+                 data_source: Optional[PerspectiveSource] = None):
         """
         初始化分析器
 
         Args:
             es_host: Elasticsearch 主機地址
+            data_source: 雙視角數據來源（預設直接查詢 ES）
         """
         self.es_host = es_host
         self.src_index = "netflow_stats_3m_by_src"
         self.dst_index = "netflow_stats_3m_by_dst"
+        self.data_source = data_source or ESPerspectiveSource(es_host, caller='bidirectional_correlation')
 
     def get_bidirectional_features(self, ip: str, time_range: str = "now-10m") -> Dict:
         """
@@ -58,6 +62,14 @@ class BidirectionalCorrelationAnalyzer:
 
         return features
 
+    def _query_view(self, ip: str, time_range: str, perspective: str) -> Optional[Dict]:
+        """查詢 IP 在指定視角的統計數據（聚合結果）"""
+        try:
+            return self.data_source.view_stats(ip, time_range=time_range, perspective=perspective)
+        except Exception as e:
+            print(f"Warning: Failed to query {perspective} view for {ip}: {e}")
+            return None
+
     def _query_src_view(self, ip: str, time_range: str) -> Optional[Dict]:
         """
         查詢 IP 在 SRC 視角的統計數據
@@ -69,63 +81,7 @@ class BidirectionalCorrelationAnalyzer:
         Returns:
             SRC 視角的統計數據（聚合結果）
         """
-        query = {
-            "size": 0,
-            "query": {
-                "bool": {
-                    "must": [
-                        {"term": {"src_ip": ip}},
-                        {"range": {"time_bucket": {"gte": time_range}}}
-                    ]
-                }
-            },
-            "aggs": {
-                "stats": {
-                    "stats": {"field": "flow_count"}
-                },
-                "total_bytes": {
-                    "sum": {"field": "total_bytes"}
-                },
-                "unique_dsts": {
-                    "sum": {"field": "unique_dsts"}
-                },
-                "unique_dst_ports": {
-                    "sum": {"field": "unique_dst_ports"}
-                },
-                "top_src_ports": {
-                    "terms": {"field": "top_src_ports", "size": 5}
-                },
-                "records_count": {
-                    "value_count": {"field": "src_ip"}
-                }
-            }
-        }
-
-        try:
-            response = requests.post(
-                f"{self.es_host}/{self.src_index}/_search",
-                json=query,
-                headers={'Content-Type': 'application/json'},
-                timeout=10
-            )
-            response.raise_for_status()
-            data = response.json()
-
-            if data['hits']['total']['value'] == 0:
-                return None
-
-            aggs = data['aggregations']
-            return {
-                'total_flows': aggs['stats']['sum'],
-                'total_bytes': aggs['total_bytes']['value'],
-                'unique_dsts': aggs['unique_dsts']['value'],
-                'unique_dst_ports': aggs['unique_dst_ports']['value'],
-                'records_count': aggs['records_count']['value'],
-                'top_src_ports': aggs['top_src_ports']['buckets']
-            }
-        except Exception as e:
-            print(f"Warning: Failed to query SRC view for {ip}: {e}")
-            return None
+        return self._query_view(ip, time_range, 'SRC')
 
     def _query_dst_view(self, ip: str, time_range: str) -> Optional[Dict]:
         """
@@ -138,63 +94,30 @@ class BidirectionalCorrelationAnalyzer:
         Returns:
             DST 視角的統計數據（聚合結果）
         """
-        query = {
-            "size": 0,
-            "query": {
-                "bool": {
-                    "must": [
-                        {"term": {"dst_ip": ip}},
-                        {"range": {"time_bucket": {"gte": time_range}}}
-                    ]
-                }
-            },
-            "aggs": {
-                "stats": {
-                    "stats": {"field": "flow_count"}
-                },
-                "total_bytes": {
-                    "sum": {"field": "total_bytes"}
-                },
-                "unique_srcs": {
-                    "sum": {"field": "unique_srcs"}
-                },
-                "unique_src_ports": {
-                    "sum": {"field": "unique_src_ports"}
-                },
-                "top_dst_ports": {
-                    "terms": {"field": "top_dst_ports", "size": 5}
-                },
-                "records_count": {
-                    "value_count": {"field": "dst_ip"}
-                }
-            }
-        }
+        return self._query_view(ip, time_range, 'DST')
 
-        try:
-            response = requests.post(
-                f"{self.es_host}/{self.dst_index}/_search",
-                json=query,
-                headers={'Content-Type': 'application/json'},
-                timeout=10
-            )
-            response.raise_for_status()
-            data = response.json()
-
-            if data['hits']['total']['value'] == 0:
-                return None
-
-            aggs = data['aggregations']
-            return {
-                'total_flows': aggs['stats']['sum'],
-                'total_bytes': aggs['total_bytes']['value'],
-                'unique_srcs': aggs['unique_srcs']['value'],
-                'unique_src_ports': aggs['unique_src_ports']['value'],
-                'records_count': aggs['records_count']['value'],
-                'top_dst_ports': aggs['top_dst_ports']['buckets']
-            }
-        except Exception as e:
-            print(f"Warning: Failed to query DST view for {ip}: {e}")
-            return None
+    def query_views_batch(self, ips: List[str], time_range: str) -> Tuple[Dict[str, Dict], Dict[str, Dict]]:
+        """
+        批次查詢多個 IP 的 SRC / DST 視角統計
+
+        結果與 _query_src_view / _query_dst_view 逐一查詢相同；
+        查無資料的 IP 不會出現在結果中。
+
+        Args:
+            ips: IP 列表
+            time_range: 時間範圍
+
+        Returns:
+            (src_stats_by_ip, dst_stats_by_ip)
+
+        Raises:
+            查詢失敗時拋出例外，由呼叫端決定是否退回逐一查詢
+        """
+        ips = [ip for ip in ips if ip]
+        return (
+            self.data_source.view_stats_many(ips, 'SRC', time_range),
+            self.data_source.view_stats_many(ips, 'DST', time_range)
+        )
 
     def _calculate_bidirectional_features(self, src_stats: Optional[Dict],
                                          dst_stats: Optional[Dict]) -> Dict:
@@ -329,7 +252,26 @@ class BidirectionalCorrelationAnalyzer:
             }
         """
         features = self.get_bidirectional_features(ip, time_range)
+        return self.score_server_confidence(features)
+
+    def analyze_server_confidence_from_stats(self, src_stats: Optional[Dict],
+                                             dst_stats: Optional[Dict]) -> Dict:
+        """以已查詢的雙向統計（例如 query_views_batch 的結果）評估 Server 置信度"""
+        features = self._calculate_bidirectional_features(src_stats, dst_stats)
+        return self.score_server_confidence(features)
 
+    def score_server_confidence(self, features: Dict) -> Dict:
+        """
+        依雙向特徵計算 Server 置信度
+
+        Returns:
+            {
+                'is_server': bool,
+                'confidence': float,
+                'reasons': [str],
+                'features': dict
+            }
+        """
         reasons = []
         score = 0.0
 
@@ -10,6 +10,10 @@ import requests
 from typing import Dict, List
 from datetime import datetime
 from ..device_classifier import DeviceClassifier
+from .port_features import (
+    PortBatch, count_high_risk_ports, top_port_in, columns_to_dicts,
+    WEB_PORTS, DB_PORTS, DNS_PORTS, MAIL_PORTS
+)
 
 
 class FeatureEngineer:
@@ -109,6 +113,18 @@ class FeatureEngineer:
         names.extend(extra_features)
         return names
 
+    def _get_thresholds(self) -> Dict:
+        """取得二值特徵閾值（配置優先，否則使用預設值）"""
+        if self.config:
+            return self.config.thresholds
+        return {
+            'high_connection': 1000,
+            'scanning_dsts': 30,
+            'scanning_avg_bytes': 10000,
+            'small_packet': 1000,
+            'large_flow': 104857600
+        }
+
     def extract_features(self, agg_record: Dict) -> Dict:
         """
         從單筆聚合記錄提取特徵
@@ -145,13 +161,7 @@ class FeatureEngineer:
         features['bytes_per_packet'] = features['total_bytes'] / total_packets
 
         # 3. 二值特徵（行為標記）
-        thresholds = self.config.thresholds if self.config else {
-            'high_connection': 1000,
-            'scanning_dsts': 30,
-            'scanning_avg_bytes': 10000,
-            'small_packet': 1000,
-            'large_flow': 104857600
-        }
+        thresholds = self._get_thresholds()
 
         features['is_high_connection'] = 1 if features['flow_count'] > thresholds['high_connection'] else 0
 
@@ -214,6 +224,114 @@ class FeatureEngineer:
 
         return features
 
+    # 整數型特徵（旗標、計數、編碼），轉回字典時保留 int 型別
+    INT_FEATURES = (
+        'is_high_connection', 'is_scanning_pattern', 'is_small_packet',
+        'is_large_flow', 'is_likely_server_response', 'device_type',
+        'hour_of_day', 'day_of_week', 'is_weekend', 'is_business_hours', 'is_late_night',
+        'is_likely_web_server', 'is_likely_db_server', 'is_likely_dns_server',
+        'is_likely_mail_server', 'has_sequential_dst_ports', 'high_risk_ports_count'
+    )
+
+    def extract_classification_features_batch(self, agg_records: List[Dict]) -> List[Dict]:
+        """
+        批量提取分類特徵（extract_classification_features 的批次版本）
+
+        檢測特徵與端口特徵皆以列式運算一次完成，再轉回每筆記錄的字典。
+
+        Args:
+            agg_records: 多筆聚合記錄
+
+        Returns:
+            擴展的特徵字典列表（與輸入順序一致）
+        """
+        if not agg_records:
+            return []
+
+        cols = self.extract_feature_columns(agg_records)
+        cols.update(self.extract_port_features_batch(agg_records))
+
+        # 速率特徵 (窗口為 3 分鐘 = 180 秒)
+        duration = 180
+        cols['flow_rate'] = cols['flow_count'] / duration
+        cols['byte_rate'] = cols['total_bytes'] / duration
+
+        features_list = columns_to_dicts(cols, int_names=self.INT_FEATURES)
+
+        # 基礎特徵保留原始型別
+        for record, features in zip(agg_records, features_list):
+            for field in self.BASIC_FIELDS:
+                features[field] = record.get(field, 0)
+
+        return features_list
+
+    def extract_port_features_batch(self, agg_records: List[Dict]) -> Dict[str, np.ndarray]:
+        """
+        批量提取端口特徵（_extract_port_features 的向量化版本）
+
+        Args:
+            agg_records: 多筆聚合記錄，包含 top_src_ports 和 top_dst_ports
+
+        Returns:
+            {特徵名稱: 陣列}
+        """
+        n = len(agg_records)
+        flow_count = np.maximum(
+            np.fromiter((r.get('flow_count', 1) for r in agg_records), dtype=np.float64, count=n), 1
+        )
+
+        src_ports = PortBatch.from_records(agg_records, 'top_src_ports')
+        dst_ports = PortBatch.from_records(agg_records, 'top_dst_ports')
+
+        port_features = {}
+
+        # === 1. Port 集中度特徵 ===
+        port_features['top_src_port_concentration'] = src_ports.concentration(flow_count)
+        port_features['top_dst_port_concentration'] = dst_ports.concentration(flow_count)
+
+        # === 2. Well-known/Ephemeral Port 比例 ===
+        src_port_ratios = src_ports.type_ratios(flow_count)
+        dst_port_ratios = dst_ports.type_ratios(flow_count)
+
+        port_features['src_well_known_ratio'] = src_port_ratios['well_known']
+        port_features['src_ephemeral_ratio'] = src_port_ratios['ephemeral']
+        port_features['src_registered_ratio'] = src_port_ratios['registered']
+
+        port_features['dst_well_known_ratio'] = dst_port_ratios['well_known']
+        port_features['dst_ephemeral_ratio'] = dst_port_ratios['ephemeral']
+        port_features['dst_registered_ratio'] = dst_port_ratios['registered']
+
+        # 保留舊的命名以兼容現有代碼
+        port_features['common_ports_ratio'] = dst_port_ratios['well_known']
+        port_features['dynamic_ports_ratio'] = dst_port_ratios['ephemeral']
+        port_features['registered_ports_ratio'] = dst_port_ratios['registered']
+
+        # === 3. Server 角色識別特徵 ===
+        # Web Server: top src port 為 Web 端口，且 dst ports 平均為隨機高位端口
+        is_web = (
+            top_port_in(src_ports, WEB_PORTS) &
+            ~dst_ports.is_empty() &
+            (dst_ports.weighted_mean_port() > 10000)
+        )
+        port_features['is_likely_web_server'] = is_web.astype(np.float64)
+        port_features['is_likely_db_server'] = top_port_in(src_ports, DB_PORTS).astype(np.float64)
+        port_features['is_likely_dns_server'] = top_port_in(src_ports, DNS_PORTS).astype(np.float64)
+        port_features['is_likely_mail_server'] = top_port_in(src_ports, MAIL_PORTS).astype(np.float64)
+
+        # === 4. Port Entropy ===
+        port_features['src_port_entropy'] = src_ports.entropy()
+        port_features['dst_port_entropy'] = dst_ports.entropy()
+
+        # === 5. Sequential Ports 檢測 ===
+        port_features['has_sequential_dst_ports'] = dst_ports.has_sequential().astype(np.float64)
+
+        # === 6. High-risk Ports ===
+        port_features['high_risk_ports_count'] = count_high_risk_ports(
+            src_ports, dst_ports
+        ).astype(np.float64)
+
+        return port_features
+
     def _extract_port_features(self, agg_record: Dict) -> Dict:
         """
         從 top_src_ports 和 top_dst_ports 提取端口特徵
@@ -514,26 +632,123 @@ class FeatureEngineer:
 
         return time_features
 
-    def extract_features_batch(self, agg_records: List[Dict]) -> np.ndarray:
+    # 基礎特徵欄位（直接從聚合記錄讀取）
+    BASIC_FIELDS = (
+        'flow_count', 'total_bytes', 'total_packets',
+        'unique_dsts', 'unique_src_ports', 'unique_dst_ports',
+        'avg_bytes', 'max_bytes'
+    )
+
+    # 特徵提取與異常組裝需要的聚合記錄欄位（查詢時的 _source 過濾）
+    SOURCE_FIELDS = ('src_ip', 'time_bucket') + BASIC_FIELDS + ('top_src_ports', 'top_dst_ports')
+
+    def extract_feature_columns(self, agg_records: List[Dict]) -> Dict[str, np.ndarray]:
+        """
+        列式（columnar）特徵提取
+
+        一次把整批記錄轉成 NumPy 欄位，再以陣列運算計算衍生比例、
+        二值標記、對數變換與設備類型編碼。結果與 extract_features 逐筆計算一致。
+
+        Args:
+            agg_records: 多筆聚合記錄
+
+        Returns:
+            {特徵名稱: 長度為 n_samples 的 float64 陣列}
+        """
+        n = len(agg_records)
+        cols = {}
+
+        # 1. 基礎特徵
+        for field in self.BASIC_FIELDS:
+            cols[field] = np.fromiter(
+                (r.get(field, 0) for r in agg_records), dtype=np.float64, count=n
+            )
+
+        flow_count = cols['flow_count']
+        total_bytes = cols['total_bytes']
+        avg_bytes = cols['avg_bytes']
+
+        # 2. 衍生特徵（避免除以0）
+        flow_count_safe = np.maximum(flow_count, 1)
+        cols['dst_diversity'] = cols['unique_dsts'] / flow_count_safe
+        cols['src_port_diversity'] = cols['unique_src_ports'] / flow_count_safe
+        cols['dst_port_diversity'] = cols['unique_dst_ports'] / flow_count_safe
+        cols['traffic_concentration'] = cols['max_bytes'] / np.maximum(total_bytes, 1)
+        cols['bytes_per_packet'] = total_bytes / np.maximum(cols['total_packets'], 1)
+
+        # 3. 二值特徵（閾值每批只解析一次）
+        thresholds = self._get_thresholds()
+
+        cols['is_high_connection'] = (flow_count > thresholds['high_connection']).astype(np.float64)
+        cols['is_scanning_pattern'] = (
+            (cols['unique_dsts'] > thresholds['scanning_dsts']) &
+            (avg_bytes < thresholds['scanning_avg_bytes'])
+        ).astype(np.float64)
+        cols['is_small_packet'] = (avg_bytes < thresholds['small_packet']).astype(np.float64)
+        cols['is_large_flow'] = (cols['max_bytes'] > thresholds['large_flow']).astype(np.float64)
+        cols['is_likely_server_response'] = (
+            (cols['src_port_diversity'] < thresholds.get('server_response_src_port_diversity_max', 0.1)) &
+            (cols['dst_port_diversity'] > thresholds.get('server_response_dst_port_diversity_min', 0.3)) &
+            (cols['unique_src_ports'] <= thresholds.get('server_response_unique_src_ports_max', 100)) &
+            (flow_count > thresholds.get('server_response_flow_count_min', 100)) &
+            (avg_bytes < thresholds.get('server_response_avg_bytes_max', 50000))
+        ).astype(np.float64)
+
+        # 4. 對數變換
+        cols['log_flow_count'] = np.log1p(flow_count)
+        cols['log_total_bytes'] = np.log1p(total_bytes)
+
+        # 5. 設備類型（同一批內相同 IP 只分類一次）
+        cols['device_type'] = self.device_classifier.classify_many(
+            [r.get('src_ip', '') for r in agg_records]
+        ).astype(np.float64)
+
+        # 6. 時間序列特徵（同一 time_bucket 只解析一次）
+        if self.config and 'time_series' in self.config.features_config:
+            bucket_features = {}
+            for r in agg_records:
+                time_bucket = r.get('time_bucket')
+                if time_bucket not in bucket_features:
+                    bucket_features[time_bucket] = self._extract_time_features(time_bucket)
+            for name in self._extract_time_features(None):
+                cols[name] = np.fromiter(
+                    (bucket_features[r.get('time_bucket')][name] for r in agg_records),
+                    dtype=np.float64, count=n
+                )
+
+        return cols
+
+    def extract_features_batch(self, agg_records: List[Dict], columnar: bool = True) -> np.ndarray:
         """
         批量提取特徵
 
         Args:
             agg_records: 多筆聚合記錄
+            columnar: 使用列式向量化路徑（預設）；False 時逐筆呼叫 extract_features
 
         Returns:
-            特徵矩陣 (n_samples, n_features)
+            特徵矩陣 (n_samples, n_features)，欄位順序為 detection_feature_names
         """
-        features_list = []
+        if not agg_records:
+            return np.array([])
+
+        if not columnar:
+            features_list = []
+            for record in agg_records:
+                features = self.extract_features(record)
+                # 按照 detection_feature_names 的順序構建特徵向量
+                feature_vector = [features[name] for name in self.detection_feature_names]
+                features_list.append(feature_vector)
+            return np.array(features_list)
+
+        cols = self.extract_feature_columns(agg_records)
 
-        for record in agg_records:
-            features = self.extract_features(record)
-            features = self.extract_features(record)
-            # 按照 detection_feature_names 的順序構建特徵向量
-            feature_vector = [features[name] for name in self.detection_feature_names]
-            features_list.append(feature_vector)
+        # 直接寫入預先配置的矩陣
+        X = np.empty((len(agg_records), len(self.detection_feature_names)), dtype=np.float64)
+        for j, name in enumerate(self.detection_feature_names):
+            X[:, j] = cols[name]
 
-        return np.array(features_list)
+        return X
 
     def get_feature_vector(self, features_dict: Dict) -> np.ndarray:
         """
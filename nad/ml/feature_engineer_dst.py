@@ -11,9 +11,21 @@ Dst 視角的特徵工程模組
 """
 
 import numpy as np
-from typing import Dict, List
+from typing import Dict, List, Tuple
 from datetime import datetime
 
+try:
+    from .port_features import (
+        PortBatch, count_high_risk_ports, top_port_in, columns_to_dicts,
+        WEB_PORTS, DB_PORTS, DNS_PORTS
+    )
+except ImportError:
+    # 如果作為腳本直接運行
+    from port_features import (
+        PortBatch, count_high_risk_ports, top_port_in, columns_to_dicts,
+        WEB_PORTS, DB_PORTS, DNS_PORTS
+    )
+
 
 class FeatureEngineerDst:
     """
@@ -95,6 +107,14 @@ class FeatureEngineerDst:
             'multi_port_min_flow_count': 500
         }
 
+    def _get_thresholds(self) -> Dict:
+        """取得閾值設定（優先使用 thresholds_by_dst，為空時使用預設值）"""
+        if self.config and hasattr(self.config, 'thresholds_by_dst'):
+            thresholds = self.config.thresholds_by_dst
+            if thresholds:
+                return thresholds
+        return self._get_default_thresholds()
+
     def extract_features(self, record: Dict) -> np.ndarray:
         """
         從單筆 by_dst 聚合記錄提取特徵
@@ -136,13 +156,7 @@ class FeatureEngineerDst:
         bytes_per_packet = total_bytes / total_packets_safe
 
         # 取得閾值設定（優先使用 thresholds_by_dst，否則使用預設值）
-        if self.config and hasattr(self.config, 'thresholds_by_dst'):
-            thresholds = self.config.thresholds_by_dst
-            # 如果 thresholds_by_dst 為空，使用預設值
-            if not thresholds:
-                thresholds = self._get_default_thresholds()
-        else:
-            thresholds = self._get_default_thresholds()
+        thresholds = self._get_thresholds()
 
         # 二值行為特徵
         # 1. DDoS 攻擊目標檢測
@@ -264,6 +278,39 @@ class FeatureEngineerDst:
 
         return features
 
+    # 整數型端口特徵（旗標、計數），轉回字典時保留 int 型別
+    INT_PORT_FEATURES = (
+        'is_likely_web_server', 'is_likely_db_server', 'is_likely_dns_server',
+        'has_sequential_src_ports', 'high_risk_dst_ports_count'
+    )
+
+    def extract_classification_features_batch(self, records: List[Dict]) -> List[Dict]:
+        """
+        批量提取分類特徵（extract_classification_features 的批次版本）
+
+        檢測特徵與端口特徵皆以列式運算一次完成，再轉回每筆記錄的字典。
+
+        Args:
+            records: netflow_stats_3m_by_dst 記錄列表
+
+        Returns:
+            擴展的特徵字典列表（與輸入順序一致）
+        """
+        if not records:
+            return []
+
+        feature_cols = self.extract_feature_columns(records)
+        n = len(records)
+        cols = {name: feature_cols.get(name, np.zeros(n)) for name in self.feature_names}
+        cols.update(self.extract_port_features_batch(records))
+
+        # 速率特徵 (窗口為 3 分鐘 = 180 秒)
+        duration = 180
+        cols['flow_rate'] = cols.get('flow_count', np.zeros(n)) / duration
+        cols['byte_rate'] = cols.get('total_bytes', np.zeros(n)) / duration
+
+        return columns_to_dicts(cols, int_names=self.INT_PORT_FEATURES)
+
     def _extract_port_features(self, record: Dict) -> Dict:
         """
         從 top_src_ports 和 top_dst_ports 提取端口特徵（DST 視角）
@@ -318,6 +365,54 @@ class FeatureEngineerDst:
 
         return port_features
 
+    def extract_port_features_batch(self, records: List[Dict]) -> Dict[str, np.ndarray]:
+        """
+        批量提取端口特徵（_extract_port_features 的向量化版本，DST 視角）
+
+        Args:
+            records: 聚合記錄列表，包含 top_src_ports 和 top_dst_ports
+
+        Returns:
+            {特徵名稱: 陣列}
+        """
+        n = len(records)
+        flow_count = np.maximum(
+            np.fromiter((r.get('flow_count', 1) for r in records), dtype=np.float64, count=n), 1
+        )
+
+        src_ports = PortBatch.from_records(records, 'top_src_ports')
+        dst_ports = PortBatch.from_records(records, 'top_dst_ports')
+
+        port_features = {}
+
+        # === 1. Port 集中度特徵 ===
+        port_features['top_src_port_concentration'] = src_ports.concentration(flow_count)
+        port_features['top_dst_port_concentration'] = dst_ports.concentration(flow_count)
+
+        # === 2. Well-known/Ephemeral Port 比例 ===
+        src_port_ratios = src_ports.type_ratios(flow_count)
+        dst_port_ratios = dst_ports.type_ratios(flow_count)
+
+        port_features['src_well_known_ratio'] = src_port_ratios['well_known']
+        port_features['src_ephemeral_ratio'] = src_port_ratios['ephemeral']
+        port_features['dst_well_known_ratio'] = dst_port_ratios['well_known']
+        port_features['dst_ephemeral_ratio'] = dst_port_ratios['ephemeral']
+
+        # === 3. Server 識別（DST 視角：作為接收端）===
+        port_features['is_likely_web_server'] = top_port_in(dst_ports, WEB_PORTS).astype(np.float64)
+        port_features['is_likely_db_server'] = top_port_in(dst_ports, DB_PORTS).astype(np.float64)
+        port_features['is_likely_dns_server'] = top_port_in(dst_ports, DNS_PORTS).astype(np.float64)
+
+        # === 4. Port Entropy ===
+        port_features['src_port_entropy'] = src_ports.entropy()
+        port_features['dst_port_entropy'] = dst_ports.entropy()
+
+        # === 5. 攻擊模式檢測 ===
+        port_features['has_sequential_src_ports'] = src_ports.has_sequential().astype(np.float64)
+        port_features['high_risk_dst_ports_count'] = count_high_risk_ports(dst_ports).astype(np.float64)
+
+        return port_features
+
     def _calculate_port_concentration(self, ports_list: List[tuple], flow_count: int) -> float:
         """計算端口集中度"""
         if not ports_list or flow_count == 0:
@@ -407,33 +502,163 @@ class FeatureEngineerDst:
         ports = {port for port, _ in ports_list}
         return len(ports & high_risk_ports)
 
-    def extract_features_batch(self, records: List[Dict]) -> np.ndarray:
+    # 基礎特徵欄位（直接從聚合記錄讀取）
+    BASIC_FIELDS = (
+        'unique_srcs', 'unique_src_ports', 'unique_dst_ports',
+        'flow_count', 'total_bytes', 'total_packets',
+        'avg_bytes', 'max_bytes'
+    )
+
+    # 特徵提取與異常組裝需要的聚合記錄欄位（查詢時的 _source 過濾）
+    SOURCE_FIELDS = ('dst_ip', 'time_bucket') + BASIC_FIELDS + ('top_src_ports', 'top_dst_ports')
+
+    def extract_feature_columns(self, records: List[Dict]) -> Dict[str, np.ndarray]:
+        """
+        列式（columnar）特徵提取
+
+        閾值每批只解析一次，所有 per-src 比例與二值目標標記皆以陣列運算完成。
+        結果與 extract_features 逐筆計算一致。
+
+        Args:
+            records: netflow_stats_3m_by_dst 記錄列表
+
+        Returns:
+            {特徵名稱: 長度為 n_samples 的 float64 陣列}，包含所有中間特徵
+        """
+        n = len(records)
+        cols = {}
+
+        # 基礎特徵
+        for field in self.BASIC_FIELDS:
+            cols[field] = np.fromiter(
+                (r.get(field, 0) for r in records), dtype=np.float64, count=n
+            )
+
+        unique_srcs = cols['unique_srcs']
+        unique_dst_ports = cols['unique_dst_ports']
+        flow_count = cols['flow_count']
+        total_bytes = cols['total_bytes']
+        total_packets = cols['total_packets']
+        avg_bytes = cols['avg_bytes']
+
+        # 防止除以零
+        unique_srcs_safe = np.maximum(unique_srcs, 1)
+        flow_count_safe = np.maximum(flow_count, 1)
+
+        # 衍生特徵
+        cols['flows_per_src'] = flow_count / unique_srcs_safe
+        cols['bytes_per_src'] = total_bytes / unique_srcs_safe
+        cols['packets_per_src'] = total_packets / unique_srcs_safe
+        cols['bytes_per_flow'] = total_bytes / flow_count_safe
+        cols['packets_per_flow'] = total_packets / flow_count_safe
+        cols['src_port_diversity'] = cols['unique_src_ports'] / unique_srcs_safe
+        cols['dst_port_diversity'] = unique_dst_ports / unique_srcs_safe
+        cols['traffic_concentration'] = cols['bytes_per_src']
+
+        # 進階衍生特徵
+        cols['port_attack_breadth'] = unique_dst_ports / flow_count_safe
+        cols['avg_src_activity'] = cols['flows_per_src']
+        cols['bytes_per_packet'] = total_bytes / np.maximum(total_packets, 1)
+
+        # 二值行為特徵（閾值每批只解析一次）
+        t = self._get_thresholds()
+        flows_per_src = cols['flows_per_src']
+
+        flags = {
+            # 1. DDoS 攻擊目標
+            'is_ddos_target': (
+                (unique_srcs > t['ddos_min_srcs']) &
+                (flows_per_src < t['ddos_max_flows_per_src']) &
+                (avg_bytes < t['ddos_max_avg_bytes'])
+            ),
+            # 2. 被掃描目標
+            'is_scan_target': (
+                (unique_dst_ports > t['scan_min_dst_ports']) &
+                (avg_bytes < t['scan_max_avg_bytes']) &
+                (cols['packets_per_flow'] < t['scan_max_packets_per_flow'])
+            ),
+            # 3. 高流量接收
+            'is_high_receiver': (
+                (total_bytes > t['high_receiver_min_bytes']) &
+                (cols['bytes_per_src'] > t['high_receiver_min_bytes_per_src'])
+            ),
+            # 4. 服務器行為（正常）
+            'is_likely_server': (
+                (unique_srcs > t['server_min_srcs']) &
+                (unique_dst_ports <= t['server_max_dst_ports']) &
+                (cols['dst_port_diversity'] < t['server_max_dst_port_diversity']) &
+                (flows_per_src > t['server_min_flows_per_src'])
+            ),
+            # 5. 異常連線模式
+            'is_abnormal_pattern': (
+                (unique_srcs < t['abnormal_max_srcs']) &
+                (flow_count > t['abnormal_min_flow_count']) &
+                (cols['src_port_diversity'] > t['abnormal_min_src_port_diversity'])
+            ),
+            # 6. 端口集中
+            'is_port_concentrated': unique_dst_ports <= t['port_concentrated_max_dst_ports'],
+            # 7. 多端口攻擊
+            'is_multi_port_attack': (
+                (unique_dst_ports > t['multi_port_min_dst_ports']) &
+                (flow_count > t['multi_port_min_flow_count']) &
+                (avg_bytes < t['scan_max_avg_bytes'])
+            ),
+        }
+        for name, mask in flags.items():
+            cols[name] = mask.astype(np.float64)
+
+        # 對數特徵
+        cols['log_unique_srcs'] = np.log1p(unique_srcs)
+        cols['log_flow_count'] = np.log1p(flow_count)
+        cols['log_total_bytes'] = np.log1p(total_bytes)
+
+        return cols
+
+    def columns_to_matrix(self, cols: Dict[str, np.ndarray], n_samples: int) -> np.ndarray:
+        """依 feature_names 順序將特徵欄位寫入預先配置的矩陣（未知特徵為 0）"""
+        X = np.zeros((n_samples, len(self.feature_names)), dtype=np.float64)
+        for j, name in enumerate(self.feature_names):
+            if name in cols:
+                X[:, j] = cols[name]
+        return X
+
+    def extract_features_batch(self, records: List[Dict],
+                               columnar: bool = True) -> Tuple[np.ndarray, np.ndarray]:
         """
         批量提取特徵
 
         Args:
             records: netflow_stats_5m_by_dst 記錄列表
+            columnar: 使用列式向量化路徑（預設，格式錯誤的記錄會直接拋出例外）；
+                False 時逐筆呼叫 extract_features，跳過格式錯誤的記錄
 
         Returns:
-            特徵矩陣 (n_samples, n_features)
+            (特徵矩陣 (n_samples, n_features), 矩陣各列對應的記錄索引)
+
+        Note:
+            需要中間特徵欄位時，直接使用 extract_feature_columns + columns_to_matrix
         """
         if not records:
-            return np.array([])
+            return np.array([]), np.array([], dtype=np.int64)
+
+        if columnar:
+            cols = self.extract_feature_columns(records)
+            return self.columns_to_matrix(cols, len(records)), np.arange(len(records))
 
         features_list = []
-        for record in records:
+        kept = []
+        for i, record in enumerate(records):
             try:
                 features = self.extract_features(record)
                 features_list.append(features)
+                kept.append(i)
             except Exception as e:
                 # 記錄錯誤但繼續處理
                 print(f"Warning: Failed to extract features from record: {e}")
                 continue
 
-        if not features_list:
-            return np.array([])
-
-        return np.array(features_list, dtype=np.float64)
+        X = np.array(features_list, dtype=np.float64) if features_list else np.array([])
+        return X, np.array(kept, dtype=np.int64)
 
     def get_feature_names(self) -> List[str]:
         """返回特徵名稱列表"""
@@ -524,7 +749,7 @@ def test_feature_extraction():
 
     print("\n批量提取測試:")
     records = [normal_server, ddos_target, scan_target]
-    batch_features = engineer.extract_features_batch(records)
+    batch_features, _ = engineer.extract_features_batch(records)
     print(f"✓ 成功提取 {batch_features.shape[0]} 筆記錄的特徵")
     print(f"✓ 特徵維度: {batch_features.shape[1]}")
     print(f"✓ 特徵數量與定義一致: {batch_features.shape[1] == engineer.get_n_features()}")
@@ -0,0 +1,219 @@
+#!/usr/bin/env python3
+"""
+特徵矩陣磁碟快取（Feature Store）
+
+將已提取的訓練特徵矩陣依「視角 / 特徵配置雜湊 / 日期」分區存為 .npy，
+重新訓練時以 memory-map 方式讀取已完成的日期（組裝訓練矩陣時仍會複製），
+只對缺少的日期查詢 ES 並提取特徵。特徵配置（features、thresholds）或設備映射
+（device_mapping.yaml，device_type 特徵的來源）改變時雜湊不同，舊分區自動失效。
+
+目錄結構：
+    {base_dir}/{perspective}/{config_hash}/{YYYY-MM-DD}.npy
+    {base_dir}/{perspective}/{config_hash}/meta.json
+"""
+
+import hashlib
+import json
+import os
+from datetime import datetime, timedelta, timezone
+from typing import Callable, Dict, List, Optional
+
+import numpy as np
+
+# 特徵計算邏輯改版時遞增，使所有舊分區失效
+FEATURE_STORE_VERSION = 1
+
+
+def compute_config_hash(feature_names: List[str], features_config: Optional[Dict] = None,
+                        thresholds: Optional[Dict] = None, device_mapping: Optional[Dict] = None) -> str:
+    """
+    計算特徵配置雜湊
+
+    Args:
+        feature_names: 特徵名稱（依矩陣欄位順序）
+        features_config: features / features_by_dst 配置
+        thresholds: thresholds / thresholds_by_dst 配置
+        device_mapping: 設備映射內容（特徵含 device_type 時）
+
+    Returns:
+        16 字元十六進位雜湊
+    """
+    payload = {
+        'version': FEATURE_STORE_VERSION,
+        'feature_names': list(feature_names),
+        'features': features_config or {},
+        'thresholds': thresholds or {},
+        'device_mapping': device_mapping or {},
+    }
+    encoded = json.dumps(payload, sort_keys=True, default=str).encode('utf-8')
+    return hashlib.sha256(encoded).hexdigest()[:16]
+
+
+class FeatureStore:
+    """
+    依日期分區的特徵矩陣快取
+
+    只快取已結束的 UTC 日期；當天的資料仍在寫入，每次都重新查詢。
+    """
+
+    def __init__(self, base_dir: str, perspective: str, config_hash: str,
+                 feature_names: List[str]):
+        self.perspective = perspective
+        self.config_hash = config_hash
+        self.feature_names = list(feature_names)
+        self.partition_dir = os.path.join(base_dir, perspective, config_hash)
+        os.makedirs(self.partition_dir, exist_ok=True)
+        self._write_meta()
+
+    @classmethod
+    def from_config(cls, config, perspective: str, feature_names: List[str],
+                    features_config: Optional[Dict] = None,
+                    thresholds: Optional[Dict] = None,
+                    device_mapping: Optional[Dict] = None) -> Optional['FeatureStore']:
+        """
+        依 config.yaml 的 feature_store 區塊建立（未啟用時返回 None）
+
+        Args:
+            config: Config 對象
+            perspective: 'by_src' 或 'by_dst'
+            feature_names: 特徵名稱
+            features_config: 特徵配置（用於雜湊）
+            thresholds: 閾值配置（用於雜湊）
+            device_mapping: 設備映射內容（用於雜湊）
+        """
+        store_config = config.get('feature_store', {}) if hasattr(config, 'get') else {}
+        if not store_config.get('enabled', False):
+            return None
+
+        base_dir = store_config.get('dir', 'nad/feature_store')
+        config_hash = compute_config_hash(feature_names, features_config, thresholds, device_mapping)
+        return cls(base_dir, perspective, config_hash, feature_names)
+
+    # ========== 分區讀寫 ==========
+
+    def _partition_path(self, day: datetime) -> str:
+        return os.path.join(self.partition_dir, f"{day.strftime('%Y-%m-%d')}.npy")
+
+    def _write_meta(self):
+        meta_path = os.path.join(self.partition_dir, 'meta.json')
+        if os.path.exists(meta_path):
+            return
+        with open(meta_path, 'w', encoding='utf-8') as f:
+            json.dump({
+                'perspective': self.perspective,
+                'config_hash': self.config_hash,
+                'feature_names': self.feature_names,
+                'version': FEATURE_STORE_VERSION,
+                'created_at': datetime.now().isoformat(),
+            }, f, ensure_ascii=False, indent=2)
+
+    def has_day(self, day: datetime) -> bool:
+        """該日期分區是否已快取"""
+        return os.path.exists(self._partition_path(day))
+
+    def load_day(self, day: datetime) -> Optional[np.ndarray]:
+        """以 memory-map 唯讀方式載入日期分區（不存在時返回 None）"""
+        path = self._partition_path(day)
+        if not os.path.exists(path):
+            return None
+        return np.load(path, mmap_mode='r')
+
+    def save_day(self, day: datetime, X: np.ndarray):
+        """寫入日期分區（先寫暫存檔再原子替換，避免中斷留下損毀檔案）"""
+        X = np.asarray(X, dtype=np.float64)
+        if X.size == 0:
+            X = np.zeros((0, len(self.feature_names)), dtype=np.float64)
+
+        path = self._partition_path(day)
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            np.save(f, X)
+        os.replace(tmp_path, path)
+
+    # ========== 訓練矩陣組裝 ==========
+
+    def build_matrix(self, days: int,
+                     fetch_range: Callable[[datetime, datetime], List[Dict]],
+                     extract: Callable[[List[Dict]], np.ndarray],
+                     now: Optional[datetime] = None) -> np.ndarray:
+        """
+        組裝過去 N 天的訓練特徵矩陣
+
+        範圍與 ES 查詢的 now-{days}d 相同，即 [now - days, now)：
+        中間的完整 UTC 日期優先讀快取，缺少時呼叫 fetch_range(start, end)
+        與 extract(records) 後寫入快取；頭尾兩段不完整的日期
+        （[now - days, 次日 00:00) 與 [今天 00:00, now)）每次重新查詢且不快取。
+
+        Args:
+            days: 天數
+            fetch_range: 查詢 [start, end) 範圍聚合記錄的函數
+            extract: 記錄列表 → 特徵矩陣的函數
+            now: 目前時間（UTC，測試用）
+
+        Returns:
+            特徵矩陣 (n_samples, n_features)
+        """
+        now = now or datetime.now(timezone.utc)
+        start = now - timedelta(days=days)
+        today = now.replace(hour=0, minute=0, second=0, microsecond=0)
+        first_day = start.replace(hour=0, minute=0, second=0, microsecond=0)
+        if first_day < start:
+            first_day += timedelta(days=1)
+
+        parts = []
+        n_cached = 0
+        n_fetched = 0
+
+        def fetch_partial(range_start, range_end):
+            # 不完整的日期不寫入快取
+            records = fetch_range(range_start, range_end)
+            if records:
+                parts.append(extract(records))
+
+        if start < first_day:
+            fetch_partial(start, first_day)
+            n_fetched += 1
+
+        day = first_day
+        while day < today:
+            X_day = self.load_day(day)
+            if X_day is None:
+                records = fetch_range(day, day + timedelta(days=1))
+                X_day = extract(records) if records else np.zeros((0, len(self.feature_names)))
+                self.save_day(day, X_day)
+                n_fetched += 1
+            else:
+                n_cached += 1
+
+            if len(X_day) > 0:
+                parts.append(X_day)
+            day += timedelta(days=1)
+
+        if today < now:
+            fetch_partial(today, now)
+            n_fetched += 1
+
+        print(f"  Feature store ({self.perspective}/{self.config_hash}): "
+              f"{n_cached} 天來自快取, {n_fetched} 天重新查詢")
+
+        if not parts:
+            return np.array([])
+
+        return np.concatenate(parts, axis=0)
+
+    def prune(self, keep_days: int, now: Optional[datetime] = None) -> int:
+        """
+        刪除早於 keep_days 的分區
+
+        Returns:
+            刪除的分區數
+        """
+        now = now or datetime.now(timezone.utc)
+        cutoff = (now - timedelta(days=keep_days)).strftime('%Y-%m-%d')
+
+        removed = 0
+        for name in os.listdir(self.partition_dir):
+            if name.endswith('.npy') and name[:-4] < cutoff:
+                os.remove(os.path.join(self.partition_dir, name))
+                removed += 1
+        return removed
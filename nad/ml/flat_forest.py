@@ -0,0 +1,206 @@
+#!/usr/bin/env python3
+"""
+扁平化的 NumPy Isolation Forest 評分器
+
+將訓練好的 sklearn IsolationForest 匯出為連續陣列
+（feature, threshold, left, right, leaf 路徑長度），
+以向量化方式一次走訪所有樹，同時得到異常分數與預測標籤，
+取代 predict() + score_samples() 各走訪一次所有樹的作法。
+
+結果與 sklearn 一致（相同的 float32 輸入轉換、相同的逐樹累加順序）。
+"""
+
+import numpy as np
+from typing import Tuple
+
+
+def _average_path_length(n_samples: np.ndarray) -> np.ndarray:
+    """n 筆樣本的 iTree 平均路徑長度 c(n)（與 sklearn 相同公式）"""
+    n_samples = np.asarray(n_samples, dtype=np.float64)
+    result = np.zeros_like(n_samples)
+    result[n_samples == 2] = 1.0
+    mask = n_samples > 2
+    result[mask] = (
+        2.0 * (np.log(n_samples[mask] - 1.0) + np.euler_gamma)
+        - 2.0 * (n_samples[mask] - 1.0) / n_samples[mask]
+    )
+    return result
+
+
+class FlatIsolationForest:
+    """
+    扁平化的 Isolation Forest
+
+    所有樹的節點串接為同一組陣列；葉節點的 left/right 指向自己，
+    因此可以固定走訪 max_depth 步而不需分支判斷。
+    """
+
+    # 每次處理的樣本數（控制 n_samples × n_trees 中間陣列的記憶體）
+    CHUNK_SIZE = 2048
+
+    def __init__(self, feature: np.ndarray, threshold: np.ndarray,
+                 left: np.ndarray, right: np.ndarray, leaf_value: np.ndarray,
+                 roots: np.ndarray, max_depth: int, denominator: float,
+                 offset: float, n_features: int):
+        self.feature = feature
+        self.threshold = threshold
+        self.left = left
+        self.right = right
+        self.leaf_value = leaf_value
+        self.roots = roots
+        self.max_depth = max_depth
+        self.denominator = denominator
+        self.offset = offset
+        self.n_features = n_features
+        self.n_nodes = len(feature)
+        self._children = np.concatenate([left, right]).astype(np.int64)
+
+    @classmethod
+    def from_sklearn(cls, model) -> 'FlatIsolationForest':
+        """
+        從已訓練的 sklearn IsolationForest 匯出
+
+        Args:
+            model: sklearn.ensemble.IsolationForest
+
+        Returns:
+            FlatIsolationForest
+        """
+        features, thresholds, lefts, rights, leaf_values, roots = [], [], [], [], [], []
+        max_depth = 0
+        base = 0
+
+        for tree, tree_features in zip(model.estimators_, model.estimators_features_):
+            t = tree.tree_
+            n_nodes = t.node_count
+            is_leaf = t.children_left == -1
+            node_ids = np.arange(n_nodes)
+
+            # 節點深度（根為 0）
+            depth = np.zeros(n_nodes, dtype=np.int64)
+            for node in range(n_nodes):
+                if not is_leaf[node]:
+                    depth[t.children_left[node]] = depth[node] + 1
+                    depth[t.children_right[node]] = depth[node] + 1
+            max_depth = max(max_depth, int(depth.max()))
+
+            # 子樹的特徵索引轉為全域欄位索引
+            tree_features = np.asarray(tree_features)
+            features.append(np.where(is_leaf, 0, tree_features[np.where(is_leaf, 0, t.feature)]))
+            thresholds.append(np.where(is_leaf, np.inf, t.threshold))
+            lefts.append(np.where(is_leaf, node_ids, t.children_left) + base)
+            rights.append(np.where(is_leaf, node_ids, t.children_right) + base)
+
+            # 與 sklearn 相同：決策路徑節點數 + c(葉節點樣本數) - 1
+            path_length = depth + 1.0
+            leaf_values.append(
+                path_length + _average_path_length(t.n_node_samples) - 1.0
+            )
+
+            roots.append(base)
+            base += n_nodes
+
+        denominator = len(model.estimators_) * _average_path_length(
+            np.array([model._max_samples]))[0]
+
+        return cls(
+            feature=np.concatenate(features).astype(np.int64),
+            threshold=np.concatenate(thresholds).astype(np.float64),
+            left=np.concatenate(lefts).astype(np.int64),
+            right=np.concatenate(rights).astype(np.int64),
+            leaf_value=np.concatenate(leaf_values),
+            roots=np.array(roots, dtype=np.int64),
+            max_depth=max_depth,
+            denominator=float(denominator),
+            offset=float(model.offset_),
+            n_features=int(model.n_features_in_),
+        )
+
+    @property
+    def n_trees(self) -> int:
+        return len(self.roots)
+
+    def _depths(self, X: np.ndarray) -> np.ndarray:
+        """計算每筆樣本在所有樹的路徑長度總和"""
+        n = len(X)
+        nodes = np.broadcast_to(self.roots, (n, self.n_trees)).copy()
+        # 以一維索引取值：X.ravel()[row * n_features + feature]
+        row_base = (np.arange(n, dtype=self._children.dtype) * self.n_features)[:, None]
+        X_flat = X.ravel()
+
+        for _ in range(self.max_depth):
+            values = X_flat[row_base + self.feature[nodes]]
+            go_right = values > self.threshold[nodes]
+            # children = [left..., right...]
+            nodes = self._children[nodes + go_right * self.n_nodes]
+
+        leaf_values = self.leaf_value[nodes]
+
+        # 逐樹依序累加，與 sklearn 的浮點累加順序一致
+        depths = np.zeros(n, dtype=np.float64)
+        for tree_idx in range(self.n_trees):
+            depths += leaf_values[:, tree_idx]
+        return depths
+
+    def score_and_predict(self, X: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        單次走訪同時計算異常分數與預測標籤
+
+        Args:
+            X: 標準化後的特徵矩陣 (n_samples, n_features)
+
+        Returns:
+            (scores, predictions)：scores 同 sklearn score_samples（越低越異常），
+            predictions 同 sklearn predict（1 正常 / -1 異常）
+        """
+        # sklearn 樹以 float32 比較
+        X = np.asarray(X, dtype=np.float32)
+        if X.ndim != 2 or X.shape[1] != self.n_features:
+            raise ValueError(
+                f"特徵數不符：模型需要 {self.n_features} 個特徵，輸入為 {X.shape}"
+            )
+
+        depths = np.empty(len(X), dtype=np.float64)
+        for start in range(0, len(X), self.CHUNK_SIZE):
+            end = start + self.CHUNK_SIZE
+            depths[start:end] = self._depths(X[start:end])
+
+        if self.denominator != 0:
+            scores = -(2 ** (-depths / self.denominator))
+        else:
+            scores = -np.ones_like(depths)
+
+        predictions = np.where(scores - self.offset < 0, -1, 1)
+        return scores, predictions
+
+    def score_samples(self, X: np.ndarray) -> np.ndarray:
+        """同 sklearn IsolationForest.score_samples"""
+        return self.score_and_predict(X)[0]
+
+    def predict(self, X: np.ndarray) -> np.ndarray:
+        """同 sklearn IsolationForest.predict"""
+        return self.score_and_predict(X)[1]
+
+    def save(self, path: str):
+        """保存為 .npz"""
+        np.savez(
+            path,
+            feature=self.feature, threshold=self.threshold,
+            left=self.left, right=self.right, leaf_value=self.leaf_value,
+            roots=self.roots,
+            meta=np.array([self.max_depth, self.denominator, self.offset, self.n_features],
+                          dtype=np.float64),
+        )
+
+    @classmethod
+    def load(cls, path: str) -> 'FlatIsolationForest':
+        """從 .npz 載入"""
+        data = np.load(path)
+        max_depth, denominator, offset, n_features = data['meta']
+        return cls(
+            feature=data['feature'], threshold=data['threshold'],
+            left=data['left'], right=data['right'], leaf_value=data['leaf_value'],
+            roots=data['roots'], max_depth=int(max_depth),
+            denominator=float(denominator), offset=float(offset),
+            n_features=int(n_features),
+        )
@@ -26,6 +26,19 @@ except ImportError:
     sys.path.insert(0, os.path.join(os.path.dirname(__file__), '../..'))
     from nad.ml.feature_engineer_dst import FeatureEngineerDst
 
+try:
+    from .feature_store import FeatureStore
+    from .reservoir import ReservoirSampler, StratifiedReservoirSampler
+    from .flat_forest import FlatIsolationForest
+    from ..utils.es_paging import iter_search_pages
+    from ..device_classifier import DeviceClassifier
+except ImportError:
+    from nad.ml.feature_store import FeatureStore
+    from nad.ml.reservoir import ReservoirSampler, StratifiedReservoirSampler
+    from nad.ml.flat_forest import FlatIsolationForest
+    from nad.utils.es_paging import iter_search_pages
+    from nad.device_classifier import DeviceClassifier
+
 
 class IsolationForestByDst:
     """
@@ -67,9 +80,21 @@ class IsolationForestByDst:
             self.model_path = 'nad/models/isolation_forest_by_dst.pkl'
             self.scaler_path = 'nad/models/scaler_by_dst.pkl'
 
+        # 扁平化評分器（由 self.model 匯出，模型更換時重建）
+        self._flat_model = None
+        self._flat_source = None
+
         # Elasticsearch 客戶端
         self.es = None
 
+        # 特徵矩陣磁碟快取（config.yaml 的 feature_store.enabled 啟用）
+        self.feature_store = FeatureStore.from_config(
+            config, 'by_dst',
+            self.feature_engineer.feature_names,
+            features_config=config.features_by_dst_config if config else None,
+            thresholds=self.feature_engineer._get_thresholds()
+        )
+
     def _init_es_client(self):
         """初始化 Elasticsearch 客戶端"""
         if self.es is None:
@@ -97,18 +122,26 @@ class IsolationForestByDst:
 
         self._init_es_client()
 
-        # Step 1: 收集訓練數據
-        print(f"📚 Step 1: 收集過去 {days} 天的聚合數據...")
-        training_records = self._fetch_training_data(days)
+        if self.feature_store is not None:
+            # Step 1+2: 從特徵快取載入，只對缺少的日期查詢並提取
+            print(f"📚 Step 1: 從特徵快取組裝過去 {days} 天的特徵矩陣...")
+            X = self.feature_store.build_matrix(
+                days, self._fetch_range, self._extract_matrix
+            )
+            print("🔧 Step 2: 特徵提取（快取）")
+        else:
+            # Step 1: 收集訓練數據
+            print(f"📚 Step 1: 收集過去 {days} 天的聚合數據...")
+            training_records = self._fetch_training_data(days)
 
-        if len(training_records) == 0:
-            raise ValueError("沒有找到訓練數據！請檢查 netflow_stats_5m_by_dst 索引。")
+            if len(training_records) == 0:
+                raise ValueError("沒有找到訓練數據！請檢查 netflow_stats_5m_by_dst 索引。")
 
-        print(f"✓ 收集到 {len(training_records):,} 筆聚合記錄\n")
+            print(f"✓ 收集到 {len(training_records):,} 筆聚合記錄\n")
 
-        # Step 2: 特徵提取
-        print("🔧 Step 2: 提取特徵...")
-        X = self.feature_engineer.extract_features_batch(training_records)
+            # Step 2: 特徵提取
+            print("🔧 Step 2: 提取特徵...")
+            X, _ = self.feature_engineer.extract_features_batch(training_records)
 
         if len(X) == 0:
             raise ValueError("特徵提取失敗！")
@@ -129,8 +162,7 @@ class IsolationForestByDst:
 
         # Step 5: 評估
         print("📈 Step 5: 訓練集評估...")
-        predictions = self.model.predict(X_scaled)
-        scores = self.model.score_samples(X_scaled)
+        predictions, scores = self._score_batch(X_scaled)
 
         n_anomalies = np.sum(predictions == -1)
         anomaly_rate = n_anomalies / len(predictions)
@@ -164,6 +196,31 @@ class IsolationForestByDst:
         end_time = datetime.now()
         start_time = end_time - timedelta(days=days)
 
+        return self._scroll_records(start_time.isoformat(), end_time.isoformat(), include_end=True)
+
+    def _fetch_range(self, start: datetime, end: datetime) -> List[Dict]:
+        """
+        獲取 [start, end) 範圍的聚合數據（供特徵快取按日查詢）
+
+        Args:
+            start: 起始時間（UTC）
+            end: 結束時間（UTC）
+
+        Returns:
+            記錄列表
+        """
+        return self._scroll_records(
+            start.strftime('%Y-%m-%dT%H:%M:%SZ'),
+            end.strftime('%Y-%m-%dT%H:%M:%SZ')
+        )
+
+    def _extract_matrix(self, records: List[Dict]) -> np.ndarray:
+        """記錄列表 → 特徵矩陣（供特徵快取使用）"""
+        X, _ = self.feature_engineer.extract_features_batch(records)
+        return X
+
+    def _scroll_records(self, gte: str, end: str, include_end: bool = False) -> List[Dict]:
+        """以 scroll API 取回時間範圍內的所有 by_dst 聚合記錄"""
         query = {
             "size": 10000,
             "query": {
@@ -172,8 +229,8 @@ class IsolationForestByDst:
                         {
                             "range": {
                                 "time_bucket": {
-                                    "gte": start_time.isoformat(),
-                                    "lte": end_time.isoformat()
+                                    "gte": gte,
+                                    ("lte" if include_end else "lt"): end
                                 }
                             }
                         }
@@ -184,31 +241,121 @@ class IsolationForestByDst:
         }
 
         records = []
-        scroll_size = 10000
+        for page in self._iter_scroll_pages(query):
+            records.extend(page)
+
+        return records
 
+    def _iter_scroll_pages(self, query: Dict, page_size: int = 10000):
+        """以 scroll API 逐頁產生 by_dst 聚合記錄（每次只持有一頁）"""
         # 使用 scroll API 獲取大量數據
         result = self.es.search(
             index='netflow_stats_3m_by_dst',
             body=query,
             scroll='5m',
-            size=scroll_size
+            size=page_size
         )
 
         scroll_id = result['_scroll_id']
         hits = result['hits']['hits']
 
-        while hits:
-            for hit in hits:
-                records.append(hit['_source'])
+        try:
+            while hits:
+                yield [hit['_source'] for hit in hits]
 
-            # 獲取下一批
-            result = self.es.scroll(scroll_id=scroll_id, scroll='5m')
-            hits = result['hits']['hits']
+                # 獲取下一批
+                result = self.es.scroll(scroll_id=scroll_id, scroll='5m')
+                scroll_id = result['_scroll_id']
+                hits = result['hits']['hits']
+        finally:
+            # 清理 scroll
+            self.es.clear_scroll(scroll_id=scroll_id)
 
-        # 清理 scroll
-        self.es.clear_scroll(scroll_id=scroll_id)
+    def train_streaming(self, days: int = 30, sample_size: int = None,
+                        stratify_by_device: bool = False) -> 'IsolationForestByDst':
+        """
+        串流訓練：逐頁讀取 scroll、逐頁提取特徵，只保留固定容量的蓄水池樣本
 
-        return records
+        Scaler 以 partial_fit 累積全量數據的均值/變異數，模型以蓄水池樣本訓練，
+        記憶體上限與訓練天數無關。
+
+        Args:
+            days: 訓練數據天數
+            sample_size: 蓄水池容量（預設 training.reservoir_size 或 200,000）
+            stratify_by_device: 依 dst_ip 的 device_type 分層抽樣
+
+        Returns:
+            self
+        """
+        if sample_size is None:
+            sample_size = (self.config.training_config.get('reservoir_size', 200000)
+                           if self.config else 200000)
+        random_state = self.model_config.get('random_state')
+
+        print(f"\n{'='*70}")
+        print(f"Isolation Forest (by_dst) 串流訓練 - 過去 {days} 天，蓄水池容量 {sample_size:,}")
+        print(f"{'='*70}\n")
+
+        self._init_es_client()
+
+        if stratify_by_device:
+            sampler = StratifiedReservoirSampler(sample_size, random_state=random_state)
+            device_classifier = DeviceClassifier()
+        else:
+            sampler = ReservoirSampler(sample_size, random_state=random_state)
+
+        print("📚 Step 1: 串流讀取聚合數據並提取特徵...")
+        self.scaler = StandardScaler()
+        n_records = 0
+
+        end_time = datetime.now()
+        start_time = end_time - timedelta(days=days)
+        query = {
+            "query": {
+                "range": {
+                    "time_bucket": {
+                        "gte": start_time.isoformat(),
+                        "lte": end_time.isoformat()
+                    }
+                }
+            }
+        }
+
+        for page in self._iter_scroll_pages(query):
+            # 分層標籤依矩陣各列對應的記錄計算
+            X_page, kept = self.feature_engineer.extract_features_batch(page)
+            n_records += len(page)
+            if len(X_page) == 0:
+                continue
+
+            self.scaler.partial_fit(X_page)
+
+            if stratify_by_device:
+                strata = device_classifier.classify_many([page[i].get('dst_ip', '') for i in kept])
+                sampler.add(X_page, strata)
+            else:
+                sampler.add(X_page)
+
+            print(f"  已處理 {n_records:,} 筆記錄", end='\r')
+
+        if n_records == 0:
+            raise ValueError("沒有找到訓練數據！請檢查 netflow_stats_5m_by_dst 索引。")
+
+        X_sample = sampler.sample()
+        print(f"✓ 處理 {n_records:,} 筆聚合記錄，蓄水池樣本 {len(X_sample):,} 筆\n")
+
+        # Step 2: 以全量統計標準化樣本並訓練
+        print("🤖 Step 2: 訓練 Isolation Forest...")
+        X_scaled = self.scaler.transform(X_sample)
+        self.model = IsolationForest(**self.model_config)
+        self.model.fit(X_scaled)
+        print(f"✓ 模型訓練完成\n")
+
+        print("💾 Step 3: 保存模型...")
+        self._save_model()
+        print(f"✓ 模型已保存: {self.model_path}\n")
+
+        return self
 
     def predict_realtime(self, recent_minutes: int = 10) -> List[Dict]:
         """
@@ -225,14 +372,66 @@ class IsolationForestByDst:
 
         self._init_es_client()
 
-        # 查詢最近的數據
-        records = self._fetch_recent_data(recent_minutes)
+        # 逐頁查詢並評分（記憶體只持有一頁）
+        anomalies = []
+        for records in self._iter_recent_pages(recent_minutes):
+            anomalies.extend(self._predict_batch(records))
+
+        # 各頁分別評分，合併後依異常分數統一排序
+        anomalies.sort(key=lambda x: x['anomaly_score'], reverse=True)
+
+        return anomalies
+
+    def predict_time_range(self, start_time: datetime, end_time: datetime) -> List[Dict]:
+        """
+        對指定 bucket 範圍進行異常偵測（增量偵測用）
+
+        Args:
+            start_time: 起點（不含），通常為水位
+            end_time: 終點（含），通常為最新已穩定的 bucket
+
+        Returns:
+            異常列表
+        """
+        if self.model is None:
+            raise ValueError("模型尚未訓練或加載！請先調用 train_on_aggregated_data() 或 _load_model()")
+
+        self._init_es_client()
+
+        query = {
+            "range": {
+                "time_bucket": {
+                    "gt": start_time.strftime('%Y-%m-%dT%H:%M:%SZ'),
+                    "lte": end_time.strftime('%Y-%m-%dT%H:%M:%SZ')
+                }
+            }
+        }
+
+        anomalies = []
+        for records in self._iter_range_pages(query):
+            anomalies.extend(self._predict_batch(records))
 
+        # 各頁分別評分，合併後依異常分數統一排序
+        anomalies.sort(key=lambda x: x['anomaly_score'], reverse=True)
+
+        return anomalies
+
+    def _predict_batch(self, records: List[Dict]) -> List[Dict]:
+        """
+        對一批 by_dst 記錄評分並組裝異常
+
+        Args:
+            records: 聚合記錄
+
+        Returns:
+            異常列表
+        """
         if not records:
             return []
 
-        # 提取特徵
-        X = self.feature_engineer.extract_features_batch(records)
+        # 提取特徵（同時保留中間欄位，異常組裝時不必重新計算）
+        feature_columns = self.feature_engineer.extract_feature_columns(records)
+        X = self.feature_engineer.columns_to_matrix(feature_columns, len(records))
 
         if len(X) == 0:
             return []
@@ -241,50 +440,49 @@ class IsolationForestByDst:
         X_scaled = self.scaler.transform(X)
 
         # 預測
-        predictions = self.model.predict(X_scaled)
-        scores = self.model.score_samples(X_scaled)
+        predictions, scores = self._score_batch(X_scaled)
+
+        # 只對異常記錄批量提取分類特徵（含端口特徵）
+        anomaly_indices = np.flatnonzero(predictions == -1)
+        anomaly_records = [records[i] for i in anomaly_indices]
+        anomaly_features = self.feature_engineer.extract_classification_features_batch(anomaly_records)
 
         # 收集異常
         anomalies = []
-        for i, pred in enumerate(predictions):
-            if pred == -1:  # 異常
-                record = records[i]
-
-                # 計算置信度（基於異常分數）
-                confidence = self._calculate_confidence(scores[i])
-
-                # 提取特徵（用於後續分類）
-                features = self.feature_engineer.extract_features(record)
-
-                anomaly = {
-                    'dst_ip': record['dst_ip'],
-                    'time_bucket': record['time_bucket'],
-                    'anomaly_score': abs(scores[i]),
-                    'confidence': confidence,
-                    'perspective': 'DST',  # 標記視角
-
-                    # Dst 視角的關鍵指標
+        for i, record, classification_features in zip(anomaly_indices, anomaly_records, anomaly_features):
+            # 計算置信度（基於異常分數）
+            confidence = self._calculate_confidence(scores[i])
+
+            anomaly = {
+                'dst_ip': record['dst_ip'],
+                'time_bucket': record['time_bucket'],
+                'anomaly_score': abs(scores[i]),
+                'confidence': confidence,
+                'perspective': 'DST',  # 標記視角
+
+                # Dst 視角的關鍵指標
+                'unique_srcs': record.get('unique_srcs', 0),
+                'unique_src_ports': record.get('unique_src_ports', 0),
+                'unique_dst_ports': record.get('unique_dst_ports', 0),
+                'flow_count': record.get('flow_count', 0),
+                'total_bytes': record.get('total_bytes', 0),
+                'avg_bytes': record.get('avg_bytes', 0),
+
+                # 特徵向量（用於分類，含端口特徵）
+                'features': {
+                    **classification_features,
                     'unique_srcs': record.get('unique_srcs', 0),
                     'unique_src_ports': record.get('unique_src_ports', 0),
                     'unique_dst_ports': record.get('unique_dst_ports', 0),
                     'flow_count': record.get('flow_count', 0),
                     'total_bytes': record.get('total_bytes', 0),
                     'avg_bytes': record.get('avg_bytes', 0),
-
-                    # 特徵向量（用於分類）
-                    'features': {
-                        'unique_srcs': record.get('unique_srcs', 0),
-                        'unique_src_ports': record.get('unique_src_ports', 0),
-                        'unique_dst_ports': record.get('unique_dst_ports', 0),
-                        'flow_count': record.get('flow_count', 0),
-                        'total_bytes': record.get('total_bytes', 0),
-                        'avg_bytes': record.get('avg_bytes', 0),
-                        'flows_per_src': features[8] if len(features) > 8 else 0,
-                        'bytes_per_src': features[9] if len(features) > 9 else 0,
-                    }
+                    'flows_per_src': feature_columns['flows_per_src'][i],
+                    'bytes_per_src': feature_columns['bytes_per_src'][i],
                 }
+            }
 
-                anomalies.append(anomaly)
+            anomalies.append(anomaly)
 
         return anomalies
 
@@ -298,23 +496,56 @@ class IsolationForestByDst:
         Returns:
             記錄列表
         """
-        query = {
-            "size": 10000,
-            "query": {
-                "range": {
-                    "time_bucket": {
-                        "gte": f"now-{recent_minutes}m"
-                    }
+        records = []
+        for page in self._iter_recent_pages(recent_minutes):
+            records.extend(page)
+        return records
+
+    def _iter_recent_pages(self, recent_minutes: int):
+        """
+        以 PIT + search_after 逐頁查詢最近的 by_dst 數據（不受 size 上限截斷）
+
+        Args:
+            recent_minutes: 最近 N 分鐘
+
+        Yields:
+            每頁的記錄列表（只含特徵提取需要的欄位）
+        """
+        yield from self._iter_range_pages({
+            "range": {
+                "time_bucket": {
+                    "gte": f"now-{recent_minutes}m"
                 }
-            },
-            "sort": [{"time_bucket": "desc"}]
-        }
+            }
+        })
 
-        result = self.es.search(index='netflow_stats_3m_by_dst', body=query)
-        hits = result['hits']['hits']
+    def _iter_range_pages(self, query: Dict):
+        """以 PIT + search_after 逐頁查詢符合條件的 by_dst 數據"""
+        page_size = self.config.realtime_config.get('page_size', 5000) if self.config else 5000
 
-        records = [hit['_source'] for hit in hits]
-        return records
+        yield from iter_search_pages(
+            self.es, 'netflow_stats_3m_by_dst', query,
+            tiebreaker='dst_ip',
+            source_fields=self.feature_engineer.SOURCE_FIELDS,
+            page_size=page_size
+        )
+
+    def _score_batch(self, X_scaled: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        單次走訪計算預測標籤與異常分數（扁平化評分器，結果與 sklearn 一致）
+
+        Returns:
+            (predictions, scores)
+        """
+        scores, predictions = self._get_flat_model().score_and_predict(X_scaled)
+        return predictions, scores
+
+    def _get_flat_model(self) -> FlatIsolationForest:
+        """取得目前模型的扁平化評分器（模型更換時重新匯出）"""
+        if self._flat_model is None or self._flat_source is not self.model:
+            self._flat_model = FlatIsolationForest.from_sklearn(self.model)
+            self._flat_source = self.model
+        return self._flat_model
 
     def _calculate_confidence(self, score: float) -> float:
         """
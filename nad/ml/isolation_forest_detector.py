@@ -15,6 +15,10 @@ from elasticsearch import Elasticsearch
 from typing import Dict, List, Tuple
 
 from .feature_engineer import FeatureEngineer
+from .feature_store import FeatureStore
+from .reservoir import ReservoirSampler, StratifiedReservoirSampler
+from .flat_forest import FlatIsolationForest
+from ..utils.es_paging import iter_search_pages
 
 
 class OptimizedIsolationForest:
@@ -58,9 +62,22 @@ class OptimizedIsolationForest:
             self.model_path = 'nad/models/isolation_forest.pkl'
             self.scaler_path = 'nad/models/scaler.pkl'
 
+        # 扁平化評分器（由 self.model 匯出，模型更換時重建）
+        self._flat_model = None
+        self._flat_source = None
+
         # Elasticsearch 客戶端
         self.es = None
 
+        # 特徵矩陣磁碟快取（config.yaml 的 feature_store.enabled 啟用）
+        self.feature_store = FeatureStore.from_config(
+            config, 'by_src',
+            self.feature_engineer.detection_feature_names,
+            features_config=config.features_config if config else None,
+            thresholds=self.feature_engineer._get_thresholds(),
+            device_mapping=self.feature_engineer.device_classifier.get_mapping()
+        )
+
     def _init_es_client(self):
         """初始化 Elasticsearch 客戶端"""
         if self.es is None:
@@ -86,18 +103,31 @@ class OptimizedIsolationForest:
 
         self._init_es_client()
 
-        # Step 1: 收集訓練數據
-        print(f"📚 Step 1: 收集過去 {days} 天的聚合數據...")
-        training_records = self._fetch_training_data(days)
+        if self.feature_store is not None:
+            # Step 1+2: 從特徵快取載入，只對缺少的日期查詢並提取
+            print(f"📚 Step 1: 從特徵快取組裝過去 {days} 天的特徵矩陣...")
+            X = self.feature_store.build_matrix(
+                days, self._fetch_range, self.feature_engineer.extract_features_batch
+            )
+
+            if len(X) == 0:
+                raise ValueError("沒有找到訓練數據！請檢查 Elasticsearch 索引。")
 
-        if len(training_records) == 0:
-            raise ValueError("沒有找到訓練數據！請檢查 Elasticsearch 索引。")
+            print("🔧 Step 2: 特徵提取（快取）")
+        else:
+            # Step 1: 收集訓練數據
+            print(f"📚 Step 1: 收集過去 {days} 天的聚合數據...")
+            training_records = self._fetch_training_data(days)
 
-        print(f"✓ 收集到 {len(training_records):,} 筆聚合記錄\n")
+            if len(training_records) == 0:
+                raise ValueError("沒有找到訓練數據！請檢查 Elasticsearch 索引。")
+
+            print(f"✓ 收集到 {len(training_records):,} 筆聚合記錄\n")
+
+            # Step 2: 特徵提取
+            print("🔧 Step 2: 提取特徵...")
+            X = self.feature_engineer.extract_features_batch(training_records)
 
-        # Step 2: 特徵提取
-        print("🔧 Step 2: 提取特徵...")
-        X = self.feature_engineer.extract_features_batch(training_records)
         print(f"✓ 提取特徵矩陣: {X.shape}")
         print(f"  樣本數: {X.shape[0]:,}")
         print(f"  特徵數: {X.shape[1]}\n")
@@ -111,14 +141,12 @@ class OptimizedIsolationForest:
             # 找出不是服務器回應的樣本
             not_server_mask = X[:, server_response_idx] == 0
             X_filtered = X[not_server_mask]
-            training_records_filtered = [training_records[i] for i in range(len(training_records)) if not_server_mask[i]]
 
-            n_excluded = len(training_records) - len(training_records_filtered)
-            print(f"✓ 排除 {n_excluded:,} 筆服務器回應記錄 ({n_excluded/len(training_records)*100:.2f}%)")
-            print(f"  剩餘訓練樣本: {len(training_records_filtered):,}\n")
+            n_excluded = len(X) - len(X_filtered)
+            print(f"✓ 排除 {n_excluded:,} 筆服務器回應記錄 ({n_excluded/len(X)*100:.2f}%)")
+            print(f"  剩餘訓練樣本: {len(X_filtered):,}\n")
 
             X = X_filtered
-            training_records = training_records_filtered
 
         # Step 3: 標準化
         print("📊 Step 3: 標準化特徵...")
@@ -136,7 +164,7 @@ class OptimizedIsolationForest:
 
         # Step 5: 評估訓練結果
         print("📈 Step 5: 評估訓練結果...")
-        predictions = self.model.predict(X_scaled)
+        predictions, _ = self._score_batch(X_scaled)
         n_anomalies = np.sum(predictions == -1)
         anomaly_rate = n_anomalies / len(predictions) * 100
 
@@ -164,39 +192,170 @@ class OptimizedIsolationForest:
         Returns:
             聚合記錄列表
         """
-        index = self.config.es_aggregated_index if self.config else "netflow_stats_3m_by_src"
+        return self._scroll_records({
+            "range": {
+                "time_bucket": {
+                    "gte": f"now-{days}d",
+                    "lt": "now"
+                }
+            }
+        })
 
-        query = {
-            "size": 10000,
-            "query": {
-                "range": {
-                    "time_bucket": {
-                        "gte": f"now-{days}d",
-                        "lt": "now"
-                    }
+    def _fetch_range(self, start: datetime, end: datetime) -> List[Dict]:
+        """
+        從 ES 獲取 [start, end) 範圍的聚合數據（供特徵快取按日查詢）
+
+        Args:
+            start: 起始時間（UTC）
+            end: 結束時間（UTC）
+
+        Returns:
+            聚合記錄列表
+        """
+        return self._scroll_records({
+            "range": {
+                "time_bucket": {
+                    "gte": start.strftime('%Y-%m-%dT%H:%M:%SZ'),
+                    "lt": end.strftime('%Y-%m-%dT%H:%M:%SZ')
                 }
             }
+        })
+
+    def _scroll_records(self, range_query: Dict) -> List[Dict]:
+        """以 scroll API 取回查詢條件下的所有聚合記錄"""
+        records = []
+        for page in self._iter_scroll_pages(range_query):
+            records.extend(page)
+        return records
+
+    def _iter_scroll_pages(self, range_query: Dict, page_size: int = 10000):
+        """以 scroll API 逐頁產生聚合記錄（每次只持有一頁）"""
+        index = self.config.es_aggregated_index if self.config else "netflow_stats_3m_by_src"
+
+        query = {
+            "size": page_size,
+            "query": range_query
         }
 
         # 使用 scroll API 獲取所有數據
-        records = []
         response = self.es.search(index=index, body=query, scroll='5m')
 
         scroll_id = response['_scroll_id']
         hits = response['hits']['hits']
 
-        while hits:
-            for hit in hits:
-                records.append(hit['_source'])
+        try:
+            while hits:
+                yield [hit['_source'] for hit in hits]
+
+                # 繼續 scroll
+                response = self.es.scroll(scroll_id=scroll_id, scroll='5m')
+                scroll_id = response['_scroll_id']
+                hits = response['hits']['hits']
+        finally:
+            # 清理 scroll
+            self.es.clear_scroll(scroll_id=scroll_id)
+
+    def train_streaming(self, days: int = 30, sample_size: int = None,
+                        stratify_by_device: bool = False,
+                        exclude_servers: bool = False) -> 'OptimizedIsolationForest':
+        """
+        串流訓練：逐頁讀取 scroll、逐頁提取特徵，只保留固定容量的蓄水池樣本
 
-            # 繼續 scroll
-            response = self.es.scroll(scroll_id=scroll_id, scroll='5m')
-            hits = response['hits']['hits']
+        Scaler 以 partial_fit 累積全量數據的均值/變異數，模型以蓄水池樣本訓練，
+        記憶體上限與訓練天數無關，可使用 30 / 90 天的數據。
 
-        # 清理 scroll
-        self.es.clear_scroll(scroll_id=scroll_id)
+        Args:
+            days: 訓練數據天數
+            sample_size: 蓄水池容量（預設 training.reservoir_size 或 200,000）
+            stratify_by_device: 依 device_type 分層抽樣
+            exclude_servers: 是否排除可能的服務器回應流量
 
-        return records
+        Returns:
+            self
+        """
+        if sample_size is None:
+            sample_size = (self.config.training_config.get('reservoir_size', 200000)
+                           if self.config else 200000)
+        random_state = self.model_config.get('random_state')
+
+        print(f"\n{'='*70}")
+        print(f"Isolation Forest 串流訓練 - 過去 {days} 天，蓄水池容量 {sample_size:,}")
+        if stratify_by_device:
+            print("(依 device_type 分層抽樣)")
+        print(f"{'='*70}\n")
+
+        self._init_es_client()
+
+        if stratify_by_device:
+            sampler = StratifiedReservoirSampler(sample_size, random_state=random_state)
+        else:
+            sampler = ReservoirSampler(sample_size, random_state=random_state)
+
+        feature_names = self.feature_engineer.detection_feature_names
+        server_response_idx = (feature_names.index('is_likely_server_response')
+                               if exclude_servers and 'is_likely_server_response' in feature_names
+                               else None)
+
+        # Step 1: 逐頁提取特徵並更新 scaler 統計與蓄水池
+        print("📚 Step 1: 串流讀取聚合數據並提取特徵...")
+        self.scaler = StandardScaler()
+        n_records = 0
+        n_excluded = 0
+        range_query = {"range": {"time_bucket": {"gte": f"now-{days}d", "lt": "now"}}}
+
+        for page in self._iter_scroll_pages(range_query):
+            X_page = self.feature_engineer.extract_features_batch(page)
+            n_records += len(page)
+            if len(X_page) == 0:
+                continue
+
+            keep = np.ones(len(X_page), dtype=bool)
+            if server_response_idx is not None:
+                keep = X_page[:, server_response_idx] == 0
+                n_excluded += int(np.sum(~keep))
+                X_page = X_page[keep]
+                if len(X_page) == 0:
+                    continue
+
+            self.scaler.partial_fit(X_page)
+
+            if stratify_by_device:
+                strata = self.feature_engineer.device_classifier.classify_many(
+                    [r.get('src_ip', '') for r, k in zip(page, keep) if k]
+                )
+                sampler.add(X_page, strata)
+            else:
+                sampler.add(X_page)
+
+            print(f"  已處理 {n_records:,} 筆記錄", end='\r')
+
+        if n_records == 0:
+            raise ValueError("沒有找到訓練數據！請檢查 Elasticsearch 索引。")
+
+        X_sample = sampler.sample()
+        print(f"✓ 處理 {n_records:,} 筆聚合記錄，蓄水池樣本 {len(X_sample):,} 筆")
+        if exclude_servers:
+            print(f"✓ 排除 {n_excluded:,} 筆服務器回應記錄")
+        if stratify_by_device:
+            print(f"  各設備類型樣本數: {sampler.strata_counts()}")
+        print()
+
+        # Step 2: 以全量統計標準化樣本
+        X_scaled = self.scaler.transform(X_sample)
+
+        # Step 3: 訓練模型
+        print("🏋️  Step 2: 訓練 Isolation Forest...")
+        print(f"  配置: {self.model_config}")
+        self.model = IsolationForest(**self.model_config)
+        self.model.fit(X_scaled)
+        print(f"✓ 訓練完成\n")
+
+        # Step 4: 保存模型
+        print("💾 Step 3: 保存模型...")
+        self._save_model()
+        print(f"✓ 模型已保存到: {self.model_path}\n")
+
+        return self
 
     def predict_realtime(self, recent_minutes: int = 10) -> List[Dict]:
         """
@@ -223,29 +382,60 @@ class OptimizedIsolationForest:
         start_time_str = start_time.strftime('%Y-%m-%dT%H:%M:%S.000Z')
         end_time_str = end_time.strftime('%Y-%m-%dT%H:%M:%S.000Z')
 
-        # 查詢最近數據
-        index = self.config.es_aggregated_index if self.config else "netflow_stats_3m_by_src"
+        return self._predict_range({
+            "range": {
+                "time_bucket": {
+                    "gte": start_time_str,
+                    "lte": end_time_str
+                }
+            }
+        })
 
-        query = {
-            "size": 1000,
-            "query": {
-                "range": {
-                    "time_bucket": {
-                        "gte": start_time_str,
-                        "lte": end_time_str
-                    }
+    def predict_time_range(self, start_time: datetime, end_time: datetime) -> List[Dict]:
+        """
+        對指定 bucket 範圍進行異常檢測（增量偵測用）
+
+        Args:
+            start_time: 起點（不含），通常為水位
+            end_time: 終點（含），通常為最新已穩定的 bucket
+
+        Returns:
+            異常列表
+        """
+        if self.model is None:
+            self._load_model()
+
+        self._init_es_client()
+
+        return self._predict_range({
+            "range": {
+                "time_bucket": {
+                    "gt": start_time.strftime('%Y-%m-%dT%H:%M:%S.000Z'),
+                    "lte": end_time.strftime('%Y-%m-%dT%H:%M:%S.000Z')
                 }
             }
-        }
+        })
 
-        response = self.es.search(index=index, body=query)
-        records = [hit['_source'] for hit in response['hits']['hits']]
+    def _predict_range(self, query: Dict) -> List[Dict]:
+        """查詢符合條件的聚合數據並評分"""
+        # 查詢數據（PIT + search_after 逐頁讀取，逐頁評分，記憶體只持有一頁）
+        index = self.config.es_aggregated_index if self.config else "netflow_stats_3m_by_src"
+        page_size = self.config.realtime_config.get('page_size', 5000) if self.config else 5000
 
-        if len(records) == 0:
-            return []
+        results = []
+        for records in iter_search_pages(
+            self.es, index, query,
+            tiebreaker='src_ip',
+            source_fields=self.feature_engineer.SOURCE_FIELDS,
+            page_size=page_size
+        ):
+            # 預測
+            results.extend(self._predict_batch(records))
+
+        # 各頁已分別排序，合併後依異常分數重新排序
+        results.sort(key=lambda x: x['anomaly_score'], reverse=True)
 
-        # 預測
-        return self._predict_batch(records)
+        return results
 
     def predict_batch(self, records: List[Dict]) -> List[Dict]:
         """
@@ -276,38 +466,56 @@ class OptimizedIsolationForest:
         X = self.feature_engineer.extract_features_batch(records)
         X_scaled = self.scaler.transform(X)
 
-        # 預測
-        predictions = self.model.predict(X_scaled)
-        scores = self.model.score_samples(X_scaled)
+        # 預測（單次走訪同時取得標籤與分數）
+        predictions, scores = self._score_batch(X_scaled)
+
+        # 只對異常記錄批量提取分類特徵（含端口特徵）
+        anomaly_indices = np.flatnonzero(predictions == -1)
+        anomaly_records = [records[i] for i in anomaly_indices]
+        anomaly_features = self.feature_engineer.extract_classification_features_batch(anomaly_records)
 
         # 組裝結果
         results = []
-        for i, (record, pred, score) in enumerate(zip(records, predictions, scores)):
-            if pred == -1:  # 異常
-                # 使用分類特徵提取器獲取更豐富的特徵
-                features = self.feature_engineer.extract_classification_features(record)
-
-                results.append({
-                    'src_ip': record['src_ip'],
-                    'time_bucket': record['time_bucket'],
-                    'is_anomaly': True,
-                    'anomaly_score': -score,  # 轉為正值，越大越異常
-                    'confidence': self._score_to_confidence(-score),
-                    'features': features,
-                    'is_likely_server_response': features.get('is_likely_server_response', 0),  # 新增
-                    'flow_count': record['flow_count'],
-                    'unique_dsts': record['unique_dsts'],
-                    'unique_src_ports': record.get('unique_src_ports', 0),
-                    'unique_dst_ports': record.get('unique_dst_ports', 0),
-                    'avg_bytes': record['avg_bytes'],
-                    'total_bytes': record['total_bytes']
-                })
+        for i, record, features in zip(anomaly_indices, anomaly_records, anomaly_features):
+            score = scores[i]
+            results.append({
+                'src_ip': record['src_ip'],
+                'time_bucket': record['time_bucket'],
+                'is_anomaly': True,
+                'anomaly_score': -score,  # 轉為正值，越大越異常
+                'confidence': self._score_to_confidence(-score),
+                'features': features,
+                'is_likely_server_response': features.get('is_likely_server_response', 0),  # 新增
+                'flow_count': record['flow_count'],
+                'unique_dsts': record['unique_dsts'],
+                'unique_src_ports': record.get('unique_src_ports', 0),
+                'unique_dst_ports': record.get('unique_dst_ports', 0),
+                'avg_bytes': record['avg_bytes'],
+                'total_bytes': record['total_bytes']
+            })
 
         # 按異常分數排序
         results.sort(key=lambda x: x['anomaly_score'], reverse=True)
 
         return results
 
+    def _score_batch(self, X_scaled: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        單次走訪計算預測標籤與異常分數（扁平化評分器，結果與 sklearn 一致）
+
+        Returns:
+            (predictions, scores)
+        """
+        scores, predictions = self._get_flat_model().score_and_predict(X_scaled)
+        return predictions, scores
+
+    def _get_flat_model(self) -> FlatIsolationForest:
+        """取得目前模型的扁平化評分器（模型更換時重新匯出）"""
+        if self._flat_model is None or self._flat_source is not self.model:
+            self._flat_model = FlatIsolationForest.from_sklearn(self.model)
+            self._flat_source = self.model
+        return self._flat_model
+
     def _score_to_confidence(self, score: float) -> float:
         """
         將異常分數轉換為置信度 (0-1)
@@ -0,0 +1,504 @@
+#!/usr/bin/env python3
+"""
+雙視角聚合數據來源（by_src / by_dst）
+
+BidirectionalAnalyzer、BidirectionalCorrelationAnalyzer、PortAnalyzer
+都在查詢同一段時間的 netflow_stats_3m_by_src / by_dst 數據。此模組提供
+共同的查詢介面與兩種實作：
+
+- ESPerspectiveSource: 直接查詢 ES（原本的逐一查詢行為）
+- SnapshotPerspectiveSource: 每個偵測週期一次載入整個時間窗口的兩個索引，
+  以 src_ip / dst_ip / time_bucket 雜湊索引在記憶體中回答查詢；
+  超出窗口的查詢交給 fallback（通常是 ESPerspectiveSource）。
+  也可存成檔案（save / load），供離線重跑使用。
+"""
+
+import gzip
+import json
+import re
+from abc import ABC, abstractmethod
+from collections import defaultdict
+from datetime import datetime, timezone
+from typing import Dict, Iterable, List, Optional
+
+from ..utils.es_paging import iter_search_pages
+from ..utils.es_transport import get_transport
+
+
+SRC_INDEX = "netflow_stats_3m_by_src"
+DST_INDEX = "netflow_stats_3m_by_dst"
+
+# 各視角的欄位：(IP 欄位, 對端數量欄位, 對端埠數欄位, top 埠欄位)
+VIEW_FIELDS = {
+    'SRC': ('src_ip', 'unique_dsts', 'unique_dst_ports', 'top_src_ports'),
+    'DST': ('dst_ip', 'unique_srcs', 'unique_src_ports', 'top_dst_ports'),
+}
+
+# view_stats 中 top 埠的數量（與 ES terms 聚合的 size 相同）
+TOP_PORTS_SIZE = 5
+
+SNAPSHOT_FORMAT_VERSION = 1
+
+_RELATIVE_TIME = re.compile(r'^now(?:-(\d+)([smhdw]))?$')
+_UNIT_SECONDS = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400, 'w': 604800}
+
+
+def perspective_index(perspective: str) -> str:
+    return SRC_INDEX if perspective == 'SRC' else DST_INDEX
+
+
+def parse_time(value, now: Optional[datetime] = None) -> float:
+    """
+    將 ES 時間值轉為 epoch 秒
+
+    支援 "now" / "now-10m" 等相對時間、ISO 8601 字串與 epoch 毫秒
+
+    Raises:
+        ValueError: 無法解析（例如含有 /h 之類的取整語法）
+    """
+    if isinstance(value, (int, float)):
+        return value / 1000.0
+
+    match = _RELATIVE_TIME.match(value)
+    if match:
+        now = now or datetime.now(timezone.utc)
+        amount, unit = match.groups()
+        offset = int(amount) * _UNIT_SECONDS[unit] if amount else 0
+        return now.timestamp() - offset
+
+    parsed = datetime.fromisoformat(value.replace('Z', '+00:00'))
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=timezone.utc)
+    return parsed.timestamp()
+
+
+def view_aggs(perspective: str) -> Dict:
+    """視角統計的聚合定義"""
+    ip_field, peers_field, ports_field, top_ports_field = VIEW_FIELDS[perspective]
+    return {
+        "stats": {
+            "stats": {"field": "flow_count"}
+        },
+        "total_bytes": {
+            "sum": {"field": "total_bytes"}
+        },
+        peers_field: {
+            "sum": {"field": peers_field}
+        },
+        ports_field: {
+            "sum": {"field": ports_field}
+        },
+        top_ports_field: {
+            "terms": {"field": top_ports_field, "size": TOP_PORTS_SIZE}
+        },
+        "records_count": {
+            "value_count": {"field": ip_field}
+        }
+    }
+
+
+def parse_view_aggs(aggs: Dict, perspective: str) -> Dict:
+    """將聚合結果轉為視角統計"""
+    _, peers_field, ports_field, top_ports_field = VIEW_FIELDS[perspective]
+    return {
+        'total_flows': aggs['stats']['sum'],
+        'total_bytes': aggs['total_bytes']['value'],
+        peers_field: aggs[peers_field]['value'],
+        ports_field: aggs[ports_field]['value'],
+        'records_count': aggs['records_count']['value'],
+        top_ports_field: aggs[top_ports_field]['buckets']
+    }
+
+
+class PerspectiveSource(ABC):
+    """
+    雙視角聚合數據的查詢介面
+
+    time_range 使用 ES 的格式（例如 "now-10m"），表示 time_bucket >= time_range。
+    """
+
+    def latest_record(self, ip: str, perspective: str, time_range: str) -> Optional[Dict]:
+        """IP 在時間範圍內最新的一筆記錄（查無資料時為 None）"""
+        records = self.records(ip, perspective, time_range, size=1)
+        return records[0] if records else None
+
+    def latest_records(self, ips: Iterable[str], perspective: str, time_range: str) -> Dict[str, Dict]:
+        """多個 IP 最新的記錄 {ip: record}（查無資料的 IP 不在結果中）"""
+        latest = {}
+        for ip in dict.fromkeys(ips):
+            record = self.latest_record(ip, perspective, time_range)
+            if record is not None:
+                latest[ip] = record
+        return latest
+
+    @abstractmethod
+    def records(self, ip: str, perspective: str, time_range: str, size: int = 100) -> List[Dict]:
+        """IP 在時間範圍內的記錄（依 time_bucket 由新到舊，最多 size 筆）"""
+
+    @abstractmethod
+    def view_stats(self, ip: str, perspective: str, time_range: str) -> Optional[Dict]:
+        """IP 在時間範圍內的視角統計（查無資料時為 None）"""
+
+    def view_stats_many(self, ips: Iterable[str], perspective: str, time_range: str) -> Dict[str, Dict]:
+        """多個 IP 的視角統計 {ip: stats}（查無資料的 IP 不在結果中）"""
+        stats = {}
+        for ip in dict.fromkeys(ips):
+            result = self.view_stats(ip, perspective, time_range)
+            if result is not None:
+                stats[ip] = result
+        return stats
+
+    @abstractmethod
+    def top_records(self, perspective: str, field: str, min_value: float,
+                    time_range: str, size: int = 10) -> List[Dict]:
+        """時間範圍內 field >= min_value 的記錄（依 field 由大到小，最多 size 筆）"""
+
+
+class ESPerspectiveSource(PerspectiveSource):
+    """直接查詢 ES 的數據來源"""
+
+    def __init__(self, es_host: str = "http://localhost:9200", caller: str = 'perspective_source',
+                 chunk_size: int = 500):
+        """
+        Args:
+            es_host: Elasticsearch 主機地址
+            caller: 傳輸層統計使用的呼叫者名稱
+            chunk_size: 批次查詢時每次 _msearch 的 IP 數
+        """
+        self.es_host = es_host
+        self.caller = caller
+        self.chunk_size = chunk_size
+
+    def _search(self, perspective: str, query: Dict, timeout: Optional[float] = None) -> Dict:
+        response = get_transport().post(
+            f"{self.es_host}/{perspective_index(perspective)}/_search",
+            json=query, timeout=timeout, caller=self.caller
+        )
+        return response.json()
+
+    def _chunks(self, ips: Iterable[str]):
+        ips = list(dict.fromkeys(ip for ip in ips if ip))
+        for start in range(0, len(ips), self.chunk_size):
+            yield ips[start:start + self.chunk_size]
+
+    def _msearch(self, searches: List, perspective: str, what: str) -> List[Dict]:
+        responses = get_transport().msearch(self.es_host, searches, timeout=30, caller=self.caller)
+        for response in responses:
+            if 'error' in response:
+                raise RuntimeError(f"{perspective} {what} batch query failed: {response['error']}")
+        return responses
+
+    def records(self, ip: str, perspective: str, time_range: str, size: int = 100) -> List[Dict]:
+        ip_field = VIEW_FIELDS[perspective][0]
+        query = {
+            "size": size,
+            "query": {
+                "bool": {
+                    "must": [
+                        {"term": {ip_field: ip}},
+                        {"range": {"time_bucket": {"gte": time_range}}}
+                    ]
+                }
+            },
+            "sort": [{"time_bucket": "desc"}]
+        }
+        data = self._search(perspective, query)
+        return [hit['_source'] for hit in data.get('hits', {}).get('hits', [])]
+
+    def latest_records(self, ips: Iterable[str], perspective: str, time_range: str) -> Dict[str, Dict]:
+        # terms 聚合 + top_hits，每 chunk_size 個 IP 一次查詢
+        ip_field = VIEW_FIELDS[perspective][0]
+        searches = []
+        for chunk in self._chunks(ips):
+            searches.append((perspective_index(perspective), {
+                "size": 0,
+                "query": {
+                    "bool": {
+                        "filter": [
+                            {"terms": {ip_field: chunk}},
+                            {"range": {"time_bucket": {"gte": time_range}}}
+                        ]
+                    }
+                },
+                "aggs": {
+                    "by_ip": {
+                        "terms": {"field": ip_field, "include": chunk, "size": len(chunk)},
+                        "aggs": {
+                            "latest": {
+                                "top_hits": {"size": 1, "sort": [{"time_bucket": "desc"}]}
+                            }
+                        }
+                    }
+                }
+            }))
+
+        latest = {}
+        for response in self._msearch(searches, perspective, 'latest-record'):
+            for bucket in response['aggregations']['by_ip']['buckets']:
+                hits = bucket['latest']['hits']['hits']
+                if hits:
+                    latest[bucket['key']] = hits[0]['_source']
+        return latest
+
+    def view_stats(self, ip: str, perspective: str, time_range: str) -> Optional[Dict]:
+        ip_field = VIEW_FIELDS[perspective][0]
+        query = {
+            "size": 0,
+            "query": {
+                "bool": {
+                    "must": [
+                        {"term": {ip_field: ip}},
+                        {"range": {"time_bucket": {"gte": time_range}}}
+                    ]
+                }
+            },
+            "aggs": view_aggs(perspective)
+        }
+        data = self._search(perspective, query, timeout=10)
+        if data['hits']['total']['value'] == 0:
+            return None
+        return parse_view_aggs(data['aggregations'], perspective)
+
+    def view_stats_many(self, ips: Iterable[str], perspective: str, time_range: str) -> Dict[str, Dict]:
+        # terms 聚合（include 指定 IP 列表），每 chunk_size 個 IP 一次查詢
+        ip_field = VIEW_FIELDS[perspective][0]
+        searches = []
+        for chunk in self._chunks(ips):
+            searches.append((perspective_index(perspective), {
+                "size": 0,
+                "query": {
+                    "bool": {
+                        "filter": [
+                            {"terms": {ip_field: chunk}},
+                            {"range": {"time_bucket": {"gte": time_range}}}
+                        ]
+                    }
+                },
+                "aggs": {
+                    "by_ip": {
+                        "terms": {"field": ip_field, "include": chunk, "size": len(chunk)},
+                        "aggs": view_aggs(perspective)
+                    }
+                }
+            }))
+
+        stats = {}
+        for response in self._msearch(searches, perspective, 'view'):
+            for bucket in response['aggregations']['by_ip']['buckets']:
+                stats[bucket['key']] = parse_view_aggs(bucket, perspective)
+        return stats
+
+    def top_records(self, perspective: str, field: str, min_value: float,
+                    time_range: str, size: int = 10) -> List[Dict]:
+        query = {
+            "size": size,
+            "query": {
+                "bool": {
+                    "must": [
+                        {"range": {"time_bucket": {"gte": time_range}}},
+                        {"range": {field: {"gte": min_value}}}
+                    ]
+                }
+            },
+            "sort": [{field: "desc"}]
+        }
+        data = self._search(perspective, query)
+        return [hit['_source'] for hit in data.get('hits', {}).get('hits', [])]
+
+
+class _PerspectiveTable:
+    """單一視角的記憶體表格（依 IP、time_bucket 建立雜湊索引）"""
+
+    def __init__(self, perspective: str, records: List[Dict]):
+        self.perspective = perspective
+        ip_field = VIEW_FIELDS[perspective][0]
+
+        # 依 time_bucket 由新到舊排列，各索引中的列表因此也是由新到舊
+        timestamps = [parse_time(r['time_bucket']) for r in records]
+        order = sorted(range(len(records)), key=lambda i: timestamps[i], reverse=True)
+        self.records = [records[i] for i in order]
+        self.timestamps = [timestamps[i] for i in order]
+
+        self.by_ip: Dict[str, List[int]] = defaultdict(list)
+        self.by_bucket: Dict[str, List[int]] = defaultdict(list)
+        for row, record in enumerate(self.records):
+            self.by_ip[record.get(ip_field)].append(row)
+            self.by_bucket[record['time_bucket']].append(row)
+
+    def rows_for_ip(self, ip: str, start: float) -> List[int]:
+        rows = self.by_ip.get(ip, [])
+        # 由新到舊排列，遇到早於 start 的列即可停止
+        result = []
+        for row in rows:
+            if self.timestamps[row] < start:
+                break
+            result.append(row)
+        return result
+
+    def rows_since(self, start: float) -> List[int]:
+        rows = []
+        for bucket, bucket_rows in self.by_bucket.items():
+            if self.timestamps[bucket_rows[0]] >= start:
+                rows.extend(bucket_rows)
+        return rows
+
+
+class SnapshotPerspectiveSource(PerspectiveSource):
+    """
+    時間窗口內 by_src / by_dst 數據的記憶體快照
+
+    查詢的時間範圍早於快照窗口時交給 fallback；沒有 fallback（例如離線
+    重跑錄製的快照）時只以快照中的數據回答。
+    """
+
+    def __init__(self, records: Dict[str, List[Dict]], as_of: datetime, window_start: datetime,
+                 fallback: Optional[PerspectiveSource] = None):
+        """
+        Args:
+            records: {'SRC': [...], 'DST': [...]} 兩個視角的原始文件
+            as_of: 快照時間（相對時間 "now-..." 以此為準）
+            window_start: 快照涵蓋的最早 time_bucket
+            fallback: 超出快照窗口時使用的數據來源
+        """
+        self.as_of = as_of
+        self.window_start = window_start
+        self.fallback = fallback
+        self.tables = {
+            perspective: _PerspectiveTable(perspective, records.get(perspective, []))
+            for perspective in ('SRC', 'DST')
+        }
+
+    @classmethod
+    def from_es(cls, es, window: str = "now-10m", fallback: Optional[PerspectiveSource] = None,
+                page_size: int = 5000) -> 'SnapshotPerspectiveSource':
+        """
+        從 ES 載入時間窗口內兩個聚合索引的全部文件
+
+        Args:
+            es: Elasticsearch 客戶端
+            window: 時間窗口（ES 格式，例如 "now-10m"）
+            fallback: 超出窗口時使用的數據來源
+            page_size: 分頁大小
+        """
+        as_of = datetime.now(timezone.utc)
+        window_start = datetime.fromtimestamp(parse_time(window, as_of), timezone.utc)
+        query = {"range": {"time_bucket": {"gte": window_start.isoformat()}}}
+
+        records = {}
+        for perspective in ('SRC', 'DST'):
+            records[perspective] = []
+            for page in iter_search_pages(es, perspective_index(perspective), query,
+                                          tiebreaker=VIEW_FIELDS[perspective][0],
+                                          page_size=page_size):
+                records[perspective].extend(page)
+
+        return cls(records, as_of, window_start, fallback=fallback)
+
+    @classmethod
+    def load(cls, path: str, fallback: Optional[PerspectiveSource] = None) -> 'SnapshotPerspectiveSource':
+        """載入 save() 錄製的快照（.json 或 .json.gz）"""
+        opener = gzip.open if path.endswith('.gz') else open
+        with opener(path, 'rt', encoding='utf-8') as f:
+            payload = json.load(f)
+
+        if payload.get('version') != SNAPSHOT_FORMAT_VERSION:
+            raise ValueError(f"Unsupported snapshot version: {payload.get('version')}")
+
+        return cls(
+            payload['records'],
+            as_of=datetime.fromisoformat(payload['as_of']),
+            window_start=datetime.fromisoformat(payload['window_start']),
+            fallback=fallback
+        )
+
+    def save(self, path: str):
+        """錄製快照（副檔名為 .gz 時以 gzip 壓縮）"""
+        payload = {
+            'version': SNAPSHOT_FORMAT_VERSION,
+            'as_of': self.as_of.isoformat(),
+            'window_start': self.window_start.isoformat(),
+            'records': {p: table.records for p, table in self.tables.items()},
+        }
+        opener = gzip.open if path.endswith('.gz') else open
+        with opener(path, 'wt', encoding='utf-8') as f:
+            json.dump(payload, f, separators=(',', ':'))
+
+    def size(self) -> Dict[str, int]:
+        return {p: len(table.records) for p, table in self.tables.items()}
+
+    def _start(self, time_range: str) -> Optional[float]:
+        """time_range 的起點；快照窗口無法涵蓋時返回 None"""
+        try:
+            start = parse_time(time_range, self.as_of)
+        except ValueError:
+            return None
+        if start < self.window_start.timestamp():
+            return None
+        return start
+
+    def _use_fallback(self, start: Optional[float]) -> bool:
+        return start is None and self.fallback is not None
+
+    def records(self, ip: str, perspective: str, time_range: str, size: int = 100) -> List[Dict]:
+        start = self._start(time_range)
+        if self._use_fallback(start):
+            return self.fallback.records(ip, perspective, time_range, size)
+
+        table = self.tables[perspective]
+        rows = table.rows_for_ip(ip, start if start is not None else float('-inf'))
+        return [table.records[row] for row in rows[:size]]
+
+    def latest_records(self, ips: Iterable[str], perspective: str, time_range: str) -> Dict[str, Dict]:
+        if self._use_fallback(self._start(time_range)):
+            return self.fallback.latest_records(ips, perspective, time_range)
+        return super().latest_records(ips, perspective, time_range)
+
+    def view_stats(self, ip: str, perspective: str, time_range: str) -> Optional[Dict]:
+        start = self._start(time_range)
+        if self._use_fallback(start):
+            return self.fallback.view_stats(ip, perspective, time_range)
+
+        table = self.tables[perspective]
+        rows = table.rows_for_ip(ip, start if start is not None else float('-inf'))
+        if not rows:
+            return None
+        return self._aggregate([table.records[row] for row in rows], perspective)
+
+    def view_stats_many(self, ips: Iterable[str], perspective: str, time_range: str) -> Dict[str, Dict]:
+        if self._use_fallback(self._start(time_range)):
+            return self.fallback.view_stats_many(ips, perspective, time_range)
+        return super().view_stats_many(ips, perspective, time_range)
+
+    def top_records(self, perspective: str, field: str, min_value: float,
+                    time_range: str, size: int = 10) -> List[Dict]:
+        start = self._start(time_range)
+        if self._use_fallback(start):
+            return self.fallback.top_records(perspective, field, min_value, time_range, size)
+
+        table = self.tables[perspective]
+        rows = table.rows_since(start if start is not None else float('-inf'))
+        matched = [table.records[row] for row in rows
+                   if table.records[row].get(field, 0) >= min_value]
+        matched.sort(key=lambda r: r.get(field, 0), reverse=True)
+        return matched[:size]
+
+    @staticmethod
+    def _aggregate(records: List[Dict], perspective: str) -> Dict:
+        """在記憶體中計算與 view_aggs 相同的統計"""
+        _, peers_field, ports_field, top_ports_field = VIEW_FIELDS[perspective]
+
+        port_counts = defaultdict(int)
+        for record in records:
+            # top 埠欄位為 {port: count}，與 terms 聚合相同以「包含該埠的文件數」計數
+            for port in record.get(top_ports_field) or ():
+                port_counts[port] += 1
+        top_ports = sorted(port_counts.items(), key=lambda item: (-item[1], str(item[0])))[:TOP_PORTS_SIZE]
+
+        return {
+            'total_flows': float(sum(r.get('flow_count', 0) for r in records)),
+            'total_bytes': float(sum(r.get('total_bytes', 0) for r in records)),
+            peers_field: float(sum(r.get(peers_field, 0) for r in records)),
+            ports_field: float(sum(r.get(ports_field, 0) for r in records)),
+            'records_count': len(records),
+            top_ports_field: [{'key': port, 'doc_count': count} for port, count in top_ports]
+        }
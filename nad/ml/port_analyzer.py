@@ -14,7 +14,8 @@
 
 from typing import Dict, List, Optional
 from collections import Counter
-import requests
+
+from .perspective_source import PerspectiveSource, ESPerspectiveSource
 
 
 class PortAnalyzer:
@@ -47,14 +48,17 @@ class PortAnalyzer:
     # 正常客戶端常用的服務埠（用於識別 NORMAL_CLIENT_ACTIVITY）
     COMMON_CLIENT_PORTS = {80, 443, 53, 8080, 8443, 22, 3389}
 
-    def __init__(self, es_host: str = "http://localhost:9200"):
+    def __init__(self, es_host: str = "http://localhost:9200",
+                 data_source: Optional[PerspectiveSource] = None):
         """
         初始化通訊埠分析器
 
         Args:
             es_host: Elasticsearch 主機地址
+            data_source: 雙視角數據來源（預設直接查詢 ES）
         """
         self.es_host = es_host
+        self.data_source = data_source or ESPerspectiveSource(es_host, caller='port_analyzer')
 
     def analyze_port_pattern(
         self,
@@ -111,49 +115,27 @@ class PortAnalyzer:
         Returns:
             聚合數據字典
         """
-        # 根據視角選擇索引（使用 3m 聚合索引）
-        if perspective == 'SRC':
-            index = f"{self.es_host}/netflow_stats_3m_by_src/_search"
-            ip_field = "src_ip"
-        else:
-            index = f"{self.es_host}/netflow_stats_3m_by_dst/_search"
-            ip_field = "dst_ip"
-
-        # 查詢該 IP 的聚合數據
-        query = {
-            "size": 100,
-            "query": {
-                "bool": {
-                    "must": [
-                        {"term": {ip_field: ip}},
-                        {"range": {"time_bucket": {"gte": time_range}}}
-                    ]
-                }
-            },
-            "sort": [{"time_bucket": "desc"}]
-        }
-
+        # 查詢該 IP 的聚合數據（3m 聚合索引）
         try:
-            response = requests.post(index, json=query, headers={'Content-Type': 'application/json'})
-            data = response.json()
+            records = self.data_source.records(ip, perspective, time_range, size=100)
 
-            if not data.get('hits', {}).get('hits'):
+            if not records:
                 return None
 
             # 合併所有時間段的數據
-            merged = self._merge_aggregated_data(data['hits']['hits'], perspective)
+            merged = self._merge_aggregated_data(records, perspective)
             return merged
 
         except Exception as e:
             print(f"查詢失敗: {e}")
             return None
 
-    def _merge_aggregated_data(self, hits: List, perspective: str) -> Dict:
+    def _merge_aggregated_data(self, records: List[Dict], perspective: str) -> Dict:
         """
         合併多個時間段的聚合數據
 
         Args:
-            hits: Elasticsearch 查詢結果
+            records: 聚合記錄（由新到舊）
             perspective: 'SRC' 或 'DST'
 
         Returns:
@@ -163,8 +145,7 @@ class PortAnalyzer:
         all_ports = set()
 
         # 收集所有通訊埠
-        for hit in hits:
-            src = hit['_source']
+        for src in records:
             total_flows += src.get('flow_count', 0)
 
             # 根據視角選擇埠欄位
@@ -0,0 +1,202 @@
+#!/usr/bin/env python3
+"""
+批量端口特徵引擎
+
+將多筆記錄的 top_src_ports / top_dst_ports（{"port": count}）打包成
+CSR 格式 (ports, counts, offsets)，以向量化運算一次計算整批的端口特徵，
+取代逐筆轉換 tuple list 的 Python 迴圈。
+
+結果與 FeatureEngineer / FeatureEngineerDst 的逐筆方法一致。
+"""
+
+import numpy as np
+from typing import Dict, Iterable, List
+
+# 端口分類（與逐筆方法一致）
+WELL_KNOWN_MAX = 1023
+REGISTERED_MAX = 49151
+
+WEB_PORTS = (80, 443, 8080, 8443)
+DB_PORTS = (3306, 5432, 1521, 1433, 27017, 6379)
+DNS_PORTS = (53,)
+MAIL_PORTS = (25, 587, 465, 110, 143, 993, 995)
+HIGH_RISK_PORTS = (21, 23, 135, 139, 445, 3389, 5900, 1433)
+
+
+class PortBatch:
+    """
+    CSR 格式的端口分布批次
+
+    第 i 筆記錄的端口為 ports[offsets[i]:offsets[i+1]]，
+    對應的連線數為 counts[offsets[i]:offsets[i+1]]，保留原始 map 的順序。
+    """
+
+    def __init__(self, ports: np.ndarray, counts: np.ndarray, offsets: np.ndarray):
+        self.ports = ports
+        self.counts = counts
+        self.offsets = offsets
+        self.n_records = len(offsets) - 1
+        self.lengths = np.diff(offsets)
+        # 每個端口項目所屬的記錄索引
+        self.segment_ids = np.repeat(np.arange(self.n_records), self.lengths)
+
+    @classmethod
+    def from_maps(cls, port_maps: Iterable[Dict]) -> 'PortBatch':
+        """
+        從 {"port": count} 字典列表建立 CSR 批次
+
+        Args:
+            port_maps: 每筆記錄的 top ports 字典（None 視為空）
+
+        Returns:
+            PortBatch
+        """
+        keys = []
+        values = []
+        lengths = []
+        for port_map in port_maps:
+            port_map = port_map or {}
+            keys.extend(port_map.keys())
+            values.extend(port_map.values())
+            lengths.append(len(port_map))
+
+        offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+
+        # 字串 key 一次性轉為整數
+        ports = np.array(keys).astype(np.int64) if keys else np.zeros(0, dtype=np.int64)
+        counts = np.array(values, dtype=np.float64) if values else np.zeros(0, dtype=np.float64)
+
+        return cls(ports, counts, offsets)
+
+    @classmethod
+    def from_records(cls, records: List[Dict], field: str) -> 'PortBatch':
+        """從聚合記錄的指定欄位（top_src_ports / top_dst_ports）建立批次"""
+        return cls.from_maps(r.get(field, {}) for r in records)
+
+    # ========== 基本聚合 ==========
+
+    def _segment_sum(self, values: np.ndarray) -> np.ndarray:
+        """依記錄加總"""
+        return np.bincount(self.segment_ids, weights=values, minlength=self.n_records)
+
+    def is_empty(self) -> np.ndarray:
+        """每筆記錄是否沒有端口資料"""
+        return self.lengths == 0
+
+    def total_count(self) -> np.ndarray:
+        """每筆記錄的總連線數"""
+        return self._segment_sum(self.counts)
+
+    def max_count(self) -> np.ndarray:
+        """每筆記錄中最大的單一端口連線數（空記錄為 0）"""
+        result = np.full(self.n_records, -np.inf)
+        np.maximum.at(result, self.segment_ids, self.counts)
+        result[self.is_empty()] = 0.0
+        return result
+
+    def top_port(self) -> np.ndarray:
+        """每筆記錄的第一個端口（map 順序，即 ES 回傳的最常用端口），空記錄為 -1"""
+        result = np.full(self.n_records, -1, dtype=np.int64)
+        non_empty = ~self.is_empty()
+        result[non_empty] = self.ports[self.offsets[:-1][non_empty]]
+        return result
+
+    # ========== 端口特徵 ==========
+
+    def concentration(self, flow_count: np.ndarray) -> np.ndarray:
+        """最常用端口的集中度 max_count / flow_count"""
+        return np.where(self.is_empty(), 0.0, self.max_count() / flow_count)
+
+    def type_ratios(self, flow_count: np.ndarray) -> Dict[str, np.ndarray]:
+        """Well-known / Registered / Ephemeral 端口的流量比例"""
+        well_known = self.ports <= WELL_KNOWN_MAX
+        registered = ~well_known & (self.ports <= REGISTERED_MAX)
+        ephemeral = self.ports > REGISTERED_MAX
+
+        empty = self.is_empty()
+        return {
+            name: np.where(empty, 0.0, self._segment_sum(self.counts * mask) / flow_count)
+            for name, mask in (('well_known', well_known),
+                               ('registered', registered),
+                               ('ephemeral', ephemeral))
+        }
+
+    def entropy(self) -> np.ndarray:
+        """端口分布的熵值（log2）"""
+        total = self.total_count()
+        with np.errstate(divide='ignore', invalid='ignore'):
+            p = self.counts / total[self.segment_ids]
+            terms = np.where(self.counts > 0, -p * np.log2(p), 0.0)
+        return np.where(total == 0, 0.0, self._segment_sum(terms))
+
+    def weighted_mean_port(self) -> np.ndarray:
+        """以連線數加權的平均端口號（無資料時為 0）"""
+        total = self.total_count()
+        weighted = self._segment_sum(self.ports * self.counts)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return np.where(total > 0, weighted / total, 0.0)
+
+    def has_sequential(self, run_length: int = 3) -> np.ndarray:
+        """是否存在至少 run_length 個連續端口（掃描工具特徵）"""
+        result = np.zeros(self.n_records, dtype=bool)
+        if len(self.ports) < run_length:
+            return result
+
+        # 依 (記錄, 端口) 排序
+        order = np.lexsort((self.ports, self.segment_ids))
+        ports = self.ports[order]
+        segments = self.segment_ids[order]
+
+        # step[k]: 第 k 與 k+1 個端口是否同一記錄且連續
+        step = (np.diff(ports) == 1) & (segments[1:] == segments[:-1])
+
+        # run_length 個連續端口 = (run_length - 1) 個相鄰的連續步
+        window = step[:len(step) - (run_length - 2)].copy()
+        for k in range(1, run_length - 1):
+            window &= step[k:len(step) - (run_length - 2) + k]
+
+        result[segments[:len(window)][window]] = True
+        return result
+
+    def contains(self, port_set: Iterable[int]) -> np.ndarray:
+        """每個指定端口是否出現在記錄中，回傳 (n_ports, n_records) 布林矩陣"""
+        port_set = tuple(port_set)
+        presence = np.zeros((len(port_set), self.n_records), dtype=bool)
+        for i, port in enumerate(port_set):
+            hit = self.ports == port
+            presence[i, self.segment_ids[hit]] = True
+        return presence
+
+
+def count_high_risk_ports(*batches: PortBatch) -> np.ndarray:
+    """計算多個批次合併後（集合聯集）出現的高風險端口數量"""
+    presence = batches[0].contains(HIGH_RISK_PORTS)
+    for batch in batches[1:]:
+        presence |= batch.contains(HIGH_RISK_PORTS)
+    return presence.sum(axis=0)
+
+
+def top_port_in(batch: PortBatch, port_set: Iterable[int]) -> np.ndarray:
+    """每筆記錄的第一個端口是否屬於指定集合"""
+    return np.isin(batch.top_port(), tuple(port_set))
+
+
+def columns_to_dicts(columns: Dict[str, np.ndarray], int_names: Iterable[str] = ()) -> List[Dict]:
+    """
+    將列式特徵轉回每筆記錄的字典（轉為 Python 原生型別）
+
+    Args:
+        columns: {特徵名稱: 陣列}
+        int_names: 需轉為 int 的特徵（旗標、計數）
+
+    Returns:
+        特徵字典列表
+    """
+    int_names = set(int_names)
+    converted = {
+        name: values.astype(np.int64).tolist() if name in int_names else values.astype(np.float64).tolist()
+        for name, values in columns.items()
+    }
+    n = len(next(iter(converted.values()))) if converted else 0
+    return [{name: values[i] for name, values in converted.items()} for i in range(n)]
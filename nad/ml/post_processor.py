@@ -11,11 +11,12 @@
 3. 異常行為交叉驗證
 """
 
-from typing import List, Dict, Tuple
+from typing import List, Dict, Tuple, Optional
 from datetime import datetime
 from .bidirectional_analyzer import BidirectionalAnalyzer
 from .baseline_manager import BaselineManager
 from .bidirectional_correlation import BidirectionalCorrelationAnalyzer
+from .perspective_source import PerspectiveSource
 
 
 class AnomalyPostProcessor:
@@ -26,7 +27,8 @@ class AnomalyPostProcessor:
     使用雙向聚合數據進行驗證，減少誤報。
     """
 
-    def __init__(self, es_host="http://localhost:9200", enable_baseline=True, baseline_learning_days=7):
+    def __init__(self, es_host="http://localhost:9200", enable_baseline=True, baseline_learning_days=7,
+                 baseline_manager=None):
         """
         初始化後處理器
 
@@ -34,6 +36,8 @@ class AnomalyPostProcessor:
             es_host: Elasticsearch 主機地址
             enable_baseline: 是否啟用基準線驗證
             baseline_learning_days: 基準線學習期（天數）
+            baseline_manager: 已建立的基準線管理器（例如 BaselineManager.from_config），
+                未提供時以 baseline_learning_days 建立
         """
         self.bi_analyzer = BidirectionalAnalyzer(es_host)
         self.bidirectional_correlation = BidirectionalCorrelationAnalyzer(es_host)
@@ -41,7 +45,9 @@ class AnomalyPostProcessor:
         # 基準線管理器（可選）
         self.enable_baseline = enable_baseline
         if enable_baseline:
-            self.baseline_manager = BaselineManager(es_host, learning_days=baseline_learning_days)
+            self.baseline_manager = baseline_manager or BaselineManager(
+                es_host, learning_days=baseline_learning_days
+            )
         else:
             self.baseline_manager = None
 
@@ -55,10 +61,24 @@ class AnomalyPostProcessor:
             'server_identified': 0  # 新增：識別為 Server 的數量
         }
 
+    def set_data_source(self, data_source: PerspectiveSource):
+        """
+        設定雙視角數據來源（例如每個偵測週期載入的 SnapshotPerspectiveSource）
+
+        雙向分析器、通訊埠分析器與雙向關聯分析器共用同一個來源。
+        """
+        self.bi_analyzer.data_source = data_source
+        self.bi_analyzer.port_analyzer.data_source = data_source
+        self.bidirectional_correlation.data_source = data_source
+
     def validate_anomalies(self, anomalies: List[Dict], time_range: str = "now-10m") -> Dict:
         """
         驗證異常列表，排除誤報
 
+        分兩階段進行：先以批次查詢（_msearch / terms 聚合）一次取得所有異常
+        所需的雙向統計、最新聚合記錄與基準線，再逐一以記憶體中的資料驗證。
+        ES 查詢次數與異常數量無關；批次查詢失敗時退回逐一查詢。
+
         Args:
             anomalies: 來自 Isolation Forest + Classifier 的異常列表
             time_range: 時間範圍（用於查詢雙向數據）
@@ -73,33 +93,34 @@ class AnomalyPostProcessor:
         validated = []
         false_positives = []
 
+        # Phase 1: 批次查詢驗證所需的數據
+        prefetched = self._prefetch_validation_data(anomalies, time_range)
+
+        # Phase 2: 逐一驗證（使用已查詢的數據）
         for anomaly in anomalies:
             self.stats['total_processed'] += 1
 
             # 獲取 IP（根據視角不同）
-            perspective = anomaly.get('perspective', 'SRC')
-            if perspective == 'SRC':
-                ip = anomaly.get('src_ip')
-            else:  # DST
-                ip = anomaly.get('dst_ip')
+            ip = self._anomaly_ip(anomaly)
 
             threat_class = anomaly.get('classification', {}).get('class', 'UNKNOWN')
 
             # Step 1: 雙向關聯分析（檢查是否為 Server）
-            server_analysis = self._check_server_pattern(ip, time_range)
+            server_analysis = self._check_server_pattern(ip, time_range, prefetched)
 
             # Step 2: 原有的雙向驗證
             verification_result = self._verify_anomaly(
                 ip,
                 threat_class,
                 anomaly,
-                time_range
+                time_range,
+                prefetched
             )
 
             # Step 3: 基準線驗證（如果啟用）
             baseline_result = None
             if self.enable_baseline and self.baseline_manager:
-                baseline_result = self._check_baseline_deviation(ip, anomaly)
+                baseline_result = self._check_baseline_deviation(ip, anomaly, prefetched)
 
             # 合併驗證結果
             # 如果雙向分析識別為 Server，降低異常嚴重性
@@ -140,6 +161,10 @@ class AnomalyPostProcessor:
                 validated.append(anomaly)
                 self.stats['validated'] += 1
 
+        # 本批學習的基準線寫入磁碟
+        if self.enable_baseline and self.baseline_manager:
+            self.baseline_manager.flush()
+
         # 計算統計
         total = len(anomalies)
         reduction_rate = len(false_positives) / total if total > 0 else 0
@@ -156,8 +181,79 @@ class AnomalyPostProcessor:
             }
         }
 
+    @staticmethod
+    def _anomaly_ip(anomaly: Dict) -> Optional[str]:
+        """異常對應的 IP（SRC 視角為 src_ip，DST 視角為 dst_ip）"""
+        if anomaly.get('perspective', 'SRC') == 'SRC':
+            return anomaly.get('src_ip')
+        return anomaly.get('dst_ip')
+
+    def _prefetch_validation_data(self, anomalies: List[Dict], time_range: str) -> Dict:
+        """
+        批次查詢驗證階段所需的 ES 數據
+
+        Args:
+            anomalies: 異常列表
+            time_range: 時間範圍
+
+        Returns:
+            {
+                'views': (src_stats_by_ip, dst_stats_by_ip) 或 None,
+                'src_latest': {ip: _source} 或 None,   # PORT_SCAN / NETWORK_SCAN
+                'reverse_scan_records': [...] 或 None,
+                'dst_latest': {ip: _source} 或 None,   # SCAN_TARGET
+                'baselines': {ip: baseline} 或 None
+            }
+            值為 None 表示批次查詢失敗（或不需要），驗證時退回逐一查詢
+        """
+        prefetched = {
+            'views': None,
+            'src_latest': None,
+            'reverse_scan_records': None,
+            'dst_latest': None,
+            'baselines': None
+        }
+        if not anomalies:
+            return prefetched
+
+        all_ips = []
+        scan_ips = []
+        scan_target_ips = []
+        for anomaly in anomalies:
+            ip = self._anomaly_ip(anomaly)
+            all_ips.append(ip)
+            threat_class = anomaly.get('classification', {}).get('class', 'UNKNOWN')
+            if threat_class in ('PORT_SCAN', 'NETWORK_SCAN'):
+                scan_ips.append(ip)
+            elif threat_class == 'SCAN_TARGET':
+                scan_target_ips.append(ip)
+
+        try:
+            prefetched['views'] = self.bidirectional_correlation.query_views_batch(all_ips, time_range)
+        except Exception as e:
+            print(f"⚠️  雙向統計批次查詢失敗，改為逐一查詢: {e}")
+
+        if scan_ips:
+            try:
+                prefetched['src_latest'] = self.bi_analyzer.fetch_latest_records(scan_ips, 'SRC', time_range)
+                prefetched['reverse_scan_records'] = self.bi_analyzer.fetch_reverse_scan_records(time_range)
+            except Exception as e:
+                print(f"⚠️  掃描驗證數據批次查詢失敗，改為逐一查詢: {e}")
+
+        if scan_target_ips:
+            try:
+                prefetched['dst_latest'] = self.bi_analyzer.fetch_latest_records(scan_target_ips, 'DST', time_range)
+            except Exception as e:
+                print(f"⚠️  掃描目標數據批次查詢失敗，改為逐一查詢: {e}")
+
+        if self.enable_baseline and self.baseline_manager:
+            prefetched['baselines'] = self.baseline_manager.prefetch_baselines(all_ips)
+
+        return prefetched
+
     def _verify_anomaly(self, src_ip: str, threat_class: str,
-                       anomaly: Dict, time_range: str) -> Dict:
+                       anomaly: Dict, time_range: str,
+                       prefetched: Optional[Dict] = None) -> Dict:
         """
         驗證單個異常
 
@@ -166,6 +262,7 @@ class AnomalyPostProcessor:
             threat_class: 威脅類別
             anomaly: 異常記錄
             time_range: 時間範圍
+            prefetched: _prefetch_validation_data 的結果（可選）
 
         Returns:
             {
@@ -176,11 +273,11 @@ class AnomalyPostProcessor:
         """
         # 1. Port Scan 驗證（最重要）
         if threat_class == 'PORT_SCAN':
-            return self._verify_port_scan(src_ip, anomaly, time_range)
+            return self._verify_port_scan(src_ip, anomaly, time_range, prefetched)
 
         # 2. Network Scan 驗證
         elif threat_class == 'NETWORK_SCAN':
-            return self._verify_network_scan(src_ip, anomaly, time_range)
+            return self._verify_network_scan(src_ip, anomaly, time_range, prefetched)
 
         # 3. DDOS_TARGET 驗證（DST 視角）
         elif threat_class == 'DDOS_TARGET':
@@ -188,7 +285,7 @@ class AnomalyPostProcessor:
 
         # 4. SCAN_TARGET 驗證（DST 視角）
         elif threat_class == 'SCAN_TARGET':
-            return self._verify_scan_target(src_ip, anomaly, time_range)
+            return self._verify_scan_target(src_ip, anomaly, time_range, prefetched)
 
         # 5. POPULAR_SERVER 驗證
         elif threat_class == 'POPULAR_SERVER':
@@ -202,7 +299,8 @@ class AnomalyPostProcessor:
         else:
             return self._verify_unknown(src_ip, anomaly, time_range)
 
-    def _verify_port_scan(self, src_ip: str, anomaly: Dict, time_range: str) -> Dict:
+    def _verify_port_scan(self, src_ip: str, anomaly: Dict, time_range: str,
+                          prefetched: Optional[Dict] = None) -> Dict:
         """
         驗證 Port Scan（支援四種進階 Pattern）
 
@@ -217,6 +315,7 @@ class AnomalyPostProcessor:
             src_ip: 源 IP
             anomaly: 異常記錄
             time_range: 時間範圍
+            prefetched: _prefetch_validation_data 的結果（可選）
 
         Returns:
             驗證結果
@@ -224,7 +323,8 @@ class AnomalyPostProcessor:
         # 使用雙向分析器重新分析
         verification = self.bi_analyzer.detect_port_scan_improved(
             src_ip,
-            time_range
+            time_range,
+            prefetched=self._scan_prefetch(src_ip, prefetched)
         )
 
         pattern = verification.get('pattern', 'UNKNOWN')
@@ -391,7 +491,8 @@ class AnomalyPostProcessor:
             'details': verification
         }
 
-    def _verify_network_scan(self, src_ip: str, anomaly: Dict, time_range: str) -> Dict:
+    def _verify_network_scan(self, src_ip: str, anomaly: Dict, time_range: str,
+                             prefetched: Optional[Dict] = None) -> Dict:
         """
         驗證 Network Scan
 
@@ -401,6 +502,7 @@ class AnomalyPostProcessor:
             src_ip: 源 IP
             anomaly: 異常記錄
             time_range: 時間範圍
+            prefetched: _prefetch_validation_data 的結果（可選）
 
         Returns:
             驗證結果
@@ -412,7 +514,9 @@ class AnomalyPostProcessor:
         avg_bytes = features.get('avg_bytes', 0)
 
         # 【新增】使用雙向分析器檢查是否為正常客戶端行為
-        verification = self.bi_analyzer.detect_port_scan_improved(src_ip, time_range)
+        verification = self.bi_analyzer.detect_port_scan_improved(
+            src_ip, time_range, prefetched=self._scan_prefetch(src_ip, prefetched)
+        )
         pattern = verification.get('pattern', 'UNKNOWN')
 
         # 如果識別為正常客戶端行為，標記為誤報
@@ -466,13 +570,28 @@ class AnomalyPostProcessor:
             }
         }
 
-    def _check_server_pattern(self, ip: str, time_range: str) -> Dict:
+    @staticmethod
+    def _scan_prefetch(src_ip: str, prefetched: Optional[Dict]) -> Optional[Dict]:
+        """取出 detect_port_scan_improved 所需的已查詢數據"""
+        if not prefetched:
+            return None
+
+        scan_prefetch = {}
+        if prefetched.get('src_latest') is not None:
+            scan_prefetch['src_data'] = prefetched['src_latest'].get(src_ip)
+        if prefetched.get('reverse_scan_records') is not None:
+            scan_prefetch['reverse_scan_records'] = prefetched['reverse_scan_records']
+        return scan_prefetch
+
+    def _check_server_pattern(self, ip: str, time_range: str,
+                              prefetched: Optional[Dict] = None) -> Dict:
         """
         使用雙向關聯分析檢查 IP 是否為 Server
 
         Args:
             ip: IP 地址
             time_range: 時間範圍
+            prefetched: _prefetch_validation_data 的結果（可選）
 
         Returns:
             {
@@ -483,6 +602,11 @@ class AnomalyPostProcessor:
             }
         """
         try:
+            if prefetched and prefetched.get('views') is not None:
+                src_stats, dst_stats = prefetched['views']
+                return self.bidirectional_correlation.analyze_server_confidence_from_stats(
+                    src_stats.get(ip), dst_stats.get(ip)
+                )
             result = self.bidirectional_correlation.analyze_server_confidence(ip, time_range)
             return result
         except Exception as e:
@@ -494,13 +618,15 @@ class AnomalyPostProcessor:
                 'features': {}
             }
 
-    def _check_baseline_deviation(self, src_ip: str, anomaly: Dict) -> Dict:
+    def _check_baseline_deviation(self, src_ip: str, anomaly: Dict,
+                                  prefetched: Optional[Dict] = None) -> Dict:
         """
         檢查是否偏離基準線
 
         Args:
             src_ip: 源 IP
             anomaly: 異常記錄（包含 features）
+            prefetched: _prefetch_validation_data 的結果（可選）
 
         Returns:
             基準線偏離結果
@@ -515,11 +641,16 @@ class AnomalyPostProcessor:
             'unique_dsts': features.get('unique_dsts', 0),
             'flow_count': features.get('flow_count', 0),
             'avg_bytes': features.get('avg_bytes', 0),
-            'total_bytes': features.get('total_bytes', 0)
+            'total_bytes': features.get('total_bytes', 0),
+            # 週期性基準線依此選擇時段
+            'time_bucket': anomaly.get('time_bucket')
         }
 
-        # 檢查偏離
-        deviation_result = self.baseline_manager.check_deviation(src_ip, current_data)
+        # 檢查偏離（已批次學習過的 IP 不再查詢 ES）
+        baselines = (prefetched or {}).get('baselines') or {}
+        deviation_result = self.baseline_manager.check_deviation(
+            src_ip, current_data, learn=src_ip not in baselines
+        )
 
         return deviation_result
 
@@ -698,7 +829,8 @@ class AnomalyPostProcessor:
             }
         }
 
-    def _verify_scan_target(self, target_ip: str, anomaly: Dict, time_range: str) -> Dict:
+    def _verify_scan_target(self, target_ip: str, anomaly: Dict, time_range: str,
+                            prefetched: Optional[Dict] = None) -> Dict:
         """
         驗證 SCAN_TARGET（DST 視角）
 
@@ -713,27 +845,12 @@ class AnomalyPostProcessor:
         # 檢查是否為高臨時埠比例的正常伺服器流量
         try:
             # 嘗試獲取更詳細的埠分析（如果有聚合數據）
-            from elasticsearch import Elasticsearch
-            es = Elasticsearch([self.bi_analyzer.es_host])
-
-            # 查詢聚合數據
-            query = {
-                "size": 1,
-                "query": {
-                    "bool": {
-                        "must": [
-                            {"term": {"dst_ip": target_ip}},
-                            {"range": {"time_bucket": {"gte": time_range}}}
-                        ]
-                    }
-                },
-                "sort": [{"time_bucket": "desc"}]
-            }
-
-            result = es.search(index="netflow_stats_3m_by_dst", body=query)
-            if result['hits']['total']['value'] > 0:
-                agg_data = result['hits']['hits'][0]['_source']
+            if prefetched and prefetched.get('dst_latest') is not None:
+                agg_data = prefetched['dst_latest'].get(target_ip)
+            else:
+                agg_data = self.bi_analyzer.data_source.latest_record(target_ip, 'DST', time_range)
 
+            if agg_data:
                 # 使用 PortAnalyzer 分析
                 port_pattern = self.bi_analyzer.port_analyzer.analyze_port_pattern(
                     ip=target_ip,
@@ -0,0 +1,129 @@
+#!/usr/bin/env python3
+"""
+串流訓練用的蓄水池抽樣（Reservoir Sampling）
+
+Isolation Forest 每棵樹只使用 max_samples 筆樣本，不需要把 N 天的全部
+聚合記錄載入記憶體。蓄水池抽樣逐頁接收特徵矩陣，始終只保留固定容量的
+均勻隨機樣本，記憶體上限與資料量無關。
+"""
+
+import numpy as np
+from typing import Dict, Optional
+
+
+class ReservoirSampler:
+    """
+    固定容量的均勻蓄水池抽樣（Algorithm R 的批次向量化版本）
+
+    每一列被保留的機率皆為 capacity / n_seen。
+    """
+
+    def __init__(self, capacity: int, random_state: Optional[int] = None):
+        if capacity <= 0:
+            raise ValueError("capacity 必須大於 0")
+        self.capacity = capacity
+        self.rng = np.random.default_rng(random_state)
+        self.buffer = None
+        self.n_filled = 0
+        self.n_seen = 0
+
+    def add(self, X: np.ndarray):
+        """加入一批樣本 (n_rows, n_features)"""
+        X = np.asarray(X, dtype=np.float64)
+        if X.ndim != 2 or len(X) == 0:
+            return
+
+        if self.buffer is None:
+            self.buffer = np.empty((self.capacity, X.shape[1]), dtype=np.float64)
+
+        # 1. 先填滿蓄水池
+        n_fill = min(self.capacity - self.n_filled, len(X))
+        if n_fill > 0:
+            self.buffer[self.n_filled:self.n_filled + n_fill] = X[:n_fill]
+            self.n_filled += n_fill
+            self.n_seen += n_fill
+            X = X[n_fill:]
+
+        if len(X) == 0:
+            return
+
+        # 2. 第 t 筆（0-based 全域序號）以 capacity/(t+1) 機率替換隨機位置
+        t = self.n_seen + np.arange(len(X))
+        slots = (self.rng.random(len(X)) * (t + 1)).astype(np.int64)
+        accepted = slots < self.capacity
+
+        # 依序套用，同一位置以較晚的樣本為準
+        for row, slot in zip(np.flatnonzero(accepted), slots[accepted]):
+            self.buffer[slot] = X[row]
+
+        self.n_seen += len(X)
+
+    def sample(self) -> np.ndarray:
+        """目前的樣本（最多 capacity 筆）"""
+        if self.buffer is None:
+            return np.array([])
+        return self.buffer[:self.n_filled].copy()
+
+
+class StratifiedReservoirSampler:
+    """
+    分層蓄水池抽樣（例如依 device_type 分層）
+
+    每個分層各自維護一個容量為 capacity 的蓄水池；取樣時依各層出現比例
+    分配總容量，並保證每層至少 min_per_stratum 筆，避免稀有設備類型
+    （如伺服器）在樣本中消失。記憶體上限為 capacity × 分層數。
+    """
+
+    def __init__(self, capacity: int, min_per_stratum: int = 1000,
+                 random_state: Optional[int] = None):
+        self.capacity = capacity
+        self.min_per_stratum = min_per_stratum
+        self.random_state = random_state
+        self.rng = np.random.default_rng(random_state)
+        self.reservoirs: Dict[int, ReservoirSampler] = {}
+
+    @property
+    def n_seen(self) -> int:
+        return sum(r.n_seen for r in self.reservoirs.values())
+
+    def add(self, X: np.ndarray, strata: np.ndarray):
+        """
+        加入一批樣本
+
+        Args:
+            X: 特徵矩陣 (n_rows, n_features)
+            strata: 每列的分層代碼 (n_rows,)
+        """
+        X = np.asarray(X, dtype=np.float64)
+        strata = np.asarray(strata)
+        if len(X) == 0:
+            return
+
+        for code in np.unique(strata):
+            code = int(code)
+            if code not in self.reservoirs:
+                seed = None if self.random_state is None else self.random_state + code
+                self.reservoirs[code] = ReservoirSampler(self.capacity, seed)
+            self.reservoirs[code].add(X[strata == code])
+
+    def sample(self) -> np.ndarray:
+        """依比例（含每層下限）合併各層樣本，總數不超過 capacity + 下限補足量"""
+        if not self.reservoirs:
+            return np.array([])
+
+        total_seen = self.n_seen
+        parts = []
+        for code in sorted(self.reservoirs):
+            reservoir = self.reservoirs[code]
+            X = reservoir.sample()
+            quota = int(round(self.capacity * reservoir.n_seen / total_seen))
+            quota = min(len(X), max(quota, self.min_per_stratum))
+            if quota < len(X):
+                X = X[self.rng.choice(len(X), size=quota, replace=False)]
+            parts.append(X)
+
+        return np.concatenate(parts, axis=0)
+
+    def strata_counts(self) -> Dict[int, int]:
+        """各分層看過的樣本數"""
+        return {code: r.n_seen for code, r in self.reservoirs.items()}
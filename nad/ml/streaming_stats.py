@@ -0,0 +1,215 @@
+#!/usr/bin/env python3
+"""
+增量基準線用的串流統計
+
+每個指標只保留固定大小的狀態，逐筆更新：
+- Welford 演算法：平均值、變異數（與 np.mean / np.std 相同）
+- EWMA：指數加權平均與標準差，反映近期行為
+- 對數分桶分位數草圖（DDSketch 形式）：可合併，相對誤差有上界
+"""
+
+import math
+from typing import Dict, Iterable, List, Optional
+
+
+class QuantileSketch:
+    """
+    對數分桶的分位數草圖
+
+    正值 x 落在桶 ceil(log_gamma(x))，以桶的代表值回答分位數，
+    相對誤差不超過 relative_accuracy。桶數超過 max_bins 時合併最小的桶
+    （只影響低分位數，基準線用到的 p95 / p99 不受影響）。
+    相同參數的草圖可直接合併。
+    """
+
+    def __init__(self, relative_accuracy: float = 0.02, max_bins: int = 256):
+        if not 0 < relative_accuracy < 1:
+            raise ValueError("relative_accuracy 必須介於 0 與 1 之間")
+        self.relative_accuracy = relative_accuracy
+        self.max_bins = max_bins
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self.log_gamma = math.log(self.gamma)
+        self.bins: Dict[int, float] = {}
+        self.zero_count = 0.0
+        self.count = 0.0
+
+    def add(self, value: float, weight: float = 1.0):
+        if value > 0:
+            key = math.ceil(math.log(value) / self.log_gamma)
+            self.bins[key] = self.bins.get(key, 0.0) + weight
+            if len(self.bins) > self.max_bins:
+                self._collapse()
+        else:
+            self.zero_count += weight
+        self.count += weight
+
+    def merge(self, other: 'QuantileSketch'):
+        if other.gamma != self.gamma:
+            raise ValueError("只能合併相同精度的草圖")
+        for key, weight in other.bins.items():
+            self.bins[key] = self.bins.get(key, 0.0) + weight
+        self.zero_count += other.zero_count
+        self.count += other.count
+        if len(self.bins) > self.max_bins:
+            self._collapse()
+
+    def _collapse(self):
+        """將最小的桶併入第 max_bins 小的桶"""
+        keys = sorted(self.bins)
+        excess = keys[:len(keys) - self.max_bins + 1]
+        target = excess[-1]
+        self.bins[target] = sum(self.bins.pop(key) for key in excess[:-1]) + self.bins[target]
+
+    def _value(self, key: int) -> float:
+        return 2 * self.gamma ** key / (self.gamma + 1)
+
+    def quantiles(self, qs: Iterable[float]) -> List[Optional[float]]:
+        """
+        一次計算多個分位數（q 介於 0 與 1，與 np.percentile 的排名定義相同）
+
+        Returns:
+            分位數列表；草圖為空時為 None
+        """
+        qs = list(qs)
+        if self.count <= 0:
+            return [None] * len(qs)
+
+        ranks = sorted((q * (self.count - 1), i) for i, q in enumerate(qs))
+        results = [0.0] * len(qs)
+        keys = sorted(self.bins)
+        cumulative = self.zero_count
+        pos = 0
+        for rank, i in ranks:
+            if rank < self.zero_count:
+                results[i] = 0.0
+                continue
+            while pos < len(keys) - 1 and cumulative + self.bins[keys[pos]] <= rank:
+                cumulative += self.bins[keys[pos]]
+                pos += 1
+            results[i] = self._value(keys[pos])
+        return results
+
+    def to_dict(self) -> Dict:
+        keys = sorted(self.bins)
+        return {
+            'a': self.relative_accuracy,
+            'm': self.max_bins,
+            'z': self.zero_count,
+            'k': keys,
+            'n': [self.bins[key] for key in keys]
+        }
+
+    @classmethod
+    def from_dict(cls, data: Dict) -> 'QuantileSketch':
+        sketch = cls(data['a'], data['m'])
+        sketch.bins = dict(zip(data['k'], data['n']))
+        sketch.zero_count = data['z']
+        sketch.count = sketch.zero_count + sum(data['n'])
+        return sketch
+
+
+class RunningMetric:
+    """
+    單一指標的串流統計（O(1) 記憶體）
+
+    平均值 / 標準差為全部樣本的 Welford 累計，與批次學習的基準線一致；
+    ewma / ewma_std 以 ewma_alpha 衰減，反映近期行為。
+    """
+
+    def __init__(self, ewma_alpha: float = 0.05, relative_accuracy: float = 0.02,
+                 max_bins: int = 256):
+        self.ewma_alpha = ewma_alpha
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.min = math.inf
+        self.max = -math.inf
+        self.ewma = 0.0
+        self.ewm_var = 0.0
+        self.sketch = QuantileSketch(relative_accuracy, max_bins)
+
+    def update(self, value: float):
+        self.count += 1
+        delta = value - self.mean
+        self.mean += delta / self.count
+        self.m2 += delta * (value - self.mean)
+        self.min = min(self.min, value)
+        self.max = max(self.max, value)
+
+        if self.count == 1:
+            self.ewma = value
+        else:
+            diff = value - self.ewma
+            increment = self.ewma_alpha * diff
+            self.ewma += increment
+            self.ewm_var = (1 - self.ewma_alpha) * (self.ewm_var + diff * increment)
+
+        self.sketch.add(value)
+
+    def merge(self, other: 'RunningMetric'):
+        """合併另一份統計（Chan 等人的平行變異數公式；EWMA 以樣本數加權）"""
+        if other.count == 0:
+            return
+        if self.count == 0:
+            self.mean, self.m2, self.ewma, self.ewm_var = other.mean, other.m2, other.ewma, other.ewm_var
+        else:
+            total = self.count + other.count
+            delta = other.mean - self.mean
+            self.m2 += other.m2 + delta * delta * self.count * other.count / total
+            self.mean += delta * other.count / total
+            self.ewma = (self.ewma * self.count + other.ewma * other.count) / total
+            self.ewm_var = (self.ewm_var * self.count + other.ewm_var * other.count) / total
+        self.count += other.count
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+        self.sketch.merge(other.sketch)
+
+    @property
+    def std(self) -> float:
+        return math.sqrt(self.m2 / self.count) if self.count else 0.0
+
+    def to_stats(self) -> Dict:
+        """轉為與 BaselineManager._calculate_metric_stats 相同的格式（另加 EWMA）"""
+        if not self.count:
+            return {'mean': 0, 'std': 0, 'min': 0, 'max': 0, 'p50': 0, 'p95': 0, 'p99': 0,
+                    'ewma': 0, 'ewma_std': 0}
+
+        # 草圖的代表值可能略超出實際範圍，以 min / max 夾住
+        p50, p95, p99 = (min(max(q, self.min), self.max) for q in self.sketch.quantiles([0.5, 0.95, 0.99]))
+        return {
+            'mean': self.mean,
+            'std': self.std,
+            'min': self.min,
+            'max': self.max,
+            'p50': p50,
+            'p95': p95,
+            'p99': p99,
+            'ewma': self.ewma,
+            'ewma_std': math.sqrt(self.ewm_var)
+        }
+
+    def to_dict(self) -> Dict:
+        return {
+            'alpha': self.ewma_alpha,
+            'count': self.count,
+            'mean': self.mean,
+            'm2': self.m2,
+            'min': self.min if self.count else None,
+            'max': self.max if self.count else None,
+            'ewma': self.ewma,
+            'ewm_var': self.ewm_var,
+            'sketch': self.sketch.to_dict()
+        }
+
+    @classmethod
+    def from_dict(cls, data: Dict) -> 'RunningMetric':
+        metric = cls(data['alpha'])
+        metric.sketch = QuantileSketch.from_dict(data['sketch'])
+        metric.count = data['count']
+        metric.mean = data['mean']
+        metric.m2 = data['m2']
+        metric.min = data['min'] if data['min'] is not None else math.inf
+        metric.max = data['max'] if data['max'] is not None else -math.inf
+        metric.ewma = data['ewma']
+        metric.ewm_var = data['ewm_var']
+        return metric
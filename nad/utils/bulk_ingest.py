@@ -0,0 +1,202 @@
+#!/usr/bin/env python3
+"""
+分塊、並行的 ES _bulk 寫入
+
+將大量文檔切成位元組數有上限的區塊，以數個連線並行送出：
+- 每個區塊不超過 max_chunk_bytes / max_chunk_docs，不會碰到 http.max_content_length
+- 請求內容由 ESTransport 以 gzip 壓縮（超過 compress_threshold 時）
+- 只重試失敗的項目（429 / 5xx），413 時將區塊對半切分後重送
+- 無法寫入的項目逐筆計數並保留錯誤範例，不會無聲遺失
+- 累計寫入筆數、位元組與耗時，可換算 docs/sec
+"""
+
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterable, List, Tuple
+
+from .es_transport import _dumps, get_transport
+
+# 可重試的項目 / 請求狀態碼
+RETRYABLE_STATUS = (429, 502, 503, 504)
+
+# 每次寫入保留的錯誤範例數
+MAX_ERROR_SAMPLES = 5
+
+
+class BulkIngester:
+    """
+    _bulk 寫入器
+
+    index() 接受 (索引, 文檔 ID, 文檔) 序列，返回該次寫入的結果；
+    get_stats() 為所有呼叫的累計。可在多個執行緒間共用。
+    """
+
+    def __init__(self, es_url: str, max_chunk_bytes: int = 5 * 1024 * 1024, max_chunk_docs: int = 5000,
+                 workers: int = 3, max_retries: int = 3, backoff: float = 0.5, timeout: float = 120,
+                 caller: str = 'bulk'):
+        """
+        Args:
+            es_url: ES 位址（例如 http://localhost:9200）
+            max_chunk_bytes: 每個 _bulk 請求的最大位元組數（壓縮前）
+            max_chunk_docs: 每個 _bulk 請求的最大文檔數
+            workers: 並行送出的連線數
+            max_retries: 失敗項目的最大重試次數
+            backoff: 第一次重試的等待時間（秒），之後每次加倍
+            timeout: 每個請求的逾時（秒）
+            caller: ESTransport 統計用的呼叫者名稱
+        """
+        self.es_url = es_url
+        self.max_chunk_bytes = max_chunk_bytes
+        self.max_chunk_docs = max_chunk_docs
+        self.workers = max(1, workers)
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.caller = caller
+
+        self.stats = {'indexed': 0, 'failed': 0, 'rejected': 0, 'retried': 0, 'chunks': 0,
+                      'bytes': 0, 'seconds': 0.0}
+        self._lock = threading.Lock()
+
+    def index(self, actions: Iterable[Tuple[str, str, Dict]]) -> Dict:
+        """
+        寫入文檔
+
+        Args:
+            actions: [(索引, 文檔 ID, 文檔), ...]
+
+        Returns:
+            {'indexed', 'failed', 'rejected', 'retried', 'chunks', 'bytes', 'seconds',
+             'docs_per_sec', 'errors'}；rejected 為重試後仍被 429 拒絕的項目數（包含於 failed），
+            errors 為前幾筆失敗項目的 (文檔 ID, 錯誤)
+        """
+        started = time.time()
+        result = {'indexed': 0, 'failed': 0, 'rejected': 0, 'retried': 0, 'chunks': 0, 'bytes': 0,
+                  'errors': []}
+        chunks = list(self._chunks(actions))
+
+        if chunks:
+            if self.workers == 1 or len(chunks) == 1:
+                outcomes = [self._send_chunk(chunk) for chunk in chunks]
+            else:
+                with ThreadPoolExecutor(max_workers=min(self.workers, len(chunks))) as executor:
+                    outcomes = list(executor.map(self._send_chunk, chunks))
+            for outcome in outcomes:
+                for key in ('indexed', 'failed', 'rejected', 'retried', 'chunks', 'bytes'):
+                    result[key] += outcome[key]
+                result['errors'].extend(outcome['errors'])
+            del result['errors'][MAX_ERROR_SAMPLES:]
+
+        result['seconds'] = time.time() - started
+        result['docs_per_sec'] = result['indexed'] / result['seconds'] if result['seconds'] > 0 else 0.0
+        with self._lock:
+            for key in self.stats:
+                self.stats[key] += result[key]
+        return result
+
+    def get_stats(self) -> Dict:
+        """累計統計（含 docs_per_sec）"""
+        with self._lock:
+            stats = dict(self.stats)
+        stats['docs_per_sec'] = stats['indexed'] / stats['seconds'] if stats['seconds'] > 0 else 0.0
+        return stats
+
+    def _chunks(self, actions):
+        """序列化並切分：每個項目為 (文檔 ID, action + 文檔的 NDJSON 位元組)"""
+        chunk, size = [], 0
+        for index, doc_id, doc in actions:
+            line = _dumps({"index": {"_index": index, "_id": doc_id}}) + b'\n' + _dumps(doc) + b'\n'
+            if chunk and (size + len(line) > self.max_chunk_bytes or len(chunk) >= self.max_chunk_docs):
+                yield chunk
+                chunk, size = [], 0
+            chunk.append((doc_id, line))
+            size += len(line)
+        if chunk:
+            yield chunk
+
+    def _send_chunk(self, chunk: List[Tuple[str, bytes]]) -> Dict:
+        """送出一個區塊，只重試失敗的項目"""
+        outcome = {'indexed': 0, 'failed': 0, 'rejected': 0, 'retried': 0, 'chunks': 0, 'bytes': 0,
+                   'errors': []}
+        pending = chunk
+        attempt = 0
+
+        while pending:
+            body = b''.join(line for _, line in pending)
+            outcome['chunks'] += 1
+            outcome['bytes'] += len(body)
+            retry = []
+            # 本次失敗是否為 ES 過載拒絕（429）
+            throttled = False
+            try:
+                response = get_transport().post(
+                    f"{self.es_url}/_bulk", data=body,
+                    headers={'Content-Type': 'application/x-ndjson'},
+                    timeout=self.timeout, caller=self.caller
+                )
+            except Exception as e:
+                # 連線錯誤等：整個區塊重試
+                retry, error = pending, str(e)
+            else:
+                if response.status_code == 413 and len(pending) > 1:
+                    # 區塊過大：對半切分後分別送出（不計入重試次數）
+                    middle = len(pending) // 2
+                    for part in (pending[:middle], pending[middle:]):
+                        sub = self._send_chunk(part)
+                        for key in ('indexed', 'failed', 'rejected', 'retried', 'chunks', 'bytes'):
+                            outcome[key] += sub[key]
+                        outcome['errors'].extend(sub['errors'])
+                    return outcome
+                if response.status_code in RETRYABLE_STATUS:
+                    retry, error = pending, f"HTTP {response.status_code}"
+                    throttled = response.status_code == 429
+                elif response.status_code >= 300:
+                    self._fail(outcome, pending, f"HTTP {response.status_code}: {response.text[:200]}")
+                    return outcome
+                else:
+                    items = response.json().get('items', [])
+                    error = None
+                    for entry, item in zip(pending, items):
+                        result = item.get('index', {})
+                        status = result.get('status', 500)
+                        if status < 300:
+                            outcome['indexed'] += 1
+                        elif status in RETRYABLE_STATUS:
+                            retry.append(entry)
+                            error = result.get('error')
+                            throttled = throttled or status == 429
+                        else:
+                            self._fail(outcome, [entry], result.get('error'))
+                    # 回應項目數不足時，其餘視為未寫入
+                    retry.extend(pending[len(items):])
+
+            if not retry:
+                break
+
+            attempt += 1
+            if attempt > self.max_retries:
+                self._fail(outcome, retry, error)
+                if throttled:
+                    outcome['rejected'] += len(retry)
+                break
+
+            outcome['retried'] += len(retry)
+            time.sleep(self.backoff * (2 ** (attempt - 1)))
+            pending = retry
+
+        return outcome
+
+    @staticmethod
+    def _fail(outcome: Dict, entries, error):
+        outcome['failed'] += len(entries)
+        for doc_id, _ in entries[:max(0, MAX_ERROR_SAMPLES - len(outcome['errors']))]:
+            outcome['errors'].append((doc_id, error))
+
+
+def ingest_stats_line(stats: Dict) -> str:
+    """統計摘要（一行）"""
+    return (f"{stats['indexed']:,} 筆, {stats['chunks']} 個請求, "
+            f"{stats['bytes'] / 1024 / 1024:.1f} MB, {stats['docs_per_sec']:,.0f} docs/sec"
+            + (f", 重試 {stats['retried']:,} 筆" if stats['retried'] else '')
+            + (f", 失敗 {stats['failed']:,} 筆" if stats['failed'] else ''))
@@ -0,0 +1,343 @@
+#!/usr/bin/env python3
+"""
+聚合覆蓋率索引（每 3 分鐘桶的計數 + 缺口佇列）
+
+verify_backfill_coverage.py 等工具每次執行都對原始索引與聚合索引做大範圍
+聚合。CoverageIndex 改為在本機 SQLite 保存每個 3 分鐘桶的計數：
+- raw: 原始 flow 數、不重複來源 / 目標 IP 數
+- by_src / by_dst: 聚合文檔數、flow_count 總和
+
+計數以增量方式同步（每次只查詢上次同步之後的範圍，並重讀最近一段
+以涵蓋 Transform 延遲與晚到的資料），比對時將各來源展開成等長陣列，
+以一次向量化比較找出缺漏（missing）或不足（under_filled）的桶。
+找到的缺口可放入佇列，由 backfill_historical_data.py --repair-gaps 針對性回填。
+"""
+
+import os
+import sqlite3
+import threading
+import time
+from datetime import datetime, timezone
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+
+from .es_transport import get_transport
+from .watermark import latest_settled_bucket
+
+DEFAULT_COVERAGE_PATH = 'nad/state/coverage.db'
+
+BUCKET_MS = 3 * 60 * 1000
+
+# 來源: (索引, 時間欄位, 子聚合)
+COVERAGE_SOURCES = {
+    'raw': ('flow_collector-*', 'FLOW_START_MILLISECONDS', {
+        'src_ips': {'cardinality': {'field': 'IPV4_SRC_ADDR', 'precision_threshold': 3000}},
+        'dst_ips': {'cardinality': {'field': 'IPV4_DST_ADDR', 'precision_threshold': 3000}},
+    }),
+    'by_src': ('netflow_stats_3m_by_src', 'time_bucket', {
+        'flows': {'sum': {'field': 'flow_count'}},
+    }),
+    'by_dst': ('netflow_stats_3m_by_dst', 'time_bucket', {
+        'flows': {'sum': {'field': 'flow_count'}},
+    }),
+}
+
+# 聚合模式對應的原始 IP 數欄位（每個 IP 應有一筆聚合文檔）
+MODE_IP_COLUMN = {'by_src': 'src_ips', 'by_dst': 'dst_ips'}
+
+_COLUMNS = ('docs', 'flows', 'src_ips', 'dst_ips')
+
+
+def bucket_iso(bucket_ms: int) -> str:
+    """桶起點（UTC ISO 字串）"""
+    return datetime.fromtimestamp(bucket_ms / 1000, tz=timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ')
+
+
+def gap_windows(buckets: Iterable[int], max_buckets: int = 60) -> List[Tuple[int, int]]:
+    """
+    將缺口桶合併為連續窗口
+
+    Args:
+        buckets: 桶起點（epoch ms）
+        max_buckets: 每個窗口最多包含的桶數
+
+    Returns:
+        [(開始 ms, 結束 ms)]，結束不含
+    """
+    buckets = np.unique(np.asarray(list(buckets), dtype=np.int64))
+    if not len(buckets):
+        return []
+    # 不連續處或窗口已滿時切開
+    breaks = np.flatnonzero(np.diff(buckets) != BUCKET_MS) + 1
+    windows = []
+    for run in np.split(buckets, breaks):
+        for i in range(0, len(run), max_buckets):
+            part = run[i:i + max_buckets]
+            windows.append((int(part[0]), int(part[-1]) + BUCKET_MS))
+    return windows
+
+
+class CoverageIndex:
+    """每 3 分鐘桶的覆蓋率計數與缺口佇列（SQLite）"""
+
+    def __init__(self, path: Optional[str] = DEFAULT_COVERAGE_PATH, es_host: str = 'http://localhost:9200'):
+        """
+        Args:
+            path: SQLite 檔案路徑（None 表示不落地）
+            es_host: 同步計數時查詢的 ES 位址
+        """
+        self.path = path
+        self.es_host = es_host
+        if path:
+            directory = os.path.dirname(path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+        self._conn = sqlite3.connect(path or ':memory:', check_same_thread=False)
+        if path:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS coverage ("
+            "source TEXT NOT NULL, bucket INTEGER NOT NULL, docs INTEGER NOT NULL, flows INTEGER NOT NULL, "
+            "src_ips INTEGER NOT NULL DEFAULT 0, dst_ips INTEGER NOT NULL DEFAULT 0, "
+            "PRIMARY KEY (source, bucket)) WITHOUT ROWID"
+        )
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS gap_queue ("
+            "mode TEXT NOT NULL, bucket INTEGER NOT NULL, reason TEXT NOT NULL, "
+            "queued_at REAL NOT NULL, attempts INTEGER NOT NULL DEFAULT 0, "
+            "PRIMARY KEY (mode, bucket)) WITHOUT ROWID"
+        )
+        self._conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+        self._conn.commit()
+        self._lock = threading.RLock()
+
+    def close(self):
+        with self._lock:
+            self._conn.commit()
+            self._conn.close()
+
+    # ========== 同步 ==========
+
+    def synced_until(self, source: str) -> Optional[int]:
+        """來源已同步到的時間（epoch ms），尚未同步時返回 None"""
+        with self._lock:
+            row = self._conn.execute("SELECT value FROM meta WHERE key = ?", (f'synced_until:{source}',)).fetchone()
+        return int(row[0]) if row else None
+
+    def sync(self, sources: Iterable[str] = tuple(COVERAGE_SOURCES), days: int = 30,
+             resync_minutes: int = 30, now_ms: Optional[int] = None, chunk_hours: int = 24) -> Dict[str, int]:
+        """
+        增量同步各來源的計數
+
+        從上次同步位置往前 resync_minutes 開始重讀（首次同步為過去 days 天），到現在為止。
+
+        Returns:
+            {來源: 寫入的桶數}
+        """
+        now_ms = now_ms or int(time.time() * 1000)
+        ranges = {}
+        for source in sources:
+            synced = self.synced_until(source)
+            start = now_ms - days * 86400 * 1000 if synced is None else synced - resync_minutes * 60 * 1000
+            ranges[source] = (start - start % BUCKET_MS, now_ms)
+
+        start = min(r[0] for r in ranges.values())
+        return self.refresh(start, now_ms, sources=list(ranges), chunk_hours=chunk_hours,
+                            ranges=ranges, advance=True)
+
+    def refresh(self, start_ms: int, end_ms: int, sources: Iterable[str] = tuple(COVERAGE_SOURCES),
+                chunk_hours: int = 24, ranges: Optional[Dict[str, Tuple[int, int]]] = None,
+                advance: bool = False) -> Dict[str, int]:
+        """
+        重新讀取指定範圍的計數（例如回填修補之後）
+
+        每個 chunk 以一次 _msearch 查詢所有來源的 3 分鐘 date_histogram；
+        範圍內原有的計數先刪除再寫入，沒有資料的桶不保留列。
+        """
+        sources = list(sources)
+        ranges = ranges or {source: (start_ms, end_ms) for source in sources}
+        step = chunk_hours * 3600 * 1000
+        written = {source: 0 for source in sources}
+
+        chunk_start = start_ms - start_ms % BUCKET_MS
+        while chunk_start < end_ms:
+            chunk_end = min(chunk_start + step, end_ms)
+            active = [s for s in sources if ranges[s][0] < chunk_end and chunk_start < ranges[s][1]]
+            searches = []
+            for source in active:
+                index, time_field, aggs = COVERAGE_SOURCES[source]
+                lo, hi = max(chunk_start, ranges[source][0]), min(chunk_end, ranges[source][1])
+                searches.append((index, {
+                    "size": 0,
+                    "query": {"range": {time_field: {"gte": lo, "lt": hi, "format": "epoch_millis"}}},
+                    "aggs": {"buckets": {
+                        "date_histogram": {"field": time_field, "fixed_interval": "3m", "min_doc_count": 1},
+                        "aggs": aggs
+                    }}
+                }))
+
+            responses = get_transport().msearch(self.es_host, searches, timeout=120, caller='coverage_index')
+            for source, (_, body), response in zip(active, searches, responses):
+                if 'error' in response:
+                    raise RuntimeError(f"同步 {source} 覆蓋率失敗: {response['error']}")
+                time_range = body['query']['range'][COVERAGE_SOURCES[source][1]]
+                rows = self._rows(source, response['aggregations']['buckets']['buckets'])
+                self._replace(source, time_range['gte'], time_range['lt'], rows)
+                written[source] += len(rows)
+                if advance:
+                    self._set_synced(source, time_range['lt'])
+            chunk_start = chunk_end
+
+        with self._lock:
+            self._conn.commit()
+        return written
+
+    @staticmethod
+    def _rows(source: str, buckets: List[Dict]) -> List[Tuple]:
+        rows = []
+        for bucket in buckets:
+            if source == 'raw':
+                rows.append((source, int(bucket['key']), bucket['doc_count'], bucket['doc_count'],
+                             int(bucket['src_ips']['value']), int(bucket['dst_ips']['value'])))
+            else:
+                rows.append((source, int(bucket['key']), bucket['doc_count'],
+                             int(bucket['flows']['value'] or 0), 0, 0))
+        return rows
+
+    def _replace(self, source: str, start_ms: int, end_ms: int, rows: List[Tuple]):
+        with self._lock:
+            self._conn.execute("DELETE FROM coverage WHERE source = ? AND bucket >= ? AND bucket < ?",
+                               (source, start_ms, end_ms))
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO coverage (source, bucket, docs, flows, src_ips, dst_ips) "
+                "VALUES (?, ?, ?, ?, ?, ?)", rows
+            )
+
+    def _set_synced(self, source: str, until_ms: int):
+        with self._lock:
+            current = self.synced_until(source)
+            if current is None or until_ms > current:
+                self._conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)",
+                                   (f'synced_until:{source}', str(int(until_ms))))
+
+    # ========== 比對 ==========
+
+    def counts(self, source: str, start_ms: int, end_ms: int) -> Dict[str, np.ndarray]:
+        """
+        展開成等長陣列（每個桶一格，無資料為 0）
+
+        Returns:
+            {'bucket', 'docs', 'flows', 'src_ips', 'dst_ips'}
+        """
+        start_ms -= start_ms % BUCKET_MS
+        buckets = np.arange(start_ms, end_ms, BUCKET_MS, dtype=np.int64)
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT bucket, docs, flows, src_ips, dst_ips FROM coverage "
+                "WHERE source = ? AND bucket >= ? AND bucket < ?", (source, start_ms, end_ms)
+            ).fetchall()
+        data = np.array(rows, dtype=np.int64).reshape(-1, 5)
+        dense = {'bucket': buckets}
+        positions = (data[:, 0] - start_ms) // BUCKET_MS
+        for i, column in enumerate(_COLUMNS, start=1):
+            values = np.zeros(len(buckets), dtype=np.int64)
+            values[positions] = data[:, i]
+            dense[column] = values
+        return dense
+
+    def find_gaps(self, modes: Iterable[str] = ('by_src', 'by_dst'), start_ms: Optional[int] = None,
+                  end_ms: Optional[int] = None, days: int = 30, min_ratio: float = 0.99,
+                  delay_seconds: int = 90) -> List[Dict]:
+        """
+        找出聚合索引缺漏或不足的桶
+
+        - missing: 原始索引有 flow，聚合索引沒有任何文檔
+        - under_filled: 聚合的 flow_count 總和或文檔數低於原始 flow 數 / 不重複 IP 數的 min_ratio
+
+        Args:
+            modes: 聚合模式
+            start_ms: 開始（默認 end_ms 往前 days 天）
+            end_ms: 結束（默認為已同步且已穩定的最新桶）
+            min_ratio: 低於此比例視為不足
+            delay_seconds: Transform 延遲，尚未穩定的桶不比對
+
+        Returns:
+            [{'mode', 'bucket', 'time_bucket', 'reason', 'raw_flows', 'agg_flows', 'raw_ips', 'agg_docs'}]
+        """
+        modes = list(modes)
+        if end_ms is None:
+            settled = latest_settled_bucket(datetime.now(timezone.utc), 3, delay_seconds)
+            synced = [self.synced_until(source) for source in ['raw'] + modes]
+            if any(value is None for value in synced):
+                return []
+            end_ms = min(synced + [int(settled.timestamp() * 1000)])
+        if start_ms is None:
+            start_ms = end_ms - days * 86400 * 1000
+
+        raw = self.counts('raw', start_ms, end_ms)
+        has_raw = raw['flows'] > 0
+        gaps = []
+        for mode in modes:
+            agg = self.counts(mode, start_ms, end_ms)
+            raw_ips = raw[MODE_IP_COLUMN[mode]]
+            missing = has_raw & (agg['docs'] == 0)
+            under_filled = has_raw & ~missing & (
+                (agg['flows'] < raw['flows'] * min_ratio) | (agg['docs'] < raw_ips * min_ratio)
+            )
+            for i in np.flatnonzero(missing | under_filled):
+                gaps.append({
+                    'mode': mode,
+                    'bucket': int(raw['bucket'][i]),
+                    'time_bucket': bucket_iso(int(raw['bucket'][i])),
+                    'reason': 'missing' if missing[i] else 'under_filled',
+                    'raw_flows': int(raw['flows'][i]),
+                    'agg_flows': int(agg['flows'][i]),
+                    'raw_ips': int(raw_ips[i]),
+                    'agg_docs': int(agg['docs'][i]),
+                })
+        return gaps
+
+    # ========== 缺口佇列 ==========
+
+    def enqueue_gaps(self, gaps: Iterable[Dict]) -> int:
+        """放入缺口佇列（已在佇列中的桶不重複），返回新增數"""
+        now = time.time()
+        with self._lock:
+            before = self._conn.total_changes
+            self._conn.executemany(
+                "INSERT OR IGNORE INTO gap_queue (mode, bucket, reason, queued_at) VALUES (?, ?, ?, ?)",
+                [(gap['mode'], gap['bucket'], gap['reason'], now) for gap in gaps]
+            )
+            self._conn.commit()
+            return self._conn.total_changes - before
+
+    def queued_buckets(self, mode: Optional[str] = None, max_attempts: Optional[int] = None) -> Dict[str, List[int]]:
+        """佇列中的缺口 {mode: [桶起點 ms]}"""
+        query = "SELECT mode, bucket FROM gap_queue WHERE 1 = 1"
+        params = []
+        if mode is not None:
+            query += " AND mode = ?"
+            params.append(mode)
+        if max_attempts is not None:
+            query += " AND attempts < ?"
+            params.append(max_attempts)
+        queued: Dict[str, List[int]] = {}
+        with self._lock:
+            for row_mode, bucket in self._conn.execute(query + " ORDER BY mode, bucket", params):
+                queued.setdefault(row_mode, []).append(bucket)
+        return queued
+
+    def mark_repaired(self, mode: str, start_ms: int, end_ms: int):
+        """回填成功：移出佇列"""
+        with self._lock:
+            self._conn.execute("DELETE FROM gap_queue WHERE mode = ? AND bucket >= ? AND bucket < ?",
+                               (mode, start_ms, end_ms))
+            self._conn.commit()
+
+    def mark_failed(self, mode: str, start_ms: int, end_ms: int):
+        """回填失敗：累計嘗試次數"""
+        with self._lock:
+            self._conn.execute("UPDATE gap_queue SET attempts = attempts + 1 "
+                               "WHERE mode = ? AND bucket >= ? AND bucket < ?", (mode, start_ms, end_ms))
+            self._conn.commit()
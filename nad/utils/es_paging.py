@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+"""
+Elasticsearch 分頁讀取工具
+
+以 point-in-time (PIT) + search_after 逐頁讀取查詢結果，每次只持有一頁，
+不受 size 上限（index.max_result_window）截斷。叢集不支援 PIT（< 7.12）時
+退回以 (排序欄位, tiebreaker 欄位) 進行 search_after 分頁。
+"""
+
+from typing import Dict, Iterator, List, Optional
+
+
+def iter_search_pages(es, index: str, query: Dict, sort_field: str = 'time_bucket',
+                      tiebreaker: Optional[str] = None, source_fields: Optional[List[str]] = None,
+                      page_size: int = 5000, keep_alive: str = '1m') -> Iterator[List[Dict]]:
+    """
+    逐頁產生查詢結果的 _source
+
+    Args:
+        es: Elasticsearch 客戶端
+        index: 索引名稱
+        query: 查詢條件（query DSL 的 "query" 部分）
+        sort_field: 主要排序欄位
+        tiebreaker: 不支援 PIT 時用於穩定排序的欄位（例如 src_ip）
+        source_fields: 只取回的欄位（None 表示全部）
+        page_size: 每頁筆數
+        keep_alive: PIT 保留時間
+
+    Yields:
+        每頁的 _source 列表
+    """
+    body = {
+        "size": page_size,
+        "query": query,
+        "track_total_hits": False
+    }
+    if source_fields is not None:
+        body["_source"] = list(source_fields)
+
+    pit_id = None
+    try:
+        pit_id = es.open_point_in_time(index=index, keep_alive=keep_alive)['id']
+    except Exception:
+        # 舊版叢集不支援 PIT，改用一般 search_after
+        pit_id = None
+
+    if pit_id is not None:
+        body["sort"] = [{sort_field: "asc"}, {"_shard_doc": "asc"}]
+    else:
+        body["sort"] = [{sort_field: "asc"}]
+        if tiebreaker:
+            body["sort"].append({tiebreaker: "asc"})
+
+    try:
+        while True:
+            if pit_id is not None:
+                body["pit"] = {"id": pit_id, "keep_alive": keep_alive}
+                response = es.search(body=body)
+                # PIT id 可能在每次查詢後更新
+                pit_id = response.get('pit_id', pit_id)
+            else:
+                response = es.search(index=index, body=body)
+
+            hits = response['hits']['hits']
+            if not hits:
+                break
+
+            yield [hit['_source'] for hit in hits]
+
+            if len(hits) < page_size:
+                break
+            body["search_after"] = hits[-1]['sort']
+    finally:
+        if pit_id is not None:
+            try:
+                es.close_point_in_time(body={"id": pit_id})
+            except Exception:
+                pass
@@ -0,0 +1,236 @@
+#!/usr/bin/env python3
+"""
+共用的 Elasticsearch HTTP 傳輸層
+
+提供給直接以 HTTP 呼叫 ES 的模組（分類器跨視角查詢、雙向分析、基準線、
+回填腳本等）共用：
+- keep-alive 連線池，不再每次查詢重新建立 TCP/HTTP 連線
+- gzip 壓縮（回應一律接受 gzip，大型請求內容自動壓縮）
+- 一致的預設逾時；只重試連線錯誤（請求尚未送達 ES）。讀取逾時與 429 / 5xx
+  直接交給呼叫者處理，避免重送重量級聚合，也不與 BulkIngester 的項目重試、
+  回填的窗口重試與 AIMD 限流疊加，在 ES 過載時放大負載
+- 較快的 JSON 編解碼（有安裝 orjson 時使用）
+- 依呼叫者統計次數、耗時與傳輸位元組數，便於觀察每個偵測週期的 ES 成本
+"""
+
+import gzip
+import json
+import threading
+import time
+from typing import Dict, Optional
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+try:
+    import orjson
+
+    def _dumps(obj) -> bytes:
+        return orjson.dumps(obj)
+
+    def _loads(data):
+        return orjson.loads(data)
+except ImportError:
+    def _dumps(obj) -> bytes:
+        return json.dumps(obj, separators=(',', ':')).encode('utf-8')
+
+    def _loads(data):
+        return json.loads(data)
+
+
+DEFAULT_TIMEOUT = 30
+
+
+class ESResponse:
+    """ES 回應（介面與 requests.Response 常用部分相同，json() 使用較快的解碼器）"""
+
+    def __init__(self, response: requests.Response):
+        self._response = response
+        self.status_code = response.status_code
+        self.headers = response.headers
+        self.content = response.content
+
+    @property
+    def text(self) -> str:
+        return self._response.text
+
+    def json(self):
+        return _loads(self.content)
+
+    def raise_for_status(self):
+        self._response.raise_for_status()
+
+
+class ESTransport:
+    """以連線池共用連線的 ES HTTP 客戶端"""
+
+    def __init__(self, timeout: float = DEFAULT_TIMEOUT, max_retries: int = 3,
+                 backoff_factor: float = 0.5, pool_maxsize: int = 20,
+                 compress_threshold: Optional[int] = 16 * 1024):
+        """
+        Args:
+            timeout: 預設逾時（秒），可在每次呼叫覆寫
+            max_retries: 連線錯誤的最大重試次數
+            backoff_factor: 重試退避係數（等待 backoff_factor × 2^(n-1) 秒）
+            pool_maxsize: 每個主機的最大連線數
+            compress_threshold: 請求內容超過此位元組數時以 gzip 壓縮（None 表示不壓縮）
+        """
+        self.timeout = timeout
+        self.compress_threshold = compress_threshold
+
+        retry_kwargs = dict(
+            total=max_retries, connect=max_retries, read=0, status=0,
+            backoff_factor=backoff_factor, raise_on_status=False,
+        )
+        try:
+            # 連線錯誤時請求尚未送出，POST 也可安全重試
+            retry = Retry(allowed_methods=None, **retry_kwargs)
+        except TypeError:
+            # urllib3 < 1.26
+            retry = Retry(method_whitelist=False, **retry_kwargs)
+
+        adapter = HTTPAdapter(pool_connections=10, pool_maxsize=pool_maxsize, max_retries=retry)
+        self.session = requests.Session()
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.session.headers.update({'Accept-Encoding': 'gzip'})
+
+        self._stats: Dict[str, Dict] = {}
+        self._stats_lock = threading.Lock()
+
+    def request(self, method: str, url: str, json=None, data=None,
+                headers: Optional[Dict] = None, timeout: Optional[float] = None,
+                caller: str = 'default') -> ESResponse:
+        """
+        發送請求
+
+        Args:
+            method: HTTP 方法
+            url: 完整 URL（例如 http://localhost:9200/index/_search）
+            json: 以 JSON 編碼的請求內容
+            data: 原始請求內容（例如 _bulk / _msearch 的 NDJSON）
+            headers: 額外的 HTTP 標頭
+            timeout: 逾時（秒），None 使用預設值
+            caller: 呼叫者名稱（用於統計）
+
+        Returns:
+            ESResponse
+        """
+        request_headers = {}
+        if json is not None:
+            body = _dumps(json)
+            request_headers['Content-Type'] = 'application/json'
+        elif isinstance(data, str):
+            body = data.encode('utf-8')
+        else:
+            body = data
+        if headers:
+            request_headers.update(headers)
+
+        if body is not None and self.compress_threshold is not None \
+                and len(body) > self.compress_threshold:
+            body = gzip.compress(body, compresslevel=1)
+            request_headers['Content-Encoding'] = 'gzip'
+
+        start = time.perf_counter()
+        try:
+            response = self.session.request(
+                method, url, data=body, headers=request_headers,
+                timeout=timeout if timeout is not None else self.timeout
+            )
+        except Exception:
+            self._record(caller, time.perf_counter() - start, len(body or b''), 0, error=True)
+            raise
+
+        self._record(
+            caller, time.perf_counter() - start, len(body or b''),
+            int(response.headers.get('Content-Length') or len(response.content)),
+            error=response.status_code >= 400
+        )
+        return ESResponse(response)
+
+    def post(self, url: str, **kwargs) -> ESResponse:
+        return self.request('POST', url, **kwargs)
+
+    def get(self, url: str, **kwargs) -> ESResponse:
+        return self.request('GET', url, **kwargs)
+
+    def msearch(self, es_host: str, searches, timeout: Optional[float] = None,
+                caller: str = 'default'):
+        """
+        以一次 _msearch 執行多個查詢
+
+        Args:
+            es_host: ES 主機（例如 http://localhost:9200）
+            searches: [(index, body), ...]
+            timeout: 逾時（秒）
+            caller: 呼叫者名稱（用於統計）
+
+        Returns:
+            與 searches 對應的回應列表；個別查詢失敗時該項目包含 'error'
+        """
+        if not searches:
+            return []
+
+        lines = []
+        for index, body in searches:
+            lines.append(_dumps({"index": index}))
+            lines.append(_dumps(body))
+
+        response = self.post(
+            f"{es_host}/_msearch",
+            data=b'\n'.join(lines) + b'\n',
+            headers={'Content-Type': 'application/x-ndjson'},
+            timeout=timeout, caller=caller
+        )
+        response.raise_for_status()
+        return response.json().get('responses', [])
+
+    def _record(self, caller: str, seconds: float, bytes_sent: int,
+                bytes_received: int, error: bool):
+        with self._stats_lock:
+            stats = self._stats.setdefault(caller, {
+                'calls': 0, 'errors': 0, 'seconds': 0.0,
+                'bytes_sent': 0, 'bytes_received': 0
+            })
+            stats['calls'] += 1
+            stats['errors'] += int(error)
+            stats['seconds'] += seconds
+            stats['bytes_sent'] += bytes_sent
+            stats['bytes_received'] += bytes_received
+
+    def get_stats(self) -> Dict[str, Dict]:
+        """各呼叫者的統計（calls, errors, seconds, bytes_sent, bytes_received）"""
+        with self._stats_lock:
+            return {caller: dict(stats) for caller, stats in self._stats.items()}
+
+    def reset_stats(self):
+        with self._stats_lock:
+            self._stats.clear()
+
+    def format_stats(self) -> str:
+        """統計摘要（每個呼叫者一行）"""
+        lines = []
+        for caller, stats in sorted(self.get_stats().items()):
+            lines.append(
+                f"{caller}: {stats['calls']} 次, {stats['seconds']:.2f}s, "
+                f"送出 {stats['bytes_sent'] / 1024:.1f} KB, "
+                f"接收 {stats['bytes_received'] / 1024:.1f} KB"
+                + (f", 錯誤 {stats['errors']}" if stats['errors'] else '')
+            )
+        return '\n'.join(lines)
+
+
+_transport = None
+_transport_lock = threading.Lock()
+
+
+def get_transport() -> ESTransport:
+    """取得全域共用的 ESTransport"""
+    global _transport
+    if _transport is None:
+        with _transport_lock:
+            if _transport is None:
+                _transport = ESTransport()
+    return _transport
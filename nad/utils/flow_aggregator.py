@@ -0,0 +1,360 @@
+#!/usr/bin/env python3
+"""
+原始 NetFlow 的程序內 3 分鐘聚合
+
+與 setup_3m_transforms.sh 的 Transform 產生相同欄位的 by_src / by_dst 文檔，
+但聚合在本機以 NumPy 完成，ES 只需回傳原始欄位，且一次讀取即可同時產生
+兩個視角：
+- (time_bucket, IP) 編碼為單一 int64，以 np.unique + bincount 分組加總
+- 對端 IP 基數（unique_dsts / unique_srcs）以稀疏 HyperLogLog 估計：
+  只保存出現過的 (組, 暫存器)，小基數時以線性計數估計，接近精確
+- 端口以 (組, 端口) 精確計數，同時得到 unique_*_ports 與前 5 名
+  top_*_ports（與 terms size 5 相同，同次數時端口小者優先）
+
+部分結果（例如每個 slice 各自的聚合）可以 merge 合併；文檔以 iter_documents
+分批產生，不需一次建立整個窗口的文檔。
+"""
+
+import ipaddress
+from datetime import datetime, timedelta, timezone
+from typing import Dict, Iterable, Iterator, List, Optional
+
+import numpy as np
+
+BUCKET_MS = 3 * 60 * 1000
+
+# 聚合需要的原始欄位（_source 過濾）
+SOURCE_FIELDS = [
+    'FLOW_START_MILLISECONDS', 'IPV4_SRC_ADDR', 'IPV4_DST_ADDR',
+    'L4_SRC_PORT', 'L4_DST_PORT', 'IN_BYTES', 'IN_PKTS'
+]
+
+# 聚合視角: (分組欄位, 文檔 IP 欄位, 對端欄位, 對端基數欄位)
+PERSPECTIVES = {
+    'by_src': ('IPV4_SRC_ADDR', 'src_ip', 'IPV4_DST_ADDR', 'unique_dsts'),
+    'by_dst': ('IPV4_DST_ADDR', 'dst_ip', 'IPV4_SRC_ADDR', 'unique_srcs'),
+}
+
+TOP_PORTS = 5
+_PORT_BITS = 16
+_PORT_MASK = (1 << _PORT_BITS) - 1
+_IP_MASK = 0xFFFFFFFF
+
+
+def _hash64(values: np.ndarray) -> np.ndarray:
+    """splitmix64（uint64 溢位即為 mod 2^64）"""
+    with np.errstate(over='ignore'):
+        x = values.astype(np.uint64) + np.uint64(0x9E3779B97F4A7C15)
+        x = (x ^ (x >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+        x = (x ^ (x >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+        return x ^ (x >> np.uint64(31))
+
+
+def hll_registers(values: np.ndarray, precision: int):
+    """
+    HyperLogLog 的暫存器編號與 rank
+
+    Returns:
+        (register, rank)：低 precision 位元決定暫存器，
+        其餘位元的前導零個數 + 1 為 rank
+    """
+    hashed = _hash64(values)
+    register = (hashed & np.uint64((1 << precision) - 1)).astype(np.int64)
+    remaining = hashed >> np.uint64(precision)
+    # remaining < 2^(64 - precision) <= 2^60，frexp 的指數即為位元長度
+    _, bit_length = np.frexp(remaining.astype(np.float64))
+    rank = (64 - precision - bit_length + 1).astype(np.uint8)
+    return register, rank
+
+
+def hll_estimate(codes: np.ndarray, ranks: np.ndarray, n_groups: int, precision: int) -> np.ndarray:
+    """
+    各組的 HyperLogLog 基數估計
+
+    Args:
+        codes: 組 * 2^precision + 暫存器（不重複）
+        ranks: 對應暫存器的最大 rank
+        n_groups: 組數
+        precision: 暫存器位元數
+    """
+    m = 1 << precision
+    groups = codes // m
+    present = np.bincount(groups, minlength=n_groups)
+    zeros = m - present
+    inverse_sum = np.bincount(groups, weights=np.ldexp(1.0, -ranks.astype(np.int64)),
+                              minlength=n_groups) + zeros
+    alpha = 0.7213 / (1 + 1.079 / m)
+    raw = alpha * m * m / inverse_sum
+    # 小基數以線性計數修正
+    linear = m * np.log(m / np.maximum(zeros, 1))
+    estimate = np.where((raw <= 2.5 * m) & (zeros > 0), linear, raw)
+    return np.rint(estimate).astype(np.int64)
+
+
+def _numeric_column(flows: List[Dict], field: str, dtype, missing) -> np.ndarray:
+    values = (flow.get(field) for flow in flows)
+    return np.fromiter((missing if value is None else value for value in values),
+                       dtype=dtype, count=len(flows))
+
+
+class FlowAggregator:
+    """
+    將原始 flow 聚合為 3 分鐘的 by_src / by_dst 文檔
+
+    add_flows 先累積欄位，達到 flush_rows 筆時才分組併入結果，
+    合併成本與頁數無關。
+    """
+
+    def __init__(self, modes: Iterable[str] = ('by_src', 'by_dst'), utc_offset_hours: float = 8,
+                 precision: int = 14, flush_rows: int = 200000):
+        """
+        Args:
+            modes: 要產生的聚合視角
+            utc_offset_hours: time_bucket 的時區（默認 +8，與 Transform 的 Asia/Taipei 相同）
+            precision: HyperLogLog 暫存器位元數（每組最多 2^precision 個暫存器）
+            flush_rows: 累積多少筆 flow 後併入結果
+        """
+        self.modes = list(modes)
+        for mode in self.modes:
+            if mode not in PERSPECTIVES:
+                raise ValueError(f"不支援的聚合模式: {mode}")
+        self.offset_ms = int(utc_offset_hours * 3600 * 1000)
+        self.tz = timezone(timedelta(hours=utc_offset_hours))
+        self.precision = precision
+        self.flush_rows = flush_rows
+        self.flows = 0
+
+        self._states: Dict[str, Optional[Dict]] = {mode: None for mode in self.modes}
+        self._buffer: List[Dict[str, np.ndarray]] = []
+        self._buffered = 0
+        self._ip_codes: Dict = {}
+
+    # ========== 輸入 ==========
+
+    def add_flows(self, flows: List[Dict]):
+        """加入一頁原始 flow 的 _source"""
+        if not flows:
+            return
+        self._buffer.append({
+            'ts': _numeric_column(flows, 'FLOW_START_MILLISECONDS', np.int64, -1),
+            'IPV4_SRC_ADDR': self._ip_column(flows, 'IPV4_SRC_ADDR'),
+            'IPV4_DST_ADDR': self._ip_column(flows, 'IPV4_DST_ADDR'),
+            'L4_SRC_PORT': _numeric_column(flows, 'L4_SRC_PORT', np.int64, -1),
+            'L4_DST_PORT': _numeric_column(flows, 'L4_DST_PORT', np.int64, -1),
+            'IN_BYTES': _numeric_column(flows, 'IN_BYTES', np.float64, 0.0),
+            'IN_PKTS': _numeric_column(flows, 'IN_PKTS', np.float64, 0.0),
+        })
+        self._buffered += len(flows)
+        self.flows += len(flows)
+        if self._buffered >= self.flush_rows:
+            self._flush()
+
+    def merge(self, other: 'FlowAggregator'):
+        """併入另一個聚合器（相同視角與參數）的結果"""
+        if other.precision != self.precision or other.offset_ms != self.offset_ms:
+            raise ValueError("只能合併相同 precision 與時區的聚合器")
+        self._flush()
+        other._flush()
+        for mode in self.modes:
+            states = [s for s in (self._states[mode], other._states.get(mode)) if s is not None]
+            if states:
+                self._states[mode] = self._combine(states)
+        self.flows += other.flows
+
+    def _ip_column(self, flows: List[Dict], field: str) -> np.ndarray:
+        """IPv4 字串轉為整數（無法解析為 -1）"""
+        codes = np.empty(len(flows), dtype=np.int64)
+        cache = self._ip_codes
+        for i, flow in enumerate(flows):
+            value = flow.get(field)
+            code = cache.get(value)
+            if code is None:
+                try:
+                    code = int(ipaddress.IPv4Address(value))
+                except (ipaddress.AddressValueError, TypeError, ValueError):
+                    code = -1
+                cache[value] = code
+            codes[i] = code
+        return codes
+
+    # ========== 分組 ==========
+
+    def _flush(self):
+        if not self._buffer:
+            return
+        columns = {name: np.concatenate([page[name] for page in self._buffer]) for name in self._buffer[0]}
+        self._buffer = []
+        self._buffered = 0
+
+        for mode in self.modes:
+            rows = self._row_state(columns, mode)
+            current = self._states[mode]
+            self._states[mode] = self._combine([rows] if current is None else [current, rows])
+
+    def _row_state(self, columns: Dict[str, np.ndarray], mode: str) -> Dict:
+        """每筆 flow 視為一組的狀態（再由 _combine 分組）"""
+        group_field, _, peer_field, _ = PERSPECTIVES[mode]
+        m = 1 << self.precision
+        mask = (columns[group_field] >= 0) & (columns['ts'] >= 0)
+        bucket = (columns['ts'][mask] + self.offset_ms) // BUCKET_MS
+        rows = np.arange(int(mask.sum()), dtype=np.int64)
+
+        peer = columns[peer_field][mask]
+        has_peer = peer >= 0
+        register, rank = hll_registers(peer[has_peer], self.precision)
+
+        state = {
+            'keys': (bucket << 32) | columns[group_field][mask],
+            'total_bytes': columns['IN_BYTES'][mask],
+            'total_packets': columns['IN_PKTS'][mask],
+            'flow_count': np.ones(len(rows), dtype=np.int64),
+            'max_bytes': columns['IN_BYTES'][mask],
+            'hll_codes': rows[has_peer] * m + register,
+            'hll_ranks': rank,
+        }
+        for side, field in (('src', 'L4_SRC_PORT'), ('dst', 'L4_DST_PORT')):
+            port = columns[field][mask]
+            valid = (port >= 0) & (port <= _PORT_MASK)
+            state[f'{side}_port_codes'] = (rows[valid] << _PORT_BITS) | port[valid]
+            state[f'{side}_port_counts'] = np.ones(int(valid.sum()), dtype=np.int64)
+        return state
+
+    def _combine(self, states: List[Dict]) -> Dict:
+        """合併多個狀態：以 keys 重新分組，組編號改為合併後的位置"""
+        m = 1 << self.precision
+        keys, inverse = np.unique(np.concatenate([s['keys'] for s in states]), return_inverse=True)
+        inverse = inverse.reshape(-1)
+        n = len(keys)
+        offsets = np.cumsum([0] + [len(s['keys']) for s in states])
+
+        def concat(name):
+            return np.concatenate([s[name] for s in states])
+
+        # 各狀態的組編號 -> 合併後的組編號
+        hll_parts, port_parts = [], {'src': [], 'dst': []}
+        for state, offset in zip(states, offsets):
+            group_map = inverse[offset:offset + len(state['keys'])]
+            codes = state['hll_codes']
+            hll_parts.append(group_map[codes // m] * m + codes % m)
+            for side in ('src', 'dst'):
+                codes = state[f'{side}_port_codes']
+                port_parts[side].append((group_map[codes >> _PORT_BITS] << _PORT_BITS) | (codes & _PORT_MASK))
+
+        combined = {'keys': keys}
+        for name in ('total_bytes', 'total_packets'):
+            combined[name] = np.bincount(inverse, weights=concat(name), minlength=n)
+        combined['flow_count'] = np.bincount(inverse, weights=concat('flow_count'), minlength=n).astype(np.int64)
+        combined['max_bytes'] = np.full(n, -np.inf)
+        np.maximum.at(combined['max_bytes'], inverse, concat('max_bytes'))
+
+        hll_codes, hll_inverse = np.unique(np.concatenate(hll_parts), return_inverse=True)
+        combined['hll_codes'] = hll_codes
+        combined['hll_ranks'] = np.zeros(len(hll_codes), dtype=np.uint8)
+        np.maximum.at(combined['hll_ranks'], hll_inverse.reshape(-1), concat('hll_ranks'))
+
+        for side in ('src', 'dst'):
+            codes, port_inverse = np.unique(np.concatenate(port_parts[side]), return_inverse=True)
+            combined[f'{side}_port_codes'] = codes
+            combined[f'{side}_port_counts'] = np.bincount(
+                port_inverse.reshape(-1), weights=concat(f'{side}_port_counts'), minlength=len(codes)
+            ).astype(np.int64)
+        return combined
+
+    # ========== 輸出 ==========
+
+    def group_count(self, mode: str) -> int:
+        self._flush()
+        state = self._states[mode]
+        return 0 if state is None else len(state['keys'])
+
+    def documents(self, mode: str) -> List[Dict]:
+        """
+        產生全部聚合文檔（大量組數時改用 iter_documents 分批處理）
+
+        Returns:
+            依 (time_bucket, IP) 排序的文檔列表
+        """
+        return [doc for batch in self.iter_documents(mode) for doc in batch]
+
+    def iter_documents(self, mode: str, batch_size: int = 5000) -> Iterator[List[Dict]]:
+        """
+        分批產生聚合文檔
+
+        欄位與 Transform（setup_3m_transforms.sh）相同，包含 top_src_ports /
+        top_dst_ports；composite 回填引擎的文檔沒有這兩個欄位。
+        聚合狀態維持 NumPy 陣列，只有目前這批轉為 dict。
+
+        Args:
+            mode: 聚合視角
+            batch_size: 每批的文檔數
+
+        Yields:
+            依 (time_bucket, IP) 排序、最多 batch_size 筆的文檔列表
+        """
+        self._flush()
+        state = self._states[mode]
+        if state is None:
+            return
+        _, ip_field, _, cardinality_name = PERSPECTIVES[mode]
+        n = len(state['keys'])
+
+        unique_peers = hll_estimate(state['hll_codes'], state['hll_ranks'], n, self.precision)
+        buckets = state['keys'] >> 32
+        ips = state['keys'] & _IP_MASK
+        bucket_names = {int(b): self._format_bucket(int(b)) for b in np.unique(buckets)}
+        # 端口編碼已依組排序，每批以 searchsorted 取出對應範圍
+        port_groups = {side: state[f'{side}_port_codes'] >> _PORT_BITS for side in ('src', 'dst')}
+
+        for lo in range(0, n, batch_size):
+            hi = min(lo + batch_size, n)
+            ip_names = {int(ip): str(ipaddress.IPv4Address(int(ip))) for ip in np.unique(ips[lo:hi])}
+            ports = {}
+            for side in ('src', 'dst'):
+                start, end = np.searchsorted(port_groups[side], [lo, hi])
+                ports[side] = self._port_summary(
+                    state[f'{side}_port_codes'][start:end], state[f'{side}_port_counts'][start:end],
+                    port_groups[side][start:end] - lo, hi - lo
+                )
+
+            docs = []
+            for j, i in enumerate(range(lo, hi)):
+                flow_count = int(state['flow_count'][i])
+                total_bytes = float(state['total_bytes'][i])
+                docs.append({
+                    'time_bucket': bucket_names[int(buckets[i])],
+                    ip_field: ip_names[int(ips[i])],
+                    'total_bytes': total_bytes,
+                    'total_packets': float(state['total_packets'][i]),
+                    'flow_count': flow_count,
+                    cardinality_name: int(unique_peers[i]),
+                    'unique_src_ports': int(ports['src'][0][j]),
+                    'unique_dst_ports': int(ports['dst'][0][j]),
+                    'avg_bytes': total_bytes / flow_count,
+                    'max_bytes': float(state['max_bytes'][i]),
+                    'top_src_ports': ports['src'][1][j],
+                    'top_dst_ports': ports['dst'][1][j],
+                })
+            yield docs
+
+    @staticmethod
+    def _port_summary(codes: np.ndarray, counts: np.ndarray, groups: np.ndarray, n: int):
+        """每組的不重複端口數與前 TOP_PORTS 名 {端口字串: 次數}（groups 為 0..n-1 的組編號）"""
+        port = codes & _PORT_MASK
+        distinct = np.bincount(groups, minlength=n)
+
+        # 依 (組, 次數遞減, 端口) 排序後取每組前幾名
+        order = np.lexsort((port, -counts, groups))
+        sorted_groups = groups[order]
+        rank = np.arange(len(order)) - np.searchsorted(sorted_groups, sorted_groups, side='left')
+        top = order[rank < TOP_PORTS]
+
+        top_ports = [{} for _ in range(n)]
+        for group, value, count in zip(groups[top].tolist(), port[top].tolist(), counts[top].tolist()):
+            top_ports[group][str(value)] = count
+        return distinct, top_ports
+
+    def _format_bucket(self, bucket: int) -> str:
+        """與 date_histogram（time_zone + strict_date_optional_time）的 key 字串相同"""
+        start = datetime.fromtimestamp((bucket * BUCKET_MS - self.offset_ms) / 1000, tz=self.tz)
+        text = start.isoformat(timespec='milliseconds')
+        return text[:-6] + 'Z' if text.endswith('+00:00') else text
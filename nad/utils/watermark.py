@@ -0,0 +1,129 @@
+#!/usr/bin/env python3
+"""
+增量偵測的時間水位（watermark）
+
+記錄每個視角最後一個已完整處理的 time_bucket，並持久化到 JSON 檔案，
+重啟後從水位之後繼續。每次只處理「水位之後、且已穩定」的 bucket，
+確保每個 time_bucket 只被評分、分類、驗證與記錄一次。
+
+Transform 會延遲 delay（預設 90 秒）才聚合一個 bucket 的資料，因此
+bucket [T, T + bucket_minutes) 要到 T + bucket_minutes + delay 之後才穩定。
+"""
+
+import json
+import os
+import threading
+from datetime import datetime, timedelta, timezone
+from typing import Dict, Optional, Tuple
+
+DEFAULT_WATERMARK_PATH = 'nad/state/watermarks.json'
+
+
+def floor_to_bucket(dt: datetime, bucket_minutes: int = 3) -> datetime:
+    """向下取整到 bucket 起點（以 UTC epoch 對齊）"""
+    bucket_seconds = bucket_minutes * 60
+    epoch = int(dt.timestamp())
+    return datetime.fromtimestamp(epoch - epoch % bucket_seconds, tz=timezone.utc)
+
+
+def latest_settled_bucket(now: datetime, bucket_minutes: int = 3,
+                          delay_seconds: int = 90) -> datetime:
+    """
+    最新一個已穩定（transform 已完成聚合）的 bucket 起點
+
+    Args:
+        now: 目前時間（UTC）
+        bucket_minutes: bucket 長度（分鐘）
+        delay_seconds: transform 延遲（秒）
+    """
+    return floor_to_bucket(
+        now - timedelta(minutes=bucket_minutes, seconds=delay_seconds),
+        bucket_minutes
+    )
+
+
+class WatermarkStore:
+    """以 JSON 檔案持久化的各視角水位"""
+
+    def __init__(self, path: str = DEFAULT_WATERMARK_PATH, bucket_minutes: int = 3,
+                 delay_seconds: int = 90, initial_lookback_minutes: int = 10):
+        """
+        Args:
+            path: 水位檔案路徑
+            bucket_minutes: bucket 長度（分鐘）
+            delay_seconds: transform 延遲（秒）
+            initial_lookback_minutes: 首次執行（尚無水位）時回溯的分鐘數
+        """
+        self.path = path
+        self.bucket_minutes = bucket_minutes
+        self.delay_seconds = delay_seconds
+        self.initial_lookback_minutes = initial_lookback_minutes
+        self._lock = threading.Lock()
+        self._watermarks: Dict[str, str] = self._load()
+
+    @classmethod
+    def from_config(cls, config=None) -> 'WatermarkStore':
+        """依 config.yaml 的 watermark 區塊建立"""
+        wm_config = config.get('watermark', {}) if hasattr(config, 'get') else {}
+        return cls(
+            path=wm_config.get('path', DEFAULT_WATERMARK_PATH),
+            bucket_minutes=wm_config.get('bucket_minutes', 3),
+            delay_seconds=wm_config.get('transform_delay_seconds', 90),
+            initial_lookback_minutes=wm_config.get('initial_lookback_minutes', 10),
+        )
+
+    def _load(self) -> Dict[str, str]:
+        if not os.path.exists(self.path):
+            return {}
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError) as e:
+            print(f"⚠️  無法讀取水位檔案 {self.path}: {e}，從頭開始")
+            return {}
+
+    def _save(self):
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(self._watermarks, f, indent=2)
+        os.replace(tmp_path, self.path)
+
+    def get(self, perspective: str) -> Optional[datetime]:
+        """取得視角的水位（最後一個已處理 bucket 的起點），不存在時返回 None"""
+        value = self._watermarks.get(perspective)
+        if value is None:
+            return None
+        return datetime.fromisoformat(value.replace('Z', '+00:00'))
+
+    def advance(self, perspective: str, bucket: datetime):
+        """推進水位（只會往後移動）並寫入檔案"""
+        with self._lock:
+            current = self.get(perspective)
+            if current is not None and bucket <= current:
+                return
+            self._watermarks[perspective] = bucket.astimezone(timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ')
+            self._save()
+
+    def next_window(self, perspective: str,
+                    now: Optional[datetime] = None) -> Optional[Tuple[datetime, datetime]]:
+        """
+        計算本次應處理的 bucket 範圍
+
+        Returns:
+            (start_exclusive, end_inclusive)：處理 start < time_bucket <= end 的 bucket；
+            沒有新的已穩定 bucket 時返回 None
+        """
+        now = now or datetime.now(timezone.utc)
+        end = latest_settled_bucket(now, self.bucket_minutes, self.delay_seconds)
+
+        start = self.get(perspective)
+        if start is None:
+            # 首次執行：處理回溯窗口內的已穩定 bucket
+            start = end - timedelta(minutes=self.initial_lookback_minutes)
+
+        if end <= start:
+            return None
+        return start, end
@@ -20,6 +20,7 @@ from nad.ml import OptimizedIsolationForest
 from nad.ml.anomaly_classifier import AnomalyClassifier
 from nad.device_classifier import DeviceClassifier
 from nad.anomaly_logger import AnomalyLogger
+from nad.utils.watermark import WatermarkStore
 
 
 def print_anomalies(anomalies, top_n=20):
@@ -224,15 +225,26 @@ def single_detection(detector, minutes, exclude_servers=False):
         return []
 
 
-def continuous_monitoring(detector, interval_minutes, window_minutes, exclude_servers=False):
-    """持續監控模式"""
+def continuous_monitoring(detector, interval_minutes, window_minutes, exclude_servers=False,
+                          incremental=False):
+    """
+    持續監控模式
+
+    incremental=True 時使用水位模式：只處理上次水位之後、已穩定的 bucket，
+    每個 time_bucket 只處理一次，水位持久化於檔案，重啟後延續。
+    """
+    watermarks = WatermarkStore.from_config(detector.config) if incremental else None
+
     print(f"\n{'='*100}")
     print(f"持續監控模式")
     if exclude_servers:
         print("(過濾服務器回應流量)")
     print(f"{'='*100}\n")
     print(f"檢測間隔: 每 {interval_minutes} 分鐘")
-    print(f"分析窗口: 最近 {window_minutes} 分鐘")
+    if incremental:
+        print(f"分析窗口: 水位之後的已穩定 bucket（水位檔案: {watermarks.path}）")
+    else:
+        print(f"分析窗口: 最近 {window_minutes} 分鐘")
     print(f"異常記錄: 自動寫入 Elasticsearch")
     print(f"按 Ctrl+C 停止\n")
     print(f"{'='*100}\n")
@@ -256,7 +268,17 @@ def continuous_monitoring(detector, interval_minutes, window_minutes, exclude_se
             print(f"\n🔍 檢測 #{iteration} - {current_time}")
             print(f"{'-'*100}")
 
-            anomalies = detector.predict_realtime(recent_minutes=window_minutes)
+            window = None
+            if incremental:
+                window = watermarks.next_window('SRC')
+                if window is None:
+                    print("  ⏸  沒有新的已穩定 bucket")
+                    anomalies = []
+                else:
+                    print(f"  範圍: {window[0]:%H:%M} < time_bucket <= {window[1]:%H:%M} (UTC)")
+                    anomalies = detector.predict_time_range(*window)
+            else:
+                anomalies = detector.predict_realtime(recent_minutes=window_minutes)
 
             # 過濾服務器回應（如果啟用）
             if exclude_servers and anomalies:
@@ -322,6 +344,10 @@ def continuous_monitoring(detector, interval_minutes, window_minutes, exclude_se
             else:
                 print("  ✅ 未發現異常")
 
+            # 本次範圍已處理完成，推進水位
+            if window is not None:
+                watermarks.advance('SRC', window[1])
+
             # 等待下一次檢測
             print(f"\n⏰ 下次檢測: {interval_minutes} 分鐘後...")
             time.sleep(interval_minutes * 60)
@@ -364,6 +390,11 @@ def main():
         action='store_true',
         help='過濾掉可能的服務器回應流量（推薦使用）'
     )
+    parser.add_argument(
+        '--incremental',
+        action='store_true',
+        help='持續監控時使用水位模式（每個 time_bucket 只處理一次）'
+    )
 
     args = parser.parse_args()
 
@@ -399,7 +430,8 @@ def main():
 
     # 執行檢測
     if args.continuous:
-        continuous_monitoring(detector, args.interval, args.minutes, args.exclude_servers)
+        continuous_monitoring(detector, args.interval, args.minutes, args.exclude_servers,
+                              incremental=args.incremental)
     else:
         single_detection(detector, args.minutes, args.exclude_servers)
 
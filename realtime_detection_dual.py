@@ -21,7 +21,9 @@
 import time
 import sys
 import os
-from datetime import datetime
+import math
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
 
 # 添加專案根目錄到 Python 路徑
 sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
@@ -30,14 +32,20 @@ from nad.ml.isolation_forest_detector import OptimizedIsolationForest
 from nad.ml.isolation_forest_by_dst import IsolationForestByDst
 from nad.ml.anomaly_classifier import AnomalyClassifier
 from nad.ml.post_processor import AnomalyPostProcessor
+from nad.ml.baseline_manager import BaselineManager
+from nad.ml.perspective_source import ESPerspectiveSource, SnapshotPerspectiveSource, SRC_INDEX
 from nad.anomaly_logger import AnomalyLogger
 from nad.device_classifier import DeviceClassifier
+from nad.utils.watermark import WatermarkStore, latest_settled_bucket
+from nad.utils.es_paging import iter_search_pages
+from nad.utils.es_transport import get_transport
 
 
 class DualModelAnomalyDetector:
     """雙模型異常偵測系統"""
 
-    def __init__(self, config=None, enable_baseline=True, enable_dst_model=True):
+    def __init__(self, config=None, enable_baseline=True, enable_dst_model=True,
+                 concurrent=True):
         """
         初始化
 
@@ -45,9 +53,11 @@ class DualModelAnomalyDetector:
             config: 配置對象（可選）
             enable_baseline: 是否啟用基準線驗證
             enable_dst_model: 是否啟用 dst 模型
+            concurrent: src/dst 模型是否並行偵測（ES 查詢與評分互相重疊）
         """
         self.config = config
         self.enable_dst_model = enable_dst_model
+        self.concurrent = concurrent and enable_dst_model
 
         print("初始化雙模型異常偵測系統...")
 
@@ -64,10 +74,23 @@ class DualModelAnomalyDetector:
 
         # 初始化其他組件
         self.classifier = AnomalyClassifier(config)
+        # 基準線：批次建立的檔案 + SQLite 儲存（重啟後沿用）
         self.post_processor = AnomalyPostProcessor(
-            enable_baseline=enable_baseline
+            enable_baseline=enable_baseline,
+            baseline_manager=BaselineManager.from_config(config) if enable_baseline else None
         )
-        self.logger = AnomalyLogger()
+        # 已穩定 bucket 的判斷（與水位相同的 transform 延遲）
+        watermark_config = config.get('watermark', {}) if hasattr(config, 'get') else {}
+        self.bucket_minutes = watermark_config.get('bucket_minutes', 3)
+        self.transform_delay_seconds = watermark_config.get('transform_delay_seconds', 90)
+        # 驗證階段的雙視角數據：每週期載入一次記憶體快照，超出窗口時查詢 ES
+        realtime_config = config.get('realtime', {}) if hasattr(config, 'get') else {}
+        self.use_perspective_snapshot = realtime_config.get('perspective_snapshot', True)
+        self.snapshot_record_dir = realtime_config.get('snapshot_record_dir')
+        self.es_perspective_source = ESPerspectiveSource(self.post_processor.bi_analyzer.es_host)
+        self.perspective_snapshot = None
+        # 背景批量寫入，偵測流程不等待 ES 寫入
+        self.logger = AnomalyLogger(async_bulk=True)
         self.device_classifier = DeviceClassifier()
 
         # 加載模型
@@ -91,12 +114,99 @@ class DualModelAnomalyDetector:
 
         print("✓ 初始化完成\n")
 
-    def run_detection_cycle(self, recent_minutes: int = 10):
+    def _load_perspective_snapshot(self, recent_minutes: int):
+        """
+        載入本週期驗證用的 by_src / by_dst 快照（失敗或停用時直接查詢 ES）
+
+        Args:
+            recent_minutes: 快照時間窗口（與驗證的 time_range 相同）
+        """
+        self.perspective_snapshot = None
+        if not self.use_perspective_snapshot:
+            self.post_processor.set_data_source(self.es_perspective_source)
+            return
+
+        try:
+            self.iso_forest_src._init_es_client()
+            snapshot = SnapshotPerspectiveSource.from_es(
+                self.iso_forest_src.es,
+                window=f"now-{recent_minutes}m",
+                fallback=self.es_perspective_source
+            )
+        except Exception as e:
+            print(f"⚠️  雙視角快照載入失敗，驗證改為直接查詢 ES: {e}")
+            self.post_processor.set_data_source(self.es_perspective_source)
+            return
+
+        size = snapshot.size()
+        print(f"✓ 雙視角快照: by_src {size['SRC']:,} 筆, by_dst {size['DST']:,} 筆")
+        self.post_processor.set_data_source(snapshot)
+        self.perspective_snapshot = snapshot
+
+        if self.snapshot_record_dir:
+            os.makedirs(self.snapshot_record_dir, exist_ok=True)
+            path = os.path.join(
+                self.snapshot_record_dir,
+                f"perspective_{snapshot.as_of.strftime('%Y%m%dT%H%M%SZ')}.json.gz"
+            )
+            try:
+                snapshot.save(path)
+            except OSError as e:
+                print(f"⚠️  快照錄製失敗: {e}")
+
+    def _update_streaming_baselines(self, recent_minutes: int, windows: dict = None, exclude: set = None):
+        """
+        以本週期的 by_src 記錄更新增量基準線
+
+        只納入已穩定的 bucket：增量模式使用水位提供的 SRC 範圍，滑動窗口模式
+        只取到最新一個已穩定的 bucket。transform 仍在填入的 bucket 若先以
+        不完整的數值計入，下個週期完整的同一 bucket 會因不晚於 last_bucket 被略過。
+        優先使用本週期已載入的雙視角快照，否則從 ES 讀取時間窗口內的記錄。
+
+        Args:
+            recent_minutes: 時間窗口（分鐘）
+            windows: 增量模式下各視角的 bucket 範圍（None 表示滑動窗口）
+            exclude: 不納入基準線的 IP（本週期確認的異常）
+        """
+        baseline_manager = self.post_processor.baseline_manager
+        if not baseline_manager or not baseline_manager.incremental:
+            return
+
+        if windows is not None:
+            if windows.get('SRC') is None:
+                return
+            start, end = windows['SRC']
+        else:
+            end = latest_settled_bucket(datetime.now(timezone.utc), self.bucket_minutes,
+                                        self.transform_delay_seconds)
+            start = end - timedelta(minutes=recent_minutes)
+
+        try:
+            if self.perspective_snapshot is not None:
+                start_ts, end_ts = start.timestamp(), end.timestamp()
+                table = self.perspective_snapshot.tables['SRC']
+                records = [r for r, ts in zip(table.records, table.timestamps) if start_ts < ts <= end_ts]
+            else:
+                self.iso_forest_src._init_es_client()
+                query = {"range": {"time_bucket": {"gt": start.isoformat(), "lte": end.isoformat()}}}
+                records = []
+                for page in iter_search_pages(self.iso_forest_src.es, SRC_INDEX, query, tiebreaker='src_ip'):
+                    records.extend(page)
+
+            updated = baseline_manager.update_baselines(records, exclude=exclude)
+            print(f"✓ 增量基準線: 更新 {updated:,} 個 IP\n")
+        except Exception as e:
+            print(f"⚠️  增量基準線更新失敗: {e}\n")
+
+    def run_detection_cycle(self, recent_minutes: int = 10, windows: dict = None):
         """
         運行一次檢測週期
 
         Args:
             recent_minutes: 分析最近 N 分鐘的數據
+            windows: 增量模式下各視角的 bucket 範圍
+                {'SRC': (start_exclusive, end_inclusive) 或 None, 'DST': ...}；
+                提供時取代 recent_minutes 的滑動窗口
 
         Returns:
             檢測結果統計
@@ -106,17 +216,33 @@ class DualModelAnomalyDetector:
         print(f"[{timestamp}] 開始異常偵測（雙模型）")
         print(f"{'='*70}\n")
 
-        # ===== Step 1a: Isolation Forest (by_src) 偵測 =====
-        print(f"Step 1a: Isolation Forest (by_src) 偵測（最近 {recent_minutes} 分鐘）...")
-        anomalies_src = self.iso_forest_src.predict_realtime(recent_minutes=recent_minutes)
-        print(f"✓ 偵測到 {len(anomalies_src)} 個 src 視角異常\n")
+        # 統計本週期直接 HTTP 查詢 ES 的成本
+        get_transport().reset_stats()
 
-        # ===== Step 1b: Isolation Forest (by_dst) 偵測 =====
-        anomalies_dst = []
+        if windows is not None:
+            # 驗證查詢範圍需涵蓋最早的未處理 bucket
+            starts = [w[0] for w in windows.values() if w is not None]
+            if starts:
+                elapsed = (datetime.now(timezone.utc) - min(starts)).total_seconds()
+                recent_minutes = max(recent_minutes, math.ceil(elapsed / 60))
+
+        # ===== Step 1a/1b: Isolation Forest (by_src + by_dst) 偵測 =====
+        mode = "並行" if self.concurrent else "依序"
+        if windows is None:
+            print(f"Step 1: Isolation Forest 偵測（最近 {recent_minutes} 分鐘，src/dst {mode}執行）...")
+        else:
+            print(f"Step 1: Isolation Forest 增量偵測（水位之後的已穩定 bucket，src/dst {mode}執行）...")
+            for perspective, window in windows.items():
+                if window is None:
+                    print(f"  - {perspective}: 沒有新的已穩定 bucket")
+                else:
+                    print(f"  - {perspective}: {window[0]:%H:%M} < time_bucket <= {window[1]:%H:%M} (UTC)")
+        anomalies_src, anomalies_dst, timings = self._run_perspectives(recent_minutes, windows)
+
+        print(f"✓ 偵測到 {len(anomalies_src)} 個 src 視角異常 ({timings['src']:.2f}s)")
         if self.enable_dst_model:
-            print(f"Step 1b: Isolation Forest (by_dst) 偵測（最近 {recent_minutes} 分鐘）...")
-            anomalies_dst = self.iso_forest_dst.predict_realtime(recent_minutes=recent_minutes)
-            print(f"✓ 偵測到 {len(anomalies_dst)} 個 dst 視角異常\n")
+            print(f"✓ 偵測到 {len(anomalies_dst)} 個 dst 視角異常 ({timings['dst']:.2f}s)")
+        print(f"  偵測階段總耗時: {timings['detection']:.2f}s\n")
 
         # ===== Step 1c: 合併異常 =====
         print(f"Step 1c: 合併異常列表...")
@@ -124,6 +250,7 @@ class DualModelAnomalyDetector:
         print(f"✓ 總異常數: {len(all_anomalies)} (src: {len(anomalies_src)}, dst: {len(anomalies_dst)})\n")
 
         if not all_anomalies:
+            self._update_streaming_baselines(recent_minutes, windows)
             print("未發現異常，等待下一個週期....\n")
             return {
                 'timestamp': timestamp,
@@ -131,7 +258,9 @@ class DualModelAnomalyDetector:
                 'anomalies_detected_dst': 0,
                 'anomalies_total': 0,
                 'validated': 0,
-                'false_positives': 0
+                'false_positives': 0,
+                'timings': timings,
+                'logged_all': True
             }
 
         # 顯示前 5 個異常
@@ -151,6 +280,11 @@ class DualModelAnomalyDetector:
         # ===== Step 2: AnomalyClassifier 分類 =====
         print("Step 2: 威脅分類（支援 src + dst 視角）...")
 
+        # 一次預取所有 DST 異常的 SRC 視角資料，分類時直接命中快取
+        self.classifier.prefetch_src_perspective(
+            [a for a in all_anomalies if a.get('perspective') == 'DST']
+        )
+
         classified_anomalies = []
         for anomaly in all_anomalies:
             perspective = anomaly.get('perspective', 'SRC')
@@ -198,6 +332,8 @@ class DualModelAnomalyDetector:
         # ===== Step 3: 後處理驗證 =====
         print("Step 3: 雙向驗證（Pattern + Baseline）...")
 
+        self._load_perspective_snapshot(recent_minutes)
+
         validation_result = self.post_processor.validate_anomalies(
             classified_anomalies,
             time_range=f"now-{recent_minutes}m"
@@ -221,6 +357,12 @@ class DualModelAnomalyDetector:
                 print(f"    - {reason}: {count}")
         print()
 
+        # 確認的異常不納入基準線，避免攻擊流量拉高基準
+        self._update_streaming_baselines(
+            recent_minutes, windows,
+            exclude={a.get('src_ip') for a in validated if a.get('src_ip')}
+        )
+
         # ===== Step 4: 記錄到 Elasticsearch =====
         print("Step 4: 記錄異常到 Elasticsearch...")
 
@@ -249,6 +391,11 @@ class DualModelAnomalyDetector:
                 ip = anomaly.get('src_ip') or anomaly.get('dst_ip')
                 print(f"  ⚠️  記錄異常失敗 ({ip}): {e}")
 
+        # 週期結束前寫出緩衝區；有丟棄、寫入失敗或逾時時不推進水位
+        logged_all = self.logger.flush(timeout=60) and logged_count == len(validated)
+        if not logged_all:
+            print("  ⚠️  部分異常記錄未寫入 ES（佇列已滿、寫入失敗或逾時）")
+
         print(f"✓ 已記錄 {logged_count} 個真實異常\n")
 
         # ===== 生成報告 =====
@@ -257,6 +404,13 @@ class DualModelAnomalyDetector:
             report = self.post_processor.generate_report(validated, false_positives)
             print(report)
 
+        es_cost = get_transport().get_stats()
+        if es_cost:
+            print("ES 查詢成本（本週期）:")
+            for line in get_transport().format_stats().splitlines():
+                print(f"  - {line}")
+            print()
+
         # 返回統計
         return {
             'timestamp': timestamp,
@@ -265,22 +419,74 @@ class DualModelAnomalyDetector:
             'anomalies_total': len(all_anomalies),
             'validated': len(validated),
             'false_positives': len(false_positives),
-            'reduction_rate': stats['reduction_rate']
+            'reduction_rate': stats['reduction_rate'],
+            'timings': timings,
+            'es_cost': es_cost,
+            'logged_all': logged_all
         }
 
-    def run_continuous(self, interval_seconds: int = 300, recent_minutes: int = 10):
+    def _run_perspectives(self, recent_minutes: int, windows: dict = None):
+        """
+        執行 src/dst 兩個視角的偵測
+
+        並行模式下以兩個執行緒同時執行，一方等待 ES 回應時另一方可進行評分。
+
+        Args:
+            recent_minutes: 分析最近 N 分鐘的數據
+            windows: 增量模式下各視角的 bucket 範圍（None 表示滑動窗口）
+
+        Returns:
+            (src 異常列表, dst 異常列表, 各視角耗時（秒）)
+        """
+        def timed(detector, perspective):
+            start = time.perf_counter()
+            if windows is None:
+                anomalies = detector.predict_realtime(recent_minutes=recent_minutes)
+            elif windows.get(perspective) is None:
+                anomalies = []
+            else:
+                anomalies = detector.predict_time_range(*windows[perspective])
+            return anomalies, time.perf_counter() - start
+
+        start = time.perf_counter()
+        timings = {'src': 0.0, 'dst': 0.0}
+        anomalies_dst = []
+
+        if self.concurrent:
+            with ThreadPoolExecutor(max_workers=2, thread_name_prefix='nad-detect') as executor:
+                future_src = executor.submit(timed, self.iso_forest_src, 'SRC')
+                future_dst = executor.submit(timed, self.iso_forest_dst, 'DST')
+                anomalies_src, timings['src'] = future_src.result()
+                anomalies_dst, timings['dst'] = future_dst.result()
+        else:
+            anomalies_src, timings['src'] = timed(self.iso_forest_src, 'SRC')
+            if self.enable_dst_model:
+                anomalies_dst, timings['dst'] = timed(self.iso_forest_dst, 'DST')
+
+        timings['detection'] = time.perf_counter() - start
+        return anomalies_src, anomalies_dst, timings
+
+    def run_continuous(self, interval_seconds: int = 300, recent_minutes: int = 10,
+                       incremental: bool = False):
         """
         持續運行檢測
 
         Args:
             interval_seconds: 檢測間隔（秒）
             recent_minutes: 每次分析最近 N 分鐘
+            incremental: 水位模式，只處理上次水位之後、已穩定的 bucket，
+                每個 time_bucket 只處理一次（水位重啟後保留）
         """
+        watermarks = WatermarkStore.from_config(self.config) if incremental else None
+
         print(f"{'='*70}")
         print(f"啟動持續異常偵測（雙模型）")
         print(f"{'='*70}")
         print(f"檢測間隔: {interval_seconds} 秒 ({interval_seconds/60:.1f} 分鐘)")
-        print(f"分析範圍: 最近 {recent_minutes} 分鐘")
+        if incremental:
+            print(f"分析範圍: 水位之後的已穩定 bucket（水位檔案: {watermarks.path}）")
+        else:
+            print(f"分析範圍: 最近 {recent_minutes} 分鐘")
         print(f"模型: Isolation Forest (src + dst)")
         print(f"按 Ctrl+C 停止")
         print(f"{'='*70}\n")
@@ -293,7 +499,10 @@ class DualModelAnomalyDetector:
                 print(f"\n>>> 檢測週期 #{cycle_count}")
 
                 # 運行一次檢測
-                result = self.run_detection_cycle(recent_minutes)
+                if incremental:
+                    result = self.run_incremental_cycle(watermarks, recent_minutes)
+                else:
+                    result = self.run_detection_cycle(recent_minutes)
 
                 # 顯示摘要
                 print(f"\n週期 #{cycle_count} 摘要:")
@@ -302,6 +511,9 @@ class DualModelAnomalyDetector:
                 print(f"  - 總異常: {result['anomalies_total']}")
                 print(f"  - 真實異常: {result['validated']}")
                 print(f"  - 誤報排除: {result['false_positives']}")
+                timings = result['timings']
+                print(f"  - 偵測耗時: src {timings['src']:.2f}s / dst {timings['dst']:.2f}s "
+                      f"(總 {timings['detection']:.2f}s)")
 
                 # 休眠
                 print(f"\n等待 {interval_seconds} 秒...\n")
@@ -311,6 +523,10 @@ class DualModelAnomalyDetector:
             print("\n\n收到停止信號，正在關閉...")
             print(f"總共運行了 {cycle_count} 個週期")
 
+            # 寫出背景佇列中尚未寫入的異常
+            if not self.logger.close():
+                print("  ⚠️  部分異常記錄未寫入 ES")
+
             # 顯示累計統計
             stats = self.post_processor.get_stats()
             print(f"\n累計統計:")
@@ -319,8 +535,46 @@ class DualModelAnomalyDetector:
             print(f"  - 誤報排除: {stats['false_positives']}")
             print(f"  - 誤報率: {stats['false_positive_rate']*100:.1f}%")
 
+            baseline_manager = self.post_processor.baseline_manager
+            if baseline_manager:
+                baseline_manager.flush()
+                store = baseline_manager.get_stats()['store']
+                print(f"  - 基準線快取命中率: {store['hit_rate']*100:.1f}% "
+                      f"(記憶體 {store['hits']}, 磁碟 {store['disk_hits']}, 未命中 {store['misses']}, "
+                      f"過期 {store['expired']}, 淘汰 {store['evictions']})")
+
             print("\n程序已停止")
 
+    def run_incremental_cycle(self, watermarks: WatermarkStore, recent_minutes: int = 10):
+        """
+        運行一次增量檢測週期
+
+        只處理各視角水位之後、已穩定的 bucket；整個週期（含記錄）完成後才推進水位，
+        週期中斷或有異常未寫入 ES 時，下次會重新處理同一範圍。
+
+        Args:
+            watermarks: 水位存放
+            recent_minutes: 驗證查詢的最小範圍（分鐘）
+
+        Returns:
+            檢測結果統計
+        """
+        windows = {'SRC': watermarks.next_window('SRC')}
+        if self.enable_dst_model:
+            windows['DST'] = watermarks.next_window('DST')
+
+        result = self.run_detection_cycle(recent_minutes, windows=windows)
+
+        if not result['logged_all']:
+            # 有異常未寫入：保留水位，下次重新處理同一範圍（確定性 ID，不會重複）
+            print("⚠️  異常記錄未全部寫入，水位不推進")
+            return result
+
+        for perspective, window in windows.items():
+            if window is not None:
+                watermarks.advance(perspective, window[1])
+        return result
+
     def _merge_src_dst_anomalies(self, anomalies: list) -> list:
         """
         合併 SRC 和 DST 視角的異常記錄
@@ -586,25 +840,43 @@ def main():
         action='store_true',
         help='停用 dst 模型（只使用 src 模型）'
     )
+    parser.add_argument(
+        '--incremental',
+        action='store_true',
+        help='水位模式：只處理上次之後的已穩定 bucket，每個 bucket 只處理一次'
+    )
+    parser.add_argument(
+        '--sequential',
+        action='store_true',
+        help='src/dst 模型依序執行（預設並行）'
+    )
 
     args = parser.parse_args()
 
     # 初始化偵測器
     detector = DualModelAnomalyDetector(
         enable_baseline=not args.disable_baseline,
-        enable_dst_model=not args.disable_dst_model
+        enable_dst_model=not args.disable_dst_model,
+        concurrent=not args.sequential
     )
 
     # 運行
     if args.once:
         # 只運行一次
-        result = detector.run_detection_cycle(recent_minutes=args.recent)
+        if args.incremental:
+            result = detector.run_incremental_cycle(
+                WatermarkStore.from_config(detector.config), recent_minutes=args.recent
+            )
+        else:
+            result = detector.run_detection_cycle(recent_minutes=args.recent)
+        detector.logger.close()
         print("\n檢測完成")
     else:
         # 持續運行
         detector.run_continuous(
             interval_seconds=args.interval,
-            recent_minutes=args.recent
+            recent_minutes=args.recent,
+            incremental=args.incremental
         )
 
 
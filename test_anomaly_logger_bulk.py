@@ -0,0 +1,181 @@
+#!/usr/bin/env python3
+"""
+測試異常記錄的背景批量寫入（確定性 ID、依大小/時間寫出、拒絕項目重試）
+"""
+
+import threading
+import time
+import unittest
+from datetime import datetime, timezone
+from unittest.mock import patch
+
+from nad.anomaly_logger import AnomalyLogger, BulkAnomalyWriter, anomaly_doc_id
+
+
+class FakeES:
+    """記錄每次 _bulk 請求，依 reject 設定回傳被拒絕的項目"""
+
+    def __init__(self, reject_first=0):
+        self.requests = []
+        self.reject_remaining = reject_first
+        self.lock = threading.Lock()
+
+    def bulk(self, body):
+        with self.lock:
+            actions = body[0::2]
+            self.requests.append(actions)
+            items = []
+            for action in actions:
+                if self.reject_remaining > 0:
+                    self.reject_remaining -= 1
+                    items.append({'index': {'_id': action['index']['_id'], 'status': 429,
+                                            'error': {'type': 'es_rejected_execution_exception'}}})
+                else:
+                    items.append({'index': {'_id': action['index']['_id'], 'status': 201}})
+            return {'errors': any(i['index']['status'] >= 300 for i in items), 'items': items}
+
+    def ids(self):
+        return [a['index']['_id'] for actions in self.requests for a in actions]
+
+
+class TestAnomalyDocId(unittest.TestCase):
+    def test_deterministic_per_perspective(self):
+        src = {'src_ip': '10.0.0.1', 'dst_ip': '8.8.8.8', 'time_bucket': '2025-11-20T10:03:00Z'}
+        dst = dict(src, perspective='DST')
+
+        self.assertEqual(anomaly_doc_id(src), anomaly_doc_id(dict(src, anomaly_score=0.9)))
+        self.assertNotEqual(anomaly_doc_id(src), anomaly_doc_id(dst))
+        self.assertNotEqual(anomaly_doc_id(src),
+                            anomaly_doc_id(dict(src, time_bucket='2025-11-20T10:06:00Z')))
+
+
+class AfterMidnight(datetime):
+    """台北時間 2025-11-21 00:05 的 datetime.now"""
+
+    @classmethod
+    def now(cls, tz=None):
+        return datetime(2025, 11, 20, 16, 5, tzinfo=timezone.utc).astimezone(tz)
+
+
+class RecordingES:
+    def __init__(self):
+        self.indexed = []
+
+    def index(self, index, id, body):
+        self.indexed.append((index, id))
+
+
+class TestAnomalyIndex(unittest.TestCase):
+    def make_logger(self):
+        logger = AnomalyLogger.__new__(AnomalyLogger)
+        logger.es = RecordingES()
+        logger.index_prefix = 'anomaly_detection'
+        logger.writer = None
+        logger._sync_failures = 0
+        return logger
+
+    def test_reprocessing_after_midnight_hits_same_index(self):
+        # 台北時間 2025-11-20 23:57 的 bucket
+        anomaly = {'src_ip': '10.0.0.1', 'time_bucket': '2025-11-20T15:57:00.000Z', 'anomaly_score': 0.8}
+        logger = self.make_logger()
+        logger.log_anomaly(anomaly, device_type='unknown')
+        with patch('nad.anomaly_logger.datetime', AfterMidnight):
+            logger.log_anomaly(anomaly, device_type='unknown')
+
+        self.assertEqual(logger.es.indexed, [('anomaly_detection-2025.11.20', anomaly_doc_id(anomaly))] * 2)
+
+    def test_index_follows_bucket_timezone(self):
+        logger = self.make_logger()
+        self.assertEqual(logger.anomaly_index_name({'time_bucket': '2025-11-20T16:00:00Z'}),
+                         'anomaly_detection-2025.11.21')
+        self.assertEqual(logger.anomaly_index_name({'time_bucket': '2025-11-21T00:03:00.000+08:00'}),
+                         'anomaly_detection-2025.11.21')
+        with patch('nad.anomaly_logger.datetime', AfterMidnight):
+            self.assertEqual(logger.anomaly_index_name({}), 'anomaly_detection-2025.11.21')
+
+
+class TestBulkAnomalyWriter(unittest.TestCase):
+    def test_flush_on_size(self):
+        es = FakeES()
+        writer = BulkAnomalyWriter(es, bulk_size=3, flush_interval=60)
+        for i in range(7):
+            writer.submit('idx', f'id{i}', {'n': i})
+        self.assertTrue(writer.flush(timeout=5))
+        writer.close()
+
+        self.assertEqual([len(r) for r in es.requests], [3, 3, 1])
+        self.assertEqual(es.ids(), [f'id{i}' for i in range(7)])
+        self.assertEqual(writer.stats['written'], 7)
+
+    def test_flush_on_time(self):
+        es = FakeES()
+        writer = BulkAnomalyWriter(es, bulk_size=100, flush_interval=0.05)
+        writer.submit('idx', 'a', {})
+        time.sleep(0.3)
+        self.assertEqual(es.ids(), ['a'])
+        writer.close()
+
+    def test_retry_rejected_items(self):
+        es = FakeES(reject_first=2)
+        writer = BulkAnomalyWriter(es, bulk_size=10, flush_interval=60, backoff=0.01)
+        for i in range(4):
+            writer.submit('idx', f'id{i}', {})
+        writer.flush(timeout=5)
+        writer.close()
+
+        # 第一次 4 筆中 2 筆被拒，第二次只重送這 2 筆
+        self.assertEqual([len(r) for r in es.requests], [4, 2])
+        self.assertEqual(writer.stats['written'], 4)
+        self.assertEqual(writer.stats['retried'], 2)
+        self.assertEqual(writer.stats['failed'], 0)
+
+    def test_give_up_after_max_retries(self):
+        es = FakeES(reject_first=100)
+        writer = BulkAnomalyWriter(es, bulk_size=10, flush_interval=60,
+                                   max_retries=2, backoff=0.01)
+        writer.submit('idx', 'a', {})
+        writer.flush(timeout=5)
+        writer.close()
+
+        self.assertEqual(len(es.requests), 3)
+        self.assertEqual(writer.stats['failed'], 1)
+
+    def test_flush_reports_failed_writes(self):
+        es = FakeES(reject_first=1)
+        writer = BulkAnomalyWriter(es, bulk_size=10, flush_interval=60, max_retries=0)
+        writer.submit('idx', 'a', {})
+        self.assertFalse(writer.flush(timeout=5))
+
+        # 之後的 flush 只反映新的遺失
+        writer.submit('idx', 'b', {})
+        self.assertTrue(writer.flush(timeout=5))
+        writer.close()
+
+    def test_flush_reports_dropped_and_honors_timeout(self):
+        es = FakeES()
+        writer = BulkAnomalyWriter(es, bulk_size=10, flush_interval=60, queue_size=1,
+                                   enqueue_timeout=0.01)
+        blocker = threading.Event()
+        original_write = writer._write
+        writer._write = lambda batch: (blocker.wait(5), original_write(batch))
+
+        writer.submit('idx', 'a', {})
+        # 背景執行緒卡在寫入，佇列被填滿：後續文檔被丟棄，flush 也在時限內返回
+        writer._queue.put(threading.Event())
+        while not writer._queue.empty():
+            time.sleep(0.01)
+        self.assertTrue(writer.submit('idx', 'b', {}))
+        self.assertFalse(writer.submit('idx', 'c', {}))
+        started = time.monotonic()
+        self.assertFalse(writer.flush(timeout=0.2))
+        self.assertLess(time.monotonic() - started, 2)
+
+        blocker.set()
+        self.assertFalse(writer.flush(timeout=5))
+        self.assertEqual(writer.stats['dropped'], 1)
+        self.assertEqual(es.ids(), ['a', 'b'])
+        self.assertTrue(writer.close())
+
+
+if __name__ == '__main__':
+    unittest.main()
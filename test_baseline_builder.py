@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+"""
+測試批次建立基準線（composite 聚合）與基準線存檔
+"""
+
+import os
+import random
+import tempfile
+import unittest
+from unittest.mock import patch
+
+from nad.ml.baseline_manager import BaselineManager
+from nad.utils.es_transport import ESTransport
+from test_batched_validation import FakeES
+
+
+def make_history(n_ips=60, seed=21):
+    rng = random.Random(seed)
+    history = []
+    for i in range(n_ips):
+        ip = f'10.2.{i // 200}.{i % 200}'
+        # 部分 IP 樣本不足 10 筆，不建立基準線
+        for j in range(rng.choice([3, 12, 40])):
+            history.append({
+                'src_ip': ip, 'time_bucket': f'2026-10-1{j % 7}T00:{j % 60:02d}:00',
+                'unique_dst_ports': rng.choice([0, rng.randint(1, 30)]), 'unique_dsts': rng.randint(1, 30),
+                'flow_count': rng.randint(1, 300), 'avg_bytes': rng.randint(40, 5000),
+                'total_bytes': rng.randint(100, 10 ** 5), 'unique_src_ports': 0,
+            })
+    return history
+
+
+def strip(baseline):
+    return {k: v for k, v in baseline.items() if k != 'learned_at'}
+
+
+class TestBaselineBuilder(unittest.TestCase):
+    def setUp(self):
+        self.history = make_history()
+        self.fake = FakeES({BaselineManager.HISTORY_INDEX: self.history})
+        patcher = patch.object(ESTransport, 'request', side_effect=self.fake.request)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_matches_per_ip_learning(self):
+        manager = BaselineManager()
+        count = manager.build_all_baselines(page_size=7)
+        # 每頁 7 個 IP，加上最後一次空頁
+        self.assertEqual(self.fake.calls, 60 // 7 + 2)
+
+        ips = sorted({d['src_ip'] for d in self.history})
+        per_ip = BaselineManager()
+        expected = {ip: per_ip.learn_baseline(ip) for ip in ips}
+        expected = {ip: b for ip, b in expected.items() if b}
+
+        self.assertEqual(count, len(expected))
+        self.assertEqual(set(manager.baselines), set(expected))
+        for ip, baseline in expected.items():
+            built = manager.baselines[ip]
+            self.assertEqual(built['sample_count'], baseline['sample_count'])
+            for metric_name in BaselineManager.BASELINE_METRICS:
+                for stat, value in baseline[metric_name].items():
+                    self.assertAlmostEqual(built[metric_name][stat], value, places=6,
+                                           msg=f'{ip} {metric_name} {stat}')
+
+    def test_store_is_lookup_only(self):
+        manager = BaselineManager()
+        manager.build_all_baselines()
+        ip = next(iter(manager.baselines))
+
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'state', 'baselines.json')
+            manager.save_baselines(path)
+
+            calls = self.fake.calls
+            loaded = BaselineManager(store_path=path)
+            self.assertFalse(loaded.lazy_learning)
+            self.assertEqual({k: strip(v) for k, v in loaded.baselines.items()},
+                             {k: strip(v) for k, v in manager.baselines.items()})
+
+            # 已有基準線的 IP 只查表；沒有基準線的 IP 也不查詢 ES
+            prefetched = loaded.prefetch_baselines([ip, '10.9.9.9'])
+            self.assertIsNone(prefetched['10.9.9.9'])
+            self.assertIsNotNone(loaded.check_deviation(ip, {'flow_count': 10})['baseline'])
+            self.assertIsNone(loaded.check_deviation('10.9.9.9', {'flow_count': 10})['baseline'])
+            self.assertEqual(self.fake.calls, calls)
+
+            # 檔案不存在時退回即時學習
+            missing = BaselineManager(store_path=os.path.join(tmp, 'missing.json'))
+            self.assertTrue(missing.lazy_learning)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+"""
+測試基準線儲存（記憶體 LRU + SQLite、TTL、重啟沿用）
+"""
+
+import os
+import tempfile
+import time
+import unittest
+from unittest.mock import patch
+
+from nad.ml.baseline_manager import BaselineManager
+from nad.ml.baseline_store import BaselineStore
+from nad.utils.es_transport import ESTransport
+from test_batched_validation import FakeES
+from test_streaming_baseline import make_records
+
+
+def baseline(ip, mean=10.0):
+    return {'src_ip': ip, 'flow_count': {'mean': mean, 'std': 1.0}}
+
+
+class TestBaselineStore(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.path = os.path.join(self.tmp.name, 'state', 'baselines.db')
+
+    def test_memory_is_bounded(self):
+        store = BaselineStore(self.path, max_memory_entries=10)
+        store.update_many((f'10.0.0.{i}', baseline(f'10.0.0.{i}', i)) for i in range(100))
+        self.assertEqual(store.memory_size(), 10)
+        self.assertEqual(store.metrics['evictions'], 90)
+        self.assertEqual(len(store), 100)
+
+        self.assertEqual(store['10.0.0.3']['flow_count']['mean'], 3)
+        self.assertEqual(store['10.0.0.3']['flow_count']['mean'], 3)
+        self.assertIsNone(store.get('10.9.9.9'))
+        metrics = store.get_metrics()
+        self.assertEqual((metrics['disk_hits'], metrics['hits'], metrics['misses']), (1, 1, 1))
+        self.assertEqual(store.memory_size(), 10)
+
+    def test_survives_restart(self):
+        store = BaselineStore(self.path)
+        store['10.0.0.1'] = baseline('10.0.0.1')
+        del store['10.0.0.1']
+        store['10.0.0.2'] = baseline('10.0.0.2')
+        store.close()
+
+        reopened = BaselineStore(self.path)
+        self.assertEqual(dict(reopened.items()), {'10.0.0.2': baseline('10.0.0.2')})
+        self.assertNotIn('10.0.0.1', reopened)
+
+    def test_ttl_expiry(self):
+        store = BaselineStore(self.path, ttl_seconds=60)
+        store['10.0.0.1'] = baseline('10.0.0.1')
+        self.assertIn('10.0.0.1', store)
+        with patch('nad.ml.baseline_store.time.time', return_value=time.time() + 120):
+            self.assertIsNone(store.get('10.0.0.1'))
+            self.assertNotIn('10.0.0.1', BaselineStore(self.path, ttl_seconds=60))
+        self.assertEqual(store.metrics['expired'], 1)
+
+    def test_items_are_paged(self):
+        store = BaselineStore(self.path, max_memory_entries=5)
+        store.update_many((f'10.0.0.{i:03d}', baseline(f'10.0.0.{i:03d}', i)) for i in range(25))
+        items = list(store.items(page_size=4))
+        self.assertEqual([ip for ip, _ in items], [f'10.0.0.{i:03d}' for i in range(25)])
+        self.assertEqual(items[7][1], baseline('10.0.0.007', 7))
+
+
+class TestBaselineManagerStore(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.db_path = os.path.join(self.tmp.name, 'baselines.db')
+        self.fake = FakeES({BaselineManager.HISTORY_INDEX: make_records('10.4.0.1', 30, seed=8)})
+        patcher = patch.object(ESTransport, 'request', side_effect=self.fake.request)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_restart_is_warm(self):
+        manager = BaselineManager(db_path=self.db_path, ttl_hours=24)
+        manager.prefetch_baselines(['10.4.0.1', '10.4.0.2'])
+        learned = manager.get_baseline('10.4.0.1')
+        self.assertIsNotNone(learned)
+
+        calls = self.fake.calls
+        restarted = BaselineManager(db_path=self.db_path, ttl_hours=24)
+        self.assertEqual(restarted.check_deviation('10.4.0.1', {'flow_count': 5})['baseline'], learned)
+        self.assertEqual(self.fake.calls, calls)
+
+        # 過期後重新學習
+        with patch('nad.ml.baseline_store.time.time', return_value=time.time() + 25 * 3600):
+            restarted.check_deviation('10.4.0.1', {'flow_count': 5})
+        self.assertEqual(self.fake.calls, calls + 1)
+        self.assertEqual(restarted.get_stats()['store']['expired'], 1)
+
+    def test_store_file_imported_once(self):
+        builder = BaselineManager()
+        builder.build_all_baselines()
+        store_path = os.path.join(self.tmp.name, 'baselines.json')
+        builder.save_baselines(store_path)
+
+        first = BaselineManager(store_path=store_path, db_path=self.db_path, ttl_hours=24)
+        self.assertEqual(first.baselines.metrics['writes'], 1)
+        first.baselines.close()
+
+        second = BaselineManager(store_path=store_path, db_path=self.db_path, ttl_hours=24)
+        self.assertEqual(second.baselines.metrics['writes'], 0)
+        self.assertIsNotNone(second.get_baseline('10.4.0.1'))
+
+        # 重新建立後，只查表模式在下一次查詢時重新載入
+        builder.save_baselines(store_path)
+        os.utime(store_path, (time.time() + 10, time.time() + 10))
+        second.prefetch_baselines(['10.4.0.1'])
+        self.assertEqual(second.baselines.metrics['writes'], 1)
+
+    def test_streaming_state_memory_is_bounded(self):
+        streaming_path = os.path.join(self.tmp.name, 'baseline_streaming.db')
+        manager = BaselineManager(incremental=True, db_path=self.db_path, max_memory_entries=5,
+                                  streaming_db_path=streaming_path)
+        manager.update_baselines([r for i in range(20) for r in make_records(f'10.5.0.{i}', 12, seed=i)])
+        self.assertEqual(len(manager.streaming), 20)
+        self.assertEqual(manager.streaming.memory_size(), 5)
+
+        # 重新匯入批次基準線後，所有 IP 仍以串流基準線為準
+        builder = BaselineManager()
+        builder.build_all_baselines()
+        store_path = os.path.join(self.tmp.name, 'baselines.json')
+        builder.save_baselines(store_path)
+        manager.load_baselines(store_path)
+        self.assertEqual(manager.streaming.memory_size(), 5)
+        for i in range(20):
+            self.assertTrue(manager.get_baseline(f'10.5.0.{i}')['streaming'])
+
+
+if __name__ == '__main__':
+    unittest.main()
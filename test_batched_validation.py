@@ -0,0 +1,292 @@
+#!/usr/bin/env python3
+"""
+測試批次化的異常驗證（AnomalyPostProcessor.validate_anomalies）
+
+- 批次查詢的 ES 請求數不隨異常數量增加
+- 批次驗證結果與逐一查詢完全相同
+"""
+
+import copy
+import json
+import random
+import unittest
+from datetime import datetime, timezone
+from unittest.mock import patch
+
+import numpy as np
+from urllib.parse import urlparse
+
+from nad.ml.baseline_manager import BaselineManager
+from nad.ml.post_processor import AnomalyPostProcessor
+from nad.utils.es_transport import ESTransport
+
+
+def parse_ndjson(data):
+    return [json.loads(line) for line in data.decode().splitlines() if line]
+
+
+class FakeResponse:
+    status_code = 200
+
+    def __init__(self, payload):
+        self._payload = payload
+
+    def json(self):
+        return self._payload
+
+    def raise_for_status(self):
+        pass
+
+
+class FakeES:
+    """以記憶體中的文件回應驗證流程用到的查詢（term/terms/range 過濾、排序、聚合、composite 分頁）"""
+
+    def __init__(self, indices):
+        self.indices = indices
+        self.calls = 0
+
+    # ESTransport.request 的替身
+    def request(self, method, url, json=None, data=None, headers=None, timeout=None, caller='default'):
+        self.calls += 1
+        parts = urlparse(url).path.strip('/').split('/')
+        if parts[-1] == '_msearch':
+            lines = parse_ndjson(data)
+            responses = [self.search(header['index'], body) for header, body in zip(lines[::2], lines[1::2])]
+            return FakeResponse({'responses': responses})
+        return FakeResponse(self.search(parts[0], json))
+
+    def search(self, index, body):
+        docs = [d for d in self.indices.get(index, []) if self._matches(d, body.get('query', {}))]
+        for sort in reversed(body.get('sort', [])):
+            (field, order), = sort.items()
+            docs.sort(key=lambda d: d.get(field, 0), reverse=(order == 'desc'))
+
+        return {
+            'hits': {
+                'total': {'value': len(docs)},
+                'hits': [{'_source': d} for d in docs[:body.get('size', 10)]]
+            },
+            'aggregations': self._aggs(docs, body.get('aggs', {}))
+        }
+
+    @staticmethod
+    def _matches(doc, query):
+        bool_query = query.get('bool', {})
+        for clause in bool_query.get('must', []) + bool_query.get('filter', []):
+            (kind, spec), = clause.items()
+            (field, value), = spec.items()
+            if kind == 'term' and doc.get(field) != value:
+                return False
+            if kind == 'terms' and doc.get(field) not in value:
+                return False
+            if kind == 'range' and isinstance(value.get('gte'), (int, float)) \
+                    and doc.get(field, 0) < value['gte']:
+                return False
+            if kind == 'range' and isinstance(value.get('gt'), (int, float)) \
+                    and doc.get(field, 0) <= value['gt']:
+                return False
+        return True
+
+    def _aggs(self, docs, aggs):
+        result = {}
+        for name, spec in aggs.items():
+            sub_aggs = spec.get('aggs', {})
+            kind = next(k for k in spec if k != 'aggs')
+            params = spec[kind]
+            values = [d[params['field']] for d in docs if params.get('field') in d]
+            if kind == 'stats':
+                result[name] = {'count': len(values), 'sum': float(sum(values))}
+            elif kind == 'sum':
+                result[name] = {'value': float(sum(values))}
+            elif kind == 'value_count':
+                result[name] = {'value': len(values)}
+            elif kind == 'extended_stats':
+                array = np.array(values, dtype=float)
+                result[name] = {'count': len(values)} if not values else {
+                    'count': len(values), 'sum': float(array.sum()), 'avg': float(array.mean()),
+                    'sum_of_squares': float((array ** 2).sum()),
+                    'min': float(array.min()), 'max': float(array.max()), 'std_deviation': float(array.std()),
+                }
+            elif kind == 'percentiles':
+                result[name] = {'values': {
+                    f'{float(p)}': float(np.percentile(values, p)) if values else None for p in params['percents']
+                }}
+            elif kind == 'filter':
+                filtered = [d for d in docs if self._matches(d, {'bool': {'filter': [params]}})]
+                result[name] = {'doc_count': len(filtered), **self._aggs(filtered, sub_aggs)}
+            elif kind == 'composite':
+                fields = [(source_name, source)
+                          for source in params['sources'] for source_name, source in source.items()]
+                groups = {}
+                for d in docs:
+                    key = tuple(self._source_key(d, source) for _, source in fields)
+                    if None not in key:
+                        groups.setdefault(key, []).append(d)
+                keys = sorted(groups)
+                if 'after' in params:
+                    after = tuple(params['after'][source_name] for source_name, _ in fields)
+                    keys = [k for k in keys if k > after]
+                keys = keys[:params['size']]
+                buckets = [{'key': dict(zip([n for n, _ in fields], key)), 'doc_count': len(groups[key]),
+                            **self._aggs(groups[key], sub_aggs)} for key in keys]
+                result[name] = {'buckets': buckets}
+                if buckets:
+                    result[name]['after_key'] = buckets[-1]['key']
+            elif kind == 'top_hits':
+                ordered = self.search_sorted(docs, params.get('sort', []))
+                result[name] = {'hits': {'hits': [{'_source': d} for d in ordered[:params['size']]]}}
+            elif kind == 'terms':
+                counts = {}
+                for value in values:
+                    for key in (value if isinstance(value, (list, dict)) else [value]):
+                        if 'include' in params and key not in params['include']:
+                            continue
+                        counts[key] = counts.get(key, 0) + 1
+                keys = sorted(counts, key=lambda k: (-counts[k], str(k)))[:params['size']]
+                buckets = []
+                for key in keys:
+                    bucket_docs = [d for d in docs if key == d.get(params['field'])
+                                   or (isinstance(d.get(params['field']), (list, dict)) and key in d[params['field']])]
+                    buckets.append({'key': key, 'doc_count': counts[key], **self._aggs(bucket_docs, sub_aggs)})
+                result[name] = {'buckets': buckets}
+        return result
+
+    @staticmethod
+    def _source_key(doc, source):
+        """composite 的 terms / date_histogram（fixed_interval 為小時）來源"""
+        if 'terms' in source:
+            return doc.get(source['terms']['field'])
+        spec = source['date_histogram']
+        value = doc.get(spec['field'])
+        if value is None:
+            return None
+        dt = datetime.fromisoformat(value.replace('Z', '+00:00'))
+        if dt.tzinfo is None:
+            dt = dt.replace(tzinfo=timezone.utc)
+        interval_ms = int(spec['fixed_interval'].rstrip('h')) * 3_600_000
+        epoch_ms = int(dt.timestamp() * 1000)
+        return epoch_ms - epoch_ms % interval_ms
+
+    @staticmethod
+    def search_sorted(docs, sort):
+        docs = list(docs)
+        for item in reversed(sort):
+            (field, order), = item.items()
+            docs.sort(key=lambda d: d.get(field, 0), reverse=(order == 'desc'))
+        return docs
+
+
+def make_indices(ips, seed=7):
+    rng = random.Random(seed)
+    by_src, by_dst, history = [], [], []
+    for ip in ips:
+        for bucket in range(3):
+            ports = {str(p): rng.randint(1, 50) for p in rng.sample([22, 53, 80, 443, 3306, 8080, 40000, 50000], 3)}
+            by_src.append({
+                'src_ip': ip, 'time_bucket': f'2026-01-01T00:0{bucket}:00',
+                'flow_count': rng.randint(1, 500), 'total_bytes': rng.randint(100, 10 ** 6),
+                'unique_dsts': rng.choice([1, 3, 40, 80]), 'unique_dst_ports': rng.choice([2, 20, 150]),
+                'avg_bytes': rng.randint(40, 8000), 'top_src_ports': ports, 'top_dst_ports': ports,
+            })
+            if rng.random() < 0.7:
+                by_dst.append({
+                    'dst_ip': ip, 'time_bucket': f'2026-01-01T00:0{bucket}:00',
+                    'flow_count': rng.randint(1, 500), 'total_bytes': rng.randint(100, 10 ** 6),
+                    'unique_srcs': rng.choice([1, 5, 60]), 'unique_src_ports': rng.choice([3, 50, 150]),
+                    'unique_dst_ports': rng.choice([1, 4, 30]), 'top_dst_ports': ports,
+                })
+        for i in range(rng.choice([0, 12])):
+            history.append({
+                'src_ip': ip, 'time_bucket': f'2025-12-3{i % 2}T00:{i:02d}:00',
+                'unique_dst_ports': rng.randint(1, 30), 'unique_dsts': rng.randint(1, 30),
+                'flow_count': rng.randint(1, 300), 'avg_bytes': rng.randint(40, 5000),
+                'total_bytes': rng.randint(100, 10 ** 5),
+            })
+    # 基準線的歷史數據與 by_src 同一索引（較早的 time_bucket）
+    return {
+        'netflow_stats_3m_by_src': by_src + history,
+        'netflow_stats_3m_by_dst': by_dst,
+    }
+
+
+def make_anomalies(count, seed=11):
+    rng = random.Random(seed)
+    classes = ['PORT_SCAN', 'NETWORK_SCAN', 'SCAN_TARGET', 'DDOS_TARGET', 'POPULAR_SERVER', 'UNKNOWN']
+    anomalies = []
+    for i in range(count):
+        ip = f'192.168.{i // 200}.{i % 200 + 1}'
+        perspective = rng.choice(['SRC', 'DST'])
+        anomalies.append({
+            'perspective': perspective,
+            'src_ip' if perspective == 'SRC' else 'dst_ip': ip,
+            'classification': {'class': classes[i % len(classes)]},
+            'features': {'unique_dsts': rng.randint(1, 100), 'unique_dst_ports': rng.randint(1, 60),
+                         'avg_bytes': rng.randint(40, 8000), 'flow_count': rng.randint(1, 500)},
+            'unique_srcs': rng.randint(1, 100), 'flow_count': rng.randint(1, 500),
+            'unique_dst_ports': rng.randint(1, 60),
+        })
+    return anomalies
+
+
+def round_floats(value):
+    """基準線統計在 ES 端聚合，加總順序不同只影響最後幾位"""
+    if isinstance(value, float):
+        return float(f'{value:.9g}')
+    if isinstance(value, dict):
+        return {k: round_floats(v) for k, v in value.items()}
+    if isinstance(value, list):
+        return [round_floats(v) for v in value]
+    return value
+
+
+def normalize(records):
+    """序列化驗證結果（忽略基準線的學習時間）"""
+    records = copy.deepcopy(records)
+    for record in records:
+        record.get('baseline_deviation', {}).get('baseline', {}).pop('learned_at', None)
+    return json.dumps(round_floats(records), sort_keys=True, default=str)
+
+
+class TestBatchedValidation(unittest.TestCase):
+    def run_validation(self, anomalies, indices, batched=True, enable_baseline=False):
+        fake = FakeES(indices)
+        processor = AnomalyPostProcessor(enable_baseline=enable_baseline)
+
+        with patch.object(ESTransport, 'request', side_effect=fake.request):
+            if not batched:
+                processor._prefetch_validation_data = lambda anomalies, time_range: {}
+            result = processor.validate_anomalies(copy.deepcopy(anomalies))
+        return result, fake.calls
+
+    def test_query_count_independent_of_anomaly_count(self):
+        small = make_anomalies(12)
+        large = make_anomalies(120)
+        indices = make_indices({a.get('src_ip') or a.get('dst_ip') for a in large})
+
+        _, small_calls = self.run_validation(small, indices)
+        _, large_calls = self.run_validation(large, indices)
+        _, unbatched_calls = self.run_validation(large, indices, batched=False)
+
+        self.assertEqual(small_calls, large_calls)
+        self.assertLessEqual(large_calls, 5)
+        self.assertGreater(unbatched_calls, len(large))
+
+    def test_results_match_per_ip_queries(self):
+        anomalies = make_anomalies(150)
+        ips = [a.get('src_ip') or a.get('dst_ip') for a in anomalies]
+        # 部分 IP 查無資料
+        indices = make_indices(ips[:120])
+
+        for enable_baseline in (False, True):
+            batched, _ = self.run_validation(anomalies, indices, enable_baseline=enable_baseline)
+            per_ip, _ = self.run_validation(anomalies, indices, batched=False, enable_baseline=enable_baseline)
+
+            for key in ('validated', 'false_positives'):
+                self.assertEqual(normalize(batched[key]), normalize(per_ip[key]))
+            self.assertEqual(batched['stats'], per_ip['stats'])
+            self.assertTrue(batched['validated'])
+            self.assertTrue(batched['false_positives'])
+
+
+if __name__ == '__main__':
+    unittest.main()
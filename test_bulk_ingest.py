@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+"""
+測試分塊、並行的 _bulk 寫入（BulkIngester）
+"""
+
+import threading
+import unittest
+from unittest.mock import patch
+
+import nad.utils.bulk_ingest as bulk_ingest_module
+from nad.utils.bulk_ingest import BulkIngester
+from nad.utils.es_transport import ESTransport
+from test_batched_validation import FakeResponse, parse_ndjson
+
+
+class StatusResponse(FakeResponse):
+    def __init__(self, payload, status_code=200):
+        super().__init__(payload)
+        self.status_code = status_code
+        self.text = str(payload)
+
+
+class FakeBulkES:
+    """
+    記錄每個 _bulk 請求；reject 為 {文檔 ID: 被 429 拒絕的次數}，
+    broken 為永遠失敗（400）的文檔 ID，max_bytes 為請求大小上限（超過回 413）
+    """
+
+    def __init__(self, reject=None, broken=(), max_bytes=None):
+        self.reject = dict(reject or {})
+        self.broken = set(broken)
+        self.max_bytes = max_bytes
+        self.requests = []
+        self.indexed = {}
+        self._lock = threading.Lock()
+
+    def request(self, method, url, json=None, data=None, headers=None, timeout=None, caller='default'):
+        with self._lock:
+            self.requests.append(len(data))
+            if self.max_bytes and len(data) > self.max_bytes:
+                return StatusResponse({'error': 'request too large'}, 413)
+            lines = parse_ndjson(data)
+            items = []
+            for action, doc in zip(lines[::2], lines[1::2]):
+                doc_id = action['index']['_id']
+                if doc_id in self.broken:
+                    items.append({'index': {'status': 400, 'error': {'type': 'mapper_parsing_exception'}}})
+                elif self.reject.get(doc_id):
+                    self.reject[doc_id] -= 1
+                    items.append({'index': {'status': 429, 'error': {'type': 'es_rejected_execution_exception'}}})
+                else:
+                    self.indexed[doc_id] = doc
+                    items.append({'index': {'status': 201}})
+            return StatusResponse({'errors': any(i['index']['status'] >= 300 for i in items), 'items': items})
+
+
+def actions(n):
+    return [('netflow_stats_3m_by_src', f'doc-{i}', {'src_ip': f'10.0.0.{i % 250}', 'flow_count': i})
+            for i in range(n)]
+
+
+class TestBulkIngester(unittest.TestCase):
+    def setUp(self):
+        patcher = patch.object(bulk_ingest_module.time, 'sleep')
+        self.sleep = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def ingest(self, fake, docs, **kwargs):
+        with patch.object(ESTransport, 'request', side_effect=fake.request):
+            ingester = BulkIngester('http://es:9200', **kwargs)
+            return ingester, ingester.index(docs)
+
+    def test_chunks_bounded_by_bytes(self):
+        fake = FakeBulkES()
+        _, result = self.ingest(fake, actions(1000), max_chunk_bytes=8 * 1024, workers=4)
+        self.assertEqual(result['indexed'], 1000)
+        self.assertEqual(len(fake.indexed), 1000)
+        self.assertGreater(len(fake.requests), 5)
+        self.assertTrue(all(size <= 8 * 1024 for size in fake.requests))
+        self.assertEqual(result['chunks'], len(fake.requests))
+        self.assertGreater(result['docs_per_sec'], 0)
+
+    def test_only_failed_items_retried(self):
+        fake = FakeBulkES(reject={'doc-3': 2, 'doc-7': 1})
+        ingester, result = self.ingest(fake, actions(10))
+        self.assertEqual((result['indexed'], result['failed'], result['retried']), (10, 0, 3))
+        # 第一次 10 筆，之後只重送被拒絕的
+        self.assertEqual(len(fake.requests), 3)
+        self.assertEqual(ingester.get_stats()['indexed'], 10)
+
+    def test_failures_reported(self):
+        fake = FakeBulkES(reject={'doc-1': 10}, broken={'doc-2'})
+        _, result = self.ingest(fake, actions(5), max_retries=2)
+        self.assertEqual((result['indexed'], result['failed'], result['rejected']), (3, 2, 1))
+        self.assertEqual({doc_id for doc_id, _ in result['errors']}, {'doc-1', 'doc-2'})
+
+    def test_too_large_request_split(self):
+        fake = FakeBulkES(max_bytes=1000)
+        _, result = self.ingest(fake, actions(40), max_chunk_bytes=100000)
+        self.assertEqual((result['indexed'], result['failed']), (40, 0))
+        self.assertEqual(len(fake.indexed), 40)
+        self.sleep.assert_not_called()
+
+
+if __name__ == '__main__':
+    unittest.main()
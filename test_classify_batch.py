@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+"""
+測試向量化批次分類與逐筆 classify / classify_dst 的結果一致
+"""
+
+import unittest
+from datetime import datetime
+
+import numpy as np
+
+from nad.ml.anomaly_classifier import AnomalyClassifier
+
+
+# 每個特徵的候選值（涵蓋各規則閾值兩側）
+SRC_VALUES = {
+    'flow_count': [0, 50, 150, 500, 1500, 6000, 15000, 30000, 60000],
+    'unique_dsts': [0, 1, 3, 5, 15, 60, 80, 150],
+    'unique_dst_ports': [0, 1, 2, 3, 60, 150, 600, 1500],
+    'total_bytes': [0, 1e6, 2e9, 6e9, 2e10],
+    'avg_bytes': [100, 400, 800, 1500, 2500, 4000, 20000, 200000],
+    'dst_diversity': [0.01, 0.08, 0.2, 0.45, 0.6],
+    'dst_port_diversity': [0.1, 0.55, 0.65, 0.8],
+    'flow_rate': [0, 40, 60, 150],
+    'byte_rate': [0, 4e6, 2e7, 4e7],
+    'common_ports_ratio': [0.1, 0.8],
+    'top_dst_port_concentration': [0.1, 0.4, 0.6, 0.95],
+    'top_src_port_concentration': [0.05, 0.15, 0.5],
+    'dst_well_known_ratio': [0.1, 0.65, 0.75, 0.9],
+    'dst_registered_ratio': [0.1, 0.6],
+    'dst_ephemeral_ratio': [0.1, 0.4, 0.6, 0.9],
+    'has_sequential_dst_ports': [0, 1],
+    'is_likely_server_response': [0, 1],
+    'is_likely_web_server': [0, 1],
+    'is_likely_dns_server': [0, 1],
+    'is_likely_db_server': [0, 1],
+    'is_likely_mail_server': [0, 1],
+}
+
+DST_VALUES = {
+    'unique_srcs': [0, 1, 3, 8, 15, 30, 60, 150],
+    'unique_src_ports': [0, 50, 150],
+    'unique_dst_ports': [0, 5, 15, 60, 150],
+    'flow_count': [0, 50, 500, 1500],
+    'total_bytes': [0, 6e7, 2e8],
+    'avg_bytes': [100, 400, 800, 1500, 5000, 20000, 80000, 200000],
+    'flows_per_src': [1, 3, 8, 20],
+}
+
+
+def random_rows(values, n, seed):
+    rng = np.random.default_rng(seed)
+    return {name: rng.choice(options, size=n) for name, options in values.items()}
+
+
+class TestClassifyBatch(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.classifier = AnomalyClassifier()
+
+    def assert_src_matches_scalar(self, classifier, n=3000):
+        columns = random_rows(SRC_VALUES, n, seed=1)
+        rng = np.random.default_rng(2)
+        ip_choices = [[], ['192.168.1.5'], ['8.8.8.8'], ['192.168.1.5', '8.8.8.8']]
+        dst_ips = [ip_choices[i] for i in rng.integers(0, len(ip_choices), size=n)]
+        timestamps = [datetime(2025, 11, 20, int(h)) for h in rng.integers(0, 24, size=n)]
+
+        classes, confidences = classifier.classify_batch(
+            columns, dst_ips=dst_ips, timestamps=timestamps)
+
+        for i in range(n):
+            features = {name: float(values[i]) for name, values in columns.items()}
+            expected = classifier.classify(
+                features, {'dst_ips': dst_ips[i], 'timestamp': timestamps[i]})
+            self.assertEqual(classes[i], expected['class'], features)
+            self.assertEqual(confidences[i], expected['confidence'], features)
+
+        # 規則應被實際覆蓋到，避免測試只比對 UNKNOWN
+        self.assertGreater(len(set(classes)), 5)
+        return classes
+
+    def test_src_matches_scalar(self):
+        self.assert_src_matches_scalar(self.classifier)
+
+    def test_configured_thresholds_match_scalar(self):
+        # 配置覆寫部分預設閾值、停用規則時，兩條路徑讀取相同的規則閾值
+        classifier = AnomalyClassifier()
+        classifier.src_thresholds = {
+            'PORT_SCAN': {'enabled': False},
+            'DDOS': {'thresholds': {'flow_count': 1000}},
+        }
+        classes = self.assert_src_matches_scalar(classifier, n=1000)
+        self.assertNotIn('PORT_SCAN', set(classes))
+
+        classifier.dst_thresholds = {'DDOS_TARGET': {'enabled': False},
+                                     'POPULAR_SERVER': {'thresholds': {'unique_srcs': 5}}}
+        columns = random_rows(DST_VALUES, 500, seed=6)
+        dst_ips = ['192.168.1.5'] * 250 + ['8.8.8.8'] * 250
+        classes, confidences = classifier.classify_dst_batch(columns, dst_ips=dst_ips)
+        self.assertNotIn('DDOS_TARGET', set(classes))
+        for i in range(500):
+            features = {name: float(values[i]) for name, values in columns.items()}
+            expected = classifier.classify_dst(features, {'dst_ip': dst_ips[i]})
+            self.assertEqual(classes[i], expected['class'], features)
+            self.assertEqual(confidences[i], expected['confidence'], features)
+
+    def test_matrix_input(self):
+        columns = random_rows(SRC_VALUES, 200, seed=3)
+        names = list(columns)
+        matrix = np.column_stack([columns[name] for name in names])
+
+        from_dict = self.classifier.classify_batch(columns)
+        from_matrix = self.classifier.classify_batch(matrix, feature_names=names)
+
+        np.testing.assert_array_equal(from_dict[0], from_matrix[0])
+        np.testing.assert_array_equal(from_dict[1], from_matrix[1])
+
+        with self.assertRaises(ValueError):
+            self.classifier.classify_batch(matrix)
+
+    def test_dst_matches_scalar(self):
+        n = 3000
+        columns = random_rows(DST_VALUES, n, seed=4)
+        rng = np.random.default_rng(5)
+        dst_ips = list(rng.choice(['192.168.1.5', '8.8.8.8'], size=n))
+
+        classes, confidences = self.classifier.classify_dst_batch(columns, dst_ips=dst_ips)
+
+        for i in range(n):
+            features = {name: float(values[i]) for name, values in columns.items()}
+            # 不提供 time_bucket，略過跨視角查詢
+            expected = self.classifier.classify_dst(features, {'dst_ip': dst_ips[i]})
+            self.assertEqual(classes[i], expected['class'], features)
+            self.assertEqual(confidences[i], expected['confidence'], features)
+
+        self.assertGreater(len(set(classes)), 5)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,173 @@
+#!/usr/bin/env python3
+"""
+測試列式（columnar）特徵提取與逐筆路徑結果一致
+"""
+
+import unittest
+import numpy as np
+from nad.ml.feature_engineer import FeatureEngineer
+from nad.ml.feature_engineer_dst import FeatureEngineerDst
+
+
+class MockConfig:
+    def __init__(self, time_series=False):
+        self.features_config = {
+            'basic': ['flow_count', 'total_bytes', 'total_packets', 'unique_dsts',
+                      'unique_src_ports', 'unique_dst_ports', 'avg_bytes', 'max_bytes'],
+            'derived': ['dst_diversity', 'src_port_diversity', 'dst_port_diversity',
+                        'traffic_concentration', 'bytes_per_packet'],
+            'binary': ['is_high_connection', 'is_scanning_pattern', 'is_small_packet',
+                       'is_large_flow', 'is_likely_server_response'],
+            'log_transform': ['log_flow_count', 'log_total_bytes'],
+            'device_type': ['device_type']
+        }
+        if time_series:
+            self.features_config['time_series'] = [
+                'hour_of_day', 'hour_sin', 'hour_cos', 'day_of_week',
+                'is_weekend', 'is_business_hours', 'is_late_night'
+            ]
+        self.thresholds = {
+            'high_connection': 352,
+            'scanning_dsts': 3,
+            'scanning_avg_bytes': 2200,
+            'small_packet': 456,
+            'large_flow': 7914975
+        }
+
+
+def make_records(n, seed=0):
+    """產生隨機聚合記錄（含邊界值：0 連線、缺欄位、無效時間）"""
+    rng = np.random.default_rng(seed)
+    ips = ['192.168.10.160', '192.168.20.50', '192.168.0.4', '8.8.8.8', '10.10.10.5', '']
+    buckets = ['2025-11-17T10:03:00.000Z', '2025-11-22T23:00:00Z', '2025-11-18T09:30:00+00:00', 'bad']
+    records = []
+    for i in range(n):
+        flow_count = int(rng.integers(0, 5000))
+        record = {
+            'src_ip': ips[i % len(ips)],
+            'time_bucket': buckets[i % len(buckets)],
+            'flow_count': flow_count,
+            'total_bytes': int(rng.integers(0, 10**10)),
+            'total_packets': int(rng.integers(0, 10**6)),
+            'unique_dsts': int(rng.integers(0, 200)),
+            'unique_src_ports': int(rng.integers(0, 2000)),
+            'unique_dst_ports': int(rng.integers(0, 2000)),
+            'avg_bytes': float(rng.uniform(0, 60000)),
+            'max_bytes': int(rng.integers(0, 10**8)),
+        }
+        if i % 7 == 0:
+            del record['max_bytes']
+        records.append(record)
+    return records
+
+
+class TestColumnarFeatures(unittest.TestCase):
+    def assert_paths_match(self, engineer, records):
+        X_columnar = engineer.extract_features_batch(records)
+        X_per_record = engineer.extract_features_batch(records, columnar=False)
+
+        self.assertEqual(X_columnar.shape, (len(records), len(engineer.detection_feature_names)))
+        self.assertEqual(X_columnar.dtype, np.float64)
+        np.testing.assert_array_equal(X_columnar, X_per_record.astype(np.float64))
+
+    def test_matches_per_record_path(self):
+        engineer = FeatureEngineer(MockConfig())
+        self.assert_paths_match(engineer, make_records(500))
+
+    def test_matches_with_time_series_features(self):
+        engineer = FeatureEngineer(MockConfig(time_series=True))
+        self.assert_paths_match(engineer, make_records(200, seed=1))
+
+    def test_default_feature_set(self):
+        engineer = FeatureEngineer()
+        self.assert_paths_match(engineer, make_records(100, seed=2))
+
+    def test_empty_batch(self):
+        engineer = FeatureEngineer(MockConfig())
+        self.assertEqual(len(engineer.extract_features_batch([])), 0)
+
+
+class MockDstConfig:
+    def __init__(self):
+        self.features_by_dst_config = {
+            'basic': ['unique_srcs', 'unique_dst_ports', 'flow_count', 'total_bytes', 'avg_bytes'],
+            'derived': ['flows_per_src', 'bytes_per_src', 'packets_per_flow', 'port_attack_breadth'],
+            'binary': ['is_ddos_target', 'is_scan_target', 'is_likely_server',
+                       'is_abnormal_pattern', 'is_multi_port_attack', 'unknown_flag'],
+            'log_transform': ['log_unique_srcs', 'log_total_bytes'],
+        }
+        self.thresholds_by_dst = {}
+
+
+def make_dst_records(n, seed=0):
+    """產生隨機 by_dst 聚合記錄（含 0 來源、缺欄位）"""
+    rng = np.random.default_rng(seed)
+    records = []
+    for i in range(n):
+        record = {
+            'dst_ip': '192.168.20.50',
+            'time_bucket': '2025-11-17T10:03:00.000Z',
+            'unique_srcs': int(rng.integers(0, 300)),
+            'unique_src_ports': int(rng.integers(0, 2000)),
+            'unique_dst_ports': int(rng.integers(0, 200)),
+            'flow_count': int(rng.integers(0, 5000)),
+            'total_bytes': int(rng.integers(0, 10**10)),
+            'total_packets': int(rng.integers(0, 10**6)),
+            'avg_bytes': float(rng.uniform(0, 8000)),
+            'max_bytes': int(rng.integers(0, 10**8)),
+        }
+        if i % 5 == 0:
+            del record['total_packets']
+        records.append(record)
+    return records
+
+
+class TestColumnarFeaturesDst(unittest.TestCase):
+    def assert_paths_match(self, engineer, records):
+        X_columnar, kept_columnar = engineer.extract_features_batch(records)
+        X_per_record, kept_per_record = engineer.extract_features_batch(records, columnar=False)
+
+        self.assertEqual(X_columnar.shape, (len(records), len(engineer.feature_names)))
+        np.testing.assert_array_equal(X_columnar, X_per_record)
+        np.testing.assert_array_equal(kept_columnar, kept_per_record)
+
+    def test_default_feature_set(self):
+        self.assert_paths_match(FeatureEngineerDst(), make_dst_records(500))
+
+    def test_configured_feature_set(self):
+        self.assert_paths_match(FeatureEngineerDst(MockDstConfig()), make_dst_records(300, seed=1))
+
+    def test_feature_columns(self):
+        engineer = FeatureEngineerDst()
+        records = make_dst_records(50, seed=2)
+        columns = engineer.extract_feature_columns(records)
+        X, _ = engineer.extract_features_batch(records)
+        np.testing.assert_array_equal(engineer.columns_to_matrix(columns, len(records)), X)
+        for i, record in enumerate(records):
+            features = engineer.extract_features(record)
+            self.assertEqual(columns['flows_per_src'][i], features[8])
+            self.assertEqual(columns['bytes_per_src'][i], features[9])
+
+    def test_empty_batch(self):
+        X, kept = FeatureEngineerDst().extract_features_batch([])
+        self.assertEqual(len(X), 0)
+        self.assertEqual(len(kept), 0)
+
+    def test_columnar_raises_on_bad_records(self):
+        records = make_dst_records(6, seed=3)
+        records[2]['flow_count'] = 'n/a'
+        with self.assertRaises((TypeError, ValueError)):
+            FeatureEngineerDst().extract_features_batch(records)
+
+    def test_per_record_skips_bad_records(self):
+        engineer = FeatureEngineerDst()
+        records = make_dst_records(6, seed=3)
+        records[2]['flow_count'] = 'n/a'
+        X, kept = engineer.extract_features_batch(records, columnar=False)
+        np.testing.assert_array_equal(kept, [0, 1, 3, 4, 5])
+        self.assertEqual(len(X), len(kept))
+        np.testing.assert_array_equal(X[2], engineer.extract_features(records[3]))
+
+
+if __name__ == '__main__':
+    unittest.main()
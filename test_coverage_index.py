@@ -0,0 +1,154 @@
+#!/usr/bin/env python3
+"""
+測試覆蓋率索引（增量同步、向量化缺口比對、缺口佇列與修補）
+"""
+
+import os
+import tempfile
+import unittest
+from collections import defaultdict
+from unittest.mock import patch
+
+import backfill_historical_data as backfill_module
+from nad.utils.coverage_index import BUCKET_MS, CoverageIndex, gap_windows
+from nad.utils.es_transport import ESTransport
+from test_batched_validation import FakeResponse, parse_ndjson
+
+START_MS = 1790000000000 - 1790000000000 % BUCKET_MS
+N_BUCKETS = 40
+
+
+class FakeCoverageES:
+    """以記憶體中的文件回應 _msearch 的 3 分鐘 date_histogram"""
+
+    def __init__(self, raw, aggregated):
+        self.raw = raw
+        self.aggregated = aggregated
+        self.ranges = []
+
+    def request(self, method, url, json=None, data=None, headers=None, timeout=None, caller='default'):
+        lines = parse_ndjson(data)
+        responses = []
+        for header, body in zip(lines[::2], lines[1::2]):
+            index = header['index']
+            docs = self.raw if index.startswith('flow_collector') else self.aggregated[index]
+            [(time_field, time_range)] = body['query']['range'].items()
+            self.ranges.append((index, time_range['gte'], time_range['lt']))
+            histogram = body['aggs']['buckets']
+            groups = defaultdict(list)
+            for doc in docs:
+                if time_range['gte'] <= doc[time_field] < time_range['lt']:
+                    groups[doc[time_field] - doc[time_field] % BUCKET_MS].append(doc)
+
+            buckets = []
+            for key in sorted(groups):
+                bucket = {'key': key, 'doc_count': len(groups[key])}
+                for name, agg in histogram['aggs'].items():
+                    [(kind, spec)] = agg.items()
+                    values = [doc[spec['field']] for doc in groups[key]]
+                    bucket[name] = {'value': len(set(values)) if kind == 'cardinality' else sum(values)}
+                buckets.append(bucket)
+            responses.append({'aggregations': {'buckets': {'buckets': buckets}}})
+        return FakeResponse({'responses': responses})
+
+
+def aggregate(raw, group_field, ip_field):
+    docs = defaultdict(int)
+    for flow in raw:
+        docs[(flow['FLOW_START_MILLISECONDS'] // BUCKET_MS * BUCKET_MS, flow[group_field])] += 1
+    return [{'time_bucket': bucket, ip_field: ip, 'flow_count': count} for (bucket, ip), count in docs.items()]
+
+
+def make_data():
+    raw = []
+    for b in range(N_BUCKETS):
+        for i in range(10):
+            raw.append({'FLOW_START_MILLISECONDS': START_MS + b * BUCKET_MS + i * 1000,
+                        'IPV4_SRC_ADDR': f'10.0.0.{i % 5}', 'IPV4_DST_ADDR': f'10.1.0.{i % 2}'})
+
+    by_src = aggregate(raw, 'IPV4_SRC_ADDR', 'src_ip')
+    by_dst = aggregate(raw, 'IPV4_DST_ADDR', 'dst_ip')
+    missing_bucket = START_MS + 5 * BUCKET_MS
+    partial_bucket = START_MS + 12 * BUCKET_MS
+    by_src = [doc for doc in by_src if doc['time_bucket'] != missing_bucket
+              and not (doc['time_bucket'] == partial_bucket and doc['src_ip'] == '10.0.0.1')]
+    return raw, {'netflow_stats_3m_by_src': by_src, 'netflow_stats_3m_by_dst': by_dst}, \
+        missing_bucket, partial_bucket
+
+
+class TestCoverageIndex(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.path = os.path.join(self.tmp.name, 'state', 'coverage.db')
+        raw, aggregated, self.missing, self.partial = make_data()
+        self.fake = FakeCoverageES(raw, aggregated)
+        patcher = patch.object(ESTransport, 'request', side_effect=self.fake.request)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.end_ms = START_MS + N_BUCKETS * BUCKET_MS
+
+    def sync(self, index, end_ms=None):
+        return index.sync(days=1, now_ms=end_ms or self.end_ms, chunk_hours=1)
+
+    def test_gap_windows(self):
+        buckets = [START_MS + i * BUCKET_MS for i in (0, 1, 2, 5, 6, 9)]
+        self.assertEqual(gap_windows(buckets),
+                         [(START_MS, START_MS + 3 * BUCKET_MS), (START_MS + 5 * BUCKET_MS, START_MS + 7 * BUCKET_MS),
+                          (START_MS + 9 * BUCKET_MS, START_MS + 10 * BUCKET_MS)])
+        self.assertEqual(len(gap_windows(buckets[:3], max_buckets=2)), 2)
+
+    def test_finds_missing_and_under_filled(self):
+        index = CoverageIndex(self.path)
+        written = self.sync(index)
+        self.assertEqual(written, {'raw': N_BUCKETS, 'by_src': N_BUCKETS - 1, 'by_dst': N_BUCKETS})
+
+        gaps = index.find_gaps(start_ms=START_MS, end_ms=self.end_ms)
+        self.assertEqual([(g['mode'], g['bucket'], g['reason']) for g in gaps],
+                         [('by_src', self.missing, 'missing'), ('by_src', self.partial, 'under_filled')])
+        self.assertEqual((gaps[1]['raw_flows'], gaps[1]['agg_flows'], gaps[1]['raw_ips'], gaps[1]['agg_docs']),
+                         (10, 8, 5, 4))
+
+    def test_incremental_sync(self):
+        index = CoverageIndex(self.path)
+        self.sync(index)
+        index.close()
+
+        self.fake.ranges.clear()
+        reopened = CoverageIndex(self.path)
+        self.sync(reopened, self.end_ms + 60 * 60 * 1000)
+        # 只重讀上次同步位置前 30 分鐘之後的範圍
+        resync_start = self.end_ms - 30 * 60 * 1000
+        self.assertTrue(all(lo >= resync_start for _, lo, _ in self.fake.ranges))
+        self.assertEqual(reopened.synced_until('raw'), self.end_ms + 60 * 60 * 1000)
+        self.assertEqual(len(reopened.find_gaps(start_ms=START_MS, end_ms=self.end_ms)), 2)
+
+    def test_queue_and_repair(self):
+        index = CoverageIndex(self.path)
+        self.sync(index)
+        gaps = index.find_gaps(start_ms=START_MS, end_ms=self.end_ms)
+        self.assertEqual(index.enqueue_gaps(gaps), 2)
+        self.assertEqual(index.enqueue_gaps(gaps), 0)
+        index.close()
+
+        repaired_windows = []
+
+        def fake_process(backfill, start_time, end_time, dry_run=False, page_size=None):
+            # 模擬回填：補齊聚合索引
+            self.fake.aggregated['netflow_stats_3m_by_src'] = aggregate(self.fake.raw, 'IPV4_SRC_ADDR', 'src_ip')
+            repaired_windows.append((backfill.mode, start_time, end_time))
+
+        with patch.object(backfill_module.HistoricalDataBackfill, '_process_time_range', fake_process):
+            repaired, failed = backfill_module.repair_gaps(['by_src', 'by_dst'], coverage_path=self.path)
+
+        self.assertEqual((repaired, failed), (2, 0))
+        self.assertEqual([w[0] for w in repaired_windows], ['by_src', 'by_src'])
+        self.assertEqual(repaired_windows[0][2] - repaired_windows[0][1], backfill_module.timedelta(minutes=3))
+
+        index = CoverageIndex(self.path)
+        self.assertEqual(index.queued_buckets(), {})
+        self.assertEqual(index.find_gaps(start_ms=START_MS, end_ms=self.end_ms), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
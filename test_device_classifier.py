@@ -0,0 +1,146 @@
+#!/usr/bin/env python3
+"""
+測試 DeviceClassifier 的編譯區間索引與批量分類
+"""
+
+import ipaddress
+import os
+import random
+import tempfile
+import unittest
+
+import numpy as np
+import yaml
+
+from nad.device_classifier import DeviceClassifier
+
+CONFIG = {
+    'device_types': {
+        'external': {'ip_ranges': []},
+        # 與後面的網段重疊：先出現的類型優先
+        'vpn': {'ip_ranges': ['10.10.10.0/24', '192.168.20.128/25']},
+        'server_farm': {'ip_ranges': ['192.168.10.0/24', '192.168.20.0/24', '10.0.0.0/8']},
+        'station': {'ip_ranges': ['192.168.0.0/16', 'fd00::/8', 'not-a-network']},
+        'iot': {'ip_ranges': ['192.168.0.0/24', '172.16.5.7/32']},
+    },
+    'special_devices': {
+        'critical_servers': {'device_type': 'server_farm', 'ips': ['192.168.50.9', '8.8.8.8']},
+        'legacy_group': {'device_type': 'iot', '192.168.10.77': None},
+    },
+}
+
+
+def reference_classify(config, ip):
+    """逐一比對網段的分類方式（編譯索引前的實作）"""
+    special = {}
+    for group in config['special_devices'].values():
+        ips = group.get('ips') or [k for k in group if k not in ('device_type', 'ips')]
+        for special_ip in ips:
+            special[special_ip] = group['device_type']
+    if ip in special:
+        return special[ip]
+    try:
+        ip_obj = ipaddress.ip_address(ip)
+    except ValueError:
+        return 'external'
+    for device_type, type_config in config['device_types'].items():
+        for ip_range in type_config.get('ip_ranges', []):
+            try:
+                if ip_obj in ipaddress.ip_network(ip_range, strict=False):
+                    return device_type
+            except ValueError:
+                continue
+    return 'external'
+
+
+class TestDeviceClassifierIndex(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.tmp = tempfile.TemporaryDirectory()
+        path = os.path.join(cls.tmp.name, 'device_mapping.yaml')
+        with open(path, 'w', encoding='utf-8') as f:
+            yaml.safe_dump(CONFIG, f, allow_unicode=True, sort_keys=False)
+        cls.classifier = DeviceClassifier(path)
+
+        rng = random.Random(5)
+        ips = ['192.168.50.9', '8.8.8.8', '192.168.10.77', '172.16.5.7', '172.16.5.8',
+               '0.0.0.0', '255.255.255.255', '192.168.20.127', '192.168.20.128']
+        for _ in range(3000):
+            prefix = rng.choice(['192.168.', '10.', '172.16.', ''])
+            parts = 4 - prefix.count('.')
+            ips.append(prefix + '.'.join(str(rng.randint(0, 255)) for _ in range(parts)))
+        cls.ipv4 = ips
+        cls.others = ['fd00::1', '2001:db8::1', 'not-an-ip', '']
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.tmp.cleanup()
+
+    def test_classify_matches_reference(self):
+        for ip in self.ipv4 + self.others:
+            self.assertEqual(self.classifier.classify(ip), reference_classify(CONFIG, ip), ip)
+
+    def test_special_ips_list(self):
+        # special_devices 的 ips 列表優先於網段（改變 device_type 特徵）
+        self.assertEqual(self.classifier.classify('8.8.8.8'), 'server_farm')
+        self.assertEqual(self.classifier.classify('192.168.50.9'), 'server_farm')
+        self.assertEqual(self.classifier.classify('192.168.10.77'), 'iot')
+        self.assertEqual(self.classifier.classify('ips'), 'external')
+
+    def test_classify_many_integers(self):
+        expected = [self.classifier.get_device_type_code(ip) for ip in self.ipv4]
+        values = np.array([int(ipaddress.IPv4Address(ip)) for ip in self.ipv4], dtype=np.uint32)
+        np.testing.assert_array_equal(self.classifier.classify_many(values), expected)
+
+    def test_classify_many_strings(self):
+        ips = self.ipv4 + self.others
+        expected = [self.classifier.get_device_type_code(ip) for ip in ips]
+        np.testing.assert_array_equal(self.classifier.classify_many(ips), expected)
+        self.assertEqual(len(self.classifier.classify_many([])), 0)
+
+    def test_reload_rebuilds_index(self):
+        path = os.path.join(self.tmp.name, 'reload.yaml')
+        with open(path, 'w', encoding='utf-8') as f:
+            yaml.safe_dump(CONFIG, f, allow_unicode=True, sort_keys=False)
+        classifier = DeviceClassifier(path)
+        self.assertEqual(classifier.classify('8.8.8.8'), 'server_farm')
+
+        config = {'device_types': dict(CONFIG['device_types']), 'special_devices': {}}
+        config['device_types']['iot'] = {'ip_ranges': ['8.8.8.0/24']}
+        with open(path, 'w', encoding='utf-8') as f:
+            yaml.safe_dump(config, f, allow_unicode=True, sort_keys=False)
+        classifier.reload_config()
+
+        self.assertEqual(classifier.classify('8.8.8.8'), 'iot')
+        self.assertEqual(classifier.classify_many(np.array([int(ipaddress.IPv4Address('8.8.8.8'))]))[0],
+                         classifier.get_device_type_code('8.8.8.8'))
+
+    def test_many_overlapping_ranges(self):
+        rng = random.Random(11)
+        device_types = {'external': {'ip_ranges': []}}
+        for t in range(6):
+            ranges = []
+            for _ in range(40):
+                prefix = rng.randint(8, 30)
+                address = rng.getrandbits(32) & ~((1 << (32 - prefix)) - 1)
+                ranges.append(f"{ipaddress.IPv4Address(address)}/{prefix}")
+            device_types[f'type{t}'] = {'ip_ranges': ranges}
+        config = {'device_types': device_types, 'special_devices': {}}
+
+        path = os.path.join(self.tmp.name, 'overlapping.yaml')
+        with open(path, 'w', encoding='utf-8') as f:
+            yaml.safe_dump(config, f, sort_keys=False)
+        classifier = DeviceClassifier(path)
+
+        probes = []
+        for ranges in (t['ip_ranges'] for t in device_types.values()):
+            for network in map(ipaddress.ip_network, ranges):
+                first, last = int(network.network_address), int(network.broadcast_address)
+                probes += [first - 1, first, last, last + 1]
+        probes = [str(ipaddress.IPv4Address(p)) for p in probes if 0 <= p < 2 ** 32]
+        for ip in probes:
+            self.assertEqual(classifier.classify(ip), reference_classify(config, ip), ip)
+
+
+if __name__ == '__main__':
+    unittest.main()
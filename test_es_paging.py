@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+"""
+測試 PIT + search_after 分頁讀取
+"""
+
+import unittest
+from datetime import datetime, timedelta
+
+from nad.ml.feature_engineer import FeatureEngineer
+from nad.ml.feature_engineer_dst import FeatureEngineerDst
+from nad.ml.isolation_forest_by_dst import IsolationForestByDst
+from nad.ml.isolation_forest_detector import OptimizedIsolationForest
+from nad.utils.es_paging import iter_search_pages
+
+
+class FakeES:
+    """依 search_after 回傳排序後文件的假 ES 客戶端"""
+
+    def __init__(self, n_docs, support_pit=True):
+        self.docs = [{'time_bucket': i // 10, 'src_ip': f'10.0.0.{i % 10}', 'flow_count': i}
+                     for i in range(n_docs)]
+        self.support_pit = support_pit
+        self.bodies = []
+        self.closed = []
+
+    def open_point_in_time(self, index, keep_alive):
+        if not self.support_pit:
+            raise RuntimeError('PIT not supported')
+        return {'id': 'pit-1'}
+
+    def close_point_in_time(self, body):
+        self.closed.append(body['id'])
+
+    def search(self, body, index=None):
+        self.bodies.append(dict(body))
+        start = 0
+        if 'search_after' in body:
+            start = body['search_after'][0] + 1
+        page = self.docs[start:start + body['size']]
+        hits = [{'_source': {k: v for k, v in d.items() if k in body.get('_source', d)},
+                 'sort': [d['flow_count']]} for d in page]
+        return {'hits': {'hits': hits}, 'pit_id': 'pit-2'}
+
+
+class TestIterSearchPages(unittest.TestCase):
+    def test_reads_all_pages_with_pit(self):
+        es = FakeES(2500)
+        pages = list(iter_search_pages(es, 'idx', {'match_all': {}}, page_size=1000))
+        self.assertEqual([len(p) for p in pages], [1000, 1000, 500])
+        self.assertEqual(sum(len(p) for p in pages), 2500)
+        # 使用 PIT 查詢（不帶 index），並關閉最新的 PIT id
+        self.assertEqual(es.bodies[1]['pit']['id'], 'pit-2')
+        self.assertIn({'_shard_doc': 'asc'}, es.bodies[0]['sort'])
+        self.assertEqual(es.closed, ['pit-2'])
+
+    def test_fallback_without_pit(self):
+        es = FakeES(1200, support_pit=False)
+        pages = list(iter_search_pages(es, 'idx', {'match_all': {}}, tiebreaker='src_ip',
+                                       page_size=500))
+        self.assertEqual(sum(len(p) for p in pages), 1200)
+        self.assertNotIn('pit', es.bodies[0])
+        self.assertEqual(es.bodies[0]['sort'], [{'time_bucket': 'asc'}, {'src_ip': 'asc'}])
+        self.assertEqual(es.closed, [])
+
+    def test_source_filtering(self):
+        es = FakeES(10)
+        pages = list(iter_search_pages(es, 'idx', {'match_all': {}},
+                                       source_fields=('src_ip', 'flow_count')))
+        self.assertEqual(set(pages[0][0]), {'src_ip', 'flow_count'})
+
+    def test_pit_closed_when_consumer_stops(self):
+        es = FakeES(3000)
+        pages = iter_search_pages(es, 'idx', {'match_all': {}}, page_size=1000)
+        next(pages)
+        pages.close()
+        self.assertEqual(es.closed, ['pit-2'])
+
+
+class PagingConfig:
+    es_aggregated_index = 'idx'
+    realtime_config = {'page_size': 1000}
+
+
+class TestPagedPredictionOrder(unittest.TestCase):
+    """逐頁評分後，合併結果仍依異常分數由高到低排序"""
+
+    @staticmethod
+    def score_page(records):
+        # 每頁各自排序，分數與 flow_count 相關但跨頁交錯
+        results = [{'anomaly_score': (r['flow_count'] * 7919) % 1000} for r in records]
+        return sorted(results, key=lambda x: x['anomaly_score'], reverse=True)
+
+    def make_detector(self, cls):
+        detector = cls.__new__(cls)
+        detector.config = PagingConfig()
+        detector.model = object()
+        detector.es = FakeES(2500)
+        detector._init_es_client = lambda: None
+        detector._predict_batch = self.score_page
+        return detector
+
+    def assert_ranked(self, detector, anomalies):
+        # 確實分成多頁評分
+        self.assertGreater(len(detector.es.bodies), 1)
+        scores = [a['anomaly_score'] for a in anomalies]
+        self.assertEqual(len(scores), 2500)
+        self.assertEqual(scores, sorted(scores, reverse=True))
+
+    def test_src_results_ranked_across_pages(self):
+        detector = self.make_detector(OptimizedIsolationForest)
+        detector.feature_engineer = FeatureEngineer()
+        self.assert_ranked(detector, detector.predict_realtime(recent_minutes=10))
+
+    def test_dst_results_ranked_across_pages(self):
+        detector = self.make_detector(IsolationForestByDst)
+        detector.feature_engineer = FeatureEngineerDst()
+        end = datetime(2025, 11, 20, 12, 0)
+        self.assert_ranked(detector, detector.predict_time_range(end - timedelta(minutes=30), end))
+
+
+if __name__ == '__main__':
+    unittest.main()
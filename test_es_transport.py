@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+"""
+測試共用 ES 傳輸層（連線重用、gzip、重試、依呼叫者統計）
+"""
+
+import gzip
+import json
+import threading
+import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from nad.utils.es_transport import ESTransport
+
+
+class FakeESHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        server = self.server
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        if self.headers.get('Content-Encoding') == 'gzip':
+            body = gzip.decompress(body)
+
+        with server.lock:
+            server.requests.append({
+                'path': self.path,
+                'body': body,
+                'encoding': self.headers.get('Content-Encoding'),
+                'client_port': self.client_address[1],
+            })
+            fail = server.fail_remaining > 0
+            server.fail_remaining -= int(fail)
+
+        status = server.fail_status if fail else 200
+        payload = json.dumps({'hits': {'hits': [], 'total': {'value': 0}}}).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, *args):
+        pass
+
+
+class TestESTransport(unittest.TestCase):
+    def setUp(self):
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), FakeESHandler)
+        self.server.lock = threading.Lock()
+        self.server.requests = []
+        self.server.fail_remaining = 0
+        self.server.fail_status = 503
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}"
+        self.transport = ESTransport(backoff_factor=0.01, compress_threshold=1024)
+
+    def tearDown(self):
+        self.transport.session.close()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_connection_reuse(self):
+        for _ in range(5):
+            response = self.transport.post(f"{self.url}/idx/_search", json={'size': 0})
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.json()['hits']['total']['value'], 0)
+
+        ports = {r['client_port'] for r in self.server.requests}
+        self.assertEqual(len(ports), 1)
+
+    def test_large_body_gzipped(self):
+        small = {'query': {'match_all': {}}}
+        large = {'query': {'terms': {'src_ip': [f'10.0.{i // 256}.{i % 256}' for i in range(500)]}}}
+        self.transport.post(f"{self.url}/idx/_search", json=small)
+        self.transport.post(f"{self.url}/idx/_search", json=large)
+
+        self.assertIsNone(self.server.requests[0]['encoding'])
+        self.assertEqual(self.server.requests[1]['encoding'], 'gzip')
+        self.assertEqual(json.loads(self.server.requests[1]['body']), large)
+
+    def test_status_errors_left_to_caller(self):
+        # 429 / 5xx 不在傳輸層重送，由呼叫者（BulkIngester、回填 AIMD）決定是否重試
+        for status in (429, 503):
+            self.server.requests.clear()
+            self.server.fail_status = status
+            self.server.fail_remaining = 1
+            response = self.transport.post(f"{self.url}/idx/_search", json={})
+            self.assertEqual(response.status_code, status)
+            self.assertEqual(len(self.server.requests), 1)
+
+    def test_only_connection_errors_retried(self):
+        retry = self.transport.session.get_adapter(self.url).max_retries
+        self.assertEqual((retry.connect, retry.read, retry.status), (3, 0, 0))
+
+    def test_stats_by_caller(self):
+        self.transport.post(f"{self.url}/idx/_search", json={}, caller='a')
+        self.transport.post(f"{self.url}/idx/_search", json={}, caller='a')
+        self.transport.post(f"{self.url}/_msearch", data='{}\n{}\n',
+                            headers={'Content-Type': 'application/x-ndjson'}, caller='b')
+
+        stats = self.transport.get_stats()
+        self.assertEqual(stats['a']['calls'], 2)
+        self.assertEqual(stats['b']['calls'], 1)
+        self.assertEqual(stats['b']['bytes_sent'], 6)
+        self.assertGreater(stats['a']['bytes_received'], 0)
+        self.assertIn('a: 2 次', self.transport.format_stats())
+
+        self.transport.reset_stats()
+        self.assertEqual(self.transport.get_stats(), {})
+
+
+if __name__ == '__main__':
+    unittest.main()
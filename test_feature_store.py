@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+"""
+測試特徵矩陣磁碟快取（按日分區、配置雜湊失效）
+"""
+
+import shutil
+import tempfile
+import unittest
+from datetime import datetime, timedelta, timezone
+
+import numpy as np
+from nad.ml.feature_store import FeatureStore, compute_config_hash
+
+
+NOW = datetime(2025, 11, 20, 13, 30, tzinfo=timezone.utc)
+
+
+class FakeSource:
+    """每天回傳一筆記錄，記錄查詢過的範圍"""
+
+    def __init__(self):
+        self.calls = []
+
+    def fetch_range(self, start, end):
+        self.calls.append((start, end))
+        return [{'day': start.day, 'hour': end.hour}]
+
+    @staticmethod
+    def extract(records):
+        return np.array([[r['day'], r['hour']] for r in records], dtype=np.float64)
+
+
+class TestFeatureStore(unittest.TestCase):
+    def setUp(self):
+        self.base_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.base_dir)
+
+    def make_store(self, feature_names=('a', 'b'), thresholds=None):
+        config_hash = compute_config_hash(list(feature_names), thresholds=thresholds)
+        return FeatureStore(self.base_dir, 'by_src', config_hash, list(feature_names))
+
+    def test_cached_days_not_refetched(self):
+        source = FakeSource()
+        X1 = self.make_store().build_matrix(3, source.fetch_range, source.extract, now=NOW)
+        # 頭段不完整日期 + 2 個完整日期 + 當天
+        self.assertEqual(len(source.calls), 4)
+        np.testing.assert_array_equal(X1[:, 0], [17, 18, 19, 20])
+
+        source.calls.clear()
+        X2 = self.make_store().build_matrix(3, source.fetch_range, source.extract, now=NOW)
+        # 只重新查詢頭尾兩段不完整的日期
+        self.assertEqual(source.calls, [
+            (datetime(2025, 11, 17, 13, 30, tzinfo=timezone.utc), datetime(2025, 11, 18, tzinfo=timezone.utc)),
+            (datetime(2025, 11, 20, tzinfo=timezone.utc), NOW),
+        ])
+        np.testing.assert_array_equal(X1, X2)
+
+    def test_span_matches_es_range(self):
+        for now in (NOW, datetime(2025, 11, 20, tzinfo=timezone.utc)):
+            source = FakeSource()
+            FeatureStore(tempfile.mkdtemp(dir=self.base_dir), 'by_src', 'h', ['a', 'b']).build_matrix(
+                3, source.fetch_range, source.extract, now=now)
+            # 各段首尾相接，合起來恰為 [now-3d, now)
+            self.assertEqual(source.calls[0][0], now - timedelta(days=3))
+            self.assertEqual(source.calls[-1][1], now)
+            for (_, end), (start, _) in zip(source.calls, source.calls[1:]):
+                self.assertEqual(end, start)
+
+    def test_config_change_invalidates(self):
+        source = FakeSource()
+        self.make_store().build_matrix(2, source.fetch_range, source.extract, now=NOW)
+
+        source.calls.clear()
+        store = self.make_store(thresholds={'high_connection': 500})
+        store.build_matrix(2, source.fetch_range, source.extract, now=NOW)
+        self.assertEqual(len(source.calls), 3)
+
+    def test_device_mapping_change_invalidates(self):
+        mapping = {'device_types': {'station': {'ip_ranges': ['192.168.20.0/24']}}, 'special_devices': {}}
+        changed = {'device_types': {'station': {'ip_ranges': ['192.168.30.0/24']}}, 'special_devices': {}}
+        self.assertEqual(compute_config_hash(['a'], device_mapping=mapping),
+                         compute_config_hash(['a'], device_mapping=dict(mapping)))
+        self.assertNotEqual(compute_config_hash(['a'], device_mapping=mapping),
+                            compute_config_hash(['a'], device_mapping=changed))
+
+    def test_partitions_are_memory_mapped(self):
+        store = self.make_store()
+        day = datetime(2025, 11, 18, tzinfo=timezone.utc)
+        store.save_day(day, np.ones((5, 2)))
+        X = store.load_day(day)
+        self.assertIsInstance(X, np.memmap)
+        self.assertEqual(X.shape, (5, 2))
+
+    def test_prune(self):
+        store = self.make_store()
+        for day in (1, 10, 19):
+            store.save_day(datetime(2025, 11, day, tzinfo=timezone.utc), np.zeros((1, 2)))
+        self.assertEqual(store.prune(keep_days=5, now=NOW), 2)
+        self.assertTrue(store.has_day(datetime(2025, 11, 19, tzinfo=timezone.utc)))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+"""
+測試扁平化 Isolation Forest 評分器與 sklearn 結果一致
+"""
+
+import os
+import tempfile
+import unittest
+import numpy as np
+from sklearn.ensemble import IsolationForest
+from nad.ml.flat_forest import FlatIsolationForest
+
+
+def make_model(n_features=12, max_features=0.8, max_samples=512, seed=0):
+    rng = np.random.default_rng(seed)
+    X = rng.normal(size=(5000, n_features))
+    model = IsolationForest(n_estimators=60, max_samples=max_samples,
+                            max_features=max_features, contamination=0.05,
+                            random_state=42).fit(X)
+    return model, rng
+
+
+class TestFlatIsolationForest(unittest.TestCase):
+    def assert_matches(self, model, X):
+        flat = FlatIsolationForest.from_sklearn(model)
+        scores, predictions = flat.score_and_predict(X)
+        np.testing.assert_array_equal(scores, model.score_samples(X))
+        np.testing.assert_array_equal(predictions, model.predict(X))
+
+    def test_matches_sklearn(self):
+        model, rng = make_model()
+        # 含離群值
+        X = np.vstack([rng.normal(size=(3000, 12)), rng.normal(0, 6, size=(300, 12))])
+        self.assert_matches(model, X)
+
+    def test_matches_sklearn_all_features(self):
+        model, rng = make_model(n_features=5, max_features=1.0, max_samples=256, seed=1)
+        self.assert_matches(model, rng.normal(size=(1000, 5)) * 2)
+
+    def test_chunking(self):
+        model, rng = make_model(seed=2)
+        flat = FlatIsolationForest.from_sklearn(model)
+        flat.CHUNK_SIZE = 7
+        X = rng.normal(size=(100, 12))
+        np.testing.assert_array_equal(flat.score_samples(X), model.score_samples(X))
+
+    def test_save_and_load(self):
+        model, rng = make_model(seed=3)
+        flat = FlatIsolationForest.from_sklearn(model)
+        X = rng.normal(size=(200, 12))
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'flat.npz')
+            flat.save(path)
+            loaded = FlatIsolationForest.load(path)
+        np.testing.assert_array_equal(loaded.score_samples(X), model.score_samples(X))
+
+    def test_feature_count_mismatch(self):
+        model, rng = make_model(seed=4)
+        with self.assertRaises(ValueError):
+            FlatIsolationForest.from_sklearn(model).predict(rng.normal(size=(10, 3)))
+
+
+if __name__ == '__main__':
+    unittest.main()
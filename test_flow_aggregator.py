@@ -0,0 +1,218 @@
+#!/usr/bin/env python3
+"""
+測試本機聚合（FlowAggregator）與單次讀取回填引擎
+"""
+
+import os
+import random
+import tempfile
+import threading
+import unittest
+from collections import Counter, defaultdict
+from datetime import datetime, timedelta, timezone
+from unittest.mock import patch
+
+import numpy as np
+
+import backfill_historical_data as backfill_module
+from backfill_historical_data import ParallelBackfill
+from nad.utils.es_transport import ESTransport
+from nad.utils.flow_aggregator import BUCKET_MS, FlowAggregator, hll_estimate, hll_registers
+from test_batched_validation import FakeResponse, parse_ndjson
+
+START_MS = int(datetime(2026, 10, 1, tzinfo=timezone.utc).timestamp() * 1000)
+
+
+def make_flows(n=6000, seed=4):
+    rng = random.Random(seed)
+    flows = []
+    for _ in range(n):
+        flows.append({
+            'FLOW_START_MILLISECONDS': START_MS + rng.randrange(3600 * 1000),
+            'IPV4_SRC_ADDR': f'10.0.0.{rng.randint(1, 6)}',
+            'IPV4_DST_ADDR': f'192.168.{rng.randint(0, 3)}.{rng.randint(1, 60)}',
+            'L4_SRC_PORT': rng.randint(40000, 40100),
+            'L4_DST_PORT': rng.choice([22, 53, 80, 443, 443, 443, 8080, 3389]),
+            'IN_BYTES': rng.randint(40, 9000),
+            'IN_PKTS': rng.randint(1, 20),
+        })
+    return flows
+
+
+def reference_docs(flows, group_field, ip_field, peer_field, cardinality_name):
+    """以 Python 逐筆計算的精確結果（與 Transform 定義相同）"""
+    tz = timezone(timedelta(hours=8))
+    groups = defaultdict(list)
+    for flow in flows:
+        bucket = flow['FLOW_START_MILLISECONDS'] // BUCKET_MS * BUCKET_MS
+        time_bucket = datetime.fromtimestamp(bucket / 1000, tz).isoformat(timespec='milliseconds')
+        groups[(time_bucket, flow[group_field])].append(flow)
+
+    docs = {}
+    for (time_bucket, ip), members in groups.items():
+        top = {}
+        for side, field in (('src', 'L4_SRC_PORT'), ('dst', 'L4_DST_PORT')):
+            counts = Counter(f[field] for f in members)
+            ranked = sorted(counts.items(), key=lambda item: (-item[1], item[0]))[:5]
+            top[side] = ({str(port): count for port, count in ranked}, len(counts))
+        docs[(time_bucket, ip)] = {
+            'time_bucket': time_bucket, ip_field: ip,
+            'total_bytes': float(sum(f['IN_BYTES'] for f in members)),
+            'total_packets': float(sum(f['IN_PKTS'] for f in members)),
+            'flow_count': len(members),
+            cardinality_name: len({f[peer_field] for f in members}),
+            'unique_src_ports': top['src'][1], 'unique_dst_ports': top['dst'][1],
+            'avg_bytes': sum(f['IN_BYTES'] for f in members) / len(members),
+            'max_bytes': float(max(f['IN_BYTES'] for f in members)),
+            'top_src_ports': top['src'][0], 'top_dst_ports': top['dst'][0],
+        }
+    return docs
+
+
+class FakeSlicedPitES:
+    """以 sliced PIT + search_after 回傳原始 flow，並記錄 bulk 寫入"""
+
+    def __init__(self, flows):
+        self.flows = flows
+        self.searches = []
+        self.indexed = {}
+        self.pits = set()
+        self._lock = threading.Lock()
+
+    def request(self, method, url, json=None, data=None, headers=None, timeout=None, caller='default'):
+        with self._lock:
+            if '/_pit' in url:
+                if method == 'DELETE':
+                    self.pits.discard(json['id'])
+                    return FakeResponse({'succeeded': True})
+                pit_id = f'pit-{len(self.pits)}'
+                self.pits.add(pit_id)
+                return FakeResponse({'id': pit_id})
+
+            if url.endswith('/_bulk'):
+                lines = parse_ndjson(data.encode() if isinstance(data, str) else data)
+                for action, doc in zip(lines[::2], lines[1::2]):
+                    self.indexed[(action['index']['_index'], action['index']['_id'])] = doc
+                return FakeResponse({'errors': False, 'items': [{'index': {'status': 201}} for _ in lines[::2]]})
+
+            assert json['pit']['id'] in self.pits
+            self.searches.append(json)
+            sliced = json.get('slice', {'id': 0, 'max': 1})
+            positions = [i for i in range(len(self.flows)) if i % sliced['max'] == sliced['id']]
+            after = json.get('search_after', [-1])[0]
+            page = [i for i in positions if i > after][:json['size']]
+            hits = [{'_source': {k: self.flows[i][k] for k in json['_source']}, 'sort': [i]} for i in page]
+            return FakeResponse({'pit_id': json['pit']['id'], 'hits': {'hits': hits}})
+
+
+class TestFlowAggregator(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.flows = make_flows()
+        cls.aggregator = FlowAggregator(flush_rows=1000)
+        for i in range(0, len(cls.flows), 700):
+            cls.aggregator.add_flows(cls.flows[i:i + 700])
+
+    def test_matches_exact_reference(self):
+        for mode, spec in (('by_src', ('IPV4_SRC_ADDR', 'src_ip', 'IPV4_DST_ADDR', 'unique_dsts')),
+                           ('by_dst', ('IPV4_DST_ADDR', 'dst_ip', 'IPV4_SRC_ADDR', 'unique_srcs'))):
+            expected = reference_docs(self.flows, *spec)
+            docs = self.aggregator.documents(mode)
+            self.assertEqual(len(docs), len(expected))
+            for doc in docs:
+                reference = dict(expected[(doc['time_bucket'], doc[spec[1]])])
+                # HyperLogLog 估計：小基數時只可能因暫存器碰撞而少算
+                estimate, exact = doc.pop(spec[3]), reference.pop(spec[3])
+                self.assertLessEqual(abs(estimate - exact), max(1, exact * 0.02))
+                self.assertEqual(doc, reference)
+
+    def test_merge_equals_single_pass(self):
+        left, right = FlowAggregator(['by_src']), FlowAggregator(['by_src'])
+        left.add_flows(self.flows[::2])
+        right.add_flows(self.flows[1::2])
+        left.merge(right)
+        self.assertEqual(left.documents('by_src'), self.aggregator.documents('by_src'))
+        self.assertEqual(left.flows, len(self.flows))
+
+    def test_documents_in_batches(self):
+        for mode in ('by_src', 'by_dst'):
+            batches = list(self.aggregator.iter_documents(mode, batch_size=37))
+            self.assertTrue(all(len(batch) <= 37 for batch in batches))
+            self.assertEqual([doc for batch in batches for doc in batch], self.aggregator.documents(mode))
+
+    def test_hll_large_cardinality(self):
+        rng = np.random.default_rng(5)
+        for true_count in (500, 50000):
+            values = rng.choice(2 ** 32, true_count, replace=False)
+            values = np.concatenate([values, values[:true_count // 2]])
+            register, rank = hll_registers(values, 14)
+            codes, inverse = np.unique(register, return_inverse=True)
+            ranks = np.zeros(len(codes), dtype=np.uint8)
+            np.maximum.at(ranks, inverse.reshape(-1), rank)
+            estimate = hll_estimate(codes, ranks, 1, 14)[0]
+            self.assertLess(abs(estimate - true_count) / true_count, 0.03)
+
+    def test_skips_unparseable_flows(self):
+        aggregator = FlowAggregator(['by_src'])
+        aggregator.add_flows([
+            {'FLOW_START_MILLISECONDS': START_MS, 'IPV4_SRC_ADDR': 'not-an-ip', 'IPV4_DST_ADDR': '10.0.0.2'},
+            {'IPV4_SRC_ADDR': '10.0.0.1', 'IPV4_DST_ADDR': '10.0.0.2'},
+            {'FLOW_START_MILLISECONDS': START_MS, 'IPV4_SRC_ADDR': '10.0.0.1', 'L4_DST_PORT': 443},
+        ])
+        [doc] = aggregator.documents('by_src')
+        self.assertEqual((doc['flow_count'], doc['unique_dsts'], doc['unique_src_ports']), (1, 0, 0))
+        self.assertEqual(doc['top_dst_ports'], {'443': 1})
+        self.assertEqual(doc['time_bucket'], '2026-10-01T08:00:00.000+08:00')
+
+
+class TestSinglePassBackfill(unittest.TestCase):
+    def test_one_read_feeds_both_modes(self):
+        flows = make_flows(3000, seed=6)
+        fake = FakeSlicedPitES(flows)
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+
+        bulk_sizes = []
+        bulk_index = backfill_module.HistoricalDataBackfill._bulk_index
+
+        def record_bulk(backfill, docs):
+            bulk_sizes.append(len(docs))
+            bulk_index(backfill, docs)
+
+        with patch.object(ESTransport, 'request', side_effect=fake.request), \
+                patch.object(backfill_module.HistoricalDataBackfill, '_bulk_index', record_bulk):
+            job = ParallelBackfill(['by_src', 'by_dst'], max_workers=1, page_size=500,
+                                   checkpoint_path=os.path.join(tmp.name, 'checkpoint.json'),
+                                   engine='inprocess', slices=3)
+            job.single_pass.scroll_size = 400
+            job.single_pass._process_time_range(datetime(2026, 10, 1), datetime(2026, 10, 1, 1))
+
+        # 每筆 flow 只讀取一次，三個 slice 都只取回必要欄位
+        self.assertEqual(job.single_pass.flows_read, len(flows))
+        self.assertEqual({search['slice']['id'] for search in fake.searches}, {0, 1, 2})
+        self.assertTrue(all(len(search['_source']) == 7 for search in fake.searches))
+        self.assertEqual(fake.pits, set())
+        # 文檔以 page_size 為單位分批寫入
+        self.assertGreater(len(bulk_sizes), 2)
+        self.assertTrue(all(size <= 500 for size in bulk_sizes))
+
+        for mode, spec in (('by_src', ('IPV4_SRC_ADDR', 'src_ip', 'IPV4_DST_ADDR', 'unique_dsts')),
+                           ('by_dst', ('IPV4_DST_ADDR', 'dst_ip', 'IPV4_SRC_ADDR', 'unique_srcs'))):
+            dest_index = backfill_module.AGGREGATION_MODES[mode]['dest_index']
+            expected = reference_docs(flows, *spec)
+            written = {doc_id: doc for (index, doc_id), doc in fake.indexed.items() if index == dest_index}
+            self.assertEqual(set(written), {f'{time_bucket}_{ip}' for time_bucket, ip in expected})
+            for (time_bucket, ip), reference in expected.items():
+                doc = written[f'{time_bucket}_{ip}']
+                self.assertEqual(doc['top_dst_ports'], reference['top_dst_ports'])
+                self.assertEqual(doc['total_bytes'], reference['total_bytes'])
+                self.assertLessEqual(abs(doc[spec[3]] - reference[spec[3]]), 1)
+            self.assertEqual(job.backfills[mode].processed_docs, len(expected))
+
+    def test_engine_validation(self):
+        with self.assertRaises(ValueError):
+            ParallelBackfill(['by_src'], engine='spark')
+
+
+if __name__ == '__main__':
+    unittest.main()
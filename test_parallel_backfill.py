@@ -0,0 +1,185 @@
+#!/usr/bin/env python3
+"""
+測試並行、可續傳的歷史資料回填（ParallelBackfill）
+"""
+
+import json
+import os
+import tempfile
+import threading
+import unittest
+from datetime import datetime
+from unittest.mock import patch
+
+import backfill_historical_data as backfill_module
+import nad.utils.bulk_ingest as bulk_ingest_module
+from backfill_historical_data import AdaptiveConcurrency, BackfillCheckpoint, ParallelBackfill
+from nad.utils.es_transport import ESTransport
+from test_batched_validation import FakeResponse, parse_ndjson
+
+
+class FakeBackfillES:
+    """回應回填的聚合查詢與 bulk 寫入；前 reject_bulks 次 bulk 以 429 拒絕"""
+
+    def __init__(self, reject_bulks=0):
+        self.reject_bulks = reject_bulks
+        self.searches = []
+        self.indexed = {}
+        self._lock = threading.Lock()
+
+    def request(self, method, url, json=None, data=None, headers=None, timeout=None, caller='default'):
+        with self._lock:
+            if url.endswith('/_bulk'):
+                lines = parse_ndjson(data.encode() if isinstance(data, str) else data)
+                if self.reject_bulks:
+                    self.reject_bulks -= 1
+                    return FakeResponse({'errors': True, 'items': [
+                        {'index': {'status': 429, 'error': {'type': 'es_rejected_execution_exception'}}}
+                        for _ in lines[::2]
+                    ]})
+                for action, doc in zip(lines[::2], lines[1::2]):
+                    self.indexed[(action['index']['_index'], action['index']['_id'])] = doc
+                return FakeResponse({'errors': False, 'items': [{'index': {'status': 201}} for _ in lines[::2]]})
+
+            start = json['query']['range']['FLOW_START_MILLISECONDS']['gte']
+            composite = json['aggs']['by_bucket_ip']['composite']
+            if 'after' in composite:
+                return FakeResponse({'aggregations': {'by_bucket_ip': {'buckets': []}}})
+
+            self.searches.append((url.split('/')[-2], start))
+            bucket = {
+                'key': {'time_bucket': start, 'ip': '10.0.0.1'}, 'doc_count': 2,
+                'total_bytes': {'value': 100.0}, 'total_packets': {'value': 5.0},
+                'flow_count': {'value': 2}, 'unique_dsts': {'value': 1}, 'unique_srcs': {'value': 1},
+                'unique_src_ports': {'value': 1}, 'unique_dst_ports': {'value': 1},
+                'avg_bytes': {'value': 50.0}, 'max_bytes': {'value': 60.0},
+            }
+            return FakeResponse({'aggregations': {'by_bucket_ip': {
+                'buckets': [bucket], 'after_key': bucket['key']
+            }}})
+
+
+class FakeCompositeES(FakeBackfillES):
+    """n_keys 個 (time_bucket, IP) 組合，依 after_key 分頁"""
+
+    def __init__(self, n_keys):
+        super().__init__()
+        self.keys = [{'time_bucket': f'2026-10-01T08:{i // 10 * 3:02d}:00.000+08:00', 'ip': f'10.0.{i % 10}.1'}
+                     for i in range(n_keys)]
+        self.bulk_sizes = []
+
+    def request(self, method, url, json=None, data=None, headers=None, timeout=None, caller='default'):
+        if url.endswith('/_bulk'):
+            self.bulk_sizes.append(len(parse_ndjson(data.encode() if isinstance(data, str) else data)) // 2)
+            return super().request(method, url, json, data, headers, timeout, caller)
+
+        composite = json['aggs']['by_bucket_ip']['composite']
+        start = self.keys.index(composite['after']) + 1 if 'after' in composite else 0
+        page = self.keys[start:start + composite['size']]
+        values = {name: {'value': 1} for name in json['aggs']['by_bucket_ip']['aggs']}
+        result = {'buckets': [{'key': key, 'doc_count': 1, **values} for key in page]}
+        if page:
+            result['after_key'] = page[-1]
+        return FakeResponse({'aggregations': {'by_bucket_ip': result}})
+
+
+class TestCompositePaging(unittest.TestCase):
+    def test_pages_stream_into_bulk_writer(self):
+        fake = FakeCompositeES(25)
+        backfill = backfill_module.HistoricalDataBackfill('by_dst', page_size=10)
+        backfill.verbose = False
+        with patch.object(ESTransport, 'request', side_effect=fake.request):
+            backfill._process_time_range(datetime(2026, 10, 1), datetime(2026, 10, 1, 1))
+
+        # 每頁取回後立即寫入，不會在 10 個 IP 截斷
+        self.assertEqual(fake.bulk_sizes, [10, 10, 5])
+        self.assertEqual(len(fake.indexed), 25)
+        self.assertEqual((backfill.processed_docs, backfill.processed_buckets), (25, 3))
+        doc = fake.indexed[('netflow_stats_3m_by_dst', '2026-10-01T08:00:00.000+08:00_10.0.0.1')]
+        self.assertEqual((doc['dst_ip'], doc['unique_srcs']), ('10.0.0.1', 1))
+
+
+class TestParallelBackfill(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.checkpoint_path = os.path.join(self.tmp.name, 'state', 'backfill_checkpoint.json')
+        for module in (backfill_module, bulk_ingest_module):
+            patcher = patch.object(module.time, 'sleep')
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def run_backfill(self, fake, bulk_retries=3, **kwargs):
+        with patch.object(ESTransport, 'request', side_effect=fake.request):
+            job = ParallelBackfill(['by_src', 'by_dst'], max_workers=4,
+                                   checkpoint_path=self.checkpoint_path, **kwargs)
+            for backfill in job.backfills.values():
+                backfill.ingester.max_retries = bulk_retries
+            job.run(days=1, batch_hours=3, auto_confirm=True)
+        return job
+
+    def test_plan_windows_aligned(self):
+        windows = ParallelBackfill.plan_windows(datetime(2026, 10, 1, 4, 20), datetime(2026, 10, 1, 11, 5), 3)
+        self.assertEqual([(s.hour, e.hour, complete) for s, e, complete in windows],
+                         [(3, 6, True), (6, 9, True), (9, 11, False)])
+        self.assertEqual(windows[-1][1], datetime(2026, 10, 1, 11, 5))
+
+    def test_adaptive_concurrency(self):
+        concurrency = AdaptiveConcurrency(initial=2, max_limit=4, target_latency=10)
+        for _ in range(5):
+            concurrency.acquire()
+            concurrency.release(1.0)
+        self.assertEqual(concurrency.limit, 4)
+        concurrency.acquire()
+        concurrency.release(20.0)
+        self.assertEqual(concurrency.limit, 3)
+        concurrency.acquire()
+        concurrency.release(1.0, rejected=True)
+        self.assertEqual(concurrency.limit, 1)
+        self.assertEqual(concurrency.rejections, 1)
+
+    def test_runs_both_modes_and_resumes(self):
+        # 不在 bulk 層重試：被拒絕的窗口整個退避重試
+        fake = FakeBackfillES(reject_bulks=2)
+        job = self.run_backfill(fake, bulk_retries=0)
+
+        n_windows = len(ParallelBackfill.plan_windows(*self._range(), 3))
+        self.assertEqual(job.concurrency.rejections, 2)
+        self.assertFalse(any(b.errors for b in job.backfills.values()))
+        for mode in ('by_src', 'by_dst'):
+            dest_index = backfill_module.AGGREGATION_MODES[mode]['dest_index']
+            self.assertEqual(sum(index == dest_index for index, _ in fake.indexed), n_windows)
+
+        with open(self.checkpoint_path, encoding='utf-8') as f:
+            done = json.load(f)
+        # 最後一個窗口尚未結束，不記錄
+        self.assertEqual({mode: len(windows) for mode, windows in done.items()},
+                         {'by_src': n_windows - 1, 'by_dst': n_windows - 1})
+
+        # 重新執行只處理未完成的窗口
+        resumed = FakeBackfillES()
+        self.run_backfill(resumed)
+        self.assertEqual(len(resumed.searches), 2)
+
+        checkpoint = BackfillCheckpoint(self.checkpoint_path)
+        checkpoint.reset(['by_src'])
+        self.assertFalse(os.path.exists(self.checkpoint_path + '.tmp'))
+
+    def test_rejected_items_retried_in_place(self):
+        fake = FakeBackfillES(reject_bulks=2)
+        job = self.run_backfill(fake)
+
+        # bulk 層只重送被拒絕的文檔，窗口不需要重跑
+        self.assertEqual(job.concurrency.rejections, 0)
+        self.assertEqual(sum(b.ingester.get_stats()['retried'] for b in job.backfills.values()), 2)
+        n_windows = len(ParallelBackfill.plan_windows(*self._range(), 3))
+        self.assertEqual(len(fake.indexed), 2 * n_windows)
+
+    @staticmethod
+    def _range():
+        end = datetime.utcnow()
+        return end - backfill_module.timedelta(days=1), end
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+"""
+測試雙視角數據來源（記憶體快照 vs 直接查詢 ES）
+"""
+
+import os
+import random
+import tempfile
+import unittest
+from datetime import datetime, timedelta, timezone
+from unittest.mock import patch
+
+from nad.ml.perspective_source import ESPerspectiveSource, SnapshotPerspectiveSource
+from nad.utils.es_transport import ESTransport
+from test_batched_validation import FakeES
+
+
+def make_records(now, seed=3):
+    rng = random.Random(seed)
+    records = {'SRC': [], 'DST': []}
+    for i in range(40):
+        ip = f'10.1.0.{i}'
+        for minutes_ago in rng.sample(range(0, 30, 3), rng.randint(1, 6)):
+            bucket = (now - timedelta(minutes=minutes_ago)).replace(second=0, microsecond=0)
+            ports = {str(p): rng.randint(1, 9) for p in rng.sample([22, 53, 80, 443, 8080, 50000], 3)}
+            records['SRC'].append({
+                'src_ip': ip, 'time_bucket': bucket.strftime('%Y-%m-%dT%H:%M:%S.000Z'),
+                'flow_count': rng.randint(1, 500), 'total_bytes': rng.randint(100, 10 ** 6),
+                'unique_dsts': rng.randint(1, 80), 'unique_dst_ports': rng.randint(1, 200),
+                'top_src_ports': ports,
+            })
+            if i % 3:
+                records['DST'].append({
+                    'dst_ip': ip, 'time_bucket': bucket.strftime('%Y-%m-%dT%H:%M:%S.000Z'),
+                    'flow_count': rng.randint(1, 500), 'total_bytes': rng.randint(100, 10 ** 6),
+                    'unique_srcs': rng.randint(1, 80), 'unique_src_ports': rng.randint(1, 300),
+                    'top_dst_ports': ports,
+                })
+    return records
+
+
+class TestSnapshotPerspectiveSource(unittest.TestCase):
+    def setUp(self):
+        self.now = datetime.now(timezone.utc)
+        self.records = make_records(self.now)
+        self.fake = FakeES({
+            'netflow_stats_3m_by_src': self.records['SRC'],
+            'netflow_stats_3m_by_dst': self.records['DST'],
+        })
+        patcher = patch.object(ESTransport, 'request', side_effect=self.fake.request)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.es_source = ESPerspectiveSource()
+        self.snapshot = SnapshotPerspectiveSource(
+            self.records, as_of=self.now, window_start=self.now - timedelta(minutes=31),
+            fallback=self.es_source
+        )
+
+    def test_matches_es_source(self):
+        # 快照涵蓋全部數據，FakeES 忽略 time_bucket 範圍，兩者應完全相同
+        time_range = 'now-31m'
+        ips = [f'10.1.0.{i}' for i in range(45)]
+        for perspective in ('SRC', 'DST'):
+            for ip in ips:
+                self.assertEqual(self.snapshot.records(ip, perspective, time_range),
+                                 self.es_source.records(ip, perspective, time_range))
+                self.assertEqual(self.snapshot.view_stats(ip, perspective, time_range),
+                                 self.es_source.view_stats(ip, perspective, time_range))
+            self.assertEqual(self.snapshot.latest_records(ips, perspective, time_range),
+                             self.es_source.latest_records(ips, perspective, time_range))
+            self.assertEqual(self.snapshot.view_stats_many(ips, perspective, time_range),
+                             self.es_source.view_stats_many(ips, perspective, time_range))
+
+        self.assertEqual(
+            [r['unique_src_ports'] for r in self.snapshot.top_records('DST', 'unique_src_ports', 100, time_range)],
+            [r['unique_src_ports'] for r in self.es_source.top_records('DST', 'unique_src_ports', 100, time_range)]
+        )
+
+    def test_time_range_filter_uses_snapshot(self):
+        calls = self.fake.calls
+        for record in self.snapshot.records('10.1.0.1', 'SRC', 'now-10m'):
+            bucket = datetime.fromisoformat(record['time_bucket'].replace('Z', '+00:00'))
+            self.assertGreaterEqual(bucket, self.now - timedelta(minutes=10))
+        recent = [r for r in self.records['DST']
+                  if datetime.fromisoformat(r['time_bucket'].replace('Z', '+00:00'))
+                  >= self.now - timedelta(minutes=10)]
+        expected = sorted(r['unique_src_ports'] for r in recent if r['unique_src_ports'] >= 100)
+        top = self.snapshot.top_records('DST', 'unique_src_ports', 100, 'now-10m', size=1000)
+        self.assertEqual(sorted(r['unique_src_ports'] for r in top), expected)
+        self.assertEqual(self.fake.calls, calls)
+
+    def test_falls_back_outside_window(self):
+        calls = self.fake.calls
+        self.snapshot.view_stats('10.1.0.1', 'SRC', 'now-2h')
+        self.assertEqual(self.fake.calls, calls + 1)
+
+    def test_save_and_load(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'snapshot.json.gz')
+            self.snapshot.save(path)
+            loaded = SnapshotPerspectiveSource.load(path)
+
+        self.assertEqual(loaded.size(), self.snapshot.size())
+        self.assertIsNone(loaded.fallback)
+        for perspective in ('SRC', 'DST'):
+            for ip in ('10.1.0.1', '10.1.0.2', '10.9.9.9'):
+                self.assertEqual(loaded.view_stats(ip, perspective, 'now-10m'),
+                                 self.snapshot.view_stats(ip, perspective, 'now-10m'))
+        # 沒有 fallback 時，超出窗口的查詢只以快照回答
+        self.assertEqual(len(loaded.records('10.1.0.1', 'SRC', 'now-2h')),
+                         sum(r['src_ip'] == '10.1.0.1' for r in self.records['SRC']))
+
+
+if __name__ == '__main__':
+    unittest.main()
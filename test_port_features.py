@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+"""
+測試批量端口特徵引擎與逐筆路徑結果一致
+"""
+
+import unittest
+import numpy as np
+from nad.ml.feature_engineer import FeatureEngineer
+from nad.ml.feature_engineer_dst import FeatureEngineerDst
+from nad.ml.port_features import PortBatch
+
+
+def make_port_map(rng):
+    """產生隨機 top ports（含空值、連續端口、高風險端口、服務端口）"""
+    kind = rng.integers(0, 6)
+    if kind == 0:
+        return {}
+    if kind == 1:
+        start = int(rng.integers(1, 2000))
+        return {str(start + k): int(rng.integers(1, 50)) for k in range(int(rng.integers(2, 6)))}
+    pool = [21, 22, 23, 53, 80, 135, 443, 445, 1433, 3306, 3389, 5900, 8080,
+            25, 993, 6379, 27017, 49152, 50000, 60000, 32768]
+    n_ports = int(rng.integers(1, 10))
+    ports = list(rng.choice(pool, size=min(n_ports, len(pool)), replace=False))
+    ports += [int(p) for p in rng.integers(1024, 65536, size=int(rng.integers(0, 4)))]
+    return {str(p): int(rng.integers(0, 500)) for p in ports}
+
+
+def make_records(n, seed=0):
+    rng = np.random.default_rng(seed)
+    records = []
+    for _ in range(n):
+        record = {
+            'src_ip': '192.168.10.160',
+            'dst_ip': '192.168.20.50',
+            'time_bucket': '2025-11-17T10:03:00.000Z',
+            'flow_count': int(rng.integers(0, 3000)),
+            'total_bytes': int(rng.integers(0, 10**9)),
+            'total_packets': int(rng.integers(0, 10**5)),
+            'unique_dsts': int(rng.integers(0, 100)),
+            'unique_srcs': int(rng.integers(0, 100)),
+            'unique_src_ports': int(rng.integers(0, 500)),
+            'unique_dst_ports': int(rng.integers(0, 500)),
+            'avg_bytes': float(rng.uniform(0, 50000)),
+            'max_bytes': int(rng.integers(0, 10**7)),
+            'top_src_ports': make_port_map(rng),
+            'top_dst_ports': make_port_map(rng),
+        }
+        records.append(record)
+    # 確保至少一筆符合 Web Server 判斷條件
+    records[0]['top_src_ports'] = {'443': 10}
+    records[0]['top_dst_ports'] = {'50000': 5, '50001': 5}
+    return records
+
+
+class TestPortBatch(unittest.TestCase):
+    def test_csr_layout(self):
+        batch = PortBatch.from_maps([{'80': 3, '443': 1}, {}, None, {'53': 7}])
+        np.testing.assert_array_equal(batch.offsets, [0, 2, 2, 2, 3])
+        np.testing.assert_array_equal(batch.ports, [80, 443, 53])
+        np.testing.assert_array_equal(batch.top_port(), [80, -1, -1, 53])
+        np.testing.assert_array_equal(batch.max_count(), [3, 0, 0, 7])
+
+    def test_sequential_ports_do_not_cross_records(self):
+        batch = PortBatch.from_maps([{'100': 1, '101': 1}, {'102': 1}, {'7': 1, '8': 1, '9': 1}])
+        np.testing.assert_array_equal(batch.has_sequential(), [False, False, True])
+
+
+class TestBatchPortFeatures(unittest.TestCase):
+    def assert_columns_match(self, columns, expected_dicts):
+        for name, values in columns.items():
+            expected = np.array([d[name] for d in expected_dicts], dtype=np.float64)
+            np.testing.assert_array_equal(values, expected, err_msg=name)
+
+    def test_src_engineer_matches_per_record(self):
+        engineer = FeatureEngineer()
+        records = make_records(400)
+        expected = [engineer._extract_port_features(r) for r in records]
+        columns = engineer.extract_port_features_batch(records)
+        self.assertEqual(set(columns), set(expected[0]))
+        self.assert_columns_match(columns, expected)
+
+    def test_dst_engineer_matches_per_record(self):
+        engineer = FeatureEngineerDst()
+        records = make_records(400, seed=3)
+        expected = [engineer._extract_port_features(r) for r in records]
+        columns = engineer.extract_port_features_batch(records)
+        self.assertEqual(set(columns), set(expected[0]))
+        self.assert_columns_match(columns, expected)
+
+    def test_classification_features_batch(self):
+        engineer = FeatureEngineer()
+        records = make_records(100, seed=5)
+        batch = engineer.extract_classification_features_batch(records)
+        for record, features in zip(records, batch):
+            expected = engineer.extract_classification_features(record)
+            self.assertEqual(set(features), set(expected))
+            for name, value in expected.items():
+                self.assertEqual(features[name], value, msg=name)
+                self.assertEqual(isinstance(features[name], int), isinstance(value, int), msg=name)
+
+    def test_dst_classification_features_batch(self):
+        engineer = FeatureEngineerDst()
+        records = make_records(100, seed=7)
+        batch = engineer.extract_classification_features_batch(records)
+        for record, features in zip(records, batch):
+            expected = engineer.extract_classification_features(record)
+            self.assertEqual(set(features), set(expected))
+            for name, value in expected.items():
+                self.assertAlmostEqual(features[name], value, msg=name)
+                self.assertEqual(isinstance(features[name], int), isinstance(value, int), msg=name)
+
+
+if __name__ == '__main__':
+    unittest.main()
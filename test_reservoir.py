@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+"""
+測試串流訓練用的蓄水池抽樣
+"""
+
+import unittest
+from unittest.mock import MagicMock, patch
+import numpy as np
+from sklearn.preprocessing import StandardScaler
+from nad.ml.reservoir import ReservoirSampler, StratifiedReservoirSampler
+import train_isolation_forest
+import train_isolation_forest_by_dst
+
+
+def pages(X, page_size):
+    for start in range(0, len(X), page_size):
+        yield X[start:start + page_size]
+
+
+class TestReservoirSampler(unittest.TestCase):
+    def test_capacity_and_membership(self):
+        X = np.arange(20000, dtype=np.float64).reshape(-1, 2)
+        sampler = ReservoirSampler(500, random_state=0)
+        for page in pages(X, 777):
+            sampler.add(page)
+
+        sample = sampler.sample()
+        self.assertEqual(sample.shape, (500, 2))
+        self.assertEqual(sampler.n_seen, 10000)
+        # 每列必須是原始數據中的完整列
+        np.testing.assert_array_equal(sample[:, 1] - sample[:, 0], np.ones(500))
+        self.assertEqual(len(np.unique(sample[:, 0])), 500)
+
+    def test_sample_is_uniform(self):
+        X = np.arange(100000, dtype=np.float64).reshape(-1, 1)
+        sampler = ReservoirSampler(5000, random_state=1)
+        for page in pages(X, 10000):
+            sampler.add(page)
+        # 均勻抽樣的平均值應接近母體平均值
+        self.assertAlmostEqual(sampler.sample().mean() / X.mean(), 1.0, delta=0.03)
+
+    def test_small_stream_keeps_everything(self):
+        sampler = ReservoirSampler(100, random_state=0)
+        sampler.add(np.ones((30, 3)))
+        self.assertEqual(sampler.sample().shape, (30, 3))
+
+
+class TestStratifiedReservoirSampler(unittest.TestCase):
+    def test_rare_stratum_is_kept(self):
+        rng = np.random.default_rng(0)
+        X = rng.normal(size=(50000, 2))
+        strata = np.where(rng.random(50000) < 0.01, 3, 0)
+
+        sampler = StratifiedReservoirSampler(2000, min_per_stratum=300, random_state=0)
+        for start in range(0, 50000, 5000):
+            sampler.add(X[start:start + 5000], strata[start:start + 5000])
+
+        sample = sampler.sample()
+        n_rare = int(np.sum(strata == 3))
+        # 多數分層依比例分配，稀有分層至少保留 min_per_stratum 筆（或全部）
+        expected = round(2000 * (50000 - n_rare) / 50000) + min(300, n_rare)
+        self.assertEqual(len(sample), expected)
+        self.assertEqual(sampler.strata_counts()[3], n_rare)
+
+
+class TestStreamingScaler(unittest.TestCase):
+    def test_partial_fit_matches_full_fit(self):
+        X = np.random.default_rng(2).normal(5, 3, size=(30000, 4))
+        streaming = StandardScaler()
+        for page in pages(X, 4096):
+            streaming.partial_fit(page)
+        full = StandardScaler().fit(X)
+        np.testing.assert_allclose(streaming.mean_, full.mean_)
+        np.testing.assert_allclose(streaming.scale_, full.scale_)
+
+
+
+class TestTrainingScripts(unittest.TestCase):
+    """--streaming 由訓練腳本轉給 train_streaming"""
+
+    def run_main(self, module, detector_name, argv):
+        detector = MagicMock()
+        with patch.object(module, detector_name, return_value=detector), \
+                patch.object(module.sys, 'argv', [module.__file__] + argv), \
+                patch('builtins.print'):
+            if hasattr(module, 'load_config'):
+                with patch.object(module, 'load_config'):
+                    module.main()
+            else:
+                module.main()
+        return detector
+
+    def test_src_streaming(self):
+        detector = self.run_main(train_isolation_forest, 'OptimizedIsolationForest',
+                                 ['--days', '90', '--streaming', '--sample-size', '5000'])
+        detector.train_streaming.assert_called_once_with(
+            days=90, sample_size=5000, stratify_by_device=False, exclude_servers=False)
+        detector.train_on_aggregated_data.assert_not_called()
+
+    def test_dst_streaming(self):
+        detector = self.run_main(train_isolation_forest_by_dst, 'IsolationForestByDst',
+                                 ['--days', '30', '--streaming', '--stratify-by-device'])
+        detector.train_streaming.assert_called_once_with(days=30, sample_size=None, stratify_by_device=True)
+
+    def test_default_is_in_memory(self):
+        detector = self.run_main(train_isolation_forest_by_dst, 'IsolationForestByDst', ['--days', '7'])
+        detector.train_on_aggregated_data.assert_called_once_with(days=7)
+        detector.train_streaming.assert_not_called()
+
+
+if __name__ == '__main__':
+    unittest.main()
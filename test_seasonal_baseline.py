@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+"""
+測試週期性（星期幾 × 小時）基準線
+"""
+
+import random
+import unittest
+from datetime import datetime, timedelta, timezone
+from unittest.mock import patch
+
+import numpy as np
+
+from nad.ml.baseline_manager import BaselineManager
+from nad.utils.es_transport import ESTransport
+from test_batched_validation import FakeES
+
+LOCAL = timezone(timedelta(hours=8))
+
+
+def busy(dt_utc):
+    local = dt_utc.astimezone(LOCAL)
+    return local.weekday() < 5 and 9 <= local.hour < 18
+
+
+def make_history(ip='10.5.0.1', days=14, seed=9):
+    """上班時間繁忙、夜間與週末清閒的伺服器"""
+    rng = random.Random(seed)
+    start = datetime(2026, 10, 5, tzinfo=timezone.utc)
+    records = []
+    for i in range(days * 480):
+        dt = start + timedelta(minutes=3 * i)
+        flow_count = rng.randint(900, 1100) if busy(dt) else rng.randint(10, 30)
+        records.append({
+            'src_ip': ip, 'time_bucket': dt.strftime('%Y-%m-%dT%H:%M:%S.000Z'),
+            'flow_count': flow_count, 'unique_dsts': rng.randint(1, 5),
+            'unique_dst_ports': rng.randint(1, 4), 'avg_bytes': rng.randint(400, 600),
+            'total_bytes': flow_count * 500, 'unique_src_ports': rng.randint(1, 50),
+        })
+    return records
+
+
+class TestSeasonalBaseline(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.history = make_history()
+        fake = FakeES({BaselineManager.HISTORY_INDEX: cls.history})
+        with patch.object(ESTransport, 'request', side_effect=fake.request):
+            cls.manager = BaselineManager(learning_days=14)
+            cls.manager.build_all_baselines()
+            cls.updated = cls.manager.build_seasonal_baselines(page_size=100)
+
+    def test_hour_of_week(self):
+        manager = BaselineManager()
+        # 2026-10-19 為星期一；UTC 01:00 為本地 09:00
+        self.assertEqual(manager.hour_of_week('2026-10-19T01:00:00.000Z'), 9)
+        self.assertEqual(manager.hour_of_week('2026-10-18T16:30:00Z'), 0)
+        self.assertEqual(manager.hour_of_week(datetime(2026, 10, 25, 15, 59, tzinfo=timezone.utc)), 167)
+
+        rng = np.random.default_rng(3)
+        epoch_ms = rng.integers(0, 2 * 10 ** 12, 500)
+        expected = [manager.hour_of_week(int(ms)) for ms in epoch_ms]
+        np.testing.assert_array_equal(manager._hour_of_week_array(epoch_ms), expected)
+
+    def test_slot_stats_match_reference(self):
+        self.assertEqual(self.updated, 1)
+        baseline = self.manager.get_baseline('10.5.0.1')
+
+        by_slot = {}
+        for record in self.history:
+            slot = self.manager.hour_of_week(record['time_bucket'])
+            by_slot.setdefault(slot, []).append(record)
+        self.assertEqual(len(by_slot), 168)
+
+        for slot, records in by_slot.items():
+            stats = self.manager._seasonal_slot_stats(baseline, slot)
+            for metric_name in BaselineManager.SEASONAL_METRICS:
+                values = np.array([r[metric_name] for r in records], dtype=float)
+                expected = {'mean': values.mean(), 'std': values.std(), 'max': values.max()}
+                for stat, value in expected.items():
+                    self.assertAlmostEqual(stats[metric_name][stat], value, delta=1e-3 * max(value, 1))
+                # 各週每小時分位數的加權平均：介於中位數與最大值之間，連續值的指標與整個時段的分位數相近
+                for stat, q in (('p95', 95), ('p99', 99)):
+                    value = np.percentile(values, q)
+                    self.assertLessEqual(np.percentile(values, 50), stats[metric_name][stat] + 1e-3)
+                    self.assertLessEqual(stats[metric_name][stat], values.max() + 1e-3)
+                    if metric_name in ('flow_count', 'avg_bytes'):
+                        self.assertAlmostEqual(stats[metric_name][stat], value, delta=0.1 * value)
+
+    def test_check_deviation_uses_matching_slot(self):
+        monday_9am = '2026-10-19T01:00:00.000Z'
+        monday_3am = '2026-10-18T19:00:00.000Z'
+
+        night = self.manager.check_deviation('10.5.0.1', {'flow_count': 400, 'time_bucket': monday_3am})
+        self.assertTrue(night['has_deviation'])
+        self.assertIn('flow_count', night['deviations'])
+        self.assertEqual(night['seasonal_slot'], 3)
+        # 分位數門檻也使用夜間時段的統計
+        self.assertLess(night['deviations']['flow_count']['baseline_p95'], 40)
+        self.assertLess(night['deviations']['flow_count']['baseline_p99'], 40)
+
+        day = self.manager.check_deviation('10.5.0.1', {'flow_count': 1050, 'time_bucket': monday_9am})
+        self.assertNotIn('flow_count', day['deviations'])
+
+        # 沒有週期性統計時，夜間的 400 不會偏離整體基準線
+        flat = dict(self.manager.get_baseline('10.5.0.1'))
+        flat.pop('seasonal')
+        manager = BaselineManager()
+        manager.baselines['10.5.0.1'] = flat
+        result = manager.check_deviation('10.5.0.1', {'flow_count': 400, 'time_bucket': monday_3am})
+        self.assertNotIn('flow_count', result['deviations'])
+        self.assertIsNone(result['seasonal_slot'])
+
+    def test_streaming_update_keeps_seasonal(self):
+        manager = BaselineManager(incremental=True)
+        manager.baselines['10.5.0.1'] = self.manager.get_baseline('10.5.0.1')
+        manager.update_baselines(self.history[-50:])
+
+        baseline = manager.get_baseline('10.5.0.1')
+        self.assertTrue(baseline['streaming'])
+        self.assertEqual(baseline['seasonal'], self.manager.get_baseline('10.5.0.1')['seasonal'])
+        night = manager.check_deviation('10.5.0.1', {'flow_count': 400, 'time_bucket': '2026-10-18T19:00:00.000Z'})
+        self.assertEqual(night['seasonal_slot'], 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
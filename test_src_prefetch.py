@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+"""
+測試 DST 異常的 SRC 視角批次預取（一次 _msearch 填入快取，classify_dst 不再逐筆查詢）
+"""
+
+import json
+import unittest
+from unittest import mock
+
+from nad.ml.anomaly_classifier import AnomalyClassifier
+
+
+SCAN_FEATURES = {
+    'unique_srcs': 3, 'unique_dst_ports': 200, 'flow_count': 300,
+    'avg_bytes': 100, 'flows_per_src': 100, 'total_bytes': 30000
+}
+
+SERVER_SRC = {'src_ip': '10.0.0.1', 'top_dst_ports': {'161': 500}}
+
+
+def msearch_response(lines, sources):
+    """依查詢的 src_ip 從 sources 回傳對應的 hits"""
+    responses = []
+    for query in lines[1::2]:
+        ip = query['query']['bool']['must'][0]['term']['src_ip']
+        hits = [{'_source': sources[ip]}] if ip in sources else []
+        responses.append({'hits': {'hits': hits}})
+    response = mock.Mock(status_code=200)
+    response.json.return_value = {'responses': responses}
+    return response
+
+
+class TestSrcPrefetch(unittest.TestCase):
+    def setUp(self):
+        self.classifier = AnomalyClassifier()
+
+    def _post(self, sources):
+        calls = []
+
+        def post(url, data=None, headers=None, timeout=None, caller=None):
+            calls.append(url)
+            lines = [json.loads(line) for line in data.strip().split(b'\n')]
+            return msearch_response(lines, sources)
+
+        return calls, post
+
+    def test_single_msearch_fills_cache(self):
+        anomalies = [
+            {'dst_ip': '10.0.0.1', 'time_bucket': '2025-11-20T10:03:00Z', 'features': SCAN_FEATURES},
+            {'dst_ip': '10.0.0.2', 'time_bucket': '2025-11-20T10:03:00Z', 'features': SCAN_FEATURES},
+            # 同一快取 key（10 分鐘內）只查一次
+            {'dst_ip': '10.0.0.2', 'time_bucket': '2025-11-20T10:06:00Z', 'features': SCAN_FEATURES},
+            # 不會觸發跨視角查詢
+            {'dst_ip': '10.0.0.3', 'time_bucket': '2025-11-20T10:03:00Z',
+             'features': dict(SCAN_FEATURES, unique_dst_ports=5)},
+        ]
+        calls, post = self._post({'10.0.0.1': SERVER_SRC})
+
+        with mock.patch('nad.utils.es_transport.ESTransport.post', side_effect=post):
+            filled = self.classifier.prefetch_src_perspective(anomalies)
+
+            self.assertEqual(filled, 2)
+            self.assertEqual(len(calls), 1)
+            self.assertTrue(calls[0].endswith('/_msearch'))
+
+            self.assertEqual(
+                self.classifier._check_src_cache('10.0.0.1', '2025-11-20T10:03:00Z')['result'],
+                'SERVER_RESPONSE')
+            self.assertEqual(
+                self.classifier._check_src_cache('10.0.0.2', '2025-11-20T10:03:00Z')['result'],
+                'NO_DATA')
+
+            # 分類時直接命中快取，不再發出查詢
+            result = self.classifier.classify_dst(
+                SCAN_FEATURES, {'dst_ip': '10.0.0.1', 'time_bucket': '2025-11-20T10:03:00Z'})
+            self.assertEqual(result['class'], 'SERVER_RESPONSE_TRAFFIC')
+            self.classifier.classify_dst(
+                SCAN_FEATURES, {'dst_ip': '10.0.0.2', 'time_bucket': '2025-11-20T10:06:00Z'})
+            self.assertEqual(len(calls), 1)
+
+    def test_prefetch_matches_per_anomaly_lookup(self):
+        context = {'dst_ip': '10.0.0.1', 'time_bucket': '2025-11-20T10:03:00Z'}
+        _, post = self._post({'10.0.0.1': SERVER_SRC})
+
+        def single_post(url, **kwargs):
+            response = mock.Mock(status_code=200)
+            response.json.return_value = {'hits': {'hits': [{'_source': SERVER_SRC}]}}
+            return response
+
+        with mock.patch('nad.utils.es_transport.ESTransport.post', side_effect=single_post):
+            expected = self.classifier.classify_dst(SCAN_FEATURES, dict(context))
+
+        self.classifier.clear_cache()
+        with mock.patch('nad.utils.es_transport.ESTransport.post', side_effect=post):
+            self.classifier.prefetch_src_perspective([dict(context, features=SCAN_FEATURES)])
+            actual = self.classifier.classify_dst(SCAN_FEATURES, dict(context))
+
+        self.assertEqual(actual['class'], expected['class'])
+        self.assertEqual(actual['confidence'], expected['confidence'])
+
+    def test_failure_leaves_cache_empty(self):
+        with mock.patch('nad.utils.es_transport.ESTransport.post', side_effect=ConnectionError):
+            filled = self.classifier.prefetch_src_perspective([
+                {'dst_ip': '10.0.0.1', 'time_bucket': '2025-11-20T10:03:00Z', 'features': SCAN_FEATURES}
+            ])
+        self.assertEqual(filled, 0)
+        self.assertEqual(self.classifier.get_cache_stats()['cache_size'], 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,190 @@
+#!/usr/bin/env python3
+"""
+測試增量基準線（Welford / EWMA / 分位數草圖）
+"""
+
+import os
+import random
+import tempfile
+import unittest
+from datetime import datetime, timedelta, timezone
+from types import SimpleNamespace
+from unittest.mock import patch
+
+import numpy as np
+
+import realtime_detection_dual
+from nad.ml.baseline_manager import BaselineManager
+from nad.ml.perspective_source import SnapshotPerspectiveSource
+from nad.ml.streaming_stats import QuantileSketch, RunningMetric
+from nad.utils.es_transport import ESTransport
+
+
+def make_records(ip, n, seed):
+    rng = random.Random(seed)
+    return [{
+        'src_ip': ip, 'time_bucket': f'2026-10-{1 + i // 480:02d}T{i % 480 // 20:02d}:{i % 20 * 3:02d}:00.000Z',
+        'unique_dst_ports': rng.choice([0, rng.randint(1, 30)]), 'unique_dsts': rng.randint(1, 30),
+        'flow_count': int(rng.lognormvariate(3, 1)) + 1, 'avg_bytes': rng.randint(40, 5000),
+        'total_bytes': rng.randint(100, 10 ** 6), 'unique_src_ports': rng.randint(1, 200),
+    } for i in range(n)]
+
+
+class TestStreamingStats(unittest.TestCase):
+    def test_running_metric_matches_numpy(self):
+        rng = np.random.default_rng(1)
+        values = rng.lognormal(4, 1.5, 5000)
+        metric = RunningMetric()
+        for value in values:
+            metric.update(value)
+
+        stats = metric.to_stats()
+        self.assertAlmostEqual(stats['mean'], values.mean(), places=6)
+        self.assertAlmostEqual(stats['std'] / values.std(), 1.0, places=9)
+        self.assertEqual(stats['min'], values.min())
+        self.assertEqual(stats['max'], values.max())
+        for name, q in (('p50', 50), ('p95', 95), ('p99', 99)):
+            expected = np.percentile(values, q, method='lower')
+            self.assertLessEqual(abs(stats[name] - expected) / expected, 0.02, name)
+
+    def test_merge_equals_single_pass(self):
+        rng = np.random.default_rng(2)
+        values = rng.integers(1, 10 ** 6, 3000)
+        whole, left, right = RunningMetric(), RunningMetric(), RunningMetric()
+        for i, value in enumerate(values):
+            whole.update(value)
+            (left if i % 3 else right).update(value)
+        left.merge(right)
+
+        self.assertEqual(left.count, whole.count)
+        self.assertAlmostEqual(left.mean, whole.mean, places=6)
+        self.assertAlmostEqual(left.std / whole.std, 1.0, places=9)
+        self.assertEqual(left.sketch.bins, whole.sketch.bins)
+        restored = RunningMetric.from_dict(left.to_dict())
+        self.assertEqual(restored.to_stats(), left.to_stats())
+
+    def test_sketch_memory_is_bounded(self):
+        sketch = QuantileSketch(max_bins=64)
+        for exponent in np.linspace(-3, 12, 20000):
+            sketch.add(10 ** exponent)
+        self.assertLessEqual(len(sketch.bins), 64)
+        p99, = sketch.quantiles([0.99])
+        self.assertLessEqual(abs(p99 - 10 ** (-3 + 15 * 0.99)) / 10 ** (-3 + 15 * 0.99), 0.05)
+
+
+class TestIncrementalBaselines(unittest.TestCase):
+    def setUp(self):
+        # 增量模式不應查詢 ES
+        patcher = patch.object(ESTransport, 'request', side_effect=AssertionError('unexpected ES query'))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_updates_match_batch_baseline(self):
+        records = make_records('10.3.0.1', 300, seed=4)
+        manager = BaselineManager(incremental=True)
+        # 重疊的偵測窗口：每個週期 10 筆，與上一週期重疊 5 筆
+        for start in range(0, 300, 5):
+            manager.update_baselines(records[start:start + 10])
+
+        expected = BaselineManager()._build_baseline('10.3.0.1', records)
+        baseline = manager.get_baseline('10.3.0.1')
+        self.assertEqual(baseline['sample_count'], expected['sample_count'])
+        for metric_name in BaselineManager.BASELINE_METRICS:
+            for stat in ('mean', 'std', 'min', 'max'):
+                self.assertAlmostEqual(baseline[metric_name][stat], expected[metric_name][stat], places=6)
+
+        deviation = manager.check_deviation('10.3.0.1', {'flow_count': 10 ** 6, 'unique_dst_ports': 1})
+        self.assertTrue(deviation['has_deviation'])
+        self.assertIn('flow_count', deviation['deviations'])
+
+    def test_min_samples_and_exclude(self):
+        manager = BaselineManager(incremental=True)
+        manager.update_baselines(make_records('10.3.0.2', 5, seed=5) + make_records('10.3.0.3', 50, seed=6),
+                                 exclude={'10.3.0.3'})
+        self.assertIn('10.3.0.2', manager.streaming)
+        self.assertIsNone(manager.get_baseline('10.3.0.2'))
+        self.assertNotIn('10.3.0.3', manager.streaming)
+
+    def test_state_round_trip(self):
+        records = make_records('10.3.0.4', 40, seed=7)
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'state', 'baseline_streaming.db')
+            manager = BaselineManager(incremental=True, streaming_db_path=path)
+            manager.update_baselines(records[:30])
+            manager.streaming.close()
+            restored = BaselineManager(incremental=True, streaming_db_path=path)
+            self.assertEqual(len(restored.streaming), 1)
+
+            manager = BaselineManager(incremental=True)
+            manager.update_baselines(records[:30])
+            manager.update_baselines(records)
+            restored.update_baselines(records)
+            for metric_name in BaselineManager.BASELINE_METRICS:
+                self.assertEqual(restored.get_baseline('10.3.0.4')[metric_name],
+                                 manager.get_baseline('10.3.0.4')[metric_name])
+
+    def test_writes_only_touched_ips(self):
+        manager = BaselineManager(incremental=True)
+        manager.update_baselines([r for i in range(20) for r in make_records(f'10.4.0.{i}', 12, seed=i)])
+        writes = manager.streaming.metrics['writes']
+
+        manager.update_baselines(make_records('10.4.0.3', 15, seed=3)[12:])
+        self.assertEqual(manager.streaming.metrics['writes'] - writes, 1)
+        self.assertEqual(manager.streaming['10.4.0.3']['sample_count'], 15)
+
+
+class TestStreamingIngestWindow(unittest.TestCase):
+    """實時偵測只以已穩定的 bucket 更新增量基準線"""
+
+    def setUp(self):
+        patcher = patch.object(ESTransport, 'request', side_effect=AssertionError('unexpected ES query'))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.manager = BaselineManager(incremental=True)
+        self.detector = realtime_detection_dual.DualModelAnomalyDetector.__new__(
+            realtime_detection_dual.DualModelAnomalyDetector)
+        self.detector.post_processor = SimpleNamespace(baseline_manager=self.manager)
+        self.detector.bucket_minutes = 3
+        self.detector.transform_delay_seconds = 90
+
+    @staticmethod
+    def bucket(i):
+        return datetime(2026, 10, 1, 10, tzinfo=timezone.utc) + timedelta(minutes=3 * i)
+
+    def record(self, i, flow_count):
+        return {'src_ip': '10.6.0.1', 'time_bucket': self.bucket(i).strftime('%Y-%m-%dT%H:%M:%S.000Z'),
+                'flow_count': flow_count, 'unique_dsts': 2, 'unique_dst_ports': 2, 'avg_bytes': 500,
+                'total_bytes': flow_count * 500, 'unique_src_ports': 3}
+
+    def run_cycle(self, records, settled=None, windows=None):
+        self.detector.perspective_snapshot = SnapshotPerspectiveSource(
+            {'SRC': records, 'DST': []}, as_of=self.bucket(len(records)), window_start=self.bucket(0))
+        with patch.object(realtime_detection_dual, 'latest_settled_bucket', return_value=settled):
+            self.detector._update_streaming_baselines(60, windows)
+
+    def test_partial_bucket_replaced_by_complete(self):
+        complete = [self.record(i, 50) for i in range(12)]
+        # 第 12 個 bucket 仍在聚合中（只有 1 筆 flow），尚未穩定
+        self.run_cycle(complete + [self.record(12, 1)], settled=self.bucket(11))
+        self.assertEqual(self.manager.streaming['10.6.0.1']['sample_count'], 12)
+
+        self.run_cycle(complete + [self.record(12, 100)], settled=self.bucket(12))
+        baseline = self.manager.get_baseline('10.6.0.1')
+        self.assertEqual(baseline['sample_count'], 13)
+        self.assertEqual(baseline['flow_count']['min'], 50)
+        self.assertEqual(baseline['flow_count']['max'], 100)
+
+    def test_uses_watermark_window(self):
+        records = [self.record(i, 50) for i in range(14)]
+        self.run_cycle(records, windows={'SRC': (self.bucket(1), self.bucket(11))})
+        state = self.manager.streaming['10.6.0.1']
+        self.assertEqual(state['sample_count'], 10)
+        self.assertEqual(state['first_bucket'], records[2]['time_bucket'])
+        self.assertEqual(state['last_bucket'], records[11]['time_bucket'])
+
+        self.run_cycle(records, windows={'SRC': None})
+        self.assertEqual(self.manager.streaming['10.6.0.1']['sample_count'], 10)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+"""
+測試增量偵測水位（已穩定 bucket 計算、持久化、只前進）
+"""
+
+import os
+import tempfile
+import unittest
+from datetime import datetime, timezone
+from unittest.mock import patch
+
+import realtime_detection_dual
+from nad.utils.watermark import WatermarkStore, floor_to_bucket, latest_settled_bucket
+
+
+def utc(hour, minute, second=0):
+    return datetime(2025, 11, 20, hour, minute, second, tzinfo=timezone.utc)
+
+
+class TestSettledBucket(unittest.TestCase):
+    def test_floor_to_bucket(self):
+        self.assertEqual(floor_to_bucket(utc(10, 5, 59)), utc(10, 3))
+        self.assertEqual(floor_to_bucket(utc(10, 6)), utc(10, 6))
+
+    def test_transform_delay(self):
+        # bucket [10:03, 10:06) 在 10:07:30 才穩定
+        self.assertEqual(latest_settled_bucket(utc(10, 7, 29)), utc(10, 0))
+        self.assertEqual(latest_settled_bucket(utc(10, 7, 30)), utc(10, 3))
+
+
+class TestWatermarkStore(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp.name, 'state', 'watermarks.json')
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_first_window_uses_lookback(self):
+        store = WatermarkStore(self.path, initial_lookback_minutes=9)
+        self.assertEqual(store.next_window('SRC', now=utc(10, 20)), (utc(10, 6), utc(10, 15)))
+
+    def test_consecutive_windows_do_not_overlap(self):
+        store = WatermarkStore(self.path)
+        start, end = store.next_window('SRC', now=utc(10, 20))
+        store.advance('SRC', end)
+
+        # 同一個 bucket 尚未有新資料穩定 → 沒有可處理範圍
+        self.assertIsNone(store.next_window('SRC', now=utc(10, 21)))
+        self.assertEqual(store.next_window('SRC', now=utc(10, 25)), (end, utc(10, 18)))
+
+    def test_survives_restart_and_only_moves_forward(self):
+        store = WatermarkStore(self.path)
+        store.advance('DST', utc(10, 12))
+        store.advance('DST', utc(10, 9))
+
+        restarted = WatermarkStore(self.path)
+        self.assertEqual(restarted.get('DST'), utc(10, 12))
+        self.assertIsNone(restarted.get('SRC'))
+
+
+class TestIncrementalCycle(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.store = WatermarkStore(os.path.join(self.tmp.name, 'watermarks.json'))
+        self.store.advance('SRC', utc(10, 0))
+        self.detector = realtime_detection_dual.DualModelAnomalyDetector.__new__(
+            realtime_detection_dual.DualModelAnomalyDetector)
+        self.detector.enable_dst_model = False
+
+    def run_cycle(self, logged_all):
+        with patch.object(self.detector, 'run_detection_cycle', return_value={'logged_all': logged_all}), \
+                patch.object(self.store, 'next_window', return_value=(utc(10, 0), utc(10, 9))):
+            self.detector.run_incremental_cycle(self.store)
+
+    def test_advances_after_all_logged(self):
+        self.run_cycle(logged_all=True)
+        self.assertEqual(self.store.get('SRC'), utc(10, 9))
+
+    def test_keeps_watermark_when_logging_incomplete(self):
+        self.run_cycle(logged_all=False)
+        self.assertEqual(self.store.get('SRC'), utc(10, 0))
+
+
+if __name__ == '__main__':
+    unittest.main()
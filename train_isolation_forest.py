@@ -43,6 +43,22 @@ def main():
         action='store_true',
         help='訓練時排除可能的服務器回應流量（is_likely_server_response=1）'
     )
+    parser.add_argument(
+        '--streaming',
+        action='store_true',
+        help='串流訓練：逐頁讀取並以蓄水池抽樣，記憶體上限與天數無關（適合 30 / 90 天）'
+    )
+    parser.add_argument(
+        '--sample-size',
+        type=int,
+        default=None,
+        help='串流訓練的蓄水池容量（默認: training.reservoir_size 或 200000）'
+    )
+    parser.add_argument(
+        '--stratify-by-device',
+        action='store_true',
+        help='串流訓練時依 device_type 分層抽樣'
+    )
 
     args = parser.parse_args()
 
@@ -62,10 +78,18 @@ def main():
     try:
         start_time = datetime.now()
 
-        detector.train_on_aggregated_data(
-            days=args.days,
-            exclude_servers=args.exclude_servers
-        )
+        if args.streaming:
+            detector.train_streaming(
+                days=args.days,
+                sample_size=args.sample_size,
+                stratify_by_device=args.stratify_by_device,
+                exclude_servers=args.exclude_servers
+            )
+        else:
+            detector.train_on_aggregated_data(
+                days=args.days,
+                exclude_servers=args.exclude_servers
+            )
 
         elapsed = (datetime.now() - start_time).total_seconds()
         print(f"⏱️  總訓練時間: {elapsed:.2f} 秒\n")
@@ -106,7 +130,8 @@ def main():
     else:
         print(f"💡 提示:")
         print(f"  使用 --evaluate 參數進行模型評估")
-        print(f"  例如: python3 train_isolation_forest.py --days 7 --evaluate\n")
+        print(f"  例如: python3 train_isolation_forest.py --days 7 --evaluate")
+        print(f"  長期數據使用串流訓練: python3 train_isolation_forest.py --days 90 --streaming\n")
 
 
 if __name__ == "__main__":
@@ -30,6 +30,22 @@ def main():
         default=7,
         help='訓練數據天數（默認 7 天）'
     )
+    parser.add_argument(
+        '--streaming',
+        action='store_true',
+        help='串流訓練：逐頁讀取並以蓄水池抽樣，記憶體上限與天數無關（適合 30 / 90 天）'
+    )
+    parser.add_argument(
+        '--sample-size',
+        type=int,
+        default=None,
+        help='串流訓練的蓄水池容量（默認 training.reservoir_size 或 200000）'
+    )
+    parser.add_argument(
+        '--stratify-by-device',
+        action='store_true',
+        help='串流訓練時依 dst_ip 的 device_type 分層抽樣'
+    )
 
     args = parser.parse_args()
 
@@ -42,7 +58,14 @@ def main():
 
     try:
         # 訓練模型
-        detector.train_on_aggregated_data(days=args.days)
+        if args.streaming:
+            detector.train_streaming(
+                days=args.days,
+                sample_size=args.sample_size,
+                stratify_by_device=args.stratify_by_device
+            )
+        else:
+            detector.train_on_aggregated_data(days=args.days)
 
         # 顯示模型信息
         info = detector.get_model_info()
@@ -5,10 +5,11 @@
 驗證回填的歷史資料是否完整，比對原始索引和聚合索引的 IP 數量
 """
 
-import requests
 import json
 from datetime import datetime, timedelta
 
+from nad.utils.es_transport import get_transport
+
 ES_HOST = "http://localhost:9200"
 
 def verify_backfill_coverage(start_date=None, end_date=None):
@@ -36,10 +37,10 @@ def verify_backfill_coverage(start_date=None, end_date=None):
         }
 
         try:
-            resp = requests.post(
+            resp = get_transport().post(
                 f"{ES_HOST}/netflow_stats_3m_by_src/_search",
                 json=query,
-                headers={'Content-Type': 'application/json'}
+                caller='verify_backfill_coverage'
             )
             resp.raise_for_status()
             data = resp.json()
@@ -98,11 +99,11 @@ def verify_backfill_coverage(start_date=None, end_date=None):
     }
 
     try:
-        resp1 = requests.post(
+        resp1 = get_transport().post(
             f"{ES_HOST}/radar_flow_collector-*/_search",
             json=raw_query,
-            headers={'Content-Type': 'application/json'},
-            timeout=120
+            timeout=120,
+            caller='verify_backfill_coverage'
         )
         resp1.raise_for_status()
         raw_data = resp1.json()
@@ -157,11 +158,11 @@ def verify_backfill_coverage(start_date=None, end_date=None):
     }
 
     try:
-        resp2 = requests.post(
+        resp2 = get_transport().post(
             f"{ES_HOST}/netflow_stats_3m_by_src/_search",
             json=agg_query,
-            headers={'Content-Type': 'application/json'},
-            timeout=120
+            timeout=120,
+            caller='verify_backfill_coverage'
         )
         resp2.raise_for_status()
         agg_data = resp2.json()
@@ -304,10 +305,10 @@ def verify_specific_time_bucket(time_bucket):
     }
 
     try:
-        resp = requests.post(
+        resp = get_transport().post(
             f"{ES_HOST}/radar_flow_collector-*/_search",
             json=raw_query,
-            headers={'Content-Type': 'application/json'}
+            caller='verify_backfill_coverage'
         )
         resp.raise_for_status()
         raw_data = resp.json()
@@ -335,10 +336,10 @@ def verify_specific_time_bucket(time_bucket):
     }
 
     try:
-        resp = requests.post(
+        resp = get_transport().post(
             f"{ES_HOST}/netflow_stats_3m_by_src/_search",
             json=agg_query,
-            headers={'Content-Type': 'application/json'}
+            caller='verify_backfill_coverage'
         )
         resp.raise_for_status()
         agg_data = resp.json()